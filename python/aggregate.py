@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# Columnar group-by aggregation of measurements into objects.
+# This computes the same per-object quantities as the object loop in
+# nsc_instcal_combine_cluster.py but for all objects at once using
+# segmented reductions (np.add.reduceat, np.bitwise_or.reduceat, etc.).
+# The mean magnitudes and variability indices come from the segmented
+# engine in var.py.
+#
+# Tolerance: the segmented sums are accumulated sequentially while np.sum()
+# uses pairwise summation for arrays with 8 or more elements.  Objects with
+# fewer than 8 measurements (per filter for the magnitudes) give bit-identical
+# results.  For larger objects the float64 values agree to ~1e-15 relative,
+# which almost always rounds to the same value in the float32 OBJ columns.
+# Measurements with a filter not in FILTERS are ignored for the per-filter
+# columns (the loop would fail on them).
+
+import numpy as np
+import time
+from argparse import ArgumentParser
+from dlnpyutils import utils as dln
+import var
+from var import FILTERS
+
+def segindex(labels):
+    """ Create an index of label values like dln.create_index() but with a stable sort."""
+    labels = np.atleast_1d(labels)
+    nlabels = len(labels)
+    if nlabels==0:
+        raise ValueError('labels has no elements')
+    si = np.argsort(labels,kind='stable')
+    slabels = labels[si]
+    brk = np.flatnonzero(slabels[1:] != slabels[0:-1])+1
+    lo = np.hstack((0,brk))
+    hi = np.hstack((brk-1,nlabels-1))
+    index = {'index':si,'value':slabels[lo],'num':hi-lo+1,'lo':lo,'hi':hi}
+    return index
+
+def initobj(obj):
+    """ Set the aggregated object columns to their "bad" values."""
+    names = obj.dtype.names
+    for f in ['pmra','pmraerr','pmdec','pmdecerr','asemi','bsemi','theta','asemierr',
+              'bsemierr','thetaerr','fwhm','class_star','rmsvar','madvar','iqrvar',
+              'etavar','jvar','kvar','chivar','romsvar']:
+        if f in names: obj[f]=np.nan
+    for f in FILTERS:
+        if f+'mag' in names: obj[f+'mag'] = 99.99
+        if f+'err' in names: obj[f+'err'] = 9.99
+        for c in ['rms','asemi','bsemi','theta']:
+            if f+c in names: obj[f+c] = np.nan
+    if 'variable10sig' in names: obj['variable10sig'] = 0
+    if 'nsigvar' in names: obj['nsigvar'] = np.nan
+    return obj
+
+def aggregate(cat,labels,obj):
+    """ Compute mean object quantities for all objects at once.
+
+    Parameters
+    ----------
+    cat : numpy structured array
+       Measurement catalog with uppercase column names (RA, RAERR, MJD, FILTER,
+       MAG_AUTO, MAGERR_AUTO, ASEMI, ..., FLAGS, CLASS_STAR).
+    labels : numpy array
+       Object label for each measurement.
+    obj : numpy structured array
+       Object catalog with one element per unique label (in sorted label order).
+       This is filled in place, only the columns that exist are set.
+
+    Returns
+    -------
+    value : numpy array
+       Unique label values, one for each element of OBJ.
+    fidmag : numpy array
+       Fiducial magnitude for each object, used to select variables.
+
+    """
+
+    ncat = len(cat)
+    labels = np.atleast_1d(labels)
+    if len(labels) != ncat:
+        raise ValueError('cat and labels must have the same number of elements')
+    index = segindex(labels)
+    nobj = len(index['value'])
+    if len(obj) != nobj:
+        raise ValueError('obj must have one element per unique label')
+    names = obj.dtype.names
+
+    # Sort the measurements by object
+    scat = cat[index['index']]
+    lo = index['lo']
+    num = index['num']
+    single = (num==1)
+    objind = np.repeat(np.arange(nobj),num)   # object index for each sorted measurement
+
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        obj['ndet'] = num
+
+        # Mean RA/DEC, RAERR/DECERR
+        for c in ['ra','dec']:
+            val = scat[c.upper()]
+            err = scat[c.upper()+'ERR']
+            wt = 1.0/err**2
+            totwt = np.add.reduceat(wt,lo)
+            obj[c] = np.where(single,val[lo],np.add.reduceat(val*wt,lo)/totwt)
+            obj[c+'err'] = np.where(single,err[lo],np.sqrt(1.0/totwt))
+        mjd = scat['MJD']
+        if 'mjd' in names:
+            obj['mjd'] = np.where(single,mjd[lo],np.add.reduceat(mjd,lo)/num)
+        if 'deltamjd' in names:
+            obj['deltamjd'] = np.where(single,0,np.maximum.reduceat(mjd,lo)-np.minimum.reduceat(mjd,lo))
+
+        # Mean magnitudes and variability indices
+        fidmag = var.varmetrics(objind,scat['FILTER'],scat['MAG_AUTO'],scat['MAGERR_AUTO'],mjd,obj)
+
+        # Average the morphology parameters PER FILTER
+        fcode = var.filtercodes(scat['FILTER'])
+        for k,f in enumerate(FILTERS):
+            find, = np.where(fcode==k)
+            if len(find)==0: continue
+            fobj,flo,fnum = np.unique(objind[find],return_index=True,return_counts=True)
+            for c in ['asemi','bsemi','theta']:
+                obj[f+c][fobj] = np.add.reduceat(scat[c.upper()][find],flo)/fnum
+
+        # Mean morphology parameters
+        for c in ['asemi','bsemi','theta','fwhm','class_star']:
+            obj[c] = np.add.reduceat(scat[c.upper()],lo)/num
+        for c in ['asemi','bsemi','theta']:
+            obj[c+'err'] = np.sqrt(np.add.reduceat(scat[c.upper()+'ERR']**2,lo)) / num
+        obj['flags'] = np.bitwise_or.reduceat(scat['FLAGS'],lo)  # OR combine
+
+    return index['value'], fidmag
+
+
+def loopaggregate(cat,labels,obj):
+    """ Compute mean object quantities one object at a time.  This is the original algorithm."""
+
+    index = dln.create_index(labels)
+    nobj = len(index['value'])
+    fidmag = np.zeros(nobj,float)+np.nan  # fiducial magnitude
+    for i in range(nobj):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        cat1 = cat[indx]
+        ncat1 = len(cat1)
+        obj['ndet'][i] = ncat1
+
+        # Mean RA/DEC, RAERR/DECERR
+        if ncat1>1:
+            wt_ra = 1.0/cat1['RAERR']**2
+            wt_dec = 1.0/cat1['DECERR']**2
+            obj['ra'][i] = np.sum(cat1['RA']*wt_ra)/np.sum(wt_ra)
+            obj['raerr'][i] = np.sqrt(1.0/np.sum(wt_ra))
+            obj['dec'][i] = np.sum(cat1['DEC']*wt_dec)/np.sum(wt_dec)
+            obj['decerr'][i] = np.sqrt(1.0/np.sum(wt_dec))
+            obj['mjd'][i] = np.mean(cat1['MJD'])
+            obj['deltamjd'][i] = np.max(cat1['MJD'])-np.min(cat1['MJD'])
+        else:
+            obj['ra'][i] = cat1['RA'][0]
+            obj['dec'][i] = cat1['DEC'][0]
+            obj['raerr'][i] = cat1['RAERR'][0]
+            obj['decerr'][i] = cat1['DECERR'][0]
+            obj['mjd'][i] = cat1['MJD'][0]
+            obj['deltamjd'][i] = 0
+
+        # Mean magnitudes
+        filtindex = dln.create_index(cat1['FILTER'].astype(str))
+        nfilters = len(filtindex['value'])
+        resid = np.zeros(ncat1)+np.nan     # residual mag
+        relresid = np.zeros(ncat1)+np.nan  # residual mag relative to the uncertainty
+        for f in range(nfilters):
+            filt = filtindex['value'][f].lower()
+            findx = filtindex['index'][filtindex['lo'][f]:filtindex['hi'][f]+1]
+            obj['ndet'+filt][i] = filtindex['num'][f]
+            gph,ngph = dln.where(cat1['MAG_AUTO'][findx]<50)
+            obj['nphot'+filt][i] = ngph
+            if ngph==1:
+                obj[filt+'mag'][i] = cat1['MAG_AUTO'][findx[gph]][0]
+                obj[filt+'err'][i] = cat1['MAGERR_AUTO'][findx[gph]][0]
+            if ngph>1:
+                newmag, newerr = dln.wtmean(cat1['MAG_AUTO'][findx[gph]], cat1['MAGERR_AUTO'][findx[gph]],magnitude=True,reweight=True,error=True)
+                obj[filt+'mag'][i] = newmag
+                obj[filt+'err'][i] = newerr
+                obj[filt+'rms'][i] = np.sqrt(np.mean((cat1['MAG_AUTO'][findx[gph]]-newmag)**2))
+                resid[findx[gph]] = cat1['MAG_AUTO'][findx[gph]]-newmag
+                relresid[findx[gph]] = np.sqrt(ngph/(ngph-1)) * (cat1['MAG_AUTO'][findx[gph]]-newmag)/np.maximum(cat1['MAGERR_AUTO'][findx[gph]],0.02)
+            obj[filt+'asemi'][i] = np.mean(cat1['ASEMI'][findx])
+            obj[filt+'bsemi'][i] = np.mean(cat1['BSEMI'][findx])
+            obj[filt+'theta'][i] = np.mean(cat1['THETA'][findx])
+
+        # Calculate variability indices
+        gdresid = np.isfinite(resid)
+        ngdresid = np.sum(gdresid)
+        if ngdresid>0:
+            resid2 = resid[gdresid]
+            sumresidsq = np.sum(resid2**2)
+            tsi = np.argsort(cat1['MJD'][gdresid])
+            resid2tsi = resid2[tsi]
+            quartiles = np.percentile(resid2,[25,50,75])
+            obj['rmsvar'][i] = np.sqrt(sumresidsq/ngdresid)
+            obj['madvar'][i] = 1.4826*np.median(np.abs(resid2-quartiles[1]))
+            obj['iqrvar'][i] = 0.741289*(quartiles[2]-quartiles[0])
+            obj['etavar'][i] = sumresidsq / np.sum((resid2tsi[1:]-resid2tsi[0:-1])**2)
+
+        # Calculate variability indices wrt to uncertainties
+        gdrelresid = np.isfinite(relresid)
+        ngdrelresid = np.sum(gdrelresid)
+        if ngdrelresid>0:
+            relresid2 = relresid[gdrelresid]
+            pk = relresid2**2-1
+            obj['jvar'][i] = np.sum( np.sign(pk)*np.sqrt(np.abs(pk)) )/ngdrelresid
+            obj['chivar'][i] = np.sqrt(np.sum(relresid2**2))/ngdrelresid
+            kdenom = np.sqrt(np.sum(relresid2**2)/ngdrelresid)
+            if kdenom!=0:
+                obj['kvar'][i] = (np.sum(np.abs(relresid2))/ngdrelresid) / kdenom
+            else:
+                obj['kvar'][i] = np.nan
+            obj['romsvar'][i] = np.sum(np.abs(relresid2))/(ngdrelresid-1)
+
+        # Make NPHOT from NPHOTX
+        obj['nphot'][i] = obj['nphotu'][i]+obj['nphotg'][i]+obj['nphotr'][i]+obj['nphoti'][i]+obj['nphotz'][i]+obj['nphoty'][i]+obj['nphotvr'][i]
+
+        # Fiducial magnitude
+        if obj['nphot'][i]>0:
+            magarr = np.zeros(7,float)
+            for ii,nn in enumerate(['rmag','gmag','imag','zmag','ymag','vrmag','umag']): magarr[ii]=obj[nn][i]
+            gfid,ngfid = dln.where(magarr<50)
+            if ngfid>0: fidmag[i]=magarr[gfid[0]]
+
+        # Mean morphology parameters
+        obj['asemi'][i] = np.mean(cat1['ASEMI'])
+        obj['bsemi'][i] = np.mean(cat1['BSEMI'])
+        obj['theta'][i] = np.mean(cat1['THETA'])
+        obj['asemierr'][i] = np.sqrt(np.sum(cat1['ASEMIERR']**2)) / ncat1
+        obj['bsemierr'][i] = np.sqrt(np.sum(cat1['BSEMIERR']**2)) / ncat1
+        obj['thetaerr'][i] = np.sqrt(np.sum(cat1['THETAERR']**2)) / ncat1
+        obj['fwhm'][i] = np.mean(cat1['FWHM'])
+        obj['class_star'][i] = np.mean(cat1['CLASS_STAR'])
+        obj['flags'][i] = np.bitwise_or.reduce(cat1['FLAGS'])  # OR combine
+
+    return index['value'], fidmag
+
+
+def simpixel(nobj=20000,nexp=30,seed=0):
+    """ Make a synthetic measurement catalog for one pixel."""
+
+    rnd = np.random.RandomState(seed)
+    dtype_hicat = np.dtype([('MEASID',(str,30)),('EXPOSURE',(str,40)),('CCDNUM',int),('FILTER',(str,3)),
+                            ('MJD',float),('RA',float),('RAERR',float),('DEC',float),('DECERR',float),
+                            ('MAG_AUTO',float),('MAGERR_AUTO',float),('ASEMI',float),('ASEMIERR',float),('BSEMI',float),('BSEMIERR',float),
+                            ('THETA',float),('THETAERR',float),('FWHM',float),('FLAGS',int),('CLASS_STAR',float)])
+    filters = np.array(['u','g','r','i','z','Y','VR'])
+    expfilt = filters[rnd.randint(0,len(filters),nexp)]
+    expmjd = 57000+np.sort(rnd.rand(nexp))*2000
+    ra0 = 10+rnd.rand(nobj)*0.5
+    dec0 = -20+rnd.rand(nobj)*0.5
+    mag0 = 16+rnd.rand(nobj)*8
+    # Each object is detected in a random subset of the exposures
+    detected = rnd.rand(nobj,nexp) < 0.6
+    oind,eind = np.where(detected)
+    ncat = len(oind)
+    cat = np.zeros(ncat,dtype=dtype_hicat)
+    cat['MEASID'] = ['%d.%d' % (o,e) for o,e in zip(oind,eind)]
+    cat['EXPOSURE'] = np.char.add('exp',eind.astype(str))
+    cat['CCDNUM'] = rnd.randint(1,62,ncat)
+    cat['FILTER'] = expfilt[eind]
+    cat['MJD'] = expmjd[eind]
+    cat['RAERR'] = 0.01+rnd.rand(ncat)*0.1
+    cat['DECERR'] = 0.01+rnd.rand(ncat)*0.1
+    cat['RA'] = ra0[oind]+rnd.randn(ncat)*cat['RAERR']/3600
+    cat['DEC'] = dec0[oind]+rnd.randn(ncat)*cat['DECERR']/3600
+    cat['MAGERR_AUTO'] = 0.005*10**(0.2*(mag0[oind]-16))
+    cat['MAG_AUTO'] = mag0[oind]+rnd.randn(ncat)*cat['MAGERR_AUTO']
+    cat['MAG_AUTO'][rnd.rand(ncat)<0.02] = 99.99   # some bad photometry
+    cat['ASEMI'] = 1+rnd.rand(ncat)
+    cat['ASEMIERR'] = rnd.rand(ncat)*0.1
+    cat['BSEMI'] = cat['ASEMI']*(0.5+0.5*rnd.rand(ncat))
+    cat['BSEMIERR'] = rnd.rand(ncat)*0.1
+    cat['THETA'] = rnd.rand(ncat)*180-90
+    cat['THETAERR'] = rnd.rand(ncat)
+    cat['FWHM'] = 1+rnd.rand(ncat)
+    cat['FLAGS'] = rnd.randint(0,2,ncat)*rnd.choice([1,2,4,8,16],ncat)
+    cat['CLASS_STAR'] = rnd.rand(ncat)
+    # Shuffle the measurements
+    si = rnd.permutation(ncat)
+    return cat[si], oind[si]
+
+def objdtype():
+    """ Object schema with all the columns that the aggregation computes."""
+    dt = [('label',int),('ra',np.float64),('dec',np.float64),('raerr',np.float32),('decerr',np.float32),
+          ('mjd',np.float64),('deltamjd',np.float32),('ndet',np.int16),('nphot',np.int16)]
+    for f in FILTERS:
+        dt += [('ndet'+f,np.int16),('nphot'+f,np.int16),(f+'mag',np.float32),(f+'rms',np.float32),(f+'err',np.float32),
+               (f+'asemi',np.float32),(f+'bsemi',np.float32),(f+'theta',np.float32)]
+    dt += [('asemi',np.float32),('asemierr',np.float32),('bsemi',np.float32),('bsemierr',np.float32),
+           ('theta',np.float32),('thetaerr',np.float32),('fwhm',np.float32),('flags',np.int16),('class_star',np.float32),
+           ('rmsvar',np.float32),('madvar',np.float32),('iqrvar',np.float32),('etavar',np.float32),
+           ('jvar',np.float32),('kvar',np.float32),('chivar',np.float32),('romsvar',np.float32)]
+    return np.dtype(dt)
+
+def benchmark(nobj=20000,nexp=30,seed=0):
+    """ Compare the aggregation engine to the per-object loop on a synthetic pixel."""
+
+    cat,labels = simpixel(nobj,nexp,seed)
+    ncat = len(cat)
+    nobj1 = len(np.unique(labels))
+    print(str(ncat)+' measurements for '+str(nobj1)+' objects')
+
+    obj1 = initobj(np.zeros(nobj1,dtype=objdtype()))
+    t0 = time.time()
+    value1, fidmag1 = loopaggregate(cat,labels,obj1)
+    dt1 = time.time()-t0
+    print('loop:      %8.2f sec' % dt1)
+
+    obj2 = initobj(np.zeros(nobj1,dtype=objdtype()))
+    t0 = time.time()
+    value2, fidmag2 = aggregate(cat,labels,obj2)
+    dt2 = time.time()-t0
+    print('aggregate: %8.2f sec' % dt2)
+    print('speed-up:  %8.1f' % (dt1/dt2))
+
+    # Compare the columns
+    maxdiff = {}
+    for n in obj1.dtype.names:
+        v1 = obj1[n].astype(float)
+        v2 = obj2[n].astype(float)
+        bothnan = np.isnan(v1) & np.isnan(v2)
+        diff = np.abs(v1-v2)
+        diff[bothnan] = 0.0
+        maxdiff[n] = np.nanmax(np.where(np.isnan(diff),np.inf,diff))
+        nexact = np.sum((v1==v2) | bothnan)
+        if nexact<nobj1:
+            print('%-12s %7d/%7d identical  max diff = %g' % (n,nexact,nobj1,maxdiff[n]))
+    fdiff = np.nanmax(np.abs(fidmag1-fidmag2))
+    print('fidmag max diff = %g' % fdiff)
+
+    return {'nmeas':ncat,'nobj':nobj1,'dt_loop':dt1,'dt_aggregate':dt2,'maxdiff':maxdiff}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the columnar object aggregation.')
+    parser.add_argument('--nobj', type=int, default=20000, help='Number of objects')
+    parser.add_argument('--nexp', type=int, default=30, help='Number of exposures')
+    args = parser.parse_args()
+    benchmark(args.nobj,args.nexp)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+#
+# BATCHAPCOR.PY -- Aperture correction of all chips of an exposure at once
+#
+# Chip.getapcor() runs phot.apcor() on every chip: DAOPHOT PHOTOMETRY in 13
+# apertures (3 to 50 pixels) for the PSF stars on the neighbor-subtracted
+# image, ALLSTAR on the same stars and DAOGROW, which fits the growth curve
+# of the chip's ~50-100 PSF stars alone.  The growth curve changes smoothly
+# over the focal plane and a few dozen stars per chip give a noisy curve.
+#
+# With the exposure-level mode each chip only picks stars for the growth
+# curve (growstars()) from the products it has already: the 5-aperture .ap
+# of the main PHOTOMETRY run (3 to 19.7 pixels) and the .als.  The stars
+# are bright, measured in all apertures and isolated (no .als neighbor
+# within the largest aperture plus two FWHM that is brighter than
+# DMAG magnitudes below the star).  Once all chips are done fitgrowth()
+# fits one growth curve to the pooled stars, the Moffat light fraction
+#   C(r) = 1 - (1 + r^2/alpha^2)^(1-beta)
+# with a magnitude m(r) = M - 2.5 log10 C(r) for each star of total
+# magnitude M (solved for in the fit), optionally with log(alpha) linear in
+# the focal-plane position (focalplane=True) for the seeing and focus
+# change across the exposure.  The curve gives each star's total magnitude
+# from all its apertures and the aperture correction of a chip is the
+# median of the PSF minus total magnitude of its stars (chipapcor()).
+# Chips with fewer than MINSTARS stars, none at all included, get the
+# plane fit of the star corrections at the chip center with
+# focalplane=True, or the exposure median, and are logged.
+#
+# The aperture correction mode (APCORMODES) is "chip" (phot.apcor() on
+# each chip, the default), "focalplane" or "exposure".  The "exposure"
+# mode (one growth curve, no focal-plane term) cannot follow the seeing
+# change across the focal plane and is about 3x worse than the per-chip
+# correction, so it is only used when asked for.
+#
+# Exposure.exposureapcor() in nsc_instcal_sexdaophot.py runs this on the
+# per-chip star tables and applies the corrections to the final chip
+# catalogs (updatecat()).
+#
+# "python batchapcor.py --benchmark" processes the chips of a synthetic
+# exposure (FWHM changing across the focal plane, stars with a Gaussian
+# halo so the profile is no Moffat) with the stub programs of daostub.py,
+# gets the aperture corrections per chip with phot.apcor() and with the
+# exposure-level fit, and reports the differences to each other and to the
+# true corrections and the CPU time of both.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import shutil
+import tempfile
+import logging
+from argparse import ArgumentParser
+from astropy.io import fits
+from astropy.table import Table, vstack
+import daoio
+
+# Aperture correction modes, "chip" runs phot.apcor() on each chip
+APCORMODES = ['chip','exposure','focalplane']
+
+
+def readapers(apersfile):
+    """ Aperture radii of a DAOPHOT .apers file, without the sky radii."""
+    radii = []
+    for line in open(apersfile,'r').readlines():
+        arr = line.split('=')
+        if len(arr) != 2: continue
+        if arr[0].strip().upper() in ['IS','OS']: continue
+        radii.append(float(arr[1]))
+    return np.array(radii)
+
+
+def growstars(apfile,alsfile,apersfile,listfile=None,fwhm=4.0,maxerr=0.03,dmag=4.0):
+    """ Bright isolated stars for the exposure-level growth curve: ID, X, Y, the PSF
+    magnitude and error of ALSFILE and the aperture magnitudes and errors of APFILE
+    (MAG and ERR with one column per aperture), with the radii in meta['APERS'].
+    Only the stars of LISTFILE are used if it is given."""
+    radii = readapers(apersfile)
+    ap = daoio.daoread(apfile)
+    als = daoio.daoread(alsfile)
+    mag = np.array(ap['MAG']).reshape(len(ap),-1)
+    err = np.array(ap['ERR']).reshape(len(ap),-1)
+    mid, ind1, ind2 = np.intersect1d(np.array(ap['ID']),np.array(als['ID']),return_indices=True)
+    good = np.all(mag[ind1] < 50,axis=1) & (err[ind1,0] < maxerr) & (np.array(als['ERR'])[ind2] < maxerr)
+    if listfile is not None:
+        lst = daoio.daoread(listfile)
+        good &= np.in1d(mid,np.array(lst['ID']))
+    # Isolated: no brighter than mag+dmag ALLSTAR star within the largest aperture plus 2 FWHM
+    from scipy.spatial import cKDTree
+    x = np.array(als['X'])
+    y = np.array(als['Y'])
+    amag = np.array(als['MAG'])
+    tree = cKDTree(np.vstack((x,y)).T)
+    for i in np.where(good)[0]:
+        j = ind2[i]
+        nei = [k for k in tree.query_ball_point([x[j],y[j]],np.max(radii)+2*fwhm) if k != j]
+        if np.any(amag[nei] < amag[j]+dmag): good[i] = False
+    cat = Table()
+    cat['ID'] = mid[good]
+    cat['X'] = x[ind2[good]]
+    cat['Y'] = y[ind2[good]]
+    cat['MAGPSF'] = amag[ind2[good]]
+    cat['ERRPSF'] = np.array(als['ERR'])[ind2[good]]
+    cat['MAG'] = mag[ind1[good]]
+    cat['ERR'] = err[ind1[good]]
+    cat.meta['APERS'] = ','.join(['%.4f' % r for r in radii])
+    return cat
+
+
+def addcoords(cat,wcs,ccdnum,nx,ny):
+    """ Add the RA, DEC and CCDNUM columns of exposureapcor() to the growstars() table CAT of
+    chip CCDNUM, and the CCDNUM and the RA/DEC of the center of the NXxNY chip to its meta
+    (for the chips with no stars)."""
+    ra, dec = wcs.all_pix2world(cat['X'],cat['Y'],1)
+    cat['RA'] = ra
+    cat['DEC'] = dec
+    cat['CCDNUM'] = np.zeros(len(cat),int)+ccdnum
+    rac, decc = wcs.all_pix2world(0.5*(nx+1),0.5*(ny+1),1)
+    cat.meta['CCDNUM'] = int(ccdnum)
+    cat.meta['RA'] = float(rac)
+    cat.meta['DEC'] = float(decc)
+    return cat
+
+
+def growth(r,alpha,beta):
+    """ Fraction of the light of a Moffat star within radius R."""
+    return 1.0-(1.0+(r/alpha)**2)**(1.0-beta)
+
+
+def focalplane(ra,dec,ra0=None,dec0=None):
+    """ Tangent-plane coordinates in degrees around RA0/DEC0 (the mean by default)."""
+    ra = np.asarray(ra,float)
+    dec = np.asarray(dec,float)
+    if dec0 is None: dec0 = np.mean(dec)
+    if ra0 is None: ra0 = np.degrees(np.arctan2(np.mean(np.sin(np.radians(ra))),np.mean(np.cos(np.radians(ra)))))
+    a, d, a0, d0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    cosc = np.sin(d0)*np.sin(d)+np.cos(d0)*np.cos(d)*np.cos(a-a0)
+    u = np.cos(d)*np.sin(a-a0)/cosc
+    v = (np.cos(d0)*np.sin(d)-np.sin(d0)*np.cos(d)*np.cos(a-a0))/cosc
+    return np.degrees(u), np.degrees(v)
+
+
+class GrowthCurve:
+    """ Moffat growth curve fitted to the aperture magnitudes of many stars, see fitgrowth()."""
+
+    def __init__(self,radii,pars,focal=False,errfloor=0.005):
+        self.radii = np.asarray(radii,float)
+        self.pars = np.asarray(pars,float)
+        self.focal = focal
+        self.errfloor = errfloor
+        self.nstars = 0
+        self.rms = None
+
+    def __repr__(self):
+        alpha, beta = self.alphabeta()
+        text = 'GrowthCurve(alpha=%.3f, beta=%.3f' % (alpha[0] if np.ndim(alpha) else alpha, beta)
+        if self.focal: text += ', dlnalpha/du=%.3f, dlnalpha/dv=%.3f /deg' % tuple(self.pars[2:4])
+        return text+', %d stars)' % self.nstars
+
+    def alphabeta(self,u=0.0,v=0.0):
+        lnalpha = self.pars[0]
+        if self.focal: lnalpha = lnalpha+self.pars[2]*np.asarray(u)+self.pars[3]*np.asarray(v)
+        return np.exp(lnalpha)*np.ones(np.shape(u)), 1.0+np.exp(self.pars[1])
+
+    def correction(self,u=0.0,v=0.0):
+        """ 2.5 log10 C(r) for each star (rows) and aperture (columns), the magnitude
+        to add to an aperture magnitude to get the total."""
+        alpha, beta = self.alphabeta(np.atleast_1d(u),np.atleast_1d(v))
+        return 2.5*np.log10(growth(self.radii[None,:],alpha[:,None],beta))
+
+    def totalmags(self,mag,err,u=0.0,v=0.0):
+        """ Total magnitude of each star, the weighted mean over the apertures of the
+        magnitude plus its correction, and its error."""
+        mag = np.atleast_2d(mag)
+        err = np.atleast_2d(err)
+        u = np.zeros(len(mag))+u
+        v = np.zeros(len(mag))+v
+        good = (mag < 50) & (err < 9)
+        w = np.where(good,1.0/(err**2+self.errfloor**2),0.0)
+        tot = np.sum(w*np.where(good,mag+self.correction(u,v),0.0),axis=1)/np.maximum(np.sum(w,axis=1),1e-30)
+        toterr = 1.0/np.sqrt(np.maximum(np.sum(w,axis=1),1e-30))
+        return tot, toterr
+
+
+def fitgrowth(cat,focal=False,u=None,v=None,errfloor=0.005,logger=None):
+    """ Fit one growth curve to the aperture magnitudes of the stars of CAT (see growstars()),
+    with log(alpha) linear in the focal-plane coordinates U/V (degrees) if FOCAL.  The total
+    magnitude of each star is a free parameter, solved for at each step."""
+    from scipy.optimize import least_squares
+    radii = np.array([float(r) for r in cat.meta['APERS'].split(',')])
+    mag = np.array(cat['MAG'])
+    err = np.array(cat['ERR'])
+    n = len(mag)
+    if u is None: u = np.zeros(n)
+    if v is None: v = np.zeros(n)
+    pars = [np.log(0.4*np.min(radii)+1.0),np.log(1.5)]+([0.0,0.0] if focal else [])
+    curve = GrowthCurve(radii,pars,focal=focal,errfloor=errfloor)
+    sig = np.sqrt(err**2+errfloor**2)
+
+    def resid(p):
+        curve.pars = p
+        tot, toterr = curve.totalmags(mag,err,u,v)
+        return ((mag+curve.correction(u,v)-tot[:,None])/sig).ravel()
+
+    # soft_l1 keeps stars with a neighbor or a cosmic ray in an aperture from pulling the curve
+    res = least_squares(resid,pars,loss='soft_l1',f_scale=3.0,x_scale=1.0)
+    curve.pars = res.x
+    curve.nstars = n
+    curve.rms = np.sqrt(np.median(((mag+curve.correction(u,v)-curve.totalmags(mag,err,u,v)[0][:,None]))**2))
+    if logger is not None: logger.info(str(curve))
+    return curve
+
+
+def chipapcor(cat,curve,u=None,v=None,minstars=5,ccdnums=None,centers=None,logger=None):
+    """ Aperture correction of each chip (CCDNUMS, default the CCDNUM column of CAT), the median
+    PSF minus total magnitude of its stars.  Chips with fewer than MINSTARS stars get the median
+    of all stars, or with a focal-plane curve the plane fitted to the stars' corrections at the
+    center of the chip (CENTERS, a dictionary of CCDNUM: (u,v), else the mean of its stars).
+    Returns a dictionary of CCDNUM: (apcorr, nstars)."""
+    n = len(cat)
+    if u is None: u = np.zeros(n)
+    if v is None: v = np.zeros(n)
+    tot, toterr = curve.totalmags(np.array(cat['MAG']),np.array(cat['ERR']),u,v)
+    dmag = np.array(cat['MAGPSF'])-tot
+    ccdnum = np.array(cat['CCDNUM'])
+    good = np.isfinite(dmag)
+    med = np.median(dmag[good])
+    # Clip the stars that are more than 5 sigma (MAD) off
+    sigma = 1.4826*np.median(np.abs(dmag[good]-med))
+    good &= np.abs(dmag-med) < np.maximum(5*sigma,0.02)
+    plane = None
+    if curve.focal and np.sum(good) > 10:
+        a = np.vstack((np.ones(np.sum(good)),u[good],v[good])).T
+        plane = np.linalg.lstsq(a,dmag[good],rcond=None)[0]
+    if ccdnums is None: ccdnums = np.unique(ccdnum)
+    if centers is None: centers = {}
+    out = {}
+    for c in ccdnums:
+        c = int(c)
+        ind = good & (ccdnum == c)
+        nstars = int(np.sum(ind))
+        if nstars >= minstars:
+            out[c] = (float(np.median(dmag[ind])),nstars)
+            if logger is not None: logger.info('CCDNUM %d: aperture correction = %7.3f mag from %d stars' % (c,out[c][0],nstars))
+            continue
+        center = centers.get(c)
+        if center is None and np.any(ccdnum == c): center = (np.mean(u[ccdnum==c]),np.mean(v[ccdnum==c]))
+        if plane is not None and center is not None:
+            out[c] = (float(plane[0]+plane[1]*center[0]+plane[2]*center[1]),nstars)
+            fallback = 'the focal-plane fit'
+        else:
+            out[c] = (float(np.median(dmag[good])),nstars)
+            fallback = 'the exposure median'
+        if logger is not None:
+            logger.warning('CCDNUM %d: only %d stars, aperture correction = %7.3f mag from %s' % (c,nstars,out[c][0],fallback))
+    return out
+
+
+def exposureapcor(growfiles,mode='focalplane',minstars=5,ccdnums=None,logger=None):
+    """ Aperture corrections of the chips of an exposure from the per-chip growth star tables
+    GROWFILES (growstars() and addcoords()), with the focal-plane term for MODE="focalplane".
+    Every chip of GROWFILES and CCDNUMS gets a correction, those with few or no stars from
+    the others.  Returns the dictionary of chipapcor() and the GrowthCurve, or an empty
+    dictionary and None if there are no stars at all."""
+    if mode not in APCORMODES or mode == 'chip':
+        raise ValueError("Exposure aperture correction mode must be 'exposure' or 'focalplane', not "+repr(mode))
+    cats = []
+    allccd = set() if ccdnums is None else set(int(c) for c in ccdnums)
+    centers = {}
+    for f in growfiles:
+        cat = Table.read(f)
+        c = cat.meta.get('CCDNUM')
+        if c is None and len(cat) > 0: c = cat['CCDNUM'][0]
+        if c is not None:
+            allccd.add(int(c))
+            if cat.meta.get('RA') is not None: centers[int(c)] = (cat.meta['RA'],cat.meta['DEC'])
+        if len(cat) > 0: cats.append(cat)
+        elif logger is not None: logger.warning('No growth-curve stars in '+f)
+    if len(cats) == 0:
+        if logger is not None: logger.warning('No stars for the exposure aperture correction')
+        return {}, None
+    cat = vstack(cats,metadata_conflicts='silent')
+    # The chip centers in the same tangent plane as the stars
+    cenccd = sorted(centers.keys())
+    u, v = focalplane(np.append(cat['RA'],[centers[c][0] for c in cenccd]),
+                      np.append(cat['DEC'],[centers[c][1] for c in cenccd]))
+    centers = dict(zip(cenccd,zip(u[len(cat):],v[len(cat):])))
+    u, v = u[:len(cat)], v[:len(cat)]
+    if logger is not None: logger.info('Exposure aperture correction from %d stars on %d chips' % (len(cat),len(cats)))
+    curve = fitgrowth(cat,focal=(mode=='focalplane'),u=u,v=v,logger=logger)
+    return chipapcor(cat,curve,u,v,minstars=minstars,ccdnums=sorted(allccd),centers=centers,logger=logger), curve
+
+
+def updatecat(catfile,apcorr,mode='focalplane'):
+    """ Apply the aperture correction APCORR to the MAGPSF of a final chip catalog
+    (written with no correction) and record it and the MODE in the header."""
+    hdulist = fits.open(catfile,mode='update')
+    hdulist[1].data['MAGPSF'] -= apcorr
+    hdulist[0].header['APCOR'] = (apcorr,'Aperture correction in mags')
+    hdulist[0].header['APCORMOD'] = (mode,'Aperture correction per chip or exposure')
+    hdulist.close()
+
+
+def simexposure(outdir,ccdnum,col,row,ncol=4,nrow=2,nstars=500,nx=1024,ny=1024,pixscale=0.26,gap=50,
+                fwhm0=4.0,dfwhm=(0.8,0.4),wing=0.0):
+    """ Synthetic DAOPHOT-ready chip at column COL and row ROW of an NCOLxNROW focal plane, with
+    a TAN WCS and the FWHM changing linearly over the focal plane by DFWHM from the center to
+    the edges.  The Moffat stars, with the fraction WING of their flux in a Gaussian halo of 4
+    FWHM, are added out to 50 pixels.  Returns the FWHM, the WCS and
+    the .coo table with the true magnitudes."""
+    from astropy.wcs import WCS
+    import daostub
+    rnd = np.random.RandomState(ccdnum)
+    # Chip center in the focal plane, in units of half the focal plane size
+    xc = (col+0.5-0.5*ncol)*(nx+gap)
+    yc = (row+0.5-0.5*nrow)*(ny+gap)
+    fwhm = fwhm0+dfwhm[0]*xc/(0.5*ncol*(nx+gap))+dfwhm[1]*yc/(0.5*nrow*(ny+gap))
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN','DEC--TAN']
+    wcs.wcs.crval = [150.0,2.0]
+    wcs.wcs.crpix = [0.5*nx-xc,0.5*ny-yc]
+    wcs.wcs.cdelt = [-pixscale/3600.0,pixscale/3600.0]
+    x = rnd.uniform(20,nx-20,nstars)
+    y = rnd.uniform(20,ny-20,nstars)
+    mag = rnd.uniform(14,21,nstars)
+    im = rnd.normal(1600,10,(ny,nx))
+    daostub.addstars(im,x-1,y-1,10**(-0.4*(mag-25)),fwhm,rad=50,wing=wing)
+    fits.writeto(os.path.join(outdir,'flux_dao.fits'),im.astype(np.float32),overwrite=True)
+    opt = ['RE = 1.55\n','GA = 3.91\n','LO = 7.00\n','HI = 38652.0\n','FW = %.2f\n' % fwhm,'TH = 3.50\n',
+           'LS = 0.2\n','HS = 1.0\n','LR = -1.0\n','HR = 1.0\n','WA = -2\n','FI = %.2f\n' % fwhm,
+           'PS = %.2f\n' % (4*fwhm),'VA = 2\n','AN = -6\n','EX = 5\n','PE = 0.75\n','PR = 5.00\n']
+    f = open(os.path.join(outdir,'flux_dao.opt'),'w')
+    f.writelines(opt)
+    f.close()
+    f = open(os.path.join(outdir,'flux_dao.als.opt'),'w')
+    f.writelines(['FI = %.2f\n' % fwhm,'IS = 0.00\n','OS = %.2f\n' % (4*fwhm),'RE = 1\n','MA = 50\n','PR = 5.00\n',
+                  'CR = 2.5\n','CE = 6.00\n','PE = 0.75\n'])
+    f.close()
+    cat = Table()
+    cat['NUMBER'] = np.arange(1,nstars+1)
+    cat['X_IMAGE'] = x
+    cat['Y_IMAGE'] = y
+    cat['MAG_AUTO'] = mag
+    cat['MAGERR_AUTO'] = 0.001*10**(0.2*(mag-10))
+    meta = {'NAXIS1':nx,'NAXIS2':ny,'SATURATE':38652.0,'RDNOISE':6.0,'GAIN':3.9,'SKYMED':1600.,'SKYRMS':10.}
+    daoio.sextodao(cat,meta,os.path.join(outdir,'flux_dao.coo'),format='coo')
+    return fwhm, wcs, cat
+
+
+def benchmark(ncol=4,nrow=2,nstars=500,nx=1024,ny=1024,wing=0.15,tmpdir=None):
+    """ Aperture corrections of the chips of a synthetic exposure from phot.apcor() (per chip)
+    and from the exposure-level growth curve, without and with the focal-plane term.  The stars
+    have the fraction WING of their flux in a halo, so the profile is no Moffat.  The focal-plane
+    corrections have to be about as close to the truth as the per-chip ones (RMS within 25% plus
+    5 mmag), within 0.05 mag RMS of them and take less CPU time."""
+    import phot
+    import daostub
+    import daosession
+    import stagelog
+    # phot.daoread(fast=False) uses the python 2 "long"
+    if not hasattr(phot,'long'): phot.long = int
+    logger = logging.getLogger('batchapcor')
+    outroot = tempfile.mkdtemp(prefix='batchapcor',dir=tmpdir)
+    curdir = os.getcwd()
+    oldpath = os.environ['PATH']
+    ok = True
+    try:
+        bindir = os.path.join(outroot,'bin')
+        os.mkdir(bindir)
+        daostub.mkstub(bindir)
+        os.environ['PATH'] = bindir+os.pathsep+oldpath
+        slog = stagelog.StageLog()
+        rows = []
+        growfiles = []
+        for ccdnum in range(1,ncol*nrow+1):
+            wdir = os.path.join(outroot,'chip%02d' % ccdnum)
+            os.mkdir(wdir)
+            fwhm, wcs, truecat = simexposure(wdir,ccdnum,(ccdnum-1) % ncol,(ccdnum-1)//ncol,ncol,nrow,nstars,nx,ny,wing=wing)
+            os.chdir(wdir)
+            meta = {'DATE-OBS':'2016-03-01T03:04:05.6','exptime':90.0,'airmass':1.2}
+            with daosession.DaoSession(logger=logger) as session:
+                apcat, maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',
+                                                 logger=logger,session=session)
+                phot.daopickpsf('flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,logger=logger,session=session)
+                phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,logger=logger,session=session)
+                phot.allstar('flux_dao.fits','flux_dao.psf','flux_dao.ap',outfile='flux_dao.als',logger=logger,session=session)
+                with slog.stage('apcor',session=session,ccdnum=ccdnum):
+                    apcorr = phot.apcor('flux_daoa.fits','flux_dao.lst','flux_dao.psf',meta,optfile='flux_dao.opt',
+                                        alsoptfile='flux_dao.als.opt',logger=logger,session=session)
+            with slog.stage('growstars',ccdnum=ccdnum):
+                cat = growstars('flux_dao.ap','flux_dao.als','flux_dao.apers',fwhm=fwhm)
+                addcoords(cat,wcs,ccdnum,nx,ny)
+                growfile = os.path.join(outroot,'exp_%d.grow.fits' % ccdnum)
+                cat.write(growfile,overwrite=True)
+                growfiles.append(growfile)
+            # True correction: the median PSF minus input magnitude of the bright stars
+            als = daoio.daoread('flux_dao.als')
+            mid, ind1, ind2 = np.intersect1d(np.array(truecat['NUMBER']),np.array(als['ID']),return_indices=True)
+            bright = np.array(truecat['MAG_AUTO'])[ind1] < 18
+            truth = np.median(np.array(als['MAG'])[ind2[bright]]-np.array(truecat['MAG_AUTO'])[ind1[bright]])
+            rows.append({'ccdnum':ccdnum,'fwhm':fwhm,'chip':apcorr,'truth':truth,'ngrow':len(cat)})
+            os.chdir(curdir)
+        with slog.stage('exposureapcor'):
+            flat, flatcurve = exposureapcor(growfiles,mode='exposure',logger=logger)
+        with slog.stage('exposureapcor_focal'):
+            focal, focalcurve = exposureapcor(growfiles,mode='focalplane',logger=logger)
+
+        print('%d chips, %d stars, %dx%d' % (len(rows),nstars,nx,ny))
+        print(flatcurve)
+        print(focalcurve)
+        print('ccd  fwhm ngrow |  truth   chip   flat  focal |  chip-truth flat-truth focal-truth focal-chip')
+        for r in rows:
+            r['flat'] = flat[r['ccdnum']][0]
+            r['focal'] = focal[r['ccdnum']][0]
+            print('%3d %5.2f %5d | %6.3f %6.3f %6.3f %6.3f | %11.4f %10.4f %11.4f %10.4f' %
+                  (r['ccdnum'],r['fwhm'],r['ngrow'],r['truth'],r['chip'],r['flat'],r['focal'],
+                   r['chip']-r['truth'],r['flat']-r['truth'],r['focal']-r['truth'],r['focal']-r['chip']))
+        rms = {}
+        for k in ['chip','flat','focal']:
+            rms[k] = np.sqrt(np.mean([(r[k]-r['truth'])**2 for r in rows]))
+        rmschip = np.sqrt(np.mean([(r['focal']-r['chip'])**2 for r in rows]))
+        print('RMS (mean) against the truth: per chip %.4f (%.4f), exposure %.4f (%.4f), exposure+focal plane %.4f (%.4f) mag' %
+              (rms['chip'],np.mean([r['chip']-r['truth'] for r in rows]),rms['flat'],np.mean([r['flat']-r['truth'] for r in rows]),
+               rms['focal'],np.mean([r['focal']-r['truth'] for r in rows])))
+        print('RMS exposure+focal plane against per chip: %.4f mag' % rmschip)
+        cpu = {}
+        wall = {}
+        for k in ['apcor','growstars','exposureapcor','exposureapcor_focal']:
+            cpu[k] = np.sum([s['cpu'] for s in slog.records if s['stage']==k])
+            wall[k] = np.sum([s['wall'] for s in slog.records if s['stage']==k])
+        cpuexp = cpu['growstars']+cpu['exposureapcor_focal']
+        print('CPU per chip phot.apcor: %8.3f s (%.3f s wall)' % (cpu['apcor'],wall['apcor']))
+        print('CPU exposure-level:      %8.3f s (growstars %.3f s, fit %.3f s, %.3f s wall)' %
+              (cpuexp,cpu['growstars'],cpu['exposureapcor_focal'],wall['growstars']+wall['exposureapcor_focal']))
+        print('saved %.3f s CPU (%.1fx)' % (cpu['apcor']-cpuexp,cpu['apcor']/max(cpuexp,1e-6)))
+        ok &= (rms['focal'] < 1.25*rms['chip']+0.005) & (rmschip < 0.05) & (cpuexp < cpu['apcor'])
+    finally:
+        os.chdir(curdir)
+        os.environ['PATH'] = oldpath
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Exposure-level aperture correction.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--ncol', type=int, default=4, help='Number of chip columns')
+    parser.add_argument('--nrow', type=int, default=2, help='Number of chip rows')
+    parser.add_argument('--nstars', type=int, default=500, help='Number of stars per chip')
+    parser.add_argument('--wing', type=float, default=0.15, help='Fraction of the star flux in the halo')
+    args = parser.parse_args()
+    benchmark(args.ncol,args.nrow,args.nstars,wing=args.wing)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+#
+# CHIPCACHE.PY -- Decompress-once cache of the chips of fpacked InstCal files
+#
+# Exposure.loadchip() in nsc_instcal_sexdaophot.py and the HDU loop of
+# nsc_instcal_measure.py first copy the fz flux/wt/mask files off the mass
+# store, then decompress every extension and write flux.fits, wt.fits and
+# mask.fits to disk again for every chip, so the same bytes are read and
+# written several times.
+#
+# ChipCache decompresses each extension once, straight from the original
+# file, into an uncompressed single-HDU FITS file in a local scratch
+# directory.  The downstream tools get either the path (link() puts a
+# hard link under the name they expect) or a memory-mapped array of it
+# (getdata(), copy-on-write so the callers can modify it).  The files are
+# evicted in least-recently-used order when the directory goes over its
+# disk budget.  The directory itself is the state (file names are the keys
+# and the modification times the LRU order), so the chip processes of
+# chippool.py can share one cache.  A file that a chip still has linked
+# (link count above one) or that was used in the last MINAGE seconds is
+# never evicted, and the hard link keeps its pixels even if it is, so a
+# chip never ends up with a dangling flux/wt/mask file.
+# The scripts use it with --cachedir (nsc_instcal_measure.py,
+# nsc_instcal_measure_main.py and nsc_instcal_sexdaophot.py).
+#
+# "python chipcache.py --benchmark" reports the I/O bytes and time saved on
+# a synthetic multi-extension exposure.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+from argparse import ArgumentParser
+from astropy.io import fits
+
+class ChipCache:
+    """ Cache of uncompressed chips of multi-extension (fpacked) FITS files.
+
+    Parameters
+    ----------
+    cachedir : str
+       Local scratch directory for the uncompressed chips.
+    maxbytes : float, optional
+       Disk budget of the cache in bytes.  Default is 20 GB.
+    minage : float, optional
+       Files used in the last MINAGE seconds are not evicted, so another
+       process can open the path it just got.  Default is 600 sec.
+    logger : logger object, optional
+       The Logger to use for logging output.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cache = ChipCache('/data0/scratch/chipcache/')
+        cache.link('bigflux.fits.fz',1,'flux.fits',addpdu=True)
+        mask,mhead = cache.getdata('bigmask.fits.fz','S29',header=True)
+
+    """
+
+    def __init__(self,cachedir,maxbytes=20e9,minage=600.0,logger=None):
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxbytes = maxbytes
+        self.minage = minage
+        self.logger = logger
+        if os.path.exists(self.cachedir) is False:
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                pass     # made by another process
+        # Statistics
+        self.nhit = 0
+        self.nmiss = 0
+        self.nevict = 0
+        self.nwritten = 0      # bytes written to the cache
+
+    def __repr__(self):
+        return 'ChipCache(%s, %d hits, %d misses, %.1f MB written)' % (self.cachedir,self.nhit,self.nmiss,self.nwritten/1e6)
+
+    def key(self,filename,extension,addpdu=False):
+        """ Cache file name of an extension, a new file at the same path gets a new key."""
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        base = os.path.basename(filename)
+        for ext in ['.fz','.fits']:
+            if base.endswith(ext): base=base[:-len(ext)]
+        hsh = hashlib.md5(('%s %d %d' % (filename,st.st_mtime_ns,st.st_size)).encode()).hexdigest()[0:8]
+        return base+'_'+hsh+'_'+str(extension)+('_pdu' if addpdu else '')+'.fits'
+
+    def path(self,filename,extension,addpdu=False):
+        """ Path of the uncompressed extension, decompressing it if necessary.
+
+        Parameters
+        ----------
+        filename : str
+           The multi-extension (fpacked) FITS file.
+        extension : int or str
+           Extension number or EXTNAME.
+        addpdu : bool, optional
+           Add the primary header to the extension header (like loadchip()).
+
+        Returns
+        -------
+        path : str
+           The uncompressed single-HDU FITS file.
+
+        """
+        cfile = os.path.join(self.cachedir,self.key(filename,extension,addpdu))
+        if os.path.exists(cfile):
+            self.nhit += 1
+            os.utime(cfile,None)   # most recently used
+            return cfile
+        self.nmiss += 1
+        data,head = fits.getdata(filename,extension,header=True)
+        if addpdu:
+            head0 = fits.getheader(filename,0)
+            head.extend(head0,unique=True)
+        # Write to a temporary file and rename, so other processes never
+        #  see a partial file
+        tid,tfile = tempfile.mkstemp(prefix='.tmp',suffix='.fits',dir=self.cachedir)
+        os.close(tid)
+        fits.writeto(tfile,data,header=head,output_verify='silentfix',overwrite=True)
+        os.rename(tfile,cfile)
+        self.nwritten += os.path.getsize(cfile)
+        if self.logger is not None:
+            self.logger.info('Decompressed '+os.path.basename(filename)+'['+str(extension)+'] to '+cfile)
+        self.evict(keep=cfile)
+        return cfile
+
+    def getdata(self,filename,extension,header=False,addpdu=False):
+        """ Memory-mapped array of an extension (and its header), like fits.getdata().
+            The array is copy-on-write, changes are not written to the cache."""
+        cfile = self.path(filename,extension,addpdu)
+        return fits.getdata(cfile,0,header=header,memmap=True)
+
+    def link(self,filename,extension,outfile,addpdu=False):
+        """ Put a hard link OUTFILE to the uncompressed extension, replacing OUTFILE.
+
+        The link keeps the cache file in use until OUTFILE is deleted.  It
+        is a symlink if OUTFILE is on another filesystem, then only MINAGE
+        protects it.  OUTFILE is shared with the cache, do not modify it in
+        place.
+        """
+        if os.path.lexists(outfile): os.remove(outfile)
+        for i in range(3):
+            cfile = self.path(filename,extension,addpdu)
+            try:
+                os.link(cfile,outfile)
+                return outfile
+            except OSError as e:
+                if e.errno==errno.ENOENT: continue   # evicted by another process, try again
+                if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK): raise
+                os.symlink(cfile,outfile)
+                return outfile
+        raise IOError('Cannot link '+outfile+' to the cache file '+cfile)
+
+    def files(self):
+        """ Cache files with their last access times, sizes and link counts, oldest first."""
+        out = []
+        for f in os.listdir(self.cachedir):
+            if f.startswith('.tmp'): continue
+            fil = os.path.join(self.cachedir,f)
+            try:
+                st = os.stat(fil)
+            except OSError:
+                continue   # evicted by another process
+            out.append((st.st_mtime,st.st_size,fil,st.st_nlink))
+        out.sort()
+        return out
+
+    def size(self):
+        """ Total size of the cache in bytes."""
+        return sum([f[1] for f in self.files()])
+
+    def evict(self,keep=None):
+        """ Delete least-recently-used files until the cache is within its budget.
+            Files in use (linked by a chip or used in the last MINAGE seconds) are kept,
+            even if the cache stays over its budget."""
+        files = self.files()
+        total = sum([f[1] for f in files])
+        now = time.time()
+        for mtime,size,fil,nlink in files:
+            if total<=self.maxbytes: break
+            if fil==keep or nlink>1 or now-mtime<self.minage: continue
+            try:
+                os.remove(fil)
+            except OSError:
+                pass
+            total -= size
+            self.nevict += 1
+        return total
+
+    def clear(self):
+        """ Delete all of the cache files."""
+        for f in self.files():
+            os.remove(f[2])
+
+
+def simexposure(outdir,nchips=8,nx=2046,ny=4094,seed=0):
+    """ Write a synthetic fpacked flux/wt/mask exposure, returns the three file names."""
+    rnd = np.random.RandomState(seed)
+    files = []
+    for kind in ['flux','wt','mask']:
+        hdus = [fits.PrimaryHDU()]
+        hdus[0].header['DTINSTRU'] = 'decam'
+        for i in range(nchips):
+            if kind=='mask':
+                im = np.zeros((ny,nx),np.int32)
+                im[rnd.randint(0,ny,5000),rnd.randint(0,nx,5000)] = rnd.randint(1,8,5000)
+                hdu = fits.CompImageHDU(im,compression_type='RICE_1')
+            else:
+                im = rnd.normal(1000 if kind=='flux' else 0.01,3.0,(ny,nx)).astype(np.float32)
+                hdu = fits.CompImageHDU(im,compression_type='RICE_1',quantize_level=4.0)
+            hdu.header['EXTNAME'] = 'S%d' % (i+1)
+            hdu.header['CCDNUM'] = i+1
+            hdus.append(hdu)
+        fil = os.path.join(outdir,'big'+kind+'.fits.fz')
+        fits.HDUList(hdus).writeto(fil,overwrite=True)
+        files.append(fil)
+    return files
+
+def iocounts():
+    """ Bytes read and written by this process through system calls."""
+    out = {}
+    with open('/proc/self/io') as f:
+        for line in f:
+            k,v = line.split(':')
+            out[k] = int(v)
+    return out['rchar'], out['wchar']
+
+def _readchip(fluxfile,wtfile,maskfile):
+    """ What the downstream tools do with the chip files, read all of the pixels."""
+    tot = 0.0
+    for f in [fluxfile,wtfile,maskfile]:
+        tot += float(np.sum(fits.getdata(f),dtype=float))
+    return tot
+
+def benchmark(nchips=8,npass=2,nx=2046,ny=4094,tmpdir=None):
+    """ I/O bytes and time of the copy+decompress-per-chip approach and of the chip cache.
+
+    Every chip is processed NPASS times (e.g. the measurement and the
+    DAOPHOT steps, or a retried chip).
+    """
+    outroot = tempfile.mkdtemp(prefix='chipcache',dir=tmpdir)
+    results = {}
+    ok = True
+    try:
+        store = os.path.join(outroot,'mss')
+        os.makedirs(store)
+        bigfiles = simexposure(store,nchips,nx,ny)
+        fzbytes = sum([os.path.getsize(f) for f in bigfiles])
+        origdir = os.getcwd()
+
+        # Old way: copy the fz files, decompress and write every chip again
+        wdir = os.path.join(outroot,'old')
+        os.makedirs(wdir)
+        os.chdir(wdir)
+        r0,w0 = iocounts()
+        t0 = time.time()
+        sums0 = []
+        try:
+            for p in range(npass):
+                local = []
+                for f in bigfiles:
+                    shutil.copyfile(f,os.path.basename(f))
+                    local.append(os.path.basename(f))
+                for i in range(1,nchips+1):
+                    for f,out in zip(local,['flux.fits','wt.fits','mask.fits']):
+                        data,head = fits.getdata(f,i,header=True)
+                        if os.path.exists(out): os.remove(out)
+                        fits.writeto(out,data,header=head,output_verify='warn')
+                    sums0.append(_readchip('flux.fits','wt.fits','mask.fits'))
+        finally:
+            os.chdir(origdir)
+        dt0 = time.time()-t0
+        r1,w1 = iocounts()
+        results['old'] = {'time':dt0,'read':r1-r0,'written':w1-w0}
+
+        # Chip cache, decompress once from the original files
+        wdir = os.path.join(outroot,'new')
+        os.makedirs(wdir)
+        os.chdir(wdir)
+        cache = ChipCache(os.path.join(outroot,'cache'),maxbytes=1e12)
+        r0,w0 = iocounts()
+        t0 = time.time()
+        sums1 = []
+        try:
+            for p in range(npass):
+                for i in range(1,nchips+1):
+                    for f,out in zip(bigfiles,['flux.fits','wt.fits','mask.fits']):
+                        cache.link(f,i,out)
+                    sums1.append(_readchip('flux.fits','wt.fits','mask.fits'))
+        finally:
+            os.chdir(origdir)
+        dt1 = time.time()-t0
+        r1,w1 = iocounts()
+        results['cache'] = {'time':dt1,'read':r1-r0,'written':w1-w0}
+        same = np.allclose(sums0,sums1,rtol=1e-12,atol=0)
+        ok &= same
+
+        # Same pixels and headers
+        d0,h0 = fits.getdata(bigfiles[0],3,header=True)
+        d1,h1 = cache.getdata(bigfiles[0],3,header=True)
+        ok &= np.array_equal(d0,d1) & (h0['CCDNUM']==h1['CCDNUM'])
+        # Copy-on-write, changes are not written to the cache
+        d1 *= 0
+        ok &= np.array_equal(fits.getdata(cache.path(bigfiles[0],3)),d0)
+
+        # LRU eviction under a budget of 3.5 chips
+        if nchips>=5:
+            onesize = os.path.getsize(cache.path(bigfiles[0],1))
+            cache2 = ChipCache(os.path.join(outroot,'cache2'),maxbytes=3.5*onesize,minage=0.0)
+            for i in range(1,5):
+                cache2.path(bigfiles[0],i)
+                time.sleep(0.01)
+            cache2.path(bigfiles[0],2)     # used again, stays in
+            time.sleep(0.01)
+            cache2.path(bigfiles[0],5)
+            left = sorted([int(os.path.basename(f[2]).split('_')[-1][:-5]) for f in cache2.files()])
+            print('budget of 3.5 chips, kept extensions %s, %d evicted' % (left,cache2.nevict))
+            ok &= (left==[2,4,5]) & (cache2.size()<=cache2.maxbytes)
+
+        print('%d chips x %d passes, %.1f MB of fz files' % (nchips,npass,fzbytes/1e6))
+        print('%-8s %8s %12s %12s' % ('','time','read MB','written MB'))
+        for k in ['old','cache']:
+            r = results[k]
+            print('%-8s %7.2fs %12.1f %12.1f' % (k,r['time'],r['read']/1e6,r['written']/1e6))
+        saved = (results['old']['read']+results['old']['written'])-(results['cache']['read']+results['cache']['written'])
+        print('I/O bytes saved %.1f MB (%.0f%%), same pixels = %s   %s' %
+              (saved/1e6,100*saved/(results['old']['read']+results['old']['written']),same,str(cache)))
+        results['saved'] = saved
+    finally:
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the decompress-once chip cache.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nchips', type=int, default=8, help='Number of chips')
+    parser.add_argument('--npass', type=int, default=2, help='Number of times each chip is processed')
+    parser.add_argument('--nx', type=int, default=2046, help='Chip X size')
+    parser.add_argument('--ny', type=int, default=4094, help='Chip Y size')
+    args = parser.parse_args()
+    benchmark(args.nchips,args.npass,args.nx,args.ny)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# CHIPPOOL.PY -- Process the chips of an exposure in parallel
+#
+# Exposure.process() in nsc_instcal_sexdaophot.py loads and processes the
+# 60+ CCD extensions one after the other.  All of the SExtractor and
+# DAOPHOT steps work on fixed file names in the current directory
+# (flux.fits, default.config, daophot.opt, the tempfile symlinks, ...), so
+# the chips cannot simply share a directory.  Here every chip runs in its
+# own process and its own working directory, WDIR/chipNN, on a
+# multiprocessing pool, and the wall/CPU time and failure status of every
+# chip are collected.
+#
+# "python chippool.py --benchmark" runs a synthetic exposure through stub
+# sex/daophot executables that mimic the file handling of the pipeline.
+
+from __future__ import print_function
+
+import os
+import sys
+import numpy as np
+import time
+import json
+import shutil
+import socket
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+dtype_chipstat = np.dtype([('extension',int),('ccdnum',int),('ok',bool),('host',(str,50)),('pid',int),
+                           ('start',float),('wall',float),('cpu',float),('error',(str,1000))])
+
+def chipdir(wdir,extension):
+    """ Working directory of a chip."""
+    return os.path.join(wdir,'chip%02d' % extension)
+
+def _runchip(args):
+    """ Run the chip function in the chip's own working directory."""
+    func, wdir, extension, cleanup, kwargs = args
+    cdir = chipdir(wdir,extension)
+    if os.path.exists(cdir) is False: os.makedirs(cdir)
+    origdir = os.getcwd()
+    stat = {'extension':extension,'ccdnum':-1,'ok':False,'host':socket.gethostname().split('.')[0],
+            'pid':os.getpid(),'start':time.time(),'wall':0.0,'cpu':0.0,'error':''}
+    t0 = os.times()
+    try:
+        os.chdir(cdir)
+        ccdnum = func(extension,**kwargs)
+        if ccdnum is not None: stat['ccdnum'] = ccdnum
+        stat['ok'] = True
+    except Exception:
+        stat['error'] = traceback.format_exc()[-1000:]
+    finally:
+        os.chdir(origdir)
+        t1 = os.times()
+        # CPU of this process and of the sex/daophot children
+        stat['cpu'] = sum(t1[0:4])-sum(t0[0:4])
+        stat['wall'] = time.time()-stat['start']
+        if cleanup: shutil.rmtree(cdir,ignore_errors=True)
+    return stat
+
+def processchips(func,extensions,wdir,nproc=1,cleanup=True,logger=None,**kwargs):
+    """ Process the chips of an exposure, each in its own working directory.
+
+    Parameters
+    ----------
+    func : function
+       Module-level function to process one chip, called as
+       func(extension,**kwargs) in the chip's working directory.  It can
+       return the CCDNUM of the chip.
+    extensions : list
+       The extensions to process.
+    wdir : str
+       The exposure's working directory, the chips run in WDIR/chipNN.
+    nproc : int, optional
+       Number of chips to process at the same time.  Default is 1.
+    cleanup : bool, optional
+       Delete the chip working directories at the end.  Default is True.
+    logger : logger object, optional
+       The Logger to use for logging output.
+    **kwargs
+       Other keywords for func.
+
+    Returns
+    -------
+    stats : numpy structured array
+       Extension, CCDNUM, status, wall and CPU time of every chip, in the
+       order of EXTENSIONS.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        stats = processchips(processchip,range(1,nexten),wdir,nproc=8,fluxfile=fluxfile)
+
+    """
+    wdir = os.path.abspath(wdir)
+    extensions = list(extensions)
+    tasks = [(func,wdir,e,cleanup,kwargs) for e in extensions]
+    stats = np.zeros(len(extensions),dtype=dtype_chipstat)
+    index = dict([(e,i) for i,e in enumerate(extensions)])
+    t0 = time.time()
+    if nproc<=1:
+        results = (_runchip(t) for t in tasks)
+        pool = None
+    else:
+        # a new process for each chip, so the memory is released
+        pool = multiprocessing.Pool(nproc,maxtasksperchild=1)
+        results = pool.imap_unordered(_runchip,tasks)
+    try:
+        for stat in results:
+            i = index[stat['extension']]
+            for n in dtype_chipstat.names: stats[n][i]=stat[n]
+            if logger is not None:
+                if stat['ok']:
+                    logger.info('Chip %d (CCDNUM=%d) done in %.1f sec, %.1f CPU sec' %
+                                (stat['extension'],stat['ccdnum'],stat['wall'],stat['cpu']))
+                else:
+                    logger.error('Chip %d FAILED\n%s' % (stat['extension'],stat['error']))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if logger is not None:
+        logger.info('%d chips processed, %d failed, in %.1f sec with %d processes' %
+                    (len(stats),np.sum(~stats['ok']),time.time()-t0,nproc))
+    return stats
+
+
+# Stub daophot for the benchmark, it mimics the file handling of the DAOPHOT
+#  FIND step and writes the CCDNUM of its input image and of its option file
+#  so that chips which clobber each other's files are caught (the stub sex of
+#  daostub.py writes the CCDNUM of its image in the same way)
+STUBDAOPHOT = r'''#!/usr/bin/env python
+import sys, time, re
+lines = sys.stdin.read().split('\n')
+opt = open('daophot.opt').read()
+ccdopt = re.search(r"CC = (\d+)",opt).group(1)
+imfile = lines[lines.index('ATTACH')+1] if 'ATTACH' in lines else lines[0].split()[1]
+head = open(imfile+'.fits','rb').read(28800).decode('ascii','ignore')
+ccdnum = re.search(r"CCDNUM  =\s+(\d+)",head).group(1)
+outfile = [l.split('=')[1].strip() for l in lines if l.startswith('OUT')][0]
+time.sleep(float(re.search(r"DT = (\S+)",opt).group(1)))
+open(outfile,'w').write(ccdnum+' '+ccdopt+'\n')
+'''
+
+def stubchip(extension,fluxfile=None,outdir=None,dt=0.2):
+    """ Mimic one chip of the pipeline in the current directory with the stub executables."""
+    from astropy.io import fits
+    # Load the chip, like Exposure.loadchip()
+    flux,fhead = fits.getdata(fluxfile,extension,header=True)
+    ccdnum = fhead['CCDNUM']
+    for f in ['flux.fits','wt.fits','mask.fits']:
+        if os.path.exists(f): os.remove(f)
+        fits.writeto(f,flux,header=fhead)
+    # SExtractor config, like runsex()
+    with open('default.config','w') as fo:
+        fo.write('CATALOG_NAME     flux_sex.cat\nSTUBTIME '+str(dt)+'\n')
+    with open('flux_sex.log','w') as sf:
+        subprocess.call(['sex','flux.fits','-c','default.config'],stdout=sf,stderr=subprocess.STDOUT)
+    # DAOPHOT option file and tempfile symlinks/script, like daofind()
+    with open('daophot.opt','w') as fo:
+        fo.write('CC = %d\nDT = %s\n' % (ccdnum,str(dt)))
+    tid,tfile = tempfile.mkstemp(prefix="tcoo",dir=".")
+    os.close(tid)
+    tbase = os.path.basename(tfile)
+    os.symlink('flux.fits',tbase+'.fits')
+    scriptfile = 'flux_daofind.sh'
+    with open(scriptfile,'w') as fo:
+        fo.write('#!/bin/sh\ndaophot << END_DAOPHOT >> flux_daofind.log\nATTACH\n'+tbase+'\nOUT='+tbase+'.coo\nEND_DAOPHOT\n')
+    os.chmod(scriptfile,0o775)
+    subprocess.call(['./'+scriptfile],stderr=subprocess.STDOUT,shell=False)
+    shutil.move(tbase+'.coo','flux.coo')
+    for f in [tfile,tbase+'.fits']:
+        if os.path.exists(f): os.remove(f)
+    # Copy the outputs, like Chip.cleanup()
+    shutil.copyfile('flux_sex.cat',os.path.join(outdir,'chip_%d.sex' % ccdnum))
+    shutil.copyfile('flux.coo',os.path.join(outdir,'chip_%d.coo' % ccdnum))
+    for f in ['flux.fits','wt.fits','mask.fits','flux_sex.cat','flux.coo','daophot.opt','default.config']:
+        if os.path.exists(f): os.remove(f)
+    return ccdnum
+
+def simexposure(filename,nchips=16,nx=512,ny=256,seed=0):
+    """ Write a synthetic multi-extension exposure."""
+    from astropy.io import fits
+    rnd = np.random.RandomState(seed)
+    hdus = [fits.PrimaryHDU()]
+    for i in range(nchips):
+        hdu = fits.ImageHDU(rnd.normal(100,10,(ny,nx)).astype(np.float32))
+        hdu.header['CCDNUM'] = i+1
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(filename,overwrite=True)
+    return filename
+
+def benchmark(nchips=16,nproc=[1,2,4,8],dt=0.2,tmpdir=None):
+    """ Throughput of the chip pool with stub sex/daophot executables.
+
+    The stubs sleep DT seconds per call, so the speed-up is that of the
+    external programs running side by side.
+    """
+    import daostub
+    outroot = tempfile.mkdtemp(prefix='chippool',dir=tmpdir)
+    bindir = os.path.join(outroot,'bin')
+    os.makedirs(bindir)
+    daostub.mksex(bindir)
+    with open(os.path.join(bindir,'daophot'),'w') as fo:
+        fo.write(STUBDAOPHOT.replace('#!/usr/bin/env python','#!'+sys.executable))
+    os.chmod(os.path.join(bindir,'daophot'),0o775)
+    oldpath = os.environ.get('PATH','')
+    os.environ['PATH'] = bindir+os.pathsep+oldpath
+    fluxfile = simexposure(os.path.join(outroot,'bigflux.fits'),nchips)
+    results = []
+    ok = True
+    try:
+        # Old way, all chips one after the other in one directory
+        outdir = os.path.join(outroot,'out0')
+        wdir = os.path.join(outroot,'serial')
+        os.makedirs(outdir)
+        os.makedirs(wdir)
+        origdir = os.getcwd()
+        os.chdir(wdir)
+        t0 = time.time()
+        try:
+            for e in range(1,nchips+1):
+                stubchip(e,fluxfile=fluxfile,outdir=outdir,dt=dt)
+        finally:
+            os.chdir(origdir)
+        tserial = time.time()-t0
+        print('%-12s %7.2f sec  %7.1f chips/min' % ('serial loop',tserial,60*nchips/tserial))
+        for n in nproc:
+            outdir = os.path.join(outroot,'out%d' % n)
+            os.makedirs(outdir)
+            t0 = time.time()
+            stats = processchips(stubchip,range(1,nchips+1),os.path.join(outroot,'wdir%d' % n),nproc=n,
+                                 fluxfile=fluxfile,outdir=outdir,dt=dt)
+            dtime = time.time()-t0
+            # Every chip wrote its own outputs
+            good = np.all(stats['ok']) & np.array_equal(stats['ccdnum'],np.arange(1,nchips+1))
+            for c in range(1,nchips+1):
+                sexcat = json.load(open(os.path.join(outdir,'chip_%d.sex' % c)))
+                coo = open(os.path.join(outdir,'chip_%d.coo' % c)).read().split()
+                good &= (sexcat['CCDNUM']==c) & (coo==[str(c),str(c)])
+            ok &= good
+            print('%-12s %7.2f sec  %7.1f chips/min  speed-up %5.2f  mean chip %5.2f sec  isolated=%s' %
+                  ('nproc=%d' % n,dtime,60*nchips/dtime,tserial/dtime,np.mean(stats['wall']),good))
+            results.append({'nproc':n,'time':dtime,'speedup':tserial/dtime,'ok':good})
+        # A failing chip is reported and does not stop the others
+        stats = processchips(stubchip,[1,nchips+5],os.path.join(outroot,'wdirfail'),nproc=2,
+                             fluxfile=fluxfile,outdir=os.path.join(outroot,'out0'),dt=0.0)
+        failok = stats['ok'].tolist()==[True,False] and ('IndexError' in stats['error'][1])
+        print('failure status collected = %s' % failok)
+        ok &= failok
+    finally:
+        os.environ['PATH'] = oldpath
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark chip-parallel processing with stub executables.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nchips', type=int, default=16, help='Number of chips')
+    parser.add_argument('--nproc', type=str, default='1,2,4,8', help='Comma-separated list of number of processes')
+    parser.add_argument('--dt', type=float, default=0.2, help='Time of each stub call in seconds')
+    args = parser.parse_args()
+    benchmark(args.nchips,[int(n) for n in args.nproc.split(',')],args.dt)
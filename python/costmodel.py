@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+# Cost model and load balancing of the combine pixels across hosts.
+#
+# nsc_instcal_combine_main.py shuffles the HEALPix pixels randomly and
+# gives each host an equal number of them.  The cost of a pixel goes with
+# the number of measurements in it, which varies by orders of magnitude, so
+# some hosts finish hours after the others.
+#
+# Here each pixel gets a predicted CPU time and memory from its number of
+# exposures (NEXP) and its estimated number of measurements (NMEAS, the
+# summed chip source counts of the meta files scaled to the pixel area, like
+# the estimate in the combine).  The model is
+#
+#     log(time)   = c0 + c1*log(1+NMEAS) + c2*log(1+NEXP)
+#     log(maxrss) = d0 + d1*log(1+NMEAS) + d2*log(1+NEXP)
+#
+# fitted to the runtimes and peak RSS of previous runs recorded in the
+# scheduler manifests (scheduler.py), with a default model otherwise.  The
+# fit is in log space, predict() adds half the residual variance so the
+# predicted times are means and not medians.
+#
+# The pixels are run longest-predicted-time first from ONE queue that all
+# of the hosts share: every host adds all of the pixels to the same
+# manifest with that priority and its workers claim the next pixel whenever a
+# slot frees up.  Fixed per-host lists, even ones packed with LPT on the
+# predicted costs, are no better than the random split once the true costs
+# differ from the predictions, a host that got the underestimated pixels
+# finishes last.  The shared queue corrects that as it goes.
+#
+# dispatch() is both the planner and the simulator, "python costmodel.py
+# --simulate" compares the makespans of the random split, fixed LPT lists
+# and the shared LPT queue with the true costs for several random seeds.
+
+import os
+import numpy as np
+import time
+import heapq
+from argparse import ArgumentParser
+from astropy.io import fits
+import healpy as hp
+
+# Total area of the instruments in deg^2, same as the combine
+AREADICT = {'c4d':3.0, 'k4m':0.3, 'ksb':1.0}
+
+# Default model without a history of runtimes, about 0.1 ms and 1 kB per
+# measurement (see MEASMEM in nsc_instcal_combine_cluster.py)
+TIMECOEF = [np.log(1e-4),1.0,0.0]
+MEMCOEF = [np.log(1000.0),1.0,0.0]
+
+dtype_feat = np.dtype([('pix',int),('nexp',int),('nmeas',float)])
+
+
+def expsources(metafiles,fpindex=None):
+    """ Summed chip source counts and instrument of exposure meta files.
+
+    With a footprint index (see footprint.py) the meta files are not read.
+    Missing meta files get zero sources.
+    """
+    metafiles = np.atleast_1d(metafiles).astype(str)
+    nsrc = np.zeros(len(metafiles),float)
+    instrument = np.zeros(len(metafiles),(str,3))
+    if fpindex is not None:
+        expmeta = fpindex.getexposures(metafiles)
+        srt = np.argsort(metafiles)
+        ind = srt[np.searchsorted(metafiles,expmeta['metafile'],sorter=srt)]
+        nsrc[ind] = expmeta['nsources']
+        instrument[ind] = expmeta['instrument']
+        return nsrc, instrument
+    for i,mfile in enumerate(metafiles):
+        if os.path.exists(mfile) is False:
+            continue
+        meta = fits.getdata(mfile,1,memmap=False)
+        chmeta = fits.getdata(mfile,2,memmap=False)
+        inst = meta['instrument'][0]
+        if type(inst) is bytes: inst=inst.decode()
+        instrument[i] = inst.strip()
+        nsrc[i] = np.sum(chmeta['nsources'])
+    return nsrc, instrument
+
+def pixelfeatures(healstr,nside=128,fpindex=None,expinfo=None):
+    """ Number of exposures and estimated number of measurements of each pixel.
+
+    Parameters
+    ----------
+    healstr : numpy structured array
+       The healpix list with FILE (the _cat.fits file) and PIX, one row per
+       exposure and pixel.
+    nside : int, optional
+       HEALPix nside of the list.  Default is 128.
+    fpindex : FootprintIndex, optional
+       Footprint index to get the source counts from instead of the meta files.
+    expinfo : tuple, optional
+       The (nsrc, instrument) of the unique meta files if they are already known.
+
+    Returns
+    -------
+    feat : numpy structured array
+       PIX, NEXP and NMEAS of the unique pixels.
+
+    """
+    files = np.char.strip(np.asarray(healstr['FILE']).astype(str))
+    metafiles = np.char.replace(files,'_cat','_meta')
+    umeta, minv = np.unique(metafiles,return_inverse=True)
+    if expinfo is None:
+        expinfo = expsources(umeta,fpindex=fpindex)
+    nsrc, instrument = expinfo
+    area = np.array([AREADICT.get(i,1.0) for i in instrument])
+    nmeasexp = nsrc/area * hp.nside2pixarea(nside,degrees=True)
+    upix, pinv = np.unique(np.asarray(healstr['PIX']),return_inverse=True)
+    feat = np.zeros(len(upix),dtype=dtype_feat)
+    feat['pix'] = upix
+    feat['nexp'] = np.bincount(pinv,minlength=len(upix))
+    feat['nmeas'] = np.bincount(pinv,weights=nmeasexp[minv],minlength=len(upix))
+    return feat
+
+def history(manifests,feat=None):
+    """ Runtime and peak RSS of the pixels done in previous runs.
+
+    Parameters
+    ----------
+    manifests : list
+       Scheduler manifest databases of previous runs, the task names are
+       the pixel numbers.
+    feat : numpy structured array, optional
+       Pixel features, only the pixels in it are returned.
+
+    Returns
+    -------
+    hist : numpy structured array
+       PIX, RUNTIME and MAXRSS, the last run of each pixel.
+
+    """
+    import scheduler
+    dtype = np.dtype([('pix',int),('runtime',float),('maxrss',float)])
+    hist = []
+    for mfile in np.atleast_1d(manifests):
+        man = scheduler.Manifest(mfile)
+        tasks = man.tasks('done')
+        man.close()
+        tasks = tasks[np.char.isdigit(tasks['name']) & (tasks['runtime']>0)]
+        h = np.zeros(len(tasks),dtype=dtype)
+        h['pix'] = tasks['name'].astype(int)
+        h['runtime'] = tasks['runtime']
+        h['maxrss'] = tasks['maxrss']
+        hist.append(h)
+    hist = np.hstack(hist) if len(hist)>0 else np.zeros(0,dtype=dtype)
+    # last run of each pixel
+    if len(hist)>0:
+        _, ui = np.unique(hist['pix'][::-1],return_index=True)
+        hist = hist[::-1][ui]
+    if feat is not None:
+        hist = hist[np.isin(hist['pix'],feat['pix'])]
+    return hist
+
+def _design(feat):
+    return np.vstack((np.ones(len(feat)),np.log1p(feat['nmeas']),np.log1p(feat['nexp']))).T
+
+
+class CostModel:
+    """ Predicted CPU time and memory of a pixel from its NEXP and NMEAS.
+
+    Parameters
+    ----------
+    tcoef : list, optional
+       Coefficients of the log(time) model.  Default is TIMECOEF.
+    mcoef : list, optional
+       Coefficients of the log(maxrss) model.  Default is MEMCOEF.
+    memsigma : float, optional
+       Number of sigma above the fitted memory to use for the cap.  Default is 2.
+
+    """
+
+    def __init__(self,tcoef=None,mcoef=None,memsigma=2.0):
+        self.tcoef = np.array(TIMECOEF if tcoef is None else tcoef,float)
+        self.mcoef = np.array(MEMCOEF if mcoef is None else mcoef,float)
+        self.tsig = 0.0
+        self.msig = 0.0
+        self.memsigma = memsigma
+        self.nfit = 0
+
+    def __repr__(self):
+        return 'CostModel(tcoef=%s, mcoef=%s, nfit=%d)' % (np.round(self.tcoef,3),np.round(self.mcoef,3),self.nfit)
+
+    def fit(self,feat,runtime,maxrss=None):
+        """ Fit the model to the runtimes and peak RSS of previous runs."""
+        runtime = np.asarray(runtime,float)
+        gd = runtime>0
+        if np.sum(gd)<3:
+            return self
+        A = _design(feat[gd])
+        self.tcoef,_,_,_ = np.linalg.lstsq(A,np.log(runtime[gd]),rcond=None)
+        self.tsig = np.std(np.log(runtime[gd])-A.dot(self.tcoef))
+        self.nfit = int(np.sum(gd))
+        if maxrss is not None:
+            maxrss = np.asarray(maxrss,float)
+            gd = maxrss>0
+            if np.sum(gd)>=3:
+                A = _design(feat[gd])
+                self.mcoef,_,_,_ = np.linalg.lstsq(A,np.log(maxrss[gd]),rcond=None)
+                self.msig = np.std(np.log(maxrss[gd])-A.dot(self.mcoef))
+        return self
+
+    def predict(self,feat):
+        """ Predicted mean CPU time in seconds and memory in bytes (with the memsigma margin)."""
+        A = _design(feat)
+        cost = np.exp(A.dot(self.tcoef)+0.5*self.tsig**2)
+        mem = np.exp(A.dot(self.mcoef)+self.memsigma*self.msig)
+        return cost, mem
+
+
+class _Queue:
+    """ Ordered list of jobs, some of which may be shared with other hosts."""
+
+    def __init__(self,order,taken):
+        self.order = np.asarray(order,int)
+        self.taken = taken
+        self.head = 0
+
+    def __len__(self):
+        return len(self.order)-self.head
+
+    def pop(self,mem,free,maxscan):
+        """ First job that is not taken and fits in FREE memory, None if there is none."""
+        while (self.head<len(self.order)) and self.taken[self.order[self.head]]:
+            self.head += 1
+        k = self.head
+        kmax = min(len(self.order),self.head+maxscan)
+        while k<kmax:
+            j = self.order[k]
+            if (self.taken[j]==False) and (mem[j]<=free):
+                self.taken[j] = True
+                return j
+            k += 1
+        return None
+
+def dispatch(cost,mem,queues,nslots=1,maxmem=None,maxscan=1000):
+    """ Run ordered lists of jobs on hosts with NSLOTS slots and a memory cap.
+
+    A free slot starts the first job of its host's list that fits in the
+    memory left on the host (a job always starts on an idle host).  The
+    lists can be shared between hosts.
+
+    Parameters
+    ----------
+    cost : numpy array
+       Time of each job.
+    mem : numpy array
+       Memory of each job.
+    queues : list
+       Job indices for each host, in order.  A host list that is the same
+       object as another one is shared, e.g. [order]*nhosts.
+    nslots : int, optional
+       Number of jobs a host can run at the same time.  Default is 1.
+    maxmem : float, optional
+       Memory cap of each host.  Default is no cap.
+    maxscan : int, optional
+       Number of jobs to look ahead for one that fits.  Default is 1000.
+
+    Returns
+    -------
+    host : numpy array
+       Host of each job.
+    start : numpy array
+       Start time of each job.
+    finish : numpy array
+       Finish time of each job.
+
+    """
+    cost = np.asarray(cost,float)
+    mem = np.asarray(mem,float)
+    njobs = len(cost)
+    nhosts = len(queues)
+    if maxmem is None: maxmem=np.inf
+    taken = np.zeros(njobs,bool)
+    qobj = {}
+    hostq = []
+    for q in queues:
+        if id(q) not in qobj: qobj[id(q)] = _Queue(q,taken)
+        hostq.append(qobj[id(q)])
+    host = np.zeros(njobs,int)-1
+    start = np.zeros(njobs,float)
+    finish = np.zeros(njobs,float)
+    used = np.zeros(nhosts,float)
+    running = [[] for h in range(nhosts)]        # heaps of (finish,job)
+    slots = [(0.0,h) for h in range(nhosts) for s in range(nslots)]
+    heapq.heapify(slots)
+    while len(slots)>0:
+        t,h = heapq.heappop(slots)
+        # Release the jobs that are done
+        while (len(running[h])>0) and (running[h][0][0]<=t):
+            f,j = heapq.heappop(running[h])
+            used[h] -= mem[j]
+        free = maxmem-used[h] if len(running[h])>0 else np.inf
+        j = hostq[h].pop(mem,free,maxscan)
+        if j is None:
+            # Nothing fits, wait for the next job on this host to finish
+            if (len(hostq[h])>0) and (len(running[h])>0):
+                heapq.heappush(slots,(running[h][0][0],h))
+            continue
+        host[j] = h
+        start[j] = t
+        finish[j] = t+cost[j]
+        used[h] += mem[j]
+        heapq.heappush(running[h],(finish[j],j))
+        heapq.heappush(slots,(finish[j],h))
+    return host, start, finish
+
+def randomsplit(njobs,nhosts,seed=0):
+    """ Host lists of the random shuffle and even split of nsc_instcal_combine_main.py."""
+    np.random.seed(seed)
+    rnd = np.argsort(np.random.rand(njobs))
+    nperhost = int(np.ceil(njobs/nhosts))
+    return [rnd[i*nperhost:(i+1)*nperhost] for i in range(nhosts)]
+
+def lptplan(cost,mem,nhosts,nslots=1,maxmem=None):
+    """ Longest-processing-time-first packing of jobs into fixed host lists under a memory cap.
+
+    Returns the job indices for each host in the order they should be run
+    and the predicted makespan.  Only used for comparison, see balance().
+    """
+    order = np.argsort(-np.asarray(cost),kind='stable')
+    host, start, finish = dispatch(cost,mem,[order]*nhosts,nslots,maxmem)
+    queues = []
+    for h in range(nhosts):
+        ind, = np.where(host==h)
+        queues.append(ind[np.argsort(start[ind],kind='stable')])
+    return queues, np.max(finish) if len(finish)>0 else 0.0
+
+def makespan(cost,mem,queues,nslots=1,maxmem=None):
+    """ Makespan of running host lists, the same list object for all hosts is a shared queue."""
+    host, start, finish = dispatch(cost,mem,queues,nslots,maxmem)
+    return np.max(finish) if len(finish)>0 else 0.0
+
+def balance(feat,model,nhosts,nslots=1,maxmem=None,seed=0):
+    """ Order the pixels for a shared queue with the cost model.
+
+    Returns the indices into FEAT in the order to run them, longest
+    predicted time first, and a dictionary with the predicted makespans of
+    the shared queue, of fixed LPT host lists and of the random split.
+    """
+    cost, mem = model.predict(feat)
+    order = np.argsort(-cost,kind='stable')
+    tshared = makespan(cost,mem,[order]*nhosts,nslots,maxmem)
+    tstatic = lptplan(cost,mem,nhosts,nslots,maxmem)[1]
+    trand = makespan(cost,mem,randomsplit(len(feat),nhosts,seed),nslots,maxmem)
+    lower = max(np.sum(cost)/(nhosts*nslots),np.max(cost) if len(cost)>0 else 0.0)
+    return order, {'shared':tshared,'static':tstatic,'random':trand,'lower':lower}
+
+
+def simpixels(npix=20000,seed=0):
+    """ Simulate pixel features and their true runtimes and peak RSS."""
+    rnd = np.random.RandomState(seed)
+    feat = np.zeros(npix,dtype=dtype_feat)
+    feat['pix'] = rnd.choice(12*128**2,npix,replace=False)
+    # heavy tail in the number of exposures and the source density
+    feat['nexp'] = np.maximum(1,np.round(rnd.lognormal(np.log(20),1.0,npix))).astype(int)
+    feat['nmeas'] = feat['nexp']*rnd.lognormal(np.log(3000),1.2,npix)
+    runtime = 5.0+2e-4*feat['nmeas']**1.1*0.5+0.5*feat['nexp']
+    runtime *= rnd.lognormal(0.0,0.3,npix)
+    maxrss = 2e8+1200.0*feat['nmeas']
+    maxrss *= rnd.lognormal(0.0,0.1,npix)
+    return feat, runtime, maxrss
+
+def simulate(npix=20000,nhosts=5,nslots=15,maxmem=100e9,nhist=2000,seeds=[0,1,2,3,4]):
+    """ Makespans of the random split, fixed LPT lists and the shared LPT queue on simulated pixels.
+
+    For each seed the model is fitted to NHIST pixels with known runtimes,
+    the plans are made with the predicted costs and then run with the true
+    costs.
+    """
+    print('%d pixels  %d hosts x %d slots  %.0f GB cap  model fit to %d pixels' % (npix,nhosts,nslots,maxmem/1e9,nhist))
+    print('%4s %6s %9s %9s %9s %9s %9s %9s' % ('seed','corr','random','fixed','shared','bound','fixed','shared'))
+    print('%4s %6s %9s %9s %9s %9s %9s %9s' % ('','','h','h','h','h','speed-up','speed-up'))
+    results = []
+    for seed in seeds:
+        feat, runtime, maxrss = simpixels(npix,seed)
+        rnd = np.random.RandomState(seed+1)
+        hist = rnd.choice(npix,nhist,replace=False)
+        t0 = time.time()
+        model = CostModel().fit(feat[hist],runtime[hist],maxrss[hist])
+        order, pred = balance(feat,model,nhosts,nslots,maxmem,seed)
+        dt = time.time()-t0
+        cost, mem = model.predict(feat)
+        queues = lptplan(cost,mem,nhosts,nslots,maxmem)[0]
+        res = {'seed':seed,'model':model,'plantime':dt,'pred':pred,
+               'random':makespan(runtime,maxrss,randomsplit(npix,nhosts,seed),nslots,maxmem),
+               'static':makespan(runtime,maxrss,queues,nslots,maxmem),
+               'shared':makespan(runtime,maxrss,[order]*nhosts,nslots,maxmem),
+               'lower':max(np.sum(runtime)/(nhosts*nslots),np.max(runtime)),
+               'corr':np.corrcoef(np.log(cost),np.log(runtime))[0,1]}
+        print('%4d %6.3f %9.2f %9.2f %9.2f %9.2f %9.2f %9.2f' %
+              (seed,res['corr'],res['random']/3600,res['static']/3600,res['shared']/3600,res['lower']/3600,
+               res['random']/res['static'],res['random']/res['shared']))
+        results.append(res)
+    speedup = np.array([r['random']/r['shared'] for r in results])
+    over = np.array([r['shared']/r['lower'] for r in results])
+    print('shared queue speed-up over the random split: min %.2f  median %.2f' % (np.min(speedup),np.median(speedup)))
+    print('shared queue makespan over the lower bound:  max %.3f' % np.max(over))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Cost-model load balancing of the combine pixels.')
+    parser.add_argument('--simulate', action='store_true', help='Run the simulation harness')
+    parser.add_argument('--list', type=str, default=None, help='Healpix list to balance')
+    parser.add_argument('--history', type=str, nargs='+', default=None, help='Manifest databases of previous runs')
+    parser.add_argument('--npix', type=int, default=20000, help='Number of simulated pixels')
+    parser.add_argument('--nhosts', type=int, default=5, help='Number of hosts')
+    parser.add_argument('-nm','--nmulti', type=int, default=15, help='Number of jobs per host')
+    parser.add_argument('--maxmem', type=float, default=100.0, help='Memory cap per host in GB')
+    parser.add_argument('--seeds', type=str, default='0,1,2,3,4', help='Comma-separated list of random seeds')
+    args = parser.parse_args()
+    if args.list is not None:
+        healstr = fits.getdata(args.list,1)
+        feat = pixelfeatures(healstr)
+        model = CostModel()
+        if args.history is not None:
+            hist = history(args.history,feat)
+            ind = np.searchsorted(feat['pix'],hist['pix'])
+            model.fit(feat[ind],hist['runtime'],hist['maxrss'])
+        print(str(len(feat))+' pixels  '+str(model))
+        order, pred = balance(feat,model,args.nhosts,args.nmulti,args.maxmem*1e9)
+        for k in ['random','static','shared','lower']:
+            print('%-8s %10.2f h' % (k,pred[k]/3600))
+    else:
+        simulate(args.npix,args.nhosts,args.nmulti,args.maxmem*1e9,seeds=[int(s) for s in args.seeds.split(',')])
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+#
+# DAOIO.PY -- Bulk reader and writer for the DAOPHOT fixed-width files
+#
+# phot.daoread() parses the .coo, .lst, .ap, .als and .tot files one line
+# and one field at a time (a string slice and a numpy conversion per value
+# and a structured-array row assignment per star), and phot.sextodao()
+# writes the SE catalog one astropy Row at a time.  With 10k+ sources per
+# chip and the several passes of createpsf() and apcor() this text I/O
+# adds up.
+#
+# Here the file is read in one go and the star lines are packed into one
+# (nstars,width) byte array.  Every fixed-width field is then a column
+# slice of it that is converted to numbers with a single astype() (the
+# two-line .ap records are just the two interleaved line sets).  The
+# writers pull the columns out as lists once and format all of the lines
+# before a single write.  The outputs are identical to the phot functions,
+# which are kept (phot.daoread(fast=False) etc.) as the reference.
+#
+# "python daoio.py --benchmark" writes large synthetic files of all types,
+# checks that the results are identical and prints the throughputs.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import time
+import shutil
+import tempfile
+import logging
+from argparse import ArgumentParser
+from astropy.table import Table
+
+# Column names, fixed widths and types of the single-line formats
+DAOFORMATS = {'coo': ([('ID',np.int64),('X',float),('Y',float),('MAG',float),('SHARP',float),('ROUND',float),('ROUND2',float)],
+                      [7,9,9,9,9,9,9]),
+              'tot': ([('ID',np.int64),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('MAGFAP',float),
+                       ('APCORR',float),('FINALAP',int)],
+                      [7,9,9,9,9,9,9,9,9]),
+              'als': ([('ID',np.int64),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('ITER',float),
+                       ('CHI',float),('SHARP',float)],
+                      [7,9,9,9,9,9,9,9,9]),
+              'lst': ([('ID',np.int64),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float)],
+                      [7,9,9,9,9,9,9])}
+
+# DAOPHOT header, see phot.sextodao()
+HEADER = " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n"
+
+
+def readlines(fil):
+    """ Read the lines of a text file as bytes, without the newlines."""
+    with open(fil,'rb') as f:
+        data = f.read()
+    lines = data.split(b'\n')
+    if len(lines)>0 and lines[-1]==b'': lines = lines[:-1]
+    return lines
+
+
+def fixedwidth(lines,lengths):
+    """ Split lines into fixed-width fields.
+
+    Parameters
+    ----------
+    lines : list
+       The lines (bytes).
+    lengths : list or array
+       The widths of the fields.
+
+    Returns
+    -------
+    fields : list
+       One numpy bytes array per field.
+
+    """
+    lengths = np.array(lengths)
+    lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+    hi = lo+lengths
+    width = int(np.sum(lengths))
+    nlines = len(lines)
+    # Pack all lines into one (nlines,width) byte array, short lines are
+    # padded with NULs which the conversions ignore like the empty slices
+    buf = np.array(lines,dtype='S%d' % width).view(np.uint8).reshape(nlines,width)
+    fields = []
+    for l,h in zip(lo,hi):
+        fields.append(np.ascontiguousarray(buf[:,l:h]).view('S%d' % (h-l)).ravel())
+    return fields
+
+
+def daoread(fil):
+    '''
+    Read DAOPHOT-style files (.coo, .lst, .ap, .als and .tot) into an astropy table.
+    Same as phot.daoread() but all the values of a column are converted at once.
+
+    Parameters
+    ----------
+    fil : str
+        The filename of the DAOPHOT catalog file.
+
+    Returns
+    -------
+    cat : astropy table
+        The DAOPHOT catalog as an astropy table.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cat = daoread("image1.als")
+
+    '''
+
+    # Not enough inputs
+    if fil is None:
+        print("No file name input")
+        return None
+    # Make sure the file exists
+    if os.path.exists(fil) is False:
+        print(fil+" NOT found")
+        return None
+    lines = readlines(fil)
+    nstars = len(lines)-3
+    if nstars == 0:
+        print("No stars in "+fil)
+        return None
+    # Check header
+    nl = int(lines[1].strip().split(b' ')[0])
+    # Check number of columns
+    arr1 = lines[3].split()
+    if len(arr1)==0: arr1 = lines[4].split()
+    ncols = len(arr1)
+
+    # Same file types as phot.daoread()
+    if (nl==1) & (ncols==7):
+        ftype = 'coo'
+    elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
+        ftype = 'tot'
+    elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is False):
+        ftype = 'als'
+    elif nl==2:
+        ftype = 'ap'
+    elif nl==3:
+        ftype = 'lst'
+    else:
+        print("Cannot load this file")
+        return None
+
+    # Single-line formats
+    if ftype != 'ap':
+        cols,lengths = DAOFORMATS[ftype]
+        dtype = np.dtype(cols)
+        cat = np.zeros(nstars,dtype=dtype)
+        fields = fixedwidth(lines[3:],lengths[0:len(cols)])
+        for n,f in zip(dtype.names,fields):
+            cat[n] = f.astype(dtype[n])
+
+    # NL = 2  aperture photometry, two lines per star and a blank one
+    #  ID, X, Y, Mag1, Mag2, etc..
+    #  Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.
+    else:
+        naper = len(lines[4].split())-3
+        nstars = int((len(lines)-3.0)/3.0)
+        dtype = np.dtype([('ID',np.int64),('X',float),('Y',float),('SKY',float),('SKYSIG',float),('SKYSKEW',float),
+                          ('MAG',float,naper),('ERR',float,naper)])
+        cat = np.zeros(nstars,dtype=dtype)
+        fields1 = fixedwidth(lines[4:4+3*nstars:3],[7,9,9]+naper*[9])
+        fields2 = fixedwidth(lines[5:5+3*nstars:3],[14,6,6]+naper*[9])
+        for j,n in enumerate(['ID','X','Y']):
+            cat[n] = fields1[j].astype(dtype[n])
+        for j,n in enumerate(['SKY','SKYSIG','SKYSKEW']):
+            cat[n] = fields2[j].astype(float)
+        for j in range(naper):
+            cat['MAG'][:,j] = fields1[j+3].astype(float)
+            cat['ERR'][:,j] = fields2[j+3].astype(float)
+
+    # Return as astropy Table
+    return Table(cat)
+
+
+def writelines(filename,fmt,columns):
+    """ Format the rows of a list of columns with FMT and write them in one go."""
+    columns = [np.asarray(c).tolist() for c in columns]
+    with open(filename,'a') as f:
+        f.write(''.join([fmt % row for row in zip(*columns)]))
+
+
+def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=None,saturate=None,rdnoise=None,gain=None,
+             lowbad=None,thresh=None,logger=None):
+    '''
+    Write a Source Extractor catalog in a DAOPHOT format (coo, lst, als).
+    Same as phot.sextodao() but the columns are formatted in bulk.
+
+    Parameters
+    ----------
+    cat : numpy structured arrray or astropy Table format
+        The Source Extractor catalog.
+    meta : astropy header
+         The image meta-data dictionary (naxis1, naxis2, saturate, rdnoise, gain, etc.).
+    outfile : str
+            The output filename.
+    format : str, (lst, coo, als)
+           The output DAOPHOT format.
+    naxis1, naxis2, saturate, rdnoise, gain, lowbad, thresh : optional
+           Override the values in `meta`, see phot.sextodao().
+    logger : logger object, optional
+           The Logger to use for logging output.
+
+    Returns
+    -------
+    Nothing is returned.  The catalog is written to `outfile`.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        sextodao(cat,meta,"cat.coo",format="coo")
+
+    '''
+
+    if logger is None: logger = logging.getLogger('phot')
+    # Not enough inputs
+    if cat is None:
+        logger.warning("No catalog input")
+        return
+    if meta is None:
+        logger.warning("No image meta-data dictionary input")
+        return
+    if outfile is None:
+        logger.warning("No outfile given")
+        return
+    # Delete outfile
+    if os.path.exists(outfile): os.remove(outfile)
+
+    # Get meta-data parameters, keyword inputs take priority over "meta"
+    if naxis1 is None: naxis1=meta['NAXIS1']
+    if naxis2 is None: naxis2=meta['NAXIS2']
+    if saturate is None: saturate=meta['SATURATE']
+    if rdnoise is None: rdnoise=meta['RDNOISE']
+    if gain is None: gain=meta['GAIN']
+    if lowbad is None:
+        if meta.get('SKYMED') is not None:
+            skymed = meta['SKYMED']
+            skyrms = meta['SKYRMS']
+            lowbad = skymed-7.*skyrms > 0.0
+            thresh = skyrms*3.5
+        else:
+            logger.info("No sky value found in meta.  Using LOWBAD=1.0")
+            lowbad = 1.0
+    if thresh is None: thresh=20.0
+
+    if format not in ['coo','lst','als']:
+        if format == "ap":
+            logger.warning(".ap files not supported yet")
+        else:
+            logger.warning(format+" NOT supported")
+        return
+
+    # Header
+    with open(outfile,'w') as f:
+        f.write(HEADER)
+        f.write("  3 %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n" %
+                (naxis1,naxis2,lowbad,saturate,thresh,3.0,gain,rdnoise/gain,3.9))
+        f.write("\n")
+
+    # The data
+    nstars = len(cat)
+    const = lambda val: np.zeros(nstars)+val
+    # "coo" file from FIND
+    if format == "coo":
+        writelines(outfile,"%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n",
+                   [cat["NUMBER"],cat["X_IMAGE"],cat["Y_IMAGE"],cat["MAG_AUTO"],const(0.6),const(0.0),const(0.0)])
+    # "lst" file from PICKPSF
+    elif format == "lst":
+        writelines(outfile,"%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n",
+                   [cat["NUMBER"],np.asarray(cat["X_IMAGE"],float)+1,np.asarray(cat["Y_IMAGE"],float)+1,cat["MAG_AUTO"],
+                    cat["MAGERR_AUTO"],const(0.3)])
+    # "als" file from ALLSTAR
+    elif format == "als":
+        writelines(outfile,"%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n",
+                   [cat["NUMBER"],np.asarray(cat["X_IMAGE"],float)+1,np.asarray(cat["Y_IMAGE"],float)+1,cat["MAG_AUTO"],
+                    cat["MAGERR_AUTO"],const(1500.0),const(1),const(1.0),const(0.0)])
+
+
+def aperswrite(filename=None,apertures=None):
+    '''
+    Write a DAOPHOT apertures file, the last two apertures are the inner and outer
+    sky radii.  Same as phot.aperswrite() but with a single write.
+
+    Parameters
+    ----------
+    filename : str
+        The filename for the apertures.
+    apertures : list or array
+        The array of apertures.
+
+    Returns
+    -------
+    Nothing is returned but the apertures file is created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        aperswrite("photo.opt",apertures)
+
+    '''
+    # Not enough inputs
+    if filename is None:
+        print("No file name input")
+        return
+    if apertures is None:
+        print("No apertures input")
+        return
+    nap = len(apertures)
+    if nap<3:
+        print("Only "+str(nap)+" apertures input.  Need at least 3")
+        return
+    # Hexidecimal aperture ids, A1, A2, ..., AF, B0, ...
+    ids = [hex(160+i+1)[2:].capitalize() for i in range(nap-2)]+['IS','OS']
+    with open(filename,'w') as f:
+        f.write(''.join(["%2s = %7.4f\n" % (i,a) for i,a in zip(ids,apertures)]))
+
+
+def simfiles(outdir,nstars=20000,naper=12,seed=1):
+    """ Write synthetic DAOPHOT files of all types in the real fixed-width layouts.
+
+    Returns a dictionary of filenames and the synthetic SE catalog.
+    """
+    rnd = np.random.RandomState(seed)
+    ids = np.sort(rnd.choice(np.arange(1,10*nstars),nstars,replace=False))
+    x = rnd.uniform(1,2046,nstars)
+    y = rnd.uniform(1,4094,nstars)
+    mag = rnd.uniform(10,22,nstars)
+    err = 0.001*10**(0.2*(mag-10))
+    sky = rnd.normal(1600,10,nstars)
+    hdr = "  1  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n"
+    files = {}
+
+    def write(name,nl,rows):
+        filename = os.path.join(outdir,name)
+        with open(filename,'w') as f:
+            f.write(HEADER+hdr.replace('  1 ','  %d ' % nl,1))
+            f.write(''.join(rows))
+        files[name[name.rfind('.')+1:]] = filename
+
+    write('flux.coo',1,["%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n" % r for r in
+                        zip(ids,x,y,mag-25,rnd.uniform(0,1,nstars),rnd.uniform(-1,1,nstars),rnd.uniform(-1,1,nstars))])
+    write('flux.lst',3,["%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n" % r for r in zip(ids,x,y,mag,err,sky)])
+    write('flux.als',1,["%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n" % r for r in
+                        zip(ids,x,y,mag,err,sky,rnd.randint(2,20,nstars).astype(float),rnd.uniform(0.5,3,nstars),
+                            rnd.uniform(-1,1,nstars))])
+    write('flux.tot',1,["%7d %8.3f %8.3f %8.4f %8.4f %8.3f %8.3f %8.4f %8d\n" % r for r in
+                        zip(ids,x,y,mag,err,sky,mag+0.05,np.zeros(nstars)-0.069,rnd.randint(1,naper+1,nstars))])
+    # Two-line aperture photometry records
+    rows = []
+    for i in range(nstars):
+        amag = mag[i]+np.linspace(0.8,0,naper)
+        aerr = np.minimum(err[i]*np.linspace(2,1,naper),9.9999)
+        bad = amag>21.5
+        amag[bad],aerr[bad] = 99.999,9.9999
+        rows.append(("\n%7d %8.3f %8.3f" % (ids[i],x[i],y[i]))+''.join([" %8.3f" % m for m in amag])+"\n")
+        rows.append(("%14.3f %5.2f %5.2f" % (sky[i],rnd.uniform(5,30),rnd.uniform(0,1)))+''.join([" %8.4f" % e for e in aerr])+"\n")
+    write('flux.ap',2,rows)
+
+    # SE catalog for sextodao
+    secat = Table()
+    secat['NUMBER'] = ids
+    secat['X_IMAGE'] = x-1
+    secat['Y_IMAGE'] = y-1
+    secat['MAG_AUTO'] = mag
+    secat['MAGERR_AUTO'] = err
+    return files, secat
+
+
+def benchmark(nstars=20000,naper=12,nrepeat=3,tmpdir=None):
+    """ Throughput of the phot.py line-by-line readers/writers and of the bulk ones.
+
+    The outputs are checked to be identical.
+    """
+    import phot
+    # phot.daoread() uses the python 2 "long"
+    if not hasattr(phot,'long'): phot.long = int
+    outdir = tempfile.mkdtemp(prefix='daoio',dir=tmpdir)
+    ok = True
+    try:
+        files,secat = simfiles(outdir,nstars,naper)
+        secat['X_IMAGE'] = secat['X_IMAGE'].astype(np.float32)
+        secat['Y_IMAGE'] = secat['Y_IMAGE'].astype(np.float32)
+        secat['MAG_AUTO'] = secat['MAG_AUTO'].astype(np.float32)
+        secat['MAGERR_AUTO'] = secat['MAGERR_AUTO'].astype(np.float32)
+        meta = {'NAXIS1':2046,'NAXIS2':4094,'SATURATE':38652.0,'RDNOISE':6.0,'GAIN':3.9,'SKYMED':1600.,'SKYRMS':10.}
+        logger = logging.getLogger('daoio')
+        print('%d stars, %d apertures' % (nstars,naper))
+        print('%-12s %8s %10s %10s %8s %6s' % ('','MB','old s','new s','speedup','same'))
+
+        def timeit(func,*args,**kwargs):
+            best = np.inf
+            for i in range(nrepeat):
+                t0 = time.time()
+                out = func(*args,**kwargs)
+                best = min(best,time.time()-t0)
+            return out,best
+
+        # Readers
+        for ext in ['coo','lst','als','tot','ap']:
+            mb = os.path.getsize(files[ext])/1e6
+            old,told = timeit(phot.daoread,files[ext],fast=False)
+            new,tnew = timeit(daoread,files[ext])
+            same = (old is not None) and (old.colnames==new.colnames) and (len(old)==len(new))
+            if same:
+                for n in old.colnames:
+                    same &= (old[n].dtype==new[n].dtype) and np.array_equal(np.asarray(old[n]),np.asarray(new[n]))
+            ok &= same
+            print('%-12s %8.2f %10.3f %10.3f %7.1fx %6s' % ('read .'+ext,mb,told,tnew,told/tnew,same))
+
+        # Writers
+        for fmt in ['coo','lst','als']:
+            oldfile = os.path.join(outdir,'old.'+fmt)
+            newfile = os.path.join(outdir,'new.'+fmt)
+            dum,told = timeit(phot.sextodao,secat,meta,oldfile,format=fmt,logger=logger,fast=False)
+            dum,tnew = timeit(sextodao,secat,meta,newfile,format=fmt,logger=logger)
+            same = open(oldfile,'rb').read()==open(newfile,'rb').read()
+            ok &= same
+            mb = os.path.getsize(newfile)/1e6
+            print('%-12s %8.2f %10.3f %10.3f %7.1fx %6s' % ('sextodao '+fmt,mb,told,tnew,told/tnew,same))
+        apers = [3.0,3.7965,4.2431,4.6923,5.0,5.3941,5.8970,6.5,7.0,7.5,8.0,8.5,10.0,15.0,20.0]
+        phot.aperswrite(os.path.join(outdir,'old.opt'),apers,fast=False)
+        aperswrite(os.path.join(outdir,'new.opt'),apers)
+        same = open(os.path.join(outdir,'old.opt')).read()==open(os.path.join(outdir,'new.opt')).read()
+        ok &= same
+        print('%-12s %48s' % ('aperswrite',same))
+    finally:
+        shutil.rmtree(outdir)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the bulk DAOPHOT file reader and writer.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nstars', type=int, default=20000, help='Number of stars per file')
+    parser.add_argument('--naper', type=int, default=12, help='Number of apertures in the .ap file')
+    parser.add_argument('--nrepeat', type=int, default=3, help='Number of timing repeats')
+    args = parser.parse_args()
+    benchmark(args.nstars,args.naper,args.nrepeat)
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+#
+# DAOSESSION.PY -- Persistent DAOPHOT/ALLSTAR processes for the phot.py wrappers
+#
+# daofind(), daoaperphot(), daopickpsf(), daopsf(), subpsfnei(), allstar()
+# and daogrow() in phot.py each write a heredoc shell script and run it, so
+# every stage starts a shell and a new DAOPHOT (or ALLSTAR) that reads
+# daophot.opt and prints its banner again.  createpsf() does this up to
+# maxiter+2 times per chip and apcor() another three to five times.
+#
+# DaoSession keeps one DAOPHOT and one ALLSTAR process alive per chip and
+# sends them the same input lines over pipes.  The lines come from the
+# wrappers unchanged (phot.py passes its script text to runscript()), the
+# output is appended to the same logfiles, so the parsing of the logs and
+# output files in phot.py is not touched.  A stage is done when the
+# program is back at its ready prompt ("Command:" for DAOPHOT, "Input image
+# name:" for ALLSTAR).  DAOGROW cannot loop over images and is run directly
+# without the shell.  With ramdisk=True the session works in a scratch
+# directory in /dev/shm, the inputs are linked in and only the products
+# listed in "exports" are copied back to the chip directory.
+#
+# The prompt protocol has only been checked against the stub programs of
+# daostub.py, so nsc_instcal_sexdaophot.py uses a session only with
+# --session, not by default.
+#
+# "python daosession.py --benchmark" runs the wrappers with and without a
+# session on a synthetic chip against the stub executable of daostub.py,
+# which speaks the same prompt protocol, and reports the per-stage latency
+# and the number of processes started.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import time
+import glob
+import shutil
+import select
+import tempfile
+import subprocess
+import logging
+from argparse import ArgumentParser
+
+# DAOPHOT commands that are answered by a new "Command:" prompt
+DAOCOMMANDS = ['OPTIONS','ATTACH','FIND','PHOTOMETRY','PICKPSF','PSF','GROUP','NSTAR','SUBSTAR','SKY','PEAK',
+               'ADDSTAR','SORT','SELECT','OFFSET','APPEND','DUMP','FUDGE','LIST','MONITOR','NOMONITOR','HELP']
+
+# Ready prompts
+PROMPTS = {'daophot':b'Command:', 'allstar':b'Input image name:', 'allstaropt':b'OPT>'}
+
+
+def ramdir():
+    """ Directory on a RAM disk for the scratch files, the default temporary directory if there is none."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def parsescript(lines):
+    """ Program name, logfile and input lines of a phot.py heredoc script
+        ("#!/bin/sh", "prog << END >> logfile", input lines, "END").
+        The EXIT lines at the end are dropped."""
+    if not isinstance(lines,str): lines = ''.join(lines)
+    lines = lines.splitlines(True)
+    arr = lines[1].split()
+    prog = arr[0]
+    marker = arr[2]
+    logfile = arr[4] if len(arr)>4 else None
+    inputs = []
+    for l in lines[2:]:
+        if l.strip()==marker: break
+        inputs.append(l)
+    while len(inputs)>0 and inputs[-1].strip().upper()=='EXIT':
+        inputs.pop()
+    return prog, logfile, inputs
+
+
+class Program:
+    """ An interactive program on pipes.  The output is read until a prompt."""
+
+    def __init__(self,cmd,timeout=1800.0):
+        env = os.environ.copy()
+        # gfortran block-buffers output to pipes, the prompts would never arrive
+        env['GFORTRAN_UNBUFFERED_PRECONNECTED'] = 'y'
+        self.cmd = cmd
+        self.cwd = os.getcwd()
+        self.timeout = timeout
+        self.proc = subprocess.Popen([cmd],stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                                     bufsize=0,env=env,close_fds=True)
+        self.fd = self.proc.stdout.fileno()
+        self.eof = False
+
+    def alive(self):
+        return (self.eof is False) and (self.proc.poll() is None) and (os.getcwd()==self.cwd)
+
+    def send(self,lines):
+        try:
+            self.proc.stdin.write(''.join(lines).encode())
+            self.proc.stdin.flush()
+        except (IOError,OSError):
+            self.eof = True
+
+    def read(self,wait):
+        """ Read what is available within WAIT seconds."""
+        out = b''
+        while True:
+            r,w,x = select.select([self.fd],[],[],wait)
+            if len(r)==0: break
+            chunk = os.read(self.fd,65536)
+            if len(chunk)==0:
+                self.eof = True
+                break
+            out += chunk
+            wait = 0.0
+        return out
+
+    def expect(self,prompt,count=1,settle=0.0):
+        """ Read the output until it has COUNT prompts and ends with one.  With SETTLE, the
+            output also has to be quiet for that many seconds (for input lines that might be
+            answered by an extra prompt).  Returns the output and whether the prompt was reached."""
+        out = b''
+        t0 = time.time()
+        while True:
+            if (out.count(prompt)>=count) and out.rstrip().endswith(prompt):
+                if settle<=0: return out, True
+                more = self.read(settle)
+                if len(more)==0: return out, True
+                out += more
+                continue
+            if self.eof: return out, False
+            left = self.timeout-(time.time()-t0)
+            if left<=0: return out, False
+            out += self.read(min(left,1.0))
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except (IOError,OSError):
+                pass
+            t0 = time.time()
+            while (self.proc.poll() is None) and (time.time()-t0<2.0):
+                time.sleep(0.01)
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc.stdout.close()
+
+
+class DaoSession:
+    """ Persistent DAOPHOT and ALLSTAR processes for one chip.
+
+    Parameters
+    ----------
+    ramdisk : bool, optional
+       Work in a scratch directory on a RAM disk (see ramdir()).  Default is False,
+       the programs run in the current directory.
+    inputs : list, optional
+       Files that are linked into the scratch directory.
+    exports : list, optional
+       Filenames or glob patterns of the products copied back from the scratch
+       directory when the session is closed.
+    timeout : float, optional
+       Seconds to wait for a program to get back to its prompt.  Default is 1800.
+    daophot, allstar, daogrow : str, optional
+       The program names.
+    logger : logger object, optional
+       The Logger to use for logging output.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        with DaoSession(ramdisk=True,inputs=['F1_dao.fits','F1_dao.opt'],exports=['F1_dao.psf','*.log']) as session:
+            apcat, maglim = daoaperphot('F1_dao.fits','F1_dao.coo',session=session)
+            createpsf('F1_dao.fits','F1_dao.ap','F1_dao.lst',session=session)
+
+    """
+
+    def __init__(self,ramdisk=False,inputs=None,exports=None,timeout=1800.0,daophot='daophot',allstar='allstar',
+                 daogrow='daogrow',logger=None):
+        self.ramdisk = ramdisk
+        self.inputs = inputs if inputs is not None else []
+        self.exports = exports if exports is not None else []
+        self.timeout = timeout
+        self.commands = {'daophot':daophot, 'allstar':allstar, 'daogrow':daogrow}
+        self.logger = logger
+        self.programs = {}
+        self.alsoptions = None
+        self.lastlog = None
+        self.workdir = None
+        self.origdir = None
+        # Statistics
+        self.nspawn = 0
+        self.stats = []
+
+    def __repr__(self):
+        return 'DaoSession(%d stages, %d processes started%s)' % (len(self.stats),self.nspawn,
+                                                                 ', '+self.workdir if self.workdir else '')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def open(self):
+        """ Go to the scratch directory (with ramdisk=True) and link the inputs."""
+        if self.ramdisk is False: return
+        self.origdir = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='dao',dir=ramdir())
+        for f in self.inputs:
+            if os.path.exists(f) is False: continue
+            os.symlink(os.path.abspath(f),os.path.join(self.workdir,os.path.basename(f)))
+        os.chdir(self.workdir)
+        if self.logger is not None: self.logger.info('DAOPHOT session in '+self.workdir)
+
+    def close(self):
+        """ Stop the programs, copy the exports back and remove the scratch directory."""
+        self.drain()
+        for name in list(self.programs.keys()):
+            self.programs.pop(name).close()
+        if self.workdir is None: return
+        os.chdir(self.origdir)
+        for pattern in self.exports:
+            for f in glob.glob(os.path.join(self.workdir,pattern)):
+                if os.path.islink(f): continue
+                outfile = os.path.join(self.origdir,os.path.basename(f))
+                if os.path.exists(outfile): os.remove(outfile)
+                shutil.copyfile(f,outfile)
+        shutil.rmtree(self.workdir)
+        self.workdir = None
+
+    def program(self,name):
+        """ The running program NAME, started if necessary."""
+        prog = self.programs.get(name)
+        if prog is not None and prog.alive() is False:
+            prog.close()
+            prog = None
+        if prog is None:
+            prog = Program(self.commands[name],self.timeout)
+            self.programs[name] = prog
+            self.nspawn += 1
+        return prog
+
+    def drain(self):
+        """ Output that arrived after the last stage goes to its logfile."""
+        for prog in self.programs.values():
+            if prog.eof: continue
+            out = prog.read(0.0)
+            if len(out)>0 and self.lastlog is not None: self.writelog(self.lastlog,out)
+
+    def writelog(self,logfile,out):
+        if logfile is None: return
+        f = open(logfile,'ab')
+        f.write(out)
+        f.close()
+
+    def runscript(self,lines,logfile=None):
+        """ Send the input lines of a phot.py DAOPHOT, ALLSTAR or DAOGROW script to the programs.
+
+        Parameters
+        ----------
+        lines : str or list
+           The script as written by the phot.py wrappers.
+        logfile : str, optional
+           The logfile for the output, by default the one the script redirects to.
+
+        """
+        prog, slogfile, inputs = parsescript(lines)
+        if logfile is None: logfile = slogfile
+        t0 = time.time()
+        self.drain()
+        if prog=='daophot':
+            stage = self.rundaophot(inputs,logfile)
+        elif prog=='allstar':
+            stage = self.runallstar(inputs,logfile)
+        elif prog=='daogrow':
+            stage = self.rundaogrow(inputs,logfile)
+        else:
+            raise ValueError(prog+' is not a DAOPHOT program')
+        self.lastlog = logfile
+        dt = time.time()-t0
+        self.stats.append((prog,stage,dt))
+        if self.logger is not None: self.logger.info('%s %s in %.3f sec' % (prog,stage,dt))
+
+    def rundaophot(self,inputs,logfile):
+        cmds = [l.split()[0].upper() for l in inputs if len(l.split())>0 and l.split()[0].upper() in DAOCOMMANDS]
+        stage = '+'.join([c for c in cmds if c not in ['OPTIONS','ATTACH']])
+        # Blank answers after the last command could be taken as an empty command
+        lastcmd = max([i for i,l in enumerate(inputs) if len(l.split())>0 and l.split()[0].upper() in DAOCOMMANDS]+[0])
+        settle = 0.02 if np.any([l.strip()=='' for l in inputs[lastcmd+1:]]) else 0.0
+        new = ('daophot' not in self.programs) or (self.programs['daophot'].alive() is False)
+        prog = self.program('daophot')
+        out = b''
+        if new:
+            out, ready = prog.expect(PROMPTS['daophot'])
+        prog.send(inputs)
+        out1, ready = prog.expect(PROMPTS['daophot'],len(cmds),settle=settle)
+        self.writelog(logfile,out+out1)
+        if ready is False: self.failed(prog,'daophot',stage)
+        return stage
+
+    def runallstar(self,inputs,logfile):
+        # The options are only asked for once, at the start
+        iblank = [l.strip() for l in inputs].index('')
+        options = inputs[0:iblank+1]
+        names = inputs[iblank+1:]
+        if (options != self.alsoptions) and ('allstar' in self.programs):
+            self.programs.pop('allstar').close()
+        new = ('allstar' not in self.programs) or (self.programs['allstar'].alive() is False)
+        prog = self.program('allstar')
+        out = b''
+        if new:
+            out, ready = prog.expect(PROMPTS['allstaropt'])
+            prog.send(options)
+            out1, ready = prog.expect(PROMPTS['allstar'])
+            out += out1
+            self.alsoptions = options
+        prog.send(names)
+        # The ready prompt for the next image, or the end of ALLSTAR if it does not loop
+        out1, ready = prog.expect(PROMPTS['allstar'])
+        self.writelog(logfile,out+out1)
+        if ready is False and prog.eof is False: self.failed(prog,'allstar','ALLSTAR')
+        return 'ALLSTAR'
+
+    def rundaogrow(self,inputs,logfile):
+        f = open(logfile,'ab') if logfile is not None else open(os.devnull,'wb')
+        proc = subprocess.Popen([self.commands['daogrow']],stdin=subprocess.PIPE,stdout=f,stderr=subprocess.STDOUT,
+                                close_fds=True)
+        self.nspawn += 1
+        proc.communicate(''.join(inputs).encode())
+        f.close()
+        return 'DAOGROW'
+
+    def failed(self,prog,name,stage):
+        """ Kill a program that did not get back to its prompt, the next stage starts a new one."""
+        if self.logger is not None: self.logger.error(name+' '+stage+' did not finish')
+        self.programs.pop(name,None)
+        prog.close()
+
+    def summary(self):
+        """ Per-stage number of calls and time."""
+        lines = ['%-10s %-20s %6s %10s %10s' % ('program','stage','calls','total s','mean ms')]
+        keys = []
+        for s in self.stats:
+            if (s[0],s[1]) not in keys: keys.append((s[0],s[1]))
+        for k in keys:
+            dt = [s[2] for s in self.stats if (s[0],s[1])==k]
+            lines.append('%-10s %-20s %6d %10.3f %10.1f' % (k[0],k[1],len(dt),np.sum(dt),1e3*np.mean(dt)))
+        lines.append('%d stages, %d processes started' % (len(self.stats),self.nspawn))
+        return '\n'.join(lines)
+
+
+def lastpid():
+    """ The most recently assigned process ID."""
+    return int(open('/proc/loadavg').read().split()[-1])
+
+
+def benchmark(nstars=300,nx=1024,ny=2048,tmpdir=None):
+    """ Run the DAOPHOT stages of Chip.process() with the script wrappers and with a session
+    (on a RAM disk) against the stub programs.  The products have to be identical.
+    """
+    import phot
+    import daostub
+    # phot.daoread(fast=False) uses the python 2 "long"
+    if not hasattr(phot,'long'): phot.long = int
+    logger = logging.getLogger('daosession')
+    outroot = tempfile.mkdtemp(prefix='daosession',dir=tmpdir)
+    curdir = os.getcwd()
+    oldpath = os.environ['PATH']
+    ok = True
+    try:
+        bindir = os.path.join(outroot,'bin')
+        os.mkdir(bindir)
+        daostub.mkstub(bindir)
+        os.environ['PATH'] = bindir+os.pathsep+oldpath
+        countfile = os.path.join(outroot,'count.txt')
+        os.environ['DAOSTUB_COUNT'] = countfile
+        meta = {'DATE-OBS':'2016-03-01T03:04:05.6','exptime':90.0,'airmass':1.2}
+        products = ['flux_dao.ap','flux_dao.lst','flux_dao.psf','flux_dao.als','flux_daoa.ap','flux_daoa.als','flux_daoa.tot']
+        results = {}
+        for mode in ['script','session']:
+            wdir = os.path.join(outroot,mode)
+            os.mkdir(wdir)
+            daostub.simchip(wdir,nstars,nx,ny)
+            os.chdir(wdir)
+            if os.path.exists(countfile): os.remove(countfile)
+            stages = []
+            pid0 = lastpid()
+            t0 = time.time()
+
+            def stage(name,func,*args,**kwargs):
+                t1 = time.time()
+                out = func(*args,**kwargs)
+                stages.append((name,time.time()-t1))
+                return out
+
+            def run(session):
+                apcat, maglim = stage('daoaperphot',phot.daoaperphot,'flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',
+                                      logger=logger,session=session)
+                stage('daopickpsf',phot.daopickpsf,'flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,
+                      logger=logger,session=session)
+                stage('createpsf',phot.createpsf,'flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,logger=logger,
+                      session=session)
+                stage('allstar',phot.allstar,'flux_dao.fits','flux_dao.psf','flux_dao.ap',outfile='flux_dao.als',
+                      logger=logger,session=session)
+                return stage('apcor',phot.apcor,'flux_daoa.fits','flux_dao.lst','flux_dao.psf',meta,optfile='flux_dao.opt',
+                             alsoptfile='flux_dao.als.opt',logger=logger,session=session)
+
+            if mode=='script':
+                apcorr = run(None)
+                summary = None
+            else:
+                session = DaoSession(ramdisk=True,inputs=['flux_dao.fits','flux_dao.coo','flux_dao.opt','flux_dao.als.opt'],
+                                     exports=products+['*.log'],logger=logger)
+                with session:
+                    apcorr = run(session)
+                summary = session.summary()
+            dt = time.time()-t0
+            npid = lastpid()-pid0
+            nprog = len(open(countfile).readlines())
+            results[mode] = {'time':dt,'stages':stages,'pids':npid,'programs':nprog,'apcorr':apcorr,'summary':summary,
+                             'files':dict([(f,open(f,'rb').read()) for f in products if os.path.exists(f)])}
+            os.chdir(curdir)
+
+        same = True
+        for f in products:
+            s = (f in results['script']['files']) and (results['script']['files'].get(f)==results['session']['files'].get(f))
+            if s is False: print(f+' differs')
+            same &= s
+        same &= (results['script']['apcorr']==results['session']['apcorr'])
+        ok &= same
+        ok &= (results['session']['programs']<results['script']['programs'])
+
+        print('%d stars, %dx%d chip' % (nstars,nx,ny))
+        print('%-12s %10s %10s' % ('stage','script ms','session ms'))
+        for (n1,t1),(n2,t2) in zip(results['script']['stages'],results['session']['stages']):
+            print('%-12s %10.1f %10.1f' % (n1,1e3*t1,1e3*t2))
+        for k in ['script','session']:
+            r = results[k]
+            print('%-8s %7.3fs  %3d DAOPHOT/ALLSTAR/DAOGROW runs  %4d PIDs used  apcorr=%.4f' %
+                  (k,r['time'],r['programs'],r['pids'],r['apcorr']))
+        print(results['session']['summary'])
+        print('same products and aperture correction = %s' % same)
+    finally:
+        os.chdir(curdir)
+        os.environ['PATH'] = oldpath
+        if 'DAOSTUB_COUNT' in os.environ: del os.environ['DAOSTUB_COUNT']
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the persistent DAOPHOT/ALLSTAR session.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nstars', type=int, default=300, help='Number of stars')
+    parser.add_argument('--nx', type=int, default=1024, help='Chip X size')
+    parser.add_argument('--ny', type=int, default=2048, help='Chip Y size')
+    args = parser.parse_args()
+    benchmark(args.nstars,args.nx,args.ny)
@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+#
+# DAOSTUB.PY -- Stub DAOPHOT/ALLSTAR/DAOGROW/SExtractor and synthetic chips for tests and benchmarks
+#
+# The benchmarks of daosession.py, psfcache.py, stagelog.py and
+# batchapcor.py (and the tests) run the phot.py wrappers without the real
+# fortran programs.  mkstub() puts a python stand-in for daophot, allstar
+# and daogrow in a directory that is then put first in the PATH, and
+# simchip()/addstars() make the synthetic images it works on.  Setting
+# DAOSTUB_COUNT to a file name makes every stub program append its name to
+# that file, to count the program starts.  mksex() adds the SExtractor
+# stand-in used by the chippool.py and sexconfig.py benchmarks.
+
+from __future__ import print_function
+
+import os
+import sys
+import numpy as np
+
+
+# Stand-in for daophot, allstar and daogrow (chosen by the program name).  It asks for
+#  the same inputs in the same order, prompts without a newline like the fortran
+#  programs, and writes small deterministic files in the DAOPHOT layouts.  PSF
+#  fits the analytic models (all of them with AN<0, else only model AN) to the
+#  stamps of the PSF stars of the attached image, so its chi values and profile
+#  errors follow the image and the star list.  PHOTOMETRY measures the apertures,
+#  ALLSTAR fits the PSF amplitudes (scaled to aperture 1 like psf.f), SUBSTAR
+#  subtracts the PSF neighbors and DAOGROW builds an empirical growth curve, so
+#  the aperture corrections are real too.
+STUB = r'''#!%(python)s
+import os, sys, shutil
+import numpy as np
+prog = os.path.basename(sys.argv[0])
+if os.environ.get('DAOSTUB_COUNT'):
+    with open(os.environ['DAOSTUB_COUNT'],'a') as f: f.write(prog+'\n')
+HEADER = " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n"
+HEAD2 = "  %%d  2046  4094   117.7 38652.0   13.12    3.00    3.91    1.55    6.00\n\n"
+
+def out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def ask(prompt):
+    out(prompt)
+    line = sys.stdin.readline()
+    if line == '': sys.exit(0)
+    return line.strip()
+
+def readstars(fil):
+    lines = open(fil).readlines()
+    nl = int(lines[1].split()[0])
+    body = lines[4::3] if nl == 2 else [l for l in lines[3:] if l.strip() != '']
+    return [(int(l.split()[0]),float(l.split()[1]),float(l.split()[2]),float(l.split()[3])) for l in body]
+
+def write(fil,nl,rows):
+    with open(fil,'w') as f:
+        f.write(HEADER+HEAD2 %% nl+''.join(rows))
+
+def lst(stars):
+    return ["%%7d%%9.3f%%9.3f%%9.3f%%9.4f%%9.3f\n" %% (s[0],s[1],s[2],s[3],0.01,1600.0) for s in stars]
+
+MODELS = ['GAUSSIAN','MOFFAT15','MOFFAT25','LORENTZ','PENNY1','PENNY2']
+IMAGES = {}
+
+def options(lines,opts):
+    for l in lines:
+        arr = l.split('=')
+        if len(arr) == 2:
+            try:
+                opts[arr[0].strip().upper()[0:2]] = float(arr[1])
+            except ValueError:
+                pass
+
+def profile(model,r2,w):
+    g = np.exp(-0.6931*r2/w**2)
+    l = 1.0/(1.0+r2/w**2)
+    return {1:g, 2:(1.0+0.5874*r2/w**2)**-1.5, 3:(1.0+0.3195*r2/w**2)**-2.5, 4:l,
+            5:0.75*g+0.25*l, 6:0.5*g+0.5*l}[model]
+
+def getimage(image):
+    key = (image,os.path.getmtime(image))
+    if key not in IMAGES:
+        from astropy.io import fits
+        IMAGES[key] = fits.getdata(image).astype(float)
+    return IMAGES[key]
+
+def readap(fil):
+    # ID, X, Y, magnitudes and errors of all apertures, and sky of an NL=2 file
+    lines = open(fil).readlines()[4:]
+    rows = []
+    for i in range(0,len(lines)-1,3):
+        a, b = lines[i].split(), lines[i+1].split()
+        rows.append((int(a[0]),float(a[1]),float(a[2]),[float(v) for v in a[3:]],[float(v) for v in b[3:]],float(b[0])))
+    return rows
+
+def aperphot(image,stars,radii,inner,outer,opts):
+    # Aperture sums with linear partial-pixel weights less the median sky of the
+    #  inner-outer annulus, in chunks of stars to keep the stamps small
+    data = getimage(image)
+    rad = int(np.ceil(max(max(radii),outer)))+1
+    pad = np.pad(data,rad,mode='constant',constant_values=np.nan)
+    yy,xx = np.mgrid[-rad:rad+1,-rad:rad+1]
+    gain = opts.get('GA',1.0)
+    x = np.array([s[1] for s in stars])-1
+    y = np.array([s[2] for s in stars])-1
+    n = len(stars)
+    mags = np.zeros((n,len(radii)))+99.999
+    errs = np.zeros((n,len(radii)))+9.9999
+    sky = np.zeros(n)
+    skysig = np.zeros(n)
+    for i0 in range(0,n,100):
+        ix = np.round(x[i0:i0+100]).astype(int)
+        iy = np.round(y[i0:i0+100]).astype(int)
+        st = pad[(iy+rad)[:,None,None]+yy[None,:,:],(ix+rad)[:,None,None]+xx[None,:,:]]
+        r = np.sqrt((xx[None,:,:]-(x[i0:i0+100]-ix)[:,None,None])**2+(yy[None,:,:]-(y[i0:i0+100]-iy)[:,None,None])**2)
+        ann = np.where((r >= inner) & (r <= outer),st,np.nan).reshape(len(ix),-1)
+        nann = np.maximum(np.sum(np.isfinite(ann),axis=1),1)
+        s = np.nanmedian(ann,axis=1)
+        ss = np.nanstd(ann,axis=1)
+        sky[i0:i0+100] = s
+        skysig[i0:i0+100] = ss
+        for k,ap in enumerate(radii):
+            w = np.clip(ap-r+0.5,0,1)
+            inside = np.all(np.isfinite(st) | (w == 0),axis=(1,2))
+            area = w.sum(axis=(1,2))
+            f = np.nansum(w*(st-s[:,None,None]),axis=(1,2))
+            ok = inside & (f > 0)
+            fok = np.where(ok,f,1.0)
+            mags[i0:i0+100,k] = np.where(ok,25-2.5*np.log10(fok),99.999)
+            e = 1.0857*np.sqrt(np.maximum(f,0)/gain+area*ss**2*(1+area/nann))/fok
+            errs[i0:i0+100,k] = np.where(ok,np.minimum(e,9.9999),9.9999)
+    return mags, errs, sky, skysig
+
+def psffit(image,stars,opts):
+    # Least-squares amplitude of each analytic model on the star stamps over a grid of
+    #  half-widths.  AN<0 tries models 1..|AN|, AN>0 only that model (like psf.f).
+    data = getimage(image)
+    ny,nx = data.shape
+    fw = opts.get('FW',4.0)
+    fi = opts.get('FI',fw)
+    rad = int(np.ceil(fi))+int(np.ceil(2*fw))
+    an = int(opts.get('AN',-6))
+    models = [abs(an)] if an > 0 else list(range(1,abs(an)+1))
+    x = np.array([s[1] for s in stars])-1
+    y = np.array([s[2] for s in stars])-1
+    ix = np.clip(np.round(x).astype(int),rad,nx-rad-1)
+    iy = np.clip(np.round(y).astype(int),rad,ny-rad-1)
+    yy,xx = np.mgrid[-rad:rad+1,-rad:rad+1]
+    stamps = data[iy[:,None,None]+yy[None,:,:],ix[:,None,None]+xx[None,:,:]]
+    border = np.concatenate([stamps[:,0,:],stamps[:,-1,:],stamps[:,:,0],stamps[:,:,-1]],axis=1)
+    d = stamps-np.median(border,axis=1)[:,None,None]
+    r2 = (xx[None,:,:]-(x-ix)[:,None,None])**2+(yy[None,:,:]-(y-iy)[:,None,None])**2
+    disk = (r2 <= fi**2)
+    ndisk = np.maximum(disk.sum(axis=(1,2)),1)
+    satur = stamps.max(axis=(1,2)) > opts.get('HI',1e30)
+    results = []
+    best = None
+    for m in models:
+        mbest = None
+        for w in 0.5*fw*np.linspace(0.6,1.6,21):
+            p = profile(m,r2,w)*disk
+            a = (p*d).sum(axis=(1,2))/(p*p).sum(axis=(1,2))
+            rms = np.sqrt((((d-a[:,None,None]*p)*disk)**2).sum(axis=(1,2))/ndisk)
+            sig = np.where(a > 0,np.minimum(rms/np.maximum(a,1e-10),9.999),9.999)
+            chi = np.sqrt(np.mean(sig[~satur]**2)) if np.sum(~satur) > 0 else 9.999
+            if mbest is None or chi < mbest[0]: mbest = (chi,w,sig,a)
+        results.append(mbest[0:2])
+        if best is None or mbest[0] < best[1]: best = (m,mbest[0],mbest[1],mbest[2],mbest[3])
+    model, chi, width, sig, amp = best
+    med = np.median(sig[~satur]) if np.sum(~satur) > 0 else 1.0
+    flag = ['saturated' if satur[i] else ('*' if sig[i] > 3*med else ('?' if sig[i] > 2*med else ''))
+            for i in range(len(stars))]
+    return results, MODELS[model-1], chi, width, sig, flag, amp
+
+def readpsf(fil):
+    head = open(fil).readline().split()
+    return head[0], float(head[5]), float(head[7])
+
+def substar(image,stars,psf,opts,outfile):
+    # Subtract the scaled PSF model of each star out to the PSF radius
+    from astropy.io import fits
+    data = getimage(image).copy()
+    ny,nx = data.shape
+    model, width, norm = psf
+    rad = int(np.ceil(opts.get('PS',4*opts.get('FW',4.0))))
+    yy,xx = np.mgrid[-rad:rad+1,-rad:rad+1]
+    for s in stars:
+        ix, iy = int(round(s[1]-1)), int(round(s[2]-1))
+        x0, x1, y0, y1 = max(ix-rad,0), min(ix+rad+1,nx), max(iy-rad,0), min(iy+rad+1,ny)
+        if (x0 >= x1) or (y0 >= y1) or (s[3] > 90): continue
+        r2 = (xx+ix-(s[1]-1))**2+(yy+iy-(s[2]-1))**2
+        p = profile(MODELS.index(model)+1,r2,width)*(r2 <= rad**2)
+        data[y0:y1,x0:x1] -= 10**(-0.4*(s[3]-25))/norm*p[y0-iy+rad:y1-iy+rad,x0-ix+rad:x1-ix+rad]
+    fits.writeto(outfile,data.astype(np.float32),fits.getheader(image),overwrite=True)
+
+def psfphot(image,stars,model,width,opts):
+    # Amplitude of the PSF model within the fitting radius on the stamp of each star,
+    #  with the sky from the stamp border
+    data = getimage(image)
+    ny,nx = data.shape
+    fi = opts.get('FI',4.0)
+    rad = int(np.ceil(fi))+2
+    x = np.array([s[1] for s in stars])-1
+    y = np.array([s[2] for s in stars])-1
+    ix = np.clip(np.round(x).astype(int),rad,nx-rad-1)
+    iy = np.clip(np.round(y).astype(int),rad,ny-rad-1)
+    yy,xx = np.mgrid[-rad:rad+1,-rad:rad+1]
+    stamps = data[iy[:,None,None]+yy[None,:,:],ix[:,None,None]+xx[None,:,:]]
+    border = np.concatenate([stamps[:,0,:],stamps[:,-1,:],stamps[:,:,0],stamps[:,:,-1]],axis=1)
+    sky = np.median(border,axis=1)
+    d = stamps-sky[:,None,None]
+    r2 = (xx[None,:,:]-(x-ix)[:,None,None])**2+(yy[None,:,:]-(y-iy)[:,None,None])**2
+    p = profile(MODELS.index(model)+1,r2,width)*(r2 <= fi**2)
+    a = (p*d).sum(axis=(1,2))/(p*p).sum(axis=(1,2))
+    npix = np.maximum((r2 <= fi**2).sum(axis=(1,2)),1)
+    rms = np.sqrt((((d-a[:,None,None]*p)*(r2 <= fi**2))**2).sum(axis=(1,2))/npix)
+    return a, sky, rms
+
+def daophot():
+    out(" DAOPHOT II stub\n\n")
+    image = None
+    opts = {}
+    while True:
+        arr = ask("Command: ").split()
+        cmd = arr[0].upper() if len(arr) > 0 else ''
+        if cmd == 'EXIT':
+            return
+        elif cmd == 'OPTIONS':
+            optfile = ask("Enter file with parameter values: ")
+            if os.path.exists(optfile): options(open(optfile).readlines(),opts)
+            out("\n  RE =     1.00   GA =     1.00   LO =     7.00\n\n")
+            while True:
+                line = ask("OPT> ")
+                if line == '': break
+                options([line],opts)
+        elif cmd == 'ATTACH':
+            image = arr[1] if len(arr) > 1 else ask("Enter file name: ")
+            out("\n    Picture size:   2046  4094\n\n")
+        elif cmd == 'FIND':
+            ask("Number of frames averaged, summed: ")
+            outfile = ask("File for the positions: ")
+            stars = [(i+1,20.0+40*(i %% 50),20.0+80*(i // 50),-5.0+0.01*i) for i in range(500)]
+            write(outfile,1,["%%7d%%9.3f%%9.3f%%9.3f%%9.3f%%9.3f%%9.3f\n" %% (s+(0.6,0.0,0.0)) for s in stars])
+            out("\n Sky mode and standard deviation =  1600.000  10.000\n\n Clipped mean and median =  1600.100  1600.000\n\n      500 stars.\n\n")
+            ask("Are you happy with this? ")
+        elif cmd == 'PHOTOMETRY':
+            aplines = [l.split('=') for l in open(ask("Enter table name: ")).readlines() if '=' in l]
+            radii = [float(v) for k,v in aplines if k.strip() not in ['IS','OS']]
+            inner = [float(v) for k,v in aplines if k.strip() == 'IS'][0]
+            outer = [float(v) for k,v in aplines if k.strip() == 'OS'][0]
+            ask("Are these values OK? ")
+            stars = readstars(ask("Input position file: "))
+            outfile = ask("Output file: ")
+            mags, errs, sky, skysig = aperphot(image,stars,radii,inner,outer,opts)
+            rows = []
+            for i,s in enumerate(stars):
+                rows.append(("\n%%7d%%9.3f%%9.3f" %% s[0:3])+''.join(["%%9.3f" %% m for m in mags[i]])+"\n")
+                rows.append("%%14.3f%%6.2f%%6.2f" %% (sky[i],min(skysig[i],99.99),0.0)+''.join(["%%9.4f" %% e for e in errs[i]])+"\n")
+            write(outfile,2,rows)
+            out("\n Estimated magnitude limit (Aperture 1): 21.50 +-  0.25 per star.\x07\n")
+        elif cmd == 'PICKPSF':
+            stars = readstars(ask("Input file name: "))
+            nstars,faint = [float(v) for v in ask("Desired number of stars, faintest magnitude: ").split(',')]
+            outfile = ask("Output file name: ")
+            stars = sorted([s for s in stars if s[3] < faint],key=lambda s: (s[3],s[0]))[0:int(nstars)]
+            write(outfile,3,lst(stars))
+            out("\n     %%d suitable candidates were found.\n\n" %% len(stars))
+        elif cmd == 'PSF':
+            apstars = readstars(ask("File with aperture results: "))
+            ap1 = dict([(s[0],s[3]) for s in apstars])
+            stars = readstars(ask("File with PSF stars: "))
+            psffile = ask("File for the PSF: ")
+            results, model, chi, width, sig, flag, amp = psffit(image,stars,opts)
+            # Scale the PSF to the first aperture like psf.f
+            ratio = [10**(-0.4*(ap1[s[0]]-25))/amp[i] for i,s in enumerate(stars)
+                     if flag[i] == '' and amp[i] > 0 and ap1.get(s[0],99.999) < 90]
+            norm = np.median(ratio) if len(ratio) > 0 else 1.0
+            out("\n       Chi    Parameters...\n")
+            for c,w in results: out(">> %%8.4f %%9.5f %%9.5f\n" %% (c,w,w))
+            out("\n Profile errors:\n\n")
+            prof = ''
+            for i,s in enumerate(stars):
+                if flag[i] == 'saturated':
+                    prof += "%%7d saturated" %% s[0]
+                else:
+                    prof += "%%7d%%7.3f%%3s" %% (s[0],sig[i],flag[i])
+                if (i %% 5) == 4: prof += "\n"
+            out(prof.rstrip('\n')+"\n\n")
+            neifile = os.path.splitext(psffile)[0]+'.nei'
+            with open(psffile,'w') as f:
+                f.write("%%-8s  51    4    3    0   %%9.3f %%9.3f %%12.5e  1600.000  1023.500  2047.500\n" %% (model,width,chi,norm))
+                f.write(''.join(["%%7d" %% s[0] for s in stars])+"\n")
+            # Neighbors within 1.5 PSF radii plus 2 fitting radii plus 1 of a PSF star
+            nrad = 1.5*opts.get('PS',4*opts.get('FW',4.0))+2*opts.get('FI',opts.get('FW',4.0))+1
+            ids = [s[0] for s in stars]
+            psfxy = np.array([(s[1],s[2]) for s in stars]).reshape(-1,2)
+            nei = [s for s in apstars if (s[0] not in ids) and (s[3] < 90) and
+                   np.min((psfxy[:,0]-s[1])**2+(psfxy[:,1]-s[2])**2) < nrad**2]
+            write(neifile,3,lst(stars+nei))
+            out(" File with PSF stars and neighbors = "+neifile+"\n\n")
+            ask("")
+        elif cmd == 'GROUP':
+            stars = readstars(ask("File with the photometry: "))
+            ask("File with the PSF: ")
+            ask("Critical overlap: ")
+            write(ask("File for stellar groups: "),3,lst(stars))
+            out("\n     %%d stars in %%d groups.\n\n" %% (len(stars),len(stars)))
+        elif cmd == 'NSTAR':
+            ask("File with the PSF: ")
+            stars = readstars(ask("File with stellar groups: "))
+            write(ask("File for NSTAR results: "),1,
+                  ["%%7d%%9.3f%%9.3f%%9.3f%%9.4f%%9.3f%%9.0f%%9.3f%%9.3f\n" %% (s+(0.01,1600.0,3,1.0,0.0)) for s in stars])
+        elif cmd == 'SUBSTAR':
+            psf = readpsf(ask("File with the PSF: "))
+            stars = readstars(ask("File with photometry: "))
+            leave = []
+            if ask("Do you have stars to leave in? ").upper().startswith('Y'):
+                leave = [s[0] for s in readstars(ask("File with star list: "))]
+            substar(image,[s for s in stars if s[0] not in leave],psf,opts,ask("Name for subtracted image: "))
+            ask("")
+        elif cmd != '':
+            out(" Unrecognized command.\n")
+
+def allstar():
+    out(" ALLSTAR stub\n\n")
+    opts = {}
+    while True:
+        line = ask("OPT> ")
+        if line == '': break
+        options([line],opts)
+    while True:
+        image = ask("Input image name: ")
+        if image in ['','EXIT']: return
+        model, width, norm = readpsf(ask("File with the PSF: "))
+        stars = readstars(ask("Input file: "))
+        outfile = ask("File for results: ")
+        subfile = ask("Name for subtracted image: ")
+        amp, sky, rms = psfphot(image,stars,model,width,opts)
+        flux = amp*norm
+        err = 1.0857*np.sqrt(np.abs(flux)/opts.get('GA',1.0)+(np.pi*opts.get('FI',4.0)**2)*rms**2)/np.maximum(flux,1e-10)
+        write(outfile,1,["%%7d%%9.3f%%9.3f%%9.3f%%9.4f%%9.3f%%9.0f%%9.3f%%9.3f\n" %%
+                         (s[0],s[1],s[2],25-2.5*np.log10(flux[i]),min(err[i],9.9999),sky[i],4,1.0,0.0)
+                         for i,s in enumerate(stars) if flux[i] > 0])
+        shutil.copyfile(image,subfile)
+        out("\n Finished  %%d stars.\n\n" %% np.sum(flux > 0))
+
+def daogrow():
+    ask("File with aperture radii: ")
+    ask("")
+    info = open(ask("File with exposure information: ")).readline().split()
+    apfile = open(ask("File with list of photometry files: ")).readline().strip()
+    ask("Number of parameters: ")
+    ask("Fixed values: ")
+    maxerr = float(ask("Maximum error: "))
+    # Empirical growth curve: weighted mean magnitude differences of successive
+    #  apertures, the total magnitude adds the steps outside the most precise aperture
+    rows = readap(apfile)
+    mag = np.array([r[3] for r in rows])
+    err = np.array([r[4] for r in rows])
+    naper = mag.shape[1]
+    step = np.zeros(naper-1)
+    stepvar = np.zeros(naper-1)
+    for k in range(naper-1):
+        e2 = err[:,k]**2+err[:,k+1]**2
+        good = (mag[:,k] < 90) & (mag[:,k+1] < 90) & (np.sqrt(e2) < maxerr)
+        if np.sum(good) == 0: good = (mag[:,k] < 90) & (mag[:,k+1] < 90)
+        dm = (mag[:,k+1]-mag[:,k])[good]
+        w = 1.0/np.maximum(e2[good],1e-6)
+        clip = np.abs(dm-np.median(dm)) < 3*1.4826*np.median(np.abs(dm-np.median(dm)))+1e-4
+        step[k] = np.sum(w[clip]*dm[clip])/np.sum(w[clip])
+        stepvar[k] = 1.0/np.sum(w[clip])
+    tail = np.append(np.cumsum(step[::-1])[::-1],0.0)
+    tailvar = np.append(np.cumsum(stepvar[::-1])[::-1],0.0)
+    lines = []
+    for i,r in enumerate(rows):
+        tot = np.where(mag[i] < 90,np.sqrt(err[i]**2+tailvar),np.inf)
+        k = int(np.argmin(tot))
+        lines.append("%%7d%%9.3f%%9.3f%%9.4f%%9.4f%%9.3f%%9.3f%%9.4f%%9d\n" %%
+                   (r[0],r[1],r[2],mag[i,k]+tail[k],min(tot[k],9.9999),r[5],mag[i,0],mag[i,k]+tail[k]-mag[i,0],k+1))
+    name = info[0]
+    write(name+'.tot',1,lines)
+    for ext in ['.poi','.cur','.gro','.crl']:
+        with open(name+ext,'w') as f: f.write(name+"\n")
+    out("\n Done.\n")
+
+{'daophot':daophot, 'allstar':allstar, 'daogrow':daogrow}[prog]()
+'''
+
+
+# Stand-in for SExtractor, "sex IMAGE -c CONFIG [-KEYWORD VALUE ...]".  It writes the
+#  effective settings (config file plus command-line overrides, see sexconfig.py), the
+#  checksums of the auxiliary files and the CCDNUM of the image as JSON to CATALOG_NAME,
+#  after sleeping STUBTIME seconds if that is set, so the benchmarks can check that
+#  every chip got its own configuration and image.
+SEXSTUB = r'''#!%(python)s
+import sys, os, re, json, time, hashlib
+sys.path.insert(0,%(pydir)r)
+from sexconfig import parseconfig, AUXKEYS
+args = sys.argv[1:]
+imfile = args.pop(0)
+configfile = args[args.index('-c')+1]
+del args[args.index('-c'):args.index('-c')+2]
+overrides = dict(zip([a[1:] for a in args[0::2]],args[1::2]))
+settings = parseconfig(open(configfile).readlines(),overrides)
+for k in AUXKEYS:
+    if k in settings: settings[k] = hashlib.md5(open(settings[k],'rb').read()).hexdigest()
+settings['IMAGE'] = imfile
+settings['CCDNUM'] = None
+if os.path.exists(imfile):
+    m = re.search(r"CCDNUM  =\s+(\d+)",open(imfile,'rb').read(28800).decode('ascii','ignore'))
+    if m: settings['CCDNUM'] = int(m.group(1))
+if 'STUBTIME' in settings: time.sleep(float(settings['STUBTIME']))
+open(settings['CATALOG_NAME'],'w').write(json.dumps(settings,sort_keys=True))
+'''
+
+
+def mksex(bindir):
+    """ Put the stub sex program in BINDIR, returns its path."""
+    stubfile = os.path.join(bindir,'sex')
+    f = open(stubfile,'w')
+    f.write(SEXSTUB % {'python':sys.executable,'pydir':os.path.dirname(os.path.abspath(__file__))})
+    f.close()
+    os.chmod(stubfile,509)
+    return stubfile
+
+
+def mkstub(bindir):
+    """ Put the stub programs in BINDIR."""
+    stubfile = os.path.join(bindir,'daostub')
+    f = open(stubfile,'w')
+    f.write(STUB % {'python':sys.executable})
+    f.close()
+    os.chmod(stubfile,509)
+    for name in ['daophot','allstar','daogrow']:
+        os.symlink(stubfile,os.path.join(bindir,name))
+
+
+def addstars(im,x,y,flux,fwhm,beta=2.5,rad=None,wing=0.0,wingfwhm=None):
+    """ Add Moffat stars (0-based X/Y) to IM, out to RAD pixels (default 4 FWHM).  With WING>0
+    that fraction of the flux is in a Gaussian halo of WINGFWHM (default 4 FWHM) instead."""
+    ny,nx = im.shape
+    if rad is None: rad = int(np.ceil(4*fwhm))
+    if wingfwhm is None: wingfwhm = 4*fwhm
+    alpha = 0.5*fwhm/np.sqrt(2**(1.0/beta)-1)
+    norm = (1-wing)*(beta-1)/(np.pi*alpha**2)
+    sig2 = (wingfwhm/2.3548)**2
+    for x1,y1,f1 in zip(x,y,flux):
+        x0,x1b = max(int(x1)-rad,0),min(int(x1)+rad+1,nx)
+        y0,y1b = max(int(y1)-rad,0),min(int(y1)+rad+1,ny)
+        if x0 >= x1b or y0 >= y1b: continue
+        yy,xx = np.mgrid[y0:y1b,x0:x1b]
+        r2 = (xx-x1)**2+(yy-y1)**2
+        im[y0:y1b,x0:x1b] += f1*norm*(1+r2/alpha**2)**(-beta)
+        if wing > 0: im[y0:y1b,x0:x1b] += f1*wing/(2*np.pi*sig2)*np.exp(-0.5*r2/sig2)
+    return im
+
+
+def simchip(outdir,nstars=300,nx=1024,ny=2048,seed=3):
+    """ Synthetic DAOPHOT-ready chip: flux_dao.fits, .opt, .als.opt and .coo."""
+    from astropy.io import fits
+    from astropy.table import Table
+    import daoio
+    rnd = np.random.RandomState(seed)
+    im = rnd.normal(1600,10,(ny,nx))
+    opt = ['RE = 1.55\n','GA = 3.91\n','LO = 7.00\n','HI = 38652.0\n','FW = 4.00\n','TH = 3.50\n',
+           'LS = 0.2\n','HS = 1.0\n','LR = -1.0\n','HR = 1.0\n','WA = -2\n','FI = 4.0\n','PS = 16.0\n',
+           'VA = 2\n','AN = -6\n','EX = 5\n','PE = 0.75\n','PR = 5.00\n']
+    f = open(os.path.join(outdir,'flux_dao.opt'),'w')
+    f.writelines(opt)
+    f.close()
+    f = open(os.path.join(outdir,'flux_dao.als.opt'),'w')
+    f.writelines(['FI = 4.0\n','IS = 0.00\n','OS = 16.0\n','RE = 1\n','MA = 50\n','PR = 5.00\n','CR = 2.5\n',
+                  'CE = 6.00\n','PE = 0.75\n'])
+    f.close()
+    cat = Table()
+    cat['NUMBER'] = np.arange(1,nstars+1)
+    cat['X_IMAGE'] = rnd.uniform(20,nx-20,nstars)
+    cat['Y_IMAGE'] = rnd.uniform(20,ny-20,nstars)
+    cat['MAG_AUTO'] = rnd.uniform(14,22,nstars)
+    cat['MAGERR_AUTO'] = 0.001*10**(0.2*(cat['MAG_AUTO']-10))
+    addstars(im,cat['X_IMAGE']-1,cat['Y_IMAGE']-1,10**(-0.4*(cat['MAG_AUTO']-25)),4.0)
+    fits.writeto(os.path.join(outdir,'flux_dao.fits'),im.astype(np.float32),overwrite=True)
+    meta = {'NAXIS1':nx,'NAXIS2':ny,'SATURATE':38652.0,'RDNOISE':6.0,'GAIN':3.9,'SKYMED':1600.,'SKYRMS':10.}
+    daoio.sextodao(cat,meta,os.path.join(outdir,'flux_dao.coo'),format='coo')
+    return meta
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# Pooled sqlite sessions for the combine database helpers.
+#
+# The helpers in nsc_instcal_combine_cluster.py used to open a new sqlite
+# connection for every call.  A heavy pixel calls them thousands of times.
+# getsession() keeps one connection per database file (and process),
+# executemany() runs inside explicit transactions that
+# are committed in batches, and queryarray() streams the cursor straight
+# into a numpy structured array instead of building a list of tuples first.
+#
+# Every call commits before it returns so other connections (e.g. ones
+# opened by dlnpyutils.db or breakup_idstr) always see the data.  When a
+# session is closed it checkpoints the WAL and switches the file back to a
+# rollback journal so the database is a single normal file afterwards.
+# Use closesession() before deleting a database file.
+#
+# By default a session keeps sqlite's journal and synchronous settings and
+# only adds a busy timeout, that is what the durable and shared databases
+# (PIX_idstr.db, the footprint index) use.  The bulk-ingest pragmas
+# (WAL, synchronous=OFF) are only for scratch databases that can be
+# regenerated, pass pragmas=SCRATCH_PRAGMAS for those.
+
+import os
+import numpy as np
+import time
+import atexit
+import sqlite3
+import tempfile
+from argparse import ArgumentParser
+
+# Default pragmas, safe for durable and shared databases
+PRAGMAS = [('busy_timeout',600000),('temp_store','MEMORY')]
+
+# Bulk-ingest pragmas, these are only safe for scratch files we can regenerate
+SCRATCH_PRAGMAS = [('journal_mode','WAL'),('synchronous','OFF'),('cache_size',-262144),   # 256 MB
+                   ('temp_store','MEMORY'),('busy_timeout',600000)]
+
+# Convert numpy scalars when inserting
+for t in [np.int8,np.int16,np.int32,np.int64,np.uint8,np.uint16,np.uint32]:
+    sqlite3.register_adapter(t, int)
+for t in [np.float16,np.float32,np.float64]:
+    sqlite3.register_adapter(t, float)
+sqlite3.register_adapter(np.str_, str)
+
+_sessions = {}
+
+
+class DBSession:
+    """ One sqlite connection to a database file."""
+
+    def __init__(self,dbfile,pragmas=None,batchsize=500000):
+        self.dbfile = dbfile
+        self.batchsize = batchsize
+        # isolation_level=None, transactions are handled here.  No type
+        # converters are registered so detect_types is not needed.
+        self.db = sqlite3.connect(dbfile, isolation_level=None)
+        self.pragmas = []
+        self.setpragmas(PRAGMAS if pragmas is None else pragmas)
+        self.ntrans = 0
+        self.nrows = 0
+
+    def __repr__(self):
+        return 'DBSession('+self.dbfile+')'
+
+    def setpragmas(self,pragmas):
+        """ Apply a list of (name,value) pragmas."""
+        self.commit()
+        for name,value in pragmas:
+            self.db.execute('PRAGMA '+name+'='+str(value))
+        self.pragmas = list(pragmas)
+
+    def begin(self):
+        """ Start a transaction."""
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+
+    def commit(self):
+        """ Commit the current transaction."""
+        if self.db is not None and self.db.in_transaction:
+            self.db.execute('COMMIT')
+            self.ntrans += 1
+
+    def execute(self,cmd,params=()):
+        """ Execute a command and return all rows."""
+        cur = self.db.execute(cmd,params)
+        data = cur.fetchall()
+        self.commit()
+        return data
+
+    def executemany(self,cmd,data):
+        """ Execute a command for many rows, committing every BATCHSIZE rows."""
+        cur = self.db.cursor()
+        data = iter(data)
+        nrows = 0
+        while True:
+            batch = []
+            for row in data:
+                batch.append(row)
+                if len(batch)>=self.batchsize: break
+            if len(batch)==0: break
+            self.begin()
+            cur.executemany(cmd,batch)
+            self.commit()
+            nrows += len(batch)
+            if len(batch)<self.batchsize: break
+        self.nrows += nrows
+        return nrows
+
+    def insert(self,table,cols,columns):
+        """ Insert a list of column arrays into a table."""
+        cmd = 'INSERT INTO '+table+'('+','.join(cols)+') VALUES('+','.join(len(cols)*['?'])+')'
+        # tolist() gives python scalars, no adapter calls
+        return self.executemany(cmd,zip(*[np.asarray(c).tolist() for c in columns]))
+
+    def query(self,cmd):
+        """ Execute a select and return the list of rows."""
+        return self.db.execute(cmd).fetchall()
+
+    def queryarray(self,cmd,dtype):
+        """ Execute a select and read the rows directly into a numpy structured array."""
+        cur = self.db.execute(cmd)
+        return np.fromiter(cur,dtype=dtype)
+
+    def tableexists(self,table):
+        """ Check if a table exists."""
+        data = self.db.execute('SELECT name from sqlite_master where type="table" and name=?',(table,)).fetchall()
+        return len(data)>0
+
+    def close(self):
+        """ Commit, checkpoint and close the connection."""
+        if self.db is None: return
+        self.commit()
+        try:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.db.execute('PRAGMA journal_mode=DELETE')
+        except sqlite3.Error:
+            pass
+        self.db.close()
+        self.db = None
+
+
+def getsession(dbfile,pragmas=None,batchsize=None):
+    """ Get the pooled session for a database file, opening it if needed.
+
+    If the session is already open, PRAGMAS and BATCHSIZE are re-applied
+    when they are given and differ from the ones of the session.
+    """
+    key = (os.path.abspath(dbfile),os.getpid())
+    sess = _sessions.get(key)
+    if sess is None or sess.db is None:
+        kwargs = {} if batchsize is None else {'batchsize':batchsize}
+        sess = DBSession(dbfile,pragmas=pragmas,**kwargs)
+        _sessions[key] = sess
+        return sess
+    if pragmas is not None and list(pragmas)!=sess.pragmas:
+        sess.setpragmas(pragmas)
+    if batchsize is not None:
+        sess.batchsize = batchsize
+    return sess
+
+def closesession(dbfile):
+    """ Close the pooled session for a database file if it is open."""
+    key = (os.path.abspath(dbfile),os.getpid())
+    sess = _sessions.pop(key,None)
+    if sess is not None: sess.close()
+
+def closeall():
+    """ Close all of the sessions of this process."""
+    pid = os.getpid()
+    for key in list(_sessions.keys()):
+        if key[1]==pid:
+            _sessions.pop(key).close()
+
+atexit.register(closeall)
+
+
+def benchmark(nrows=1000000,nselect=200,tmpdir=None):
+    """ Compare insert and select throughput of connect-per-call and pooled sessions."""
+
+    if tmpdir is None: tmpdir = tempfile.gettempdir()
+    rnd = np.random.RandomState(0)
+    measid = np.char.add('c4d.',np.arange(nrows).astype(str))
+    ra = rnd.rand(nrows)
+    dec = rnd.rand(nrows)
+    mag = 16+rnd.rand(nrows)*8
+    labels = np.arange(nrows)//5
+    nchunk = 100
+    chunks = np.array_split(np.arange(nrows),nchunk)
+    dtype = np.dtype([('ROWID',int),('MEASID',(str,30)),('OBJLABEL',int),('RA',float),('DEC',float),('MAG',float)])
+    create = 'CREATE TABLE meas(measid TEXT, objlabel INTEGER, ra REAL, dec REAL, mag REAL)'
+    insert = 'INSERT INTO meas(measid,objlabel,ra,dec,mag) VALUES(?,?,?,?,?)'
+    step = max(nrows//5//nselect,1)
+    results = {}
+
+    for mode in ['connect','session']:
+        dbfile = os.path.join(tmpdir,'dbsession_bench_'+str(os.getpid())+'_'+mode+'.db')
+        if os.path.exists(dbfile): os.remove(dbfile)
+        res = {}
+        # Inserts, one call per chip
+        t0 = time.time()
+        for ind in chunks:
+            if mode=='connect':
+                db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                c = db.cursor()
+                if len(c.execute('SELECT name from sqlite_master where type= "table" and name="meas"').fetchall()) < 1:
+                    c.execute(create)
+                c.executemany(insert,list(zip(measid[ind],labels[ind],ra[ind],dec[ind],mag[ind])))
+                db.commit()
+                db.close()
+            else:
+                sess = getsession(dbfile,pragmas=SCRATCH_PRAGMAS)
+                if sess.tableexists('meas') is False: sess.execute(create)
+                sess.insert('meas',['measid','objlabel','ra','dec','mag'],[measid[ind],labels[ind],ra[ind],dec[ind],mag[ind]])
+        res['insert'] = time.time()-t0
+        if mode=='connect':
+            db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            db.execute('CREATE INDEX idx_objlabel_meas ON meas(objlabel)')
+            db.commit()
+            db.close()
+        else:
+            sess.execute('CREATE INDEX idx_objlabel_meas ON meas(objlabel)')
+        # Selects of object label ranges
+        t0 = time.time()
+        nsel = 0
+        for i in range(nselect):
+            cmd = 'SELECT rowid,* FROM meas WHERE objlabel>='+str(i*step)+' AND objlabel<='+str((i+1)*step-1)
+            if mode=='connect':
+                db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                data = db.execute(cmd).fetchall()
+                db.close()
+                cat = np.zeros(len(data),dtype=dtype)
+                cat[...] = data
+                del data
+            else:
+                cat = sess.queryarray(cmd,dtype)
+            nsel += len(cat)
+        res['select'] = time.time()-t0
+        # Full table read
+        t0 = time.time()
+        if mode=='connect':
+            db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            data = db.execute('SELECT rowid,* FROM meas').fetchall()
+            db.close()
+            cat = np.zeros(len(data),dtype=dtype)
+            cat[...] = data
+            del data
+        else:
+            cat = sess.queryarray('SELECT rowid,* FROM meas',dtype)
+        res['readall'] = time.time()-t0
+        res['nrows'] = len(cat)
+        if mode=='session': closesession(dbfile)
+        if os.path.exists(dbfile): os.remove(dbfile)
+        print('---- '+mode+' ----')
+        print('insert  %8.2f sec  %10.0f rows/sec' % (res['insert'],nrows/res['insert']))
+        print('select  %8.2f sec  %10.0f rows/sec  (%d queries)' % (res['select'],nsel/res['select'],nselect))
+        print('readall %8.2f sec  %10.0f rows/sec' % (res['readall'],res['nrows']/res['readall']))
+        results[mode] = res
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark pooled sqlite sessions.')
+    parser.add_argument('--nrows', type=int, default=1000000, help='Number of rows')
+    parser.add_argument('--nselect', type=int, default=200, help='Number of select queries')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Temporary directory')
+    args = parser.parse_args()
+    benchmark(args.nrows,args.nselect,args.tmpdir)
@@ -18,14 +18,19 @@ import logging
 from glob import glob
 import subprocess
 import healpy as hp
+import multiprocessing
+import pmfit
+import pmlocal
 #import tempfile
-import psycopg2 as pq
 #import psutil
 
 def get_meas(pix,nside=128):
     """ Get the measurements for a particular healpix."""
     # objid, ra, raerr, dec, decerr, mjd
 
+    # only needed for the database queries, not the local mode
+    import psycopg2 as pq
+
     t0 = time.time()
 
     connection = pq.connect(user="dlquery",host="db01.datalab.noao.edu",
@@ -114,8 +119,31 @@ def get_meas(pix,nside=128):
     return meas
 
 
-def fix_pms(pix):
-    """ Correct the proper motions in the healpix object catalog."""
+def fix_pms(pix,batch=False,local=False,combdir=None,measdir=None,nthreads=4,iddir=None):
+    """ Correct the proper motions in the healpix object catalog.
+
+    Parameters
+    ----------
+    pix : int or str
+       HEALPix pixel (nside=128).
+    batch : bool, optional
+       Use the batched proper motion solver.  Default is False.
+    local : bool, optional
+       Read the measurements from the combine products on disk instead of
+       the database, all the objects at once (see pmlocal.py).  The fit is
+       the same as with the database, set by BATCH.  Default is False.
+    combdir : str, optional
+       Directory of the combine object catalogs.
+    measdir : str, optional
+       Root directory of the exposure measurement catalogs, for LOCAL.
+    nthreads : int, optional
+       Number of threads to read the measurement catalogs, for LOCAL.
+       Default is 4.
+    iddir : str, optional
+       Idstr store of the combine (see idstore.py), for LOCAL.  By default
+       the PIX_idstr.db databases next to the object catalog are used.
+
+    """
 
     t00 = time.time()
     hostname = socket.gethostname()
@@ -125,7 +153,9 @@ def fix_pms(pix):
     nside = 128
     radeg = np.float64(180.00) / np.pi
 
-    hdir = '/net/dl2/dnidever/nsc/instcal/'+version+'/combine/'+str(int(pix)//1000)+'/'
+    if combdir is None: combdir='/net/dl2/dnidever/nsc/instcal/'+version+'/combine/'
+    if measdir is None: measdir='/net/dl2/dnidever/nsc/instcal/'+version+'/'
+    hdir = os.path.join(combdir,str(int(pix)//1000))+'/'
     objfile = hdir+str(pix)+'.fits.gz'
     outfile = hdir+str(pix)+'_pmcorr.fits'
     
@@ -155,19 +185,26 @@ def fix_pms(pix):
     #process = psutil.Process(os.getpid())
     #print('%6.1f Percent of memory used. %6.1f GB available.  Process is using %6.2f GB of memory.' % (v.percent,v.available/1e9,process.memory_info()[0]/1e9))
 
+    # Measurements from the combine products, all objects at once
+    if local:
+        meas = pmlocal.getmeas(pix,meta,hdir,measdir,nthreads=nthreads,iddir=iddir)
+        ndet = pmlocal.refit(obj,meas,batch=batch)
+        nsub = 0
+
     # Break up into subregions
-    totmeas = np.sum(obj['ndet'])
-    nsub,bestind = dln.closest([1,4,16,64],int(np.ceil(totmeas/500000)))
-    hinside = [128,256,512,1024][bestind]
-    vecbound = hp.boundaries(nside,int(pix))
-    allpix = hp.query_polygon(hinside,np.transpose(vecbound))
-    allra,alldec = hp.pix2ang(hinside,allpix,lonlat=True)
-    print(str(nsub)+' sub regions')
-
-    # Get the objects within this subpixel
-    objpix = hp.ang2pix(hinside,obj['ra'],obj['dec'],lonlat=True)
-
-    ndet = np.zeros(nobj,int)
+    else:
+        totmeas = np.sum(obj['ndet'])
+        nsub,bestind = dln.closest([1,4,16,64],int(np.ceil(totmeas/500000)))
+        hinside = [128,256,512,1024][bestind]
+        vecbound = hp.boundaries(nside,int(pix))
+        allpix = hp.query_polygon(hinside,np.transpose(vecbound))
+        allra,alldec = hp.pix2ang(hinside,allpix,lonlat=True)
+        print(str(nsub)+' sub regions')
+
+        # Get the objects within this subpixel
+        objpix = hp.ang2pix(hinside,obj['ra'],obj['dec'],lonlat=True)
+
+        ndet = np.zeros(nobj,int)
     #allpmra_old = np.zeros(nobj,float)
     #allpmdec_old = np.zeros(nobj,float)
     #allpmra_linefit = np.zeros(nobj,float)
@@ -214,6 +251,28 @@ def fix_pms(pix):
             ind1 = ind1[si]
             ind2 = ind2[si]
 
+        # Use the batched solver for all objects at once
+        if batch:
+            # Object index for each measurement
+            objk = np.zeros(len(idindex['value']),int)-1
+            objk[ind2] = ind1
+            mlabel = np.repeat(objk,idindex['num'])
+            mind = idindex['index']
+            gd, = np.where(mlabel>=0)
+            mlabel = mlabel[gd]
+            mind = mind[gd]
+            pm = pmfit.pmsolve(mlabel,meas['mjd'][mind],meas['ra'][mind],meas['dec'][mind],
+                               meas['raerr'][mind],meas['decerr'][mind],objdec=np.array(obj1['dec'][ind1]))
+            # pm is in sorted object index order, same as IND1
+            for n in ['pmra','pmraerr','pmdec','pmdecerr']:
+                gdpm = pm['ndet']>1
+                obj1[n][pm['label'][gdpm]] = pm[n][gdpm]
+            ndet1 = np.zeros(nobj1,int)
+            ndet1[pm['label']] = pm['ndet']
+            obj[objind] = obj1
+            ndet[objind] = ndet1
+            continue
+
         # Loop over
         ndet1 = np.zeros(nobj1,int)
         #allpmra_old1 = np.zeros(nobj1,float)
@@ -297,10 +356,39 @@ def fix_pms(pix):
 
     print('dt = %6.1f sec.' % (time.time()-t00))
 
+    return outfile+'.gz'
+
+
+def _fixpix(args):
+    """ Run fix_pms() for one pixel in a worker process."""
+    pix,kwargs = args
+    return fix_pms(pix,**kwargs)
+
+def fix_pms_pixels(pixels,nproc=1,**kwargs):
+    """ Correct the proper motions of many pixels, NPROC pixels in parallel."""
+    args = [(pix,kwargs) for pix in pixels]
+    if nproc>1 and len(pixels)>1:
+        pool = multiprocessing.Pool(min(nproc,len(pixels)))
+        try:
+            results = list(pool.imap(_fixpix,args))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_fixpix(a) for a in args]
+    return results
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Fix pms in healpix object catalogs.')
     parser.add_argument('pix', type=str, nargs=1, help='HEALPix')
+    parser.add_argument('--batch', action='store_true', help='Use the batched proper motion solver')
+    parser.add_argument('--local', action='store_true', help='Read the measurements from the combine products on disk')
+    parser.add_argument('--combdir', type=str, default=None, help='Combine object catalog directory')
+    parser.add_argument('--measdir', type=str, default=None, help='Exposure measurement catalog root directory')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of pixels to run in parallel')
+    parser.add_argument('--nthreads', type=int, default=4, help='Number of threads to read the measurement catalogs')
+    parser.add_argument('--iddir', type=str, default=None, help='Idstr store of the combine, for --local')
     args = parser.parse_args()
 
     hostname = socket.gethostname()
@@ -320,7 +408,7 @@ if __name__ == "__main__":
     if type(pix) is not list: pix=[pix]
     npix = len(pix)
     print('Correcting PMs for '+str(npix)+' HEALPix')
-    for i in range(len(pix)):
-        fix_pms(pix[i])
+    fix_pms_pixels(pix,nproc=args.nproc,batch=args.batch,local=args.local,combdir=args.combdir,
+                   measdir=args.measdir,nthreads=args.nthreads,iddir=args.iddir)
 
 
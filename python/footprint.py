@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+# Persistent chip-footprint index of the exposure meta files.
+#
+# For every candidate exposure of every pixel, loadmeas() and
+# checkboundaryoverlap() read the *_meta.fits file and test the ~60 chip
+# polygons against the pixel in Python.  Over a full run the same meta files
+# are read thousands of times.
+#
+# FootprintIndex keeps, in one sqlite file:
+#
+#   exposure : one row per meta file with its modification time and the
+#              exposure meta-data (the checkboundaryoverlap() columns)
+#   chip     : one row per chip with its vertices, ngaiamatch, whether the
+#              astrometry is okay and the chip _meas.fits file
+#   cellchip : the NESTED HEALPix cells (nside=256) that each chip touches
+#
+# query() looks up the cells around a pixel+buffer region, gets the
+# candidate chips in one select and runs the same exact polygon overlap test
+# as the combine on those only.  update() adds new meta files and re-indexes
+# ones that changed, so the index can be kept current as exposures are
+# calibrated.  nsc_instcal_combine_main.py (or "python footprint.py") updates
+# it once before a run, the combine jobs only query it.  The writes of an
+# update are one BEGIN IMMEDIATE transaction so several processes can update
+# the same index file at once.
+
+import os
+import numpy as np
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+import healpy as hp
+from dlnpyutils import utils as dln, coords
+import dbsession
+
+# Exposure meta-data columns, same as checkboundaryoverlap()
+dtype_meta = np.dtype([('file',(str,500)),('base',(str,200)),('instrument',(str,3)),('expnum',int),('ra',np.float64),
+                       ('dec',np.float64),('dateobs',(str,100)),('mjd',np.float64),('filter',(str,50)),
+                       ('exptime',float),('airmass',float),('nsources',int),('fwhm',float),
+                       ('nchips',int),('badchip31',bool),('rarms',float),('decrms',float),
+                       ('ebv',float),('gaianmatch',int),('zpterm',float),('zptermerr',float),
+                       ('zptermsig',float),('refmatch',int)])
+
+# Chip columns
+dtype_chip = np.dtype([('chipid',int),('metafile',(str,500)),('chfile',(str,500)),('ccdnum',int),('ngaiamatch',int),
+                       ('astokay',bool),('vra',np.float64,4),('vdec',np.float64,4)])
+
+SQLTYPES = {'i':'INTEGER','b':'INTEGER','f':'REAL','U':'TEXT'}
+
+
+def chipfile(metafile,ccdnum):
+    """ Chip-level measurement file of an exposure meta file."""
+    fdir = os.path.dirname(metafile)
+    fbase, ext = os.path.splitext(os.path.basename(metafile))
+    fbase = fbase[:-5]   # remove _meta at end
+    return fdir+'/'+fbase+'_'+str(ccdnum)+'_meas.fits'
+
+def chipcells(vra,vdec,nside):
+    """ NESTED HEALPix cells that a chip polygon touches."""
+    vec = hp.ang2vec(vra,vdec,lonlat=True)
+    cen = np.mean(vec,axis=0)
+    cen /= np.linalg.norm(cen)
+    radius = np.max(np.arccos(np.clip(np.dot(vec,cen),-1,1)))
+    return hp.query_disc(nside,cen,radius,inclusive=True,nest=True)
+
+
+class FootprintIndex:
+    """ HEALPix index of the chip footprints of the exposure meta files."""
+
+    def __init__(self,dbfile,nside=256):
+        self.dbfile = dbfile
+        sess = self._session()
+        # Create the tables in one transaction, another process may be doing the same
+        sess.commit()
+        sess.db.execute('BEGIN IMMEDIATE')
+        if sess.tableexists('info') is False:
+            self.nside = nside
+            expcols = ', '.join([n+' '+SQLTYPES[dtype_meta[n].kind] for n in dtype_meta.names])
+            sess.db.execute('CREATE TABLE info(nside INTEGER)')
+            sess.db.execute('INSERT INTO info(nside) VALUES(?)',(nside,))
+            sess.db.execute('CREATE TABLE exposure(metafile TEXT PRIMARY KEY, mtime REAL, '+expcols+')')
+            sess.db.execute('''CREATE TABLE chip(chipid INTEGER PRIMARY KEY, metafile TEXT, chfile TEXT, ccdnum INTEGER,
+                               ngaiamatch INTEGER, astokay INTEGER, vra0 REAL, vra1 REAL, vra2 REAL, vra3 REAL,
+                               vdec0 REAL, vdec1 REAL, vdec2 REAL, vdec3 REAL)''')
+            sess.db.execute('CREATE TABLE cellchip(cell INTEGER, chipid INTEGER)')
+            sess.db.execute('CREATE INDEX idx_cell_cellchip ON cellchip(cell)')
+            sess.db.execute('CREATE INDEX idx_chipid_cellchip ON cellchip(chipid)')
+            sess.db.execute('CREATE INDEX idx_metafile_chip ON chip(metafile)')
+        else:
+            self.nside = sess.query('SELECT nside FROM info')[0][0]
+        sess.commit()
+
+    def __repr__(self):
+        return 'FootprintIndex('+self.dbfile+')'
+
+    def _session(self):
+        return dbsession.getsession(self.dbfile)
+
+    def count(self):
+        """ Number of exposures and chips in the index."""
+        sess = self._session()
+        nexp = sess.query('SELECT count(*) FROM exposure')[0][0]
+        nchip = sess.query('SELECT count(*) FROM chip')[0][0]
+        return nexp, nchip
+
+    def update(self,metafiles,verbose=False):
+        """ Add new meta files to the index and re-index the ones that changed.
+
+        Parameters
+        ----------
+        metafiles : list
+           Exposure meta files.  Files that do not exist are skipped.
+        verbose : bool, optional
+           Print each file that is indexed.  Default is False.
+
+        Returns
+        -------
+        nadd : int
+           Number of meta files that were (re)indexed.
+
+        """
+        t0 = time.time()
+        sess = self._session()
+        todo = self._stale(metafiles)
+        if len(todo)==0:
+            return 0
+        # Read the meta files before locking the database
+        exprows, chiprows, cellrows = [], [], []
+        chipid = 0
+        for mfile,mtime in todo:
+            meta = fits.getdata(mfile,1,memmap=False)
+            t = Time(meta['dateobs'], format='isot', scale='utc')
+            meta['mjd'] = t.mjd                    # recompute because some MJD are bad
+            chmeta = fits.getdata(mfile,2,memmap=False)      # chip-level meta-data structure
+            if verbose: print('Indexing '+mfile+'  '+str(len(chmeta))+' chips')
+            newmeta = np.zeros(1,dtype=dtype_meta)
+            for n in newmeta.dtype.names:
+                if n.upper() in meta.dtype.names: newmeta[n]=meta[n]
+            exprows.append(tuple([mfile,mtime]+list(newmeta[0].tolist())))
+            for j in range(len(chmeta)):
+                # Same astrometry check as loadmeas()
+                astokay = True
+                if (chmeta['ngaiamatch'][j] == 0) | (np.max(np.abs(chmeta['racoef'][j]))>1) | (np.max(np.abs(chmeta['deccoef'][j]))>1):
+                    astokay = False
+                vra = np.asarray(chmeta['vra'][j],float)
+                vdec = np.asarray(chmeta['vdec'][j],float)
+                ccdnum = int(chmeta['ccdnum'][j])
+                # CHIPID is relative to the first new chip until the transaction
+                chiprows.append([chipid,mfile,chipfile(mfile,ccdnum),ccdnum,int(chmeta['ngaiamatch'][j]),int(astokay)]+
+                                vra.tolist()+vdec.tolist())
+                cellrows += [(int(c),chipid) for c in chipcells(vra,vdec,self.nside)]
+                chipid += 1
+        # Remove, number and insert in one transaction.  Another process may
+        #  have indexed some of the files in the meantime, those are skipped.
+        db = sess.db
+        sess.commit()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            mtimes = dict(db.execute('SELECT metafile, mtime FROM exposure').fetchall())
+            todo1 = set([m for m,mt in todo if mtimes.get(m)!=mt])
+            exprows = [r for r in exprows if r[0] in todo1]
+            keep = np.array([r[1] in todo1 for r in chiprows],bool)
+            old = [(m,) for m in todo1 if m in mtimes]
+            db.executemany('DELETE FROM cellchip WHERE chipid IN (SELECT chipid FROM chip WHERE metafile=?)',old)
+            db.executemany('DELETE FROM chip WHERE metafile=?',old)
+            db.executemany('DELETE FROM exposure WHERE metafile=?',old)
+            chipid0 = db.execute('SELECT max(chipid) FROM chip').fetchone()[0]
+            offset = 0 if chipid0 is None else chipid0+1
+            expcols = ['metafile','mtime']+list(dtype_meta.names)
+            db.executemany('INSERT INTO exposure('+','.join(expcols)+') VALUES('+','.join(len(expcols)*['?'])+')',exprows)
+            db.executemany('INSERT INTO chip VALUES('+','.join(14*['?'])+')',
+                           [tuple([r[0]+offset]+r[1:]) for r,k in zip(chiprows,keep) if k])
+            db.executemany('INSERT INTO cellchip(cell,chipid) VALUES(?,?)',
+                           [(c,i+offset) for c,i in cellrows if keep[i]])
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        if verbose: print(str(len(exprows))+' meta files indexed in '+str(time.time()-t0)+' sec.')
+        return len(exprows)
+
+    def _stale(self,metafiles):
+        """ Meta files that are not in the index or changed, with their modification times."""
+        mtimes = dict(self._session().query('SELECT metafile, mtime FROM exposure'))
+        todo = []
+        for mfile in np.unique(np.atleast_1d(metafiles).astype(str)):
+            mfile = str(mfile)
+            if os.path.exists(mfile) is False: continue
+            mtime = os.path.getmtime(mfile)
+            if mtimes.get(mfile)!=mtime:
+                todo.append((mfile,mtime))
+        return todo
+
+    def missing(self,metafiles):
+        """ Meta files that exist but are not in the index.  Unlike update(), the
+        modification times of the indexed files are not checked."""
+        indexed = set([m[0] for m in self._session().query('SELECT metafile FROM exposure')])
+        return [str(m) for m in np.unique(np.atleast_1d(metafiles).astype(str))
+                if (str(m) not in indexed) and os.path.exists(str(m))]
+
+    def getexposures(self,metafiles=None):
+        """ Exposure meta-data with a METAFILE column."""
+        dtype = np.dtype([('metafile',(str,500))]+[(n,dtype_meta[n]) for n in dtype_meta.names])
+        cmd = 'SELECT metafile,'+','.join(dtype_meta.names)+' FROM exposure'
+        expmeta = self._session().queryarray(cmd,dtype)
+        if metafiles is not None:
+            expmeta = expmeta[np.isin(expmeta['metafile'],np.atleast_1d(metafiles).astype(str))]
+        return expmeta
+
+    def getchips(self,cells=None,metafiles=None):
+        """ Chips that touch a list of HEALPix cells."""
+        cmd = 'SELECT chipid,metafile,chfile,ccdnum,ngaiamatch,astokay,vra0,vra1,vra2,vra3,vdec0,vdec1,vdec2,vdec3 FROM chip'
+        if cells is not None:
+            cmd += ' WHERE chipid IN (SELECT chipid FROM cellchip WHERE cell IN ('+','.join(np.asarray(cells).astype(int).astype(str))+'))'
+        dtype = np.dtype([('chipid',int),('metafile',(str,500)),('chfile',(str,500)),('ccdnum',int),('ngaiamatch',int),('astokay',bool),
+                          ('vra0',float),('vra1',float),('vra2',float),('vra3',float),('vdec0',float),('vdec1',float),('vdec2',float),('vdec3',float)])
+        data = self._session().queryarray(cmd,dtype)
+        chips = np.zeros(len(data),dtype=dtype_chip)
+        for n in ['chipid','metafile','chfile','ccdnum','ngaiamatch','astokay']: chips[n]=data[n]
+        for k in range(4):
+            chips['vra'][:,k] = data['vra'+str(k)]
+            chips['vdec'][:,k] = data['vdec'+str(k)]
+        if metafiles is not None:
+            chips = chips[np.isin(chips['metafile'],np.atleast_1d(metafiles).astype(str))]
+        return chips
+
+    def query(self,buffdict,metafiles=None):
+        """ Chips that overlap a HEALPix region+buffer.
+
+        Parameters
+        ----------
+        buffdict : dict
+           The region+buffer with cenra, cendec, ra, dec and the tangent-plane lon, lat.
+        metafiles : list, optional
+           Only use these exposures.
+
+        Returns
+        -------
+        expmeta : numpy structured array
+           Meta-data of the exposures with overlapping chips, in METAFILES order if given.
+        chips : numpy structured array
+           The chips that overlap the region, whether or not their astrometry is okay.
+
+        """
+        # Cells in a circle around the region
+        cen = hp.ang2vec(buffdict['cenra'],buffdict['cendec'],lonlat=True)
+        vec = hp.ang2vec(np.atleast_1d(buffdict['ra']),np.atleast_1d(buffdict['dec']),lonlat=True)
+        radius = np.max(np.arccos(np.clip(np.dot(vec,cen),-1,1)))
+        cells = hp.query_disc(self.nside,cen,radius,inclusive=True,nest=True)
+        chips = self.getchips(cells,metafiles)
+        # Exact overlap check, the same as the combine
+        keep = np.zeros(len(chips),bool)
+        for j in range(len(chips)):
+            vlon, vlat = coords.rotsphcen(chips['vra'][j],chips['vdec'][j],buffdict['cenra'],buffdict['cendec'],gnomic=True)
+            keep[j] = coords.doPolygonsOverlap(buffdict['lon'],buffdict['lat'],vlon,vlat)
+        chips = chips[keep]
+        expmeta = self.getexposures(np.unique(chips['metafile']))
+        if metafiles is not None:
+            order = {str(m):i for i,m in enumerate(np.atleast_1d(metafiles))}
+            expmeta = expmeta[np.argsort([order[m] for m in expmeta['metafile']],kind='stable')]
+        # Chips in exposure and CCDNUM order
+        expind = {m:i for i,m in enumerate(expmeta['metafile'])}
+        chips = chips[np.lexsort((chips['ccdnum'],[expind[m] for m in chips['metafile']]))]
+        return expmeta, chips
+
+    def close(self):
+        dbsession.closesession(self.dbfile)
+
+
+def simmetafiles(outdir,nexp=200,ra0=120.0,dec0=-30.0,size=4.0,seed=0):
+    """ Write synthetic DECam-like meta files, 60 chips of 0.15x0.3 deg in an 8x8 grid per exposure."""
+    rnd = np.random.RandomState(seed)
+    if os.path.exists(outdir) is False: os.makedirs(outdir)
+    cosd = np.cos(np.deg2rad(dec0))
+    metafiles = []
+    for i in range(nexp):
+        base = 'c4d_%06d_%06d_ooi_g_v1' % (i,i)
+        era = ra0+rnd.rand()*size/cosd
+        edec = dec0+rnd.rand()*size
+        meta = Table()
+        meta['FILE'] = [base+'.fits.fz']
+        meta['BASE'] = [base]
+        meta['INSTRUMENT'] = ['c4d']
+        meta['EXPNUM'] = [i]
+        meta['RA'] = [era]
+        meta['DEC'] = [edec]
+        meta['DATEOBS'] = ['2015-01-01T00:00:00.0']
+        meta['MJD'] = [0.0]
+        meta['FILTER'] = ['g']
+        meta['EXPTIME'] = [90.0]
+        meta['NSOURCES'] = [100000]
+        meta['NCHIPS'] = [60]
+        # Chips
+        ccd = np.arange(64)
+        ccd = ccd[(ccd!=0) & (ccd!=7) & (ccd!=56) & (ccd!=63)]
+        cx = (ccd % 8 - 3.5)*0.3
+        cy = (ccd // 8 - 3.5)*0.16
+        ch = Table()
+        ch['CCDNUM'] = np.arange(len(ccd))+1
+        dx = np.array([-0.075,0.075,0.075,-0.075])
+        dy = np.array([-0.15,-0.15,0.15,0.15])
+        ch['VRA'] = era+(cy[:,None]+dx[None,:])/np.cos(np.deg2rad(edec))
+        ch['VDEC'] = edec+cx[:,None]+dy[None,:]
+        ch['NGAIAMATCH'] = rnd.randint(0,200,len(ccd))
+        ch['RACOEF'] = np.zeros((len(ccd),4))
+        ch['DECCOEF'] = np.zeros((len(ccd),4))
+        mfile = os.path.join(outdir,base+'_meta.fits')
+        hdulist = fits.HDUList([fits.PrimaryHDU(),fits.table_to_hdu(meta),fits.table_to_hdu(ch)])
+        hdulist.writeto(mfile,overwrite=True)
+        metafiles.append(mfile)
+    return metafiles
+
+def regionbuffer(nside,pix,buffsize=10.0/3600.):
+    """ The HEALPix region+buffer dictionary like the combine uses."""
+    vecbound = hp.boundaries(nside,pix,step=100)
+    rabound, decbound = hp.vec2ang(np.transpose(vecbound),lonlat=True)
+    cenra, cendec = hp.pix2ang(nside,pix,lonlat=True)
+    lonbound, latbound = coords.rotsphcen(rabound,decbound,cenra,cendec,gnomic=True)
+    radbound = np.sqrt(lonbound**2+latbound**2)
+    frac = 1.0 + 1.5*np.max(buffsize/radbound)
+    lonbuff = lonbound*frac
+    latbuff = latbound*frac
+    rabuff, decbuff = coords.rotsphcen(lonbuff,latbuff,cenra,cendec,gnomic=True,reverse=True)
+    return {'cenra':cenra,'cendec':cendec,'rar':dln.minmax(rabuff),'decr':dln.minmax(decbuff),'ra':rabuff,'dec':decbuff,
+            'lon':lonbuff,'lat':latbuff,'lr':dln.minmax(lonbuff),'br':dln.minmax(latbuff)}
+
+def benchmark(nexp=200,nside=256,npix=20,tmpdir=None):
+    """ Compare checkboundaryoverlap() reading the meta files with the footprint index on synthetic meta files."""
+    import nsc_instcal_combine_cluster as comb
+    outdir = tempfile.mkdtemp(prefix='footprint',dir=tmpdir)
+    try:
+        metafiles = simmetafiles(os.path.join(outdir,'meta'),nexp)
+        # Pixels inside the field
+        rnd = np.random.RandomState(1)
+        pixra = 120.0+0.5+rnd.rand(npix)*3.0/np.cos(np.deg2rad(-30))
+        pixdec = -30.0+0.5+rnd.rand(npix)*3.0
+        allpix = hp.ang2pix(nside,pixra,pixdec,lonlat=True)
+        # Build the index
+        t0 = time.time()
+        fpindex = FootprintIndex(os.path.join(outdir,'footprint.db'))
+        fpindex.update(metafiles)
+        dt_build = time.time()-t0
+        # Incremental update, nothing changed
+        t0 = time.time()
+        nadd = fpindex.update(metafiles)
+        dt_update = time.time()-t0
+        # Queries
+        dt_files, dt_index, same = 0.0, 0.0, True
+        for pix in allpix:
+            buffdict = regionbuffer(nside,pix)
+            t0 = time.time()
+            meta0 = comb.checkboundaryoverlap(metafiles,buffdict)
+            dt_files += time.time()-t0
+            t0 = time.time()
+            meta1 = comb.checkboundaryoverlap(metafiles,buffdict,fpindex=fpindex)
+            dt_index += time.time()-t0
+            base0 = [] if meta0 is None else list(meta0['base'])
+            base1 = [] if meta1 is None else list(meta1['base'])
+            same &= (base0==base1)
+        nexp1, nchip1 = fpindex.count()
+        fpindex.close()
+        print('%d meta files, %d chips' % (nexp1,nchip1))
+        print('index build        %8.2f sec' % dt_build)
+        print('index update       %8.2f sec  (%d changed)' % (dt_update,nadd))
+        print('%d pixel lookups:' % npix)
+        print('  meta files       %8.2f sec' % dt_files)
+        print('  footprint index  %8.2f sec' % dt_index)
+        print('speed-up %6.1f   same=%s' % (dt_files/dt_index,same))
+    finally:
+        shutil.rmtree(outdir)
+    return {'build':dt_build,'update':dt_update,'files':dt_files,'index':dt_index,'same':same}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Build or update the chip-footprint index, or benchmark it.')
+    parser.add_argument('dbfile', type=str, nargs='?', default=None, help='Index database file')
+    parser.add_argument('metafiles', type=str, nargs='*', help='Exposure meta files')
+    parser.add_argument('--list', type=str, default=None, help='File with a list of meta files')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark on synthetic meta files')
+    parser.add_argument('--nexp', type=int, default=200, help='Number of synthetic exposures')
+    parser.add_argument('-v','--verbose', action='store_true', help='Verbose output')
+    args = parser.parse_args()
+    if args.benchmark or args.dbfile is None:
+        benchmark(args.nexp)
+    else:
+        metafiles = list(args.metafiles)
+        if args.list is not None:
+            metafiles += list(dln.readlines(args.list))
+        fpindex = FootprintIndex(args.dbfile)
+        fpindex.update(metafiles,verbose=args.verbose)
+        print('%d exposures, %d chips in the index' % fpindex.count())
+        fpindex.close()
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+# Columnar measid/objectid store partitioned by exposure.
+#
+# The idstr information of a HEALPix pixel used to be written three times:
+# the combine writes PIX_idstr.db, breakup_idstr() rewrites it as one small
+# .npy file per exposure and pixel on /data0, and exposure_update() globs,
+# de-duplicates and loads those files again.  With --iddir the combine
+# writes its idstr straight to the store instead, there is no PIX_idstr.db.  measurement_update() instead
+# runs a "where exposure==" query on the idstr database of every pixel,
+# which has to scan the whole table without the exposure index.
+#
+# IdStore keeps one segment per combine output (PIX or PIX_nNSIDE_SUBPIX):
+#
+#   segments/PIX//1000/NAME.TOKEN/measid.npy     fixed-width string columns,
+#   segments/PIX//1000/NAME.TOKEN/objectid.npy   rows sorted by exposure
+#
+# and an inverted index in index.db that maps every exposure to its row
+# range in each segment.  getexposure() looks up the ranges and reads just
+# those rows from the memory-mapped columns, so the I/O is proportional to
+# the size of the result.  A pixel job writes its segment under a new
+# unique directory and then swaps the index rows over in one sqlite
+# transaction, so many pixel jobs can append at the same time and a re-run
+# replaces the old segment of that pixel.  A reader may have looked up the
+# old segment just before the swap, so the replaced directory is only put
+# in the "retired" table and deleted by a later purge(), once no committed
+# index has pointed at it for KEEP seconds.  The index uses a normal
+# rollback journal, so the file can be closed by any process at any time.
+
+import os
+import sys
+import numpy as np
+import time
+import shutil
+import tempfile
+import multiprocessing
+from glob import glob
+from argparse import ArgumentParser
+from dlnpyutils import utils as dln
+import dbsession
+
+# The index is shared by many processes and is not regenerated, keep it
+# durable and wait for the other writers
+PRAGMAS = [('journal_mode','DELETE'),('synchronous','FULL'),('busy_timeout',600000),('temp_store','MEMORY')]
+
+# Output of getexposure(), the same columns as the breakup_idstr files plus the parent pixel
+dtype_id = np.dtype([('measid',(str,50)),('objectid',(str,50)),('pix',int)])
+
+
+def segmentinfo(name):
+    """ Parent HEALPix pixel of a segment name and whether it is a high-resolution split one."""
+    return int(name.split('_')[0]), ('_n' in name)
+
+
+class IdStore:
+    """ Exposure-partitioned columnar store of the measid/objectid pairs."""
+
+    def __init__(self,rootdir,keep=3600.0):
+        self.rootdir = rootdir
+        self.keep = keep
+        self.dbfile = os.path.join(rootdir,'index.db')
+        if os.path.exists(rootdir) is False:
+            # Sometimes this crashes because another process is making the directory at the same time
+            try:
+                os.makedirs(rootdir)
+            except:
+                pass
+        self._mmaps = {}
+        sess = self._session()
+        sess.db.execute('BEGIN IMMEDIATE')
+        if sess.tableexists('segment') is False:
+            sess.db.execute('''CREATE TABLE segment(name TEXT PRIMARY KEY, pix INTEGER, split INTEGER,
+                               path TEXT, nrows INTEGER, mtime REAL)''')
+            sess.db.execute('CREATE TABLE part(exposure TEXT, name TEXT, lo INTEGER, nrows INTEGER)')
+            sess.db.execute('CREATE INDEX idx_exposure_part ON part(exposure)')
+            sess.db.execute('CREATE INDEX idx_name_part ON part(name)')
+        # Replaced segment directories that readers may still use, and since when
+        if sess.tableexists('retired') is False:
+            sess.db.execute('CREATE TABLE retired(path TEXT, mtime REAL)')
+        sess.commit()
+
+    def __repr__(self):
+        return 'IdStore('+self.rootdir+')'
+
+    def _session(self):
+        return dbsession.getsession(self.dbfile,pragmas=PRAGMAS)
+
+    def close(self):
+        """ Close the index and the memory maps."""
+        self._mmaps = {}
+        dbsession.closesession(self.dbfile)
+
+    def count(self):
+        """ Number of segments, exposures and rows in the store."""
+        sess = self._session()
+        nseg,nrows = sess.query('SELECT count(*), sum(nrows) FROM segment')[0]
+        nexp = sess.query('SELECT count(DISTINCT exposure) FROM part')[0][0]
+        return nseg, nexp, (0 if nrows is None else nrows)
+
+    def segments(self):
+        """ The segments of the store."""
+        dtype = np.dtype([('name',(str,100)),('pix',int),('split',bool),('path',(str,500)),('nrows',int),('mtime',float)])
+        return self._session().queryarray('SELECT name,pix,split,path,nrows,mtime FROM segment',dtype)
+
+    def exposures(self):
+        """ The exposures in the store and their number of rows."""
+        dtype = np.dtype([('exposure',(str,100)),('nrows',int)])
+        return self._session().queryarray('SELECT exposure, sum(nrows) FROM part GROUP BY exposure',dtype)
+
+    def append(self,name,measid,exposure,objectid):
+        """ Write the measid/exposure/objectid of one combine output as a segment.
+
+        Parameters
+        ----------
+        name : str
+           Segment name, the combine output base name, PIX or PIX_nNSIDE_SUBPIX.
+           An existing segment of the same name is replaced.
+        measid : numpy array
+           Measurement IDs.
+        exposure : numpy array
+           Exposure names.
+        objectid : numpy array
+           Object IDs.
+
+        Returns
+        -------
+        nrows : int
+           Number of rows written.
+
+        """
+        pix,split = segmentinfo(name)
+        measid = np.asarray(measid).astype(str)
+        exposure = np.asarray(exposure).astype(str)
+        objectid = np.asarray(objectid).astype(str)
+        nrows = len(measid)
+        # Sort by exposure and get the row range of every exposure
+        if nrows>0:
+            eindex = dln.create_index(exposure)
+            ind = eindex['index']
+            parts = list(zip(eindex['value'].tolist(),len(ind)*[name],eindex['lo'].tolist(),eindex['num'].tolist()))
+        else:
+            ind = np.zeros(0,int)
+            parts = []
+
+        # Write the columns to a new directory
+        path = self._newpath(name)
+        np.save(os.path.join(path,'measid.npy'),measid[ind])
+        np.save(os.path.join(path,'objectid.npy'),objectid[ind])
+
+        # Swap the index rows over in one transaction
+        self._swap(name,path,nrows,parts)
+        return nrows
+
+    def _newpath(self,name):
+        """ New unique directory for a segment."""
+        pix,split = segmentinfo(name)
+        segdir = os.path.join(self.rootdir,'segments',str(pix//1000))
+        if os.path.exists(segdir) is False:
+            try:
+                os.makedirs(segdir)
+            except:
+                pass
+        return tempfile.mkdtemp(prefix=name+'.',dir=segdir)
+
+    def _swap(self,name,path=None,nrows=0,parts=None):
+        """ Point the index at the new segment directory PATH of NAME, or remove NAME
+        if PATH is None, in one transaction.  The old directory is retired."""
+        pix,split = segmentinfo(name)
+        sess = self._session()
+        sess.db.execute('BEGIN IMMEDIATE')
+        old = sess.db.execute('SELECT path FROM segment WHERE name=?',(name,)).fetchall()
+        sess.db.execute('DELETE FROM segment WHERE name=?',(name,))
+        if parts is not None or path is None:
+            sess.db.execute('DELETE FROM part WHERE name=?',(name,))
+        if path is not None:
+            sess.db.execute('INSERT INTO segment(name,pix,split,path,nrows,mtime) VALUES(?,?,?,?,?,?)',
+                            (name,pix,int(split),os.path.relpath(path,self.rootdir),nrows,time.time()))
+        if parts is not None:
+            sess.db.executemany('INSERT INTO part(exposure,name,lo,nrows) VALUES(?,?,?,?)',parts)
+        sess.db.executemany('INSERT INTO retired(path,mtime) VALUES(?,?)',[(p,time.time()) for p, in old])
+        sess.commit()
+        self.purge()
+
+    def purge(self,keep=None):
+        """ Delete the retired segment directories that were replaced more than KEEP
+        seconds ago (default self.keep).  Returns the number deleted."""
+        if keep is None: keep=self.keep
+        sess = self._session()
+        sess.db.execute('BEGIN IMMEDIATE')
+        tmax = time.time()-keep
+        old = sess.db.execute('SELECT path FROM retired WHERE mtime<=?',(tmax,)).fetchall()
+        sess.db.execute('DELETE FROM retired WHERE mtime<=?',(tmax,))
+        sess.commit()
+        for p, in old:
+            self._mmaps.pop(p,None)
+            shutil.rmtree(os.path.join(self.rootdir,p),ignore_errors=True)
+        return len(old)
+
+    def renumber(self,name,oldid,newid):
+        """ Change the objectids of a segment from OLDID to NEWID.
+
+        Only a new objectid column is written, the measid column is
+        hard-linked into the new segment directory.
+        """
+        sess = self._session()
+        data = sess.db.execute('SELECT path,nrows FROM segment WHERE name=?',(name,)).fetchall()
+        if len(data)==0:
+            raise ValueError('No segment '+name+' in '+self.rootdir)
+        oldpath,nrows = data[0]
+        objectid = np.load(os.path.join(self.rootdir,oldpath,'objectid.npy'))
+        oldid = np.asarray(oldid).astype(str)
+        newid = np.asarray(newid).astype(str)
+        ind1,ind2 = dln.match(objectid,oldid)
+        objectid = objectid.astype(np.result_type(objectid,newid))
+        objectid[ind1] = newid[ind2]
+        path = self._newpath(name)
+        try:
+            os.link(os.path.join(self.rootdir,oldpath,'measid.npy'),os.path.join(path,'measid.npy'))
+        except OSError:
+            shutil.copyfile(os.path.join(self.rootdir,oldpath,'measid.npy'),os.path.join(path,'measid.npy'))
+        np.save(os.path.join(path,'objectid.npy'),objectid)
+        # Same rows in the same order, the exposure row ranges stay
+        self._swap(name,path,nrows)
+        return len(ind1)
+
+    def addidstrdb(self,dbfile,name=None):
+        """ Add the idstr table of a combine PIX_idstr.db database as a segment."""
+        if name is None:
+            name = os.path.basename(dbfile)[0:-9]  # remove _idstr.db ending
+        dtype = np.dtype([('measid',(str,200)),('exposure',(str,200)),('objectid',(str,200))])
+        sess = dbsession.getsession(dbfile)
+        cat = sess.queryarray('SELECT measid,exposure,objectid FROM idstr',dtype)
+        dbsession.closesession(dbfile)
+        return self.append(name,cat['measid'],cat['exposure'],cat['objectid'])
+
+    def remove(self,name):
+        """ Remove a segment."""
+        self._swap(name)
+
+    def _columns(self,path):
+        """ Memory-mapped columns of a segment."""
+        cols = self._mmaps.get(path)
+        if cols is None:
+            if len(self._mmaps)>=256: self._mmaps = {}
+            cols = (np.load(os.path.join(self.rootdir,path,'measid.npy'),mmap_mode='r'),
+                    np.load(os.path.join(self.rootdir,path,'objectid.npy'),mmap_mode='r'))
+            self._mmaps[path] = cols
+        return cols
+
+    def getexposure(self,exposure,dedup=True):
+        """ All of the measid/objectid pairs of an exposure.
+
+        Parameters
+        ----------
+        exposure : str
+           Exposure name.
+        dedup : bool, optional
+           If a pixel has both a full and high-resolution split segments,
+           always use the split ones.  Default is True.
+
+        Returns
+        -------
+        cat : numpy structured array
+           The MEASID, OBJECTID and parent PIX of the measurements.
+
+        """
+        dtype = np.dtype([('name',(str,100)),('pix',int),('split',bool),('path',(str,500)),('lo',int),('nrows',int)])
+        cmd = 'SELECT p.name,s.pix,s.split,s.path,p.lo,p.nrows FROM part p JOIN segment s ON p.name=s.name WHERE p.exposure=?'
+        cur = self._session().db.execute(cmd,(exposure,))
+        parts = np.fromiter(cur,dtype=dtype)
+        if dedup and len(parts)>0:
+            splitpix = np.unique(parts['pix'][parts['split']])
+            parts = parts[parts['split'] | ~np.isin(parts['pix'],splitpix)]
+        cat = np.zeros(np.sum(parts['nrows']),dtype=dtype_id)
+        count = 0
+        for p in parts:
+            measid,objectid = self._columns(p['path'])
+            n = p['nrows']
+            cat['measid'][count:count+n] = measid[p['lo']:p['lo']+n]
+            cat['objectid'][count:count+n] = objectid[p['lo']:p['lo']+n]
+            cat['pix'][count:count+n] = p['pix']
+            count += n
+        return cat
+
+
+    def getpixel(self,pix,dedup=True):
+        """ All of the measid/exposure/objectid rows of the segments of a HEALPix pixel.
+
+        If the pixel has both a full and high-resolution split segments,
+        only the split ones are used unless DEDUP is False.  A measurement in
+        the buffer of two split segments is returned twice.
+        """
+        dtype = np.dtype([('measid',(str,50)),('exposure',(str,50)),('objectid',(str,50))])
+        sess = self._session()
+        segs = sess.db.execute('SELECT name,split,path FROM segment WHERE pix=? ORDER BY name',(int(pix),)).fetchall()
+        if dedup and any([sp for n,sp,p in segs]):
+            segs = [sg for sg in segs if sg[1]]
+        cats = []
+        for name,split,path in segs:
+            measid,objectid = self._columns(path)
+            parts = sess.db.execute('SELECT exposure,lo,nrows FROM part WHERE name=? ORDER BY lo',(name,)).fetchall()
+            cat = np.zeros(len(measid),dtype=dtype)
+            cat['measid'] = measid
+            cat['objectid'] = objectid
+            for exposure,lo,nrows in parts:
+                cat['exposure'][lo:lo+nrows] = exposure
+            cats.append(cat)
+        if len(cats)==0:
+            return np.zeros(0,dtype=dtype)
+        return np.hstack(cats)
+
+
+def simidstr(npix=50,nexp=400,nperexp=20,nmeas=2000,seed=0):
+    """ Simulate the idstr tables of NPIX pixels that each see NPEREXP of NEXP exposures."""
+    rnd = np.random.RandomState(seed)
+    exposures = np.char.add(np.char.add('c4d_160101_',np.char.zfill(np.arange(nexp).astype(str),6)),'_ooi_g_v1')
+    cats = []
+    for i in range(npix):
+        name = str(1000+i)
+        if i % 10 == 9: name = str(1000+i-1)+'_n256_'+str(i)    # some high-resolution ones
+        expind = rnd.choice(nexp,nperexp,replace=False)
+        n = rnd.randint(nmeas//2,nmeas*3//2,nperexp)
+        exposure = np.repeat(exposures[expind],n)
+        rnd.shuffle(exposure)
+        measid = np.char.add(np.char.add(exposure,'.'),np.arange(len(exposure)).astype(str))
+        measid = np.char.add(measid,'.'+name)
+        objectid = np.char.add(name+'.',rnd.randint(0,len(exposure)//5+1,len(exposure)).astype(str))
+        cats.append((name,measid,exposure,objectid))
+    return cats
+
+def _appendone(args):
+    rootdir,name,measid,exposure,objectid = args
+    store = IdStore(rootdir)
+    store.append(name,measid,exposure,objectid)
+    store.close()
+    return len(measid)
+
+def writenpy(iddir,name,measid,exposure,objectid):
+    """ The old breakup_idstr() layout, one .npy file per exposure and pixel."""
+    eindex = dln.create_index(exposure)
+    df = np.dtype([('measid',(str,np.max(dln.strlen(measid))+1)),('objectid',(str,np.max(dln.strlen(objectid))+1))])
+    for k in range(len(eindex['value'])):
+        ind = eindex['index'][eindex['lo'][k]:eindex['hi'][k]+1]
+        cat = np.zeros(len(ind),dtype=df)
+        cat['measid'] = measid[ind]
+        cat['objectid'] = objectid[ind]
+        edir = os.path.join(iddir,eindex['value'][k])
+        if os.path.exists(edir) is False: os.makedirs(edir)
+        np.save(os.path.join(edir,eindex['value'][k]+'__'+name+'.npy'),cat)
+
+def readnpy(iddir,exp):
+    """ The old exposure_update() loading of the .npy files of an exposure."""
+    allfiles = glob(os.path.join(iddir,exp,exp+'__*.npy'))
+    base = [os.path.splitext(os.path.basename(f))[0] for f in allfiles]
+    hfile = [f.split('__')[-1] for f in base]
+    hh = [f.split('_')[0] for f in hfile]  # the healpix portion
+    hindex = dln.create_index(hh)
+    files = []
+    for j in range(len(hindex['value'])):
+        hpix1 = hindex['value'][j]
+        hind = hindex['index'][hindex['lo'][j]:hindex['hi'][j]+1]
+        files1 = np.array(allfiles)[hind]
+        # duplicates, use the split/hires ones
+        if hindex['num'][j]>1:
+            gd = dln.grep(files1,str(hpix1)+'_n',index=True)
+            files += list(files1[gd])
+        else:
+            files += list(files1)
+    idcat = [np.load(f) for f in files]
+    if len(idcat)==0:
+        return np.zeros(0,dtype=np.dtype([('measid',(str,50)),('objectid',(str,50))]))
+    return np.hstack(idcat)
+
+def benchmark(npix=50,nexp=400,nperexp=20,nmeas=2000,nproc=[1,4],tmpdir=None):
+    """ Benchmark the write and exposure-update sweep throughput against the per-exposure .npy files."""
+    cats = simidstr(npix,nexp,nperexp,nmeas)
+    nrows = np.sum([len(c[1]) for c in cats])
+    print(str(npix)+' pixels, '+str(nexp)+' exposures, '+str(nrows)+' rows')
+    outdir = tempfile.mkdtemp(prefix='idstore',dir=tmpdir)
+    results = {}
+    try:
+        # Old layout
+        iddir = os.path.join(outdir,'npy')
+        t0 = time.time()
+        for c in cats: writenpy(iddir,*c)
+        dt = time.time()-t0
+        nfiles = len(glob(os.path.join(iddir,'*','*.npy')))
+        print('npy files    write %6.2f sec  %10.0f rows/s  (%d files)' % (dt,nrows/dt,nfiles))
+        results['npy_write'] = dt
+        # Store, with concurrent pixel jobs
+        for n in nproc:
+            rootdir = os.path.join(outdir,'store'+str(n))
+            t0 = time.time()
+            args = [(rootdir,)+c for c in cats]
+            if n>1:
+                IdStore(rootdir).close()
+                with multiprocessing.Pool(n) as pool:
+                    nwrite = np.sum(pool.map(_appendone,args))
+            else:
+                nwrite = np.sum([_appendone(a) for a in args])
+            dt = time.time()-t0
+            print('store %2d procs write %6.2f sec  %10.0f rows/s' % (n,dt,nwrite/dt))
+            results['store_write_'+str(n)] = dt
+        # Exposure-update sweep
+        store = IdStore(rootdir)
+        exposures = store.exposures()['exposure']
+        t0 = time.time()
+        ncheck = 0
+        for exp in exposures: ncheck += len(readnpy(iddir,exp))
+        dt0 = time.time()-t0
+        print('npy files    sweep %6.2f sec  %8.1f exposures/s  %10.0f rows/s' % (dt0,len(exposures)/dt0,ncheck/dt0))
+        t0 = time.time()
+        same = True
+        nread = 0
+        for exp in exposures:
+            cat = store.getexposure(exp)
+            nread += len(cat)
+        dt = time.time()-t0
+        print('store        sweep %6.2f sec  %8.1f exposures/s  %10.0f rows/s  speed-up %5.1f' % (dt,len(exposures)/dt,nread/dt,dt0/dt))
+        # Check that they agree
+        for exp in exposures[0:50]:
+            old = np.sort(readnpy(iddir,exp)['measid'])
+            new = np.sort(store.getexposure(exp)['measid'])
+            same &= np.array_equal(old,new)
+        print('same=%s' % same)
+        store.close()
+        results['npy_sweep'] = dt0
+        results['store_sweep'] = dt
+        results['same'] = same
+    finally:
+        shutil.rmtree(outdir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Add idstr databases to the exposure-partitioned idstr store.')
+    parser.add_argument('rootdir', type=str, nargs='?', default=None, help='Store directory')
+    parser.add_argument('dbfile', type=str, nargs='*', help='Idstr database files or @listfile')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark on simulated idstr tables')
+    parser.add_argument('--nproc', type=int, default=4, help='Number of processes for the benchmark')
+    parser.add_argument('--purge', type=float, default=None, help='Delete the segment directories replaced more than this many seconds ago')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(nproc=[1,args.nproc])
+        sys.exit()
+
+    if args.purge is not None:
+        store = IdStore(args.rootdir)
+        print(str(store.purge(args.purge))+' retired segment directories deleted')
+        store.close()
+        sys.exit()
+
+    dbfiles = []
+    for f in args.dbfile:
+        # Input is a list
+        if f[0]=='@':
+            dbfiles += dln.readlines(f[1:])
+        else:
+            dbfiles.append(f)
+    store = IdStore(args.rootdir)
+    for i,f in enumerate(dbfiles):
+        if os.path.exists(f) is False:
+            print(str(i+1)+' '+f+' NOT FOUND')
+            continue
+        t0 = time.time()
+        nrows = store.addidstrdb(f)
+        print(str(i+1)+' '+f+' '+str(nrows)+' rows  %5.1f sec.' % (time.time()-t0))
+    store.close()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+#
+# MASKPREP.PY -- CP data-quality masks to SExtractor flag images
+#
+# phot.runsex() and the HDU loop of nsc_instcal_measure.py turn the CP
+# mask of every chip into the bitmask for SExtractor with a chain of
+# whole-array operations (a copy, 2**(mask-1) on the nonzero pixels, or
+# five bitwise_and/compare/multiply/add passes for the pre-V3.5.0 DECam
+# masks).  The masked regions are then grown by convolving the mask with a
+# box as large as the detection filter plus two pixels, and the mask is
+# written to mask.fits a second time.
+#
+# The conversion only depends on the value of each pixel, so convert()
+# applies every rule once to all the values the mask type can hold (65536
+# for the 16-bit CP masks) and then translates the chip with one lookup.
+# Because the table is made by the original code, the result is the same
+# bit for bit.  grow() only needs to know whether a pixel has a masked
+# pixel within the box, which is a binary dilation with a rectangle.  It
+# is separable, the OR of a few shifted copies of the boolean array
+# along the rows and then along the columns.  prepare() does both and
+# returns the arrays, so the flag image is written only once.
+#
+# "python maskprep.py --benchmark" times both on synthetic 4094x2046 masks
+# and checks that the outputs are identical.
+
+from __future__ import print_function
+
+import numpy as np
+import time
+from argparse import ArgumentParser
+from scipy.ndimage import convolve
+
+# Lookup tables, by rule and mask type
+_LUTS = {}
+# Masks with integer types wider than this many bits are translated
+#  over their range of values instead of the full type
+MAXLUTBITS = 16
+
+
+def maskrule(instcode,plver):
+    """ Which conversion the CP mask of this instrument and pipeline version needs.
+
+    Returns 'integer' (V3.5.0 on, Mosaic3 and 90Prime, the mask value is the
+    number of the bit), 'bits' (DECam before V3.5.0, the CP bits are moved) or
+    None (the mask is used as it is).
+    """
+    if ((instcode=='c4d') & (plver>='V3.5.0')) | (instcode=='k4m') | (instcode=='ksb'):
+        return 'integer'
+    if (instcode=='c4d') & (plver<'V3.5.0'):
+        return 'bits'
+    return None
+
+
+def oldconvert(mask,instcode,plver):
+    """ The conversion of phot.runsex() and nsc_instcal_measure.py, in place."""
+    # Turn the mask from integer to bitmask
+    if ((instcode=='c4d') & (plver>='V3.5.0')) | (instcode=='k4m') | (instcode=='ksb'):
+         #  1 = bad (in static bad pixel mask) -> 1
+         #  2 = no value (for stacks)          -> 2
+         #  3 = saturated                      -> 4
+         #  4 = bleed mask                     -> 8
+         #  5 = cosmic ray                     -> 16
+         #  6 = low weight                     -> 32
+         #  7 = diff detect                    -> 64
+         omask = mask.copy()
+         mask *= 0
+         nonzero = (omask>0)
+         mask[nonzero] = 2**((omask-1)[nonzero])    # This takes about 1 sec
+    # Fix the DECam Pre-V3.5.0 masks
+    if (instcode=='c4d') & (plver<'V3.5.0'):
+      # --CP bit masks, Pre-V3.5.0 (PLVER)
+      # Bit   DQ Type  PROCTYPE
+      # 1  detector bad pixel          ->  1
+      # 2  saturated                   ->  4
+      # 4  interpolated                ->  32
+      # 16  single exposure cosmic ray ->  16
+      # 64  bleed trail                ->  8
+      # 128  multi-exposure transient  ->  0 TURN OFF
+      omask = mask.copy()
+      mask *= 0     # re-initialize
+      mask += (np.bitwise_and(omask,1)==1) * 1    # bad pixels
+      mask += (np.bitwise_and(omask,2)==2) * 4    # saturated
+      mask += (np.bitwise_and(omask,4)==4) * 32   # interpolated
+      mask += (np.bitwise_and(omask,16)==16) * 16  # cosmic ray
+      mask += (np.bitwise_and(omask,64)==64) * 8   # bleed trail
+    return mask
+
+
+def lut(rule,dtype,lo=None,hi=None):
+    """ Lookup table of a conversion rule for all the values of an integer type.
+
+    For types of up to MAXLUTBITS bits the table is indexed by the bit pattern
+    of the value (use it with np.take(...,mode='wrap')), otherwise it covers the
+    values LO to HI and is indexed by value-LO.
+    """
+    dtype = np.dtype(dtype).newbyteorder('=')
+    full = (dtype.itemsize*8 <= MAXLUTBITS)
+    key = (rule,dtype.str) if full else (rule,dtype.str,lo,hi)
+    if key in _LUTS: return _LUTS[key]
+    if full:
+        nbits = dtype.itemsize*8
+        values = np.arange(2**nbits,dtype=np.dtype('u%d' % dtype.itemsize)).view(dtype)
+    else:
+        values = np.arange(lo,hi+1,dtype=dtype)
+    instcode,plver = {'integer':('c4d','V3.5.0'), 'bits':('c4d','V3.4.0')}[rule]
+    table = oldconvert(values.copy(),instcode,plver)
+    if full: _LUTS[key] = table
+    return table
+
+
+def convert(mask,instcode,plver):
+    """ Convert a CP mask to the SExtractor bitmask with one table lookup.
+
+    Parameters
+    ----------
+    mask : numpy array
+       The CP data-quality mask (integer type).  It is not modified.
+    instcode : str
+       The instrument code (c4d, k4m or ksb).
+    plver : str
+       The CP pipeline version (PLVER).
+
+    Returns
+    -------
+    out : numpy array
+       The bitmask, identical to the in-place conversion in phot.runsex().
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        sexmask = convert(mask,'c4d','V3.9')
+
+    """
+    rule = maskrule(instcode,plver)
+    if rule is None: return mask
+    if mask.dtype.kind not in 'iu':
+        return oldconvert(mask.copy(),instcode,plver)
+    if mask.dtype.itemsize*8 <= MAXLUTBITS:
+        return np.take(lut(rule,mask.dtype),mask,mode='wrap')
+    # Wider integer types, table over the range of values if it is small
+    lo,hi = int(mask.min()),int(mask.max())
+    if hi-lo >= 2**MAXLUTBITS:
+        return oldconvert(mask.copy(),instcode,plver)
+    table = lut(rule,mask.dtype,lo,hi)
+    return table[mask.astype(np.int64)-lo]
+
+
+def oldgrow(mask,kernel):
+    """ The mask growing of phot.runsex() and nsc_instcal_measure.py."""
+    mask2 = convolve(mask,kernel,mode="reflect")
+    bad = ((mask == 0) & (mask2 > 0))
+    newmask = np.copy(mask)
+    newmask[bad] = 1     # mask out the neighboring pixels
+    return newmask
+
+
+def dilate(masked,shape):
+    """ Binary dilation with a SHAPE rectangle, with the window of scipy's convolve
+        (centered, one pixel lower for even sizes).  Separable, along each axis the
+        result is the OR of the shifted copies of the array."""
+    out = masked
+    for axis,size in enumerate(shape):
+        if size <= 1: continue
+        # convolve() flips the kernel, for even sizes that moves the window
+        before = size//2 - (1 if (size % 2)==0 else 0)
+        n = out.shape[axis]
+        new = out.copy()
+        for k in range(-before,size-before):
+            if (k==0) | (abs(k)>=n): continue
+            dst = [slice(None)]*out.ndim
+            src = [slice(None)]*out.ndim
+            dst[axis] = slice(0,n-k) if k>0 else slice(-k,n)
+            src[axis] = slice(k,n) if k>0 else slice(0,n+k)
+            new[tuple(dst)] |= out[tuple(src)]
+        out = new
+    return out
+
+
+def grow(mask,shape):
+    """ Grow the masked regions, like convolving with a box and flagging (with 1) the unmasked
+    pixels that got a nonzero value.
+
+    Parameters
+    ----------
+    mask : numpy array
+       The bitmask (from convert()), not modified.
+    shape : tuple
+       The shape of the box (the kernel from sexconfig.growkernel()).
+
+    Returns
+    -------
+    newmask : numpy array
+       The grown mask.
+
+    """
+    masked = (mask != 0)
+    bad = dilate(masked,shape)
+    bad[masked] = False
+    newmask = np.copy(mask)
+    newmask[bad] = 1     # mask out the neighboring pixels
+    return newmask
+
+
+def prepare(mask,wt,instcode,plver,kernel=None):
+    """ SExtractor flag image and weight map of a chip, in memory.
+
+    Parameters
+    ----------
+    mask : numpy array
+       The CP mask.
+    wt : numpy array
+       The CP weight map.  The masked (and negative) pixels are set to 0 in place.
+    instcode : str
+       The instrument code.
+    plver : str
+       The CP pipeline version.
+    kernel : numpy array, optional
+       The box to grow the masked regions with.  Not grown if None.
+
+    Returns
+    -------
+    flagmask : numpy array
+       The flag image.
+    wt : numpy array
+       The weight map.
+    sexmask : numpy array
+       The converted mask before growing.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        flagmask,wt,sexmask = prepare(mask,wt,'c4d','V3.9',tmpl.kernel)
+
+    """
+    sexmask = convert(mask,instcode,plver)
+    # Mask out bad pixels in WEIGHT image
+    #  set wt=0 for mask>0 pixels
+    wt[ (sexmask>0) | (wt<0) ] = 0   # CP sets bad pixels to wt=0 or sometimes negative
+    flagmask = grow(sexmask,kernel.shape) if kernel is not None else sexmask
+    return flagmask, wt, sexmask
+
+
+def simmask(ny=4094,nx=2046,rule='integer',seed=5):
+    """ Synthetic CP mask: bad columns, saturated stars with bleed trails, cosmic rays, edges."""
+    rnd = np.random.RandomState(seed)
+    vals = {'integer':{'bad':1,'sat':3,'bleed':4,'cr':5,'low':6,'diff':7,'novalue':2},
+            'bits':{'bad':1,'sat':2,'bleed':64,'cr':16,'low':4,'diff':128,'novalue':4}}[rule]
+    mask = np.zeros((ny,nx),np.int16)
+    edge = min(15,nx//8)
+    mask[:,0:edge] = vals['low']
+    mask[:,-edge:] = vals['low']
+    for x in rnd.randint(2*edge,nx-2*edge,6):
+        mask[rnd.randint(0,ny//2):,x] = vals['bad']
+    for i in range(40):
+        y,x = rnd.randint(2*edge,ny-2*edge),rnd.randint(2*edge,nx-2*edge)
+        r = rnd.randint(2,6)
+        mask[y-r:y+r+1,x-r:x+r+1] = vals['sat']
+        mask[max(y-8*r,0):y+8*r,x] = vals['bleed']
+    n = int(ny*nx*2e-3)
+    mask[rnd.randint(0,ny,n),rnd.randint(0,nx,n)] = vals['cr']
+    n = int(ny*nx*1e-4)
+    mask[rnd.randint(0,ny,n),rnd.randint(0,nx,n)] = vals['diff']
+    mask[rnd.randint(0,ny,n),rnd.randint(0,nx,n)] = vals['novalue']
+    if rule=='bits':
+        # combined bits
+        n = int(ny*nx*1e-4)
+        mask[rnd.randint(0,ny,n),rnd.randint(0,nx,n)] |= (vals['cr'] | vals['sat'])
+    return mask
+
+
+def benchmark(ny=4094,nx=2046,nrepeat=3):
+    """ Time the old and the lookup conversion and the convolve and separable growing
+    of the mask of a chip, and check that they give the same arrays.
+    """
+    def timeit(func,*args):
+        best = np.inf
+        for i in range(nrepeat):
+            t0 = time.time()
+            out = func(*args)
+            best = min(best,time.time()-t0)
+        return out,best
+
+    ok = True
+    print('%dx%d mask' % (ny,nx))
+    print('%-26s %9s %9s %8s %6s' % ('','old ms','new ms','speedup','same'))
+    for instcode,plver,rule in [('c4d','V3.9','integer'),('k4m','V4.8.2','integer'),('c4d','V3.4.1','bits')]:
+        mask = simmask(ny,nx,rule)
+        # FITS data are big-endian
+        mask = mask.astype('>i2')
+        old,told = timeit(lambda m: oldconvert(m.copy(),instcode,plver),mask)
+        lut(rule,mask.dtype)     # the table is made once per process
+        new,tnew = timeit(convert,mask,instcode,plver)
+        same = np.array_equal(old,new) and (old.dtype.newbyteorder('=')==new.dtype.newbyteorder('='))
+        ok &= same
+        print('%-26s %9.1f %9.1f %7.1fx %6s' % ('convert '+instcode+' '+plver,1e3*told,1e3*tnew,told/tnew,same))
+
+        # Box from the default 3x3 filter and larger ones
+        for shape in [(5,5),(9,9)]:
+            kernel = np.ones(shape,dtype='i')
+            gold,told = timeit(oldgrow,old,kernel)
+            gnew,tnew = timeit(grow,new,shape)
+            same = np.array_equal(gold,gnew)
+            ok &= same
+            print('%-26s %9.1f %9.1f %7.1fx %6s' % ('grow %dx%d' % shape,1e3*told,1e3*tnew,told/tnew,same))
+
+    # Every value of the 8 and 16-bit types, other types, even and odd boxes and edges
+    for dtype in ['>i2','<i2','u1','>i4','i8']:
+        for instcode,plver in [('c4d','V3.9'),('c4d','V3.4.1'),('k4m','V1')]:
+            if np.dtype(dtype).itemsize <= 2:
+                values = np.arange(2**(8*np.dtype(dtype).itemsize),dtype='u%d' % np.dtype(dtype).itemsize).view(dtype)
+            else:
+                values = np.arange(-300,300,dtype=dtype)
+            # (the old code cannot add the bits to an unsigned mask, neither can the table)
+            try:
+                old = oldconvert(values.copy(),instcode,plver)
+            except TypeError:
+                old = None
+            try:
+                new = convert(values,instcode,plver)
+            except TypeError:
+                new = None
+            ok &= (old is None and new is None) or np.array_equal(old,new)
+    small = simmask(64,48,'integer',seed=2)
+    small[0,0] = small[-1,-1] = small[0,-1] = small[-1,0] = 1
+    small = convert(small,'c4d','V3.9')
+    for shape in [(1,1),(2,2),(4,6),(3,8),(7,4),(5,5)]:
+        ok &= np.array_equal(oldgrow(small,np.ones(shape,dtype='i')),grow(small,shape))
+    print('all 8/16-bit values, other types and even/odd boxes identical = %s' % ok)
+
+    # Whole chip, conversion + weight + growing
+    mask = simmask(ny,nx,'integer').astype('>i2')
+    wt = np.ones((ny,nx),np.float32)
+    kernel = np.ones((5,5),dtype='i')
+    def oldprep(mask,wt):
+        m = oldconvert(mask.copy(),'c4d','V3.9')
+        w = wt.copy()
+        w[ (m>0) | (w<0) ] = 0
+        return oldgrow(m,kernel),w
+    def newprep(mask,wt):
+        flagmask,w,sexmask = prepare(mask,wt.copy(),'c4d','V3.9',kernel)
+        return flagmask,w
+    (mold,wold),told = timeit(oldprep,mask,wt)
+    (mnew,wnew),tnew = timeit(newprep,mask,wt)
+    same = np.array_equal(mold,mnew) & np.array_equal(wold,wnew)
+    ok &= same
+    print('%-26s %9.1f %9.1f %7.1fx %6s' % ('chip (mask+weight+grow)',1e3*told,1e3*tnew,told/tnew,same))
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='CP mask to SExtractor flag image conversion.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--ny', type=int, default=4094, help='Chip Y size')
+    parser.add_argument('--nx', type=int, default=2046, help='Chip X size')
+    parser.add_argument('--nrepeat', type=int, default=3, help='Number of timing repeats')
+    args = parser.parse_args()
+    benchmark(args.ny,args.nx,args.nrepeat)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# Streaming, preallocated loading of the chip-level measurement catalogs.
+#
+# loadmeas() used to read the chip catalogs one at a time and grow the
+# compact in-memory catalog with add_elements(), which copies it every
+# time.  loadchips() sizes the output once from the NAXIS2 of the chip
+# headers, gives every chip its own slice of the preallocated array, and
+# reads, fixes and cuts the chips in a thread pool that writes straight into
+# those slices.  A single pass at the end squeezes out the rows removed by
+# the region cut, so the rows are in the same order as the serial loader.
+# With a writer (measurement store or database) the filtered chips are
+# passed to it in chip order instead, with a bounded read-ahead.
+
+import os
+import numpy as np
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from astropy.io import fits
+from astropy.table import Table
+from dlnpyutils import utils as dln, coords
+
+# Number of columns of the chip-level measurement catalogs
+NCOLUMNS = 32
+
+def chipsize(chfile):
+    """ Number of rows of a chip catalog from its header."""
+    return fits.getheader(chfile,1)['NAXIS2']
+
+def readchip(chfile,buffdict=None,verbose=False):
+    """ Read a chip catalog, fix the FWHM and RAERR/DECERR values and cut to the region+buffer.
+
+    Returns the catalog or None if it has the wrong format or no rows in the region.
+    """
+    cat1 = fits.getdata(chfile,1)
+
+    # Make sure it's in the right format
+    if len(cat1.dtype.fields) != NCOLUMNS:
+        if verbose: print('  This catalog does not have the right format. Skipping')
+        return None
+
+    # Fix negative FWHM values
+    #  use A_WORLD and B_WORLD which are never negative
+    bd,nbd = dln.where(cat1['FWHM']<0.1)
+    if nbd>0:
+        cat1['FWHM'][bd] = np.sqrt(cat1['ASEMI'][bd]**2+cat1['BSEMI'][bd]**2)*2.35
+    # Fix RAERR=DECERR=0
+    bd,nbd = dln.where(cat1['RAERR']<0.0001)
+    if nbd>0:
+        snr = 1.087/cat1['MAGERR_AUTO'][bd]
+        coorderr = 0.664*cat1['FWHM'][bd]/snr
+        cat1['RAERR'][bd] = coorderr
+        cat1['DECERR'][bd] = coorderr
+
+    # Only include sources inside Boundary+Buffer zone
+    #  -use ROI_CUT
+    #  -reproject to tangent plane first so we don't have to deal
+    #     with RA=0 wrapping or pol issues
+    if buffdict is not None:
+        lon, lat = coords.rotsphcen(cat1['ra'],cat1['dec'],buffdict['cenra'],buffdict['cendec'],gnomic=True)
+        ind_out, ind_in = dln.roi_cut(buffdict['lon'],buffdict['lat'],lon,lat)
+        if dln.size(ind_in)==0:
+            return None
+        cat1 = cat1[ind_in]
+    if len(cat1)==0:
+        return None
+    return cat1
+
+
+def loadchips(chfiles,dtype=None,buffdict=None,writer=None,nthreads=4,verbose=False):
+    """ Load chip catalogs concurrently into a preallocated catalog or a writer.
+
+    Parameters
+    ----------
+    chfiles : list
+       Chip-level measurement files.
+    dtype : numpy dtype, optional
+       Data type of the output catalog, the columns are filled from the
+       upper-case chip columns.  Needed if WRITER is not given.
+    buffdict : dict, optional
+       The region+buffer to cut the measurements to.
+    writer : function, optional
+       Function that is called with each filtered chip catalog, in chip order.
+    nthreads : int, optional
+       Number of reader threads.  Default is 4.
+    verbose : bool, optional
+       Verbose output.  Default is False.
+
+    Returns
+    -------
+    cat : numpy structured array
+       The measurements, empty if WRITER is given.
+    counts : numpy array
+       Number of measurements loaded from each chip.
+    stats : dict
+       Number of chips, rows and bytes read, time, rows/s and MB/s.
+
+    """
+
+    t0 = time.time()
+    nchips = len(chfiles)
+    counts = np.zeros(nchips,int)
+    nbytes = np.sum([os.path.getsize(f) for f in chfiles]) if nchips>0 else 0
+    nthreads = max(1,min(nthreads,nchips))
+    cat = np.array([])
+
+    with ThreadPoolExecutor(nthreads) as executor:
+        # Stream the chips to the writer in order, a few chips ahead
+        if writer is not None:
+            nahead = 4*nthreads
+            futures = {}
+            for i in range(nchips):
+                while len(futures)<nahead and i+len(futures)<nchips:
+                    j = i+len(futures)
+                    futures[j] = executor.submit(readchip,chfiles[j],buffdict,verbose)
+                cat1 = futures.pop(i).result()
+                if cat1 is not None:
+                    writer(cat1)
+                    counts[i] = len(cat1)
+                if verbose: print('  '+chfiles[i]+'  '+str(counts[i])+' measurements')
+
+        # Preallocate from the headers and write straight into the chip slices
+        else:
+            sizes = np.array(list(executor.map(chipsize,chfiles)),int) if nchips>0 else np.zeros(0,int)
+            offset = np.hstack((0,np.cumsum(sizes)))
+            cat = np.zeros(offset[-1],dtype=dtype)
+
+            def loadone(i):
+                cat1 = readchip(chfiles[i],buffdict,verbose)
+                if cat1 is None: return 0
+                ncat1 = len(cat1)
+                lo = offset[i]
+                for n in dtype.names: cat[n][lo:lo+ncat1] = cat1[n.upper()]
+                return ncat1
+
+            counts[:] = list(executor.map(loadone,range(nchips)))
+            # Squeeze out the rows that were cut, one copy
+            if np.sum(counts)<len(cat):
+                keep = np.zeros(len(cat),bool)
+                gd, = np.where(counts>0)
+                if len(gd)>0:
+                    ind = np.repeat(offset[gd]-np.cumsum(np.hstack((0,counts[gd][0:-1]))),counts[gd])+np.arange(np.sum(counts))
+                    keep[ind] = True
+                cat = cat[keep]
+
+    dt = time.time()-t0
+    nrows = int(np.sum(counts))
+    stats = {'nchips':nchips,'nrows':nrows,'nbytes':nbytes,'dt':dt,'rowrate':nrows/max(dt,1e-9),'mbrate':nbytes/1e6/max(dt,1e-9)}
+    print('%d chips, %d measurements in %6.2f sec.  %10.0f rows/s  %8.1f MB/s' %
+          (nchips,nrows,dt,stats['rowrate'],stats['mbrate']))
+    return cat, counts, stats
+
+
+def growload(chfiles,dtype,buffdict=None):
+    """ The old loader, one chip at a time growing the catalog, kept as a reference."""
+    cat = None
+    ncat = 0
+    catcount = 0
+    for chfile in chfiles:
+        cat1 = readchip(chfile,buffdict)
+        if cat1 is None: continue
+        ncat1 = len(cat1)
+        if cat is None:
+            cat = np.zeros(np.maximum(100000,ncat1),dtype=dtype)
+            ncat = len(cat)
+        if (catcount+ncat1)>ncat:
+            old = cat
+            cat = np.zeros(ncat+np.maximum(100000,ncat1),dtype=dtype)
+            cat[0:ncat] = old
+            del old
+            ncat = len(cat)
+        for n in dtype.names: cat[n][catcount:catcount+ncat1] = cat1[n.upper()]
+        catcount += ncat1
+    if cat is None: return np.array([])
+    return cat[0:catcount]
+
+# Columns of the chip-level measurement catalogs
+chipcols = ['MEASID','OBJECTID','EXPOSURE','CCDNUM','FILTER','MJD','X','Y','RA','RAERR','DEC','DECERR',
+            'MAG_AUTO','MAGERR_AUTO','MAG_APER1','MAGERR_APER1','MAG_APER2','MAGERR_APER2','MAG_APER4',
+            'MAGERR_APER4','MAG_APER8','MAGERR_APER8','KRON_RADIUS','ASEMI','ASEMIERR','BSEMI','BSEMIERR',
+            'THETA','THETAERR','FWHM','FLAGS','CLASS_STAR']
+
+def simchipfiles(outdir,nchips=200,nrows=5000,seed=0):
+    """ Write synthetic chip-level measurement catalogs."""
+    rnd = np.random.RandomState(seed)
+    if os.path.exists(outdir) is False: os.makedirs(outdir)
+    chfiles = []
+    for i in range(nchips):
+        n = rnd.randint(nrows//2,nrows*3//2)
+        tab = Table()
+        for c in chipcols:
+            if c in ['MEASID','OBJECTID','EXPOSURE','FILTER']:
+                tab[c] = np.char.add(c[0:3].lower()+'%d.' % i,np.arange(n).astype(str))
+            elif c in ['CCDNUM','FLAGS']:
+                tab[c] = rnd.randint(0,60,n).astype(np.int16)
+            else:
+                tab[c] = rnd.rand(n)
+        tab['RA'] = 120.0+rnd.rand(n)*0.5
+        tab['DEC'] = -30.0+rnd.rand(n)*0.5
+        tab['FWHM'] = rnd.rand(n)*2-0.2        # some negative
+        tab['RAERR'] = rnd.rand(n)*0.01        # some zero-ish
+        tab['DECERR'] = tab['RAERR']
+        tab['MAGERR_AUTO'] = 0.01+rnd.rand(n)*0.1
+        chfile = os.path.join(outdir,'chip%04d_meas.fits' % i)
+        tab.write(chfile,overwrite=True)
+        chfiles.append(chfile)
+    return chfiles
+
+def benchmark(nchips=200,nrows=5000,nthreads=[1,2,4,8],tmpdir=None):
+    """ Benchmark the preallocated parallel loader against the old growing loader."""
+    dtype_cat = np.dtype([('MEASID',(str,30)),('EXPOSURE',(str,40)),('CCDNUM',np.int8),('FILTER',(str,3)),
+                          ('MJD',float),('RA',float),('RAERR',np.float16),('DEC',float),('DECERR',np.float16),
+                          ('MAG_AUTO',np.float16),('MAGERR_AUTO',np.float16),('ASEMI',np.float16),('ASEMIERR',np.float16),
+                          ('BSEMI',np.float16),('BSEMIERR',np.float16),('THETA',np.float16),('THETAERR',np.float16),
+                          ('FWHM',np.float16),('FLAGS',np.int16),('CLASS_STAR',np.float16)])
+    outdir = tempfile.mkdtemp(prefix='measload',dir=tmpdir)
+    try:
+        chfiles = simchipfiles(outdir,nchips,nrows)
+        # Region that cuts some of the measurements
+        lon = np.array([-0.2,0.2,0.2,-0.2])
+        lat = np.array([-0.2,-0.2,0.2,0.2])
+        buffdict = {'cenra':120.25,'cendec':-29.75,'lon':lon,'lat':lat}
+        t0 = time.time()
+        cat0 = growload(chfiles,dtype_cat,buffdict)
+        dt0 = time.time()-t0
+        print('grow loader        %6.2f sec  %d measurements' % (dt0,len(cat0)))
+        results = {'grow':dt0}
+        for nt in nthreads:
+            cat,counts,stats = loadchips(chfiles,dtype_cat,buffdict,nthreads=nt)
+            same = np.array_equal(cat,cat0)
+            print('  %d threads  speed-up %5.2f  same=%s' % (nt,dt0/stats['dt'],same))
+            results[nt] = stats
+    finally:
+        shutil.rmtree(outdir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the measurement loader on synthetic chip catalogs.')
+    parser.add_argument('--nchips', type=int, default=200, help='Number of chip catalogs')
+    parser.add_argument('--nrows', type=int, default=5000, help='Average number of rows per chip')
+    parser.add_argument('--nthreads', type=str, default='1,2,4,8', help='Comma-separated list of number of threads')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Temporary directory')
+    args = parser.parse_args()
+    benchmark(args.nchips,args.nrows,[int(n) for n in args.nthreads.split(',')],args.tmpdir)
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+
+# Temporary measurement stores for the combine step.
+#
+# When a HEALPix pixel has too many measurements to keep in memory, the
+# combine writes every chip catalog into a temporary store and reads it
+# back by RA/DEC range and object label.  Two interchangeable backends are
+# provided:
+#
+#   SqliteMeasStore : the original sqlite "meas" table.
+#   NpyMeasStore    : memory-mapped per-column .npy files sorted by
+#                     NESTED HEALPix with an index of the row ranges of
+#                     each HEALPix cell.  Label updates and row deletes
+#                     are done in place (deletes are tombstones).
+#
+# Both have the same methods: write(), finalize(), count(), radecrange(),
+# getdata(), getcoords(), setlabels(), deleterows(), createindex(),
+# analyze() and remove().  ROWID is only meaningful within one store.
+
+import os
+import numpy as np
+import time
+import json
+import shutil
+import tempfile
+from argparse import ArgumentParser
+import healpy as hp
+import dbsession
+
+# Columns of the measurement store, same as the sqlite meas table
+dtype_meas = np.dtype([('ROWID',int),('MEASID',(str,30)),('OBJLABEL',int),('EXPOSURE',(str,40)),('CCDNUM',int),('FILTER',(str,3)),
+                       ('MJD',float),('RA',float),('RAERR',float),('DEC',float),('DECERR',float),
+                       ('MAG_AUTO',float),('MAGERR_AUTO',float),('ASEMI',float),('ASEMIERR',float),('BSEMI',float),('BSEMIERR',float),
+                       ('THETA',float),('THETAERR',float),('FWHM',float),('FLAGS',int),('CLASS_STAR',float)])
+
+def diskdtype(name):
+    """ On-disk data type of a column, strings are stored as bytes."""
+    dt = dtype_meas[name]
+    if dt.kind=='U':
+        return np.dtype((bytes,dt.itemsize//4))
+    return dt
+
+def openstore(path,backend='sqlite',**kwargs):
+    """ Open a measurement store with the given backend."""
+    if backend=='sqlite':
+        return SqliteMeasStore(path,**kwargs)
+    elif backend=='npy':
+        return NpyMeasStore(path,**kwargs)
+    else:
+        raise ValueError('Backend '+str(backend)+' not supported')
+
+
+class SqliteMeasStore:
+    """ Measurement store using a temporary sqlite database."""
+
+    def __init__(self,dbfile):
+        self.dbfile = dbfile
+
+    def __repr__(self):
+        return 'SqliteMeasStore('+self.dbfile+')'
+
+    def _session(self):
+        return dbsession.getsession(self.dbfile,pragmas=dbsession.SCRATCH_PRAGMAS)
+
+    def _execute(self,cmd,data=None):
+        sess = self._session()
+        if data is None:
+            return sess.execute(cmd)
+        sess.executemany(cmd,data)
+        return []
+
+    def write(self,cat):
+        """ Write a catalog to the database """
+        ncat = len(cat)
+        sess = self._session()
+        if sess.tableexists('meas') is False:
+            sess.execute('''CREATE TABLE meas(measid TEXT, objlabel INTEGER, exposure TEXT, ccdnum INTEGER, filter TEXT, mjd REAL,
+                            ra REAL, raerr REAL, dec REAL, decerr REAL, mag_auto REAL, magerr_auto REAL, asemi REAL, asemierr REAL,
+                            bsemi REAL, bsemierr REAL, theta REAL, thetaerr REAL, fwhm REAL, flags INTEGER, class_star REAL)''')
+        cols = [n for n in dtype_meas.names if n!='ROWID']
+        sess.insert('meas',[c.lower() for c in cols],[np.zeros(ncat,int)-1 if c=='OBJLABEL' else cat[c] for c in cols])
+
+    def finalize(self):
+        """ Nothing to do for sqlite."""
+        pass
+
+    def count(self):
+        """ Number of rows."""
+        return self._execute('SELECT count(*) FROM meas')[0][0]
+
+    def radecrange(self):
+        """ Get RA/DEC ranges [min(ra),max(ra),min(dec),max(dec)]."""
+        return self._execute('SELECT MIN(ra),MAX(ra),MIN(dec),MAX(dec) FROM meas')[0]
+
+    def getdata(self,objlabel=None,rar=None,decr=None,verbose=False):
+        """ Get measurements by OBJLABEL and/or RA/DEC range."""
+        t0 = time.time()
+        where = []
+        if objlabel is not None:
+            if np.size(objlabel)==2:
+                where.append('objlabel>='+str(objlabel[0])+' AND objlabel<='+str(objlabel[1]))
+            else:
+                where.append('objlabel='+str(objlabel))
+        if rar is not None:
+            where.append('ra>='+str(rar[0])+' AND ra<'+str(rar[1]))
+        if decr is not None:
+            where.append('dec>='+str(decr[0])+' AND dec<'+str(decr[1]))
+        cmd = 'SELECT rowid,* FROM meas'
+        if len(where)>0: cmd += ' WHERE '+' AND '.join(where)
+        cat = self._session().queryarray(cmd,dtype_meas)
+        if len(cat)==0:
+            return np.array([])
+        if verbose: print('got data in '+str(time.time()-t0)+' sec.')
+        return cat
+
+    def getcoords(self):
+        """ Get the ROWID and coordinates."""
+        dtype = np.dtype([('ROWID',int),('RA',np.float64),('DEC',np.float64)])
+        return self._session().queryarray('SELECT rowid,ra,dec FROM meas',dtype)
+
+    def setlabels(self,rowid,labels):
+        """ Insert object labels."""
+        self._execute('UPDATE meas SET objlabel=? WHERE rowid=?',zip(np.asarray(labels).tolist(),np.asarray(rowid).tolist()))
+
+    def deleterows(self,rowid):
+        """ Delete rows using ROWID."""
+        self._execute('DELETE from meas WHERE rowid=?',zip(np.asarray(rowid).tolist()))
+
+    def createindex(self,col):
+        """ Index a column."""
+        index_name = 'idx_'+col+'_meas'
+        self._execute('CREATE INDEX IF NOT EXISTS '+index_name+' ON meas('+col+')')
+
+    def analyze(self):
+        """ Run ANALYZE to speed up queries."""
+        self._execute('ANALYZE meas')
+
+    def remove(self):
+        """ Delete the database file."""
+        dbsession.closesession(self.dbfile)
+        if os.path.exists(self.dbfile): os.remove(self.dbfile)
+
+
+class NpyMeasStore:
+    """ Measurement store using memory-mapped per-column .npy files sorted by HEALPix."""
+
+    def __init__(self,storedir,nside=2048):
+        self.storedir = storedir
+        self.nside = nside
+        self.columns = [n for n in dtype_meas.names if n!='ROWID']
+        self._mmap = {}
+        if os.path.exists(storedir) is False:
+            os.makedirs(storedir)
+        metafile = os.path.join(storedir,'store.json')
+        if os.path.exists(metafile):
+            with open(metafile,'r') as f:
+                self.meta = json.load(f)
+            self.nside = self.meta['nside']
+        else:
+            self.meta = {'nside':nside,'nrows':0,'finalized':False,'labelindex':False}
+            self._savemeta()
+
+    def __repr__(self):
+        return 'NpyMeasStore('+self.storedir+')'
+
+    def __getstate__(self):
+        # Do not pickle the memory maps, other processes map the files themselves
+        state = self.__dict__.copy()
+        state['_mmap'] = {}
+        return state
+
+    def _savemeta(self):
+        with open(os.path.join(self.storedir,'store.json'),'w') as f:
+            json.dump(self.meta,f)
+
+    def _file(self,name,ext='.npy'):
+        return os.path.join(self.storedir,name.lower()+ext)
+
+    def _col(self,name,mode='r'):
+        """ Memory-map a column."""
+        key = (name,mode)
+        if key not in self._mmap:
+            self._mmap[key] = np.load(self._file(name),mmap_mode=mode)
+        return self._mmap[key]
+
+    def _flush(self):
+        for k in list(self._mmap.keys()):
+            if k[1]=='r+': self._mmap[k].flush()
+        self._mmap = {}
+
+    def write(self,cat):
+        """ Append a catalog.  The rows are not available until finalize() is called."""
+        if self.meta['finalized']:
+            raise ValueError('Cannot write to a finalized store')
+        ncat = len(cat)
+        for n in self.columns:
+            if n=='OBJLABEL':
+                arr = np.zeros(ncat,int)-1
+            else:
+                arr = np.asarray(cat[n]).astype(diskdtype(n))
+            with open(self._file(n,'.raw'),'ab') as f:
+                f.write(arr.tobytes())
+        self.meta['nrows'] += ncat
+        self._savemeta()
+
+    def finalize(self):
+        """ Sort the rows by HEALPix and build the spatial index."""
+        if self.meta['finalized']: return
+        t0 = time.time()
+        nrows = self.meta['nrows']
+        # Sort by NESTED HEALPix, stable so the input order is kept within a cell
+        if nrows>0:
+            ra = np.fromfile(self._file('RA','.raw'),dtype=dtype_meas['RA'])
+            dec = np.fromfile(self._file('DEC','.raw'),dtype=dtype_meas['DEC'])
+            hpix = hp.ang2pix(self.nside,ra,dec,lonlat=True,nest=True)
+            del ra, dec
+            si = np.argsort(hpix,kind='stable')
+            hpix = hpix[si]
+        else:
+            hpix = np.zeros(0,int)
+            si = np.zeros(0,int)
+        # Rewrite each column in sorted order, one at a time
+        for n in self.columns:
+            rawfile = self._file(n,'.raw')
+            if os.path.exists(rawfile):
+                arr = np.fromfile(rawfile,dtype=diskdtype(n))
+            else:
+                arr = np.zeros(0,dtype=diskdtype(n))
+            out = np.lib.format.open_memmap(self._file(n),mode='w+',dtype=diskdtype(n),shape=(nrows,))
+            out[:] = arr[si]
+            out.flush()
+            del out, arr
+            if os.path.exists(rawfile): os.remove(rawfile)
+        # Deleted rows (tombstones)
+        deleted = np.lib.format.open_memmap(self._file('DELETED'),mode='w+',dtype=bool,shape=(nrows,))
+        deleted[:] = False
+        deleted.flush()
+        del deleted
+        # HEALPix index, unique cells with their row ranges
+        cell, lo, num = np.unique(hpix,return_index=True,return_counts=True)
+        np.save(self._file('HPIX_CELL'),cell)
+        np.save(self._file('HPIX_LO'),lo)
+        np.save(self._file('HPIX_NUM'),num)
+        self.meta['finalized'] = True
+        self._savemeta()
+        print('store finalized after '+str(time.time()-t0)+' sec')
+
+    def count(self):
+        """ Number of rows that have not been deleted."""
+        self.finalize()
+        return int(self.meta['nrows']-np.sum(self._col('DELETED')))
+
+    def radecrange(self):
+        """ Get RA/DEC ranges [min(ra),max(ra),min(dec),max(dec)]."""
+        self.finalize()
+        keep = ~self._col('DELETED')
+        ra = self._col('RA')[keep]
+        dec = self._col('DEC')[keep]
+        return (np.min(ra),np.max(ra),np.min(dec),np.max(dec))
+
+    def _cellrows(self,rar,decr):
+        """ Rows in the HEALPix cells that overlap a RA/DEC box."""
+        # Sample the box more finely than the cell size and add the neighbors
+        step = hp.nside2resol(self.nside,arcmin=True)/60.0*0.5
+        mndec = np.clip(np.mean(decr),-89.9,89.9)
+        nra = int(np.ceil((rar[1]-rar[0])*np.cos(np.deg2rad(mndec))/step))+2
+        ndec = int(np.ceil((decr[1]-decr[0])/step))+2
+        rr = np.linspace(rar[0],rar[1],nra) % 360
+        dd = np.clip(np.linspace(decr[0],decr[1],ndec),-90,90)
+        rgrid,dgrid = np.meshgrid(rr,dd)
+        pix = np.unique(hp.ang2pix(self.nside,rgrid.ravel(),dgrid.ravel(),lonlat=True,nest=True))
+        nei = hp.get_all_neighbours(self.nside,pix,nest=True).ravel()
+        pix = np.unique(np.hstack((pix,nei[nei>=0])))
+        # Row ranges of the cells that have data
+        cell = self._col('HPIX_CELL')
+        ind = np.searchsorted(cell,pix)
+        ind = ind[ind<len(cell)]
+        ind = np.unique(ind)
+        ind = ind[np.isin(cell[ind],pix)]
+        if len(ind)==0:
+            return np.zeros(0,int)
+        lo = self._col('HPIX_LO')[ind]
+        num = self._col('HPIX_NUM')[ind]
+        rows = np.repeat(lo-np.cumsum(np.hstack((0,num[0:-1]))),num)+np.arange(np.sum(num))
+        return rows
+
+    def _labelrows(self,objlabel):
+        """ Rows with an OBJLABEL in a range."""
+        if np.size(objlabel)==2:
+            lab0,lab1 = objlabel[0],objlabel[1]
+        else:
+            lab0,lab1 = objlabel,objlabel
+        if self.meta['labelindex']:
+            slabel = self._col('LABEL_SORTED')
+            lo = np.searchsorted(slabel,lab0,side='left')
+            hi = np.searchsorted(slabel,lab1,side='right')
+            return np.sort(self._col('LABEL_INDEX')[lo:hi])
+        label = self._col('OBJLABEL')
+        return np.where((label>=lab0) & (label<=lab1))[0]
+
+    def getdata(self,objlabel=None,rar=None,decr=None,verbose=False):
+        """ Get measurements by OBJLABEL and/or RA/DEC range."""
+        t0 = time.time()
+        self.finalize()
+        if objlabel is not None:
+            rows = self._labelrows(objlabel)
+        elif (rar is not None) | (decr is not None):
+            rar1 = rar if rar is not None else [0.0,360.0]
+            decr1 = decr if decr is not None else [-90.0,90.0]
+            rows = self._cellrows(rar1,decr1)
+        else:
+            rows = np.arange(self.meta['nrows'])
+        # Exact cuts
+        keep = ~self._col('DELETED')[rows]
+        if rar is not None:
+            ra = self._col('RA')[rows]
+            keep &= (ra>=rar[0]) & (ra<rar[1])
+        if decr is not None:
+            dec = self._col('DEC')[rows]
+            keep &= (dec>=decr[0]) & (dec<decr[1])
+        rows = rows[keep]
+        if len(rows)==0:
+            return np.array([])
+        cat = np.zeros(len(rows),dtype=dtype_meas)
+        cat['ROWID'] = rows
+        for n in self.columns:
+            cat[n] = self._col(n)[rows]
+        if verbose: print('got data in '+str(time.time()-t0)+' sec.')
+        return cat
+
+    def getcoords(self):
+        """ Get the ROWID and coordinates."""
+        self.finalize()
+        rows, = np.where(~self._col('DELETED'))
+        cat = np.zeros(len(rows),dtype=np.dtype([('ROWID',int),('RA',np.float64),('DEC',np.float64)]))
+        cat['ROWID'] = rows
+        cat['RA'] = self._col('RA')[rows]
+        cat['DEC'] = self._col('DEC')[rows]
+        return cat
+
+    def setlabels(self,rowid,labels):
+        """ Insert object labels in place."""
+        self.finalize()
+        label = self._col('OBJLABEL','r+')
+        label[np.asarray(rowid)] = labels
+        label.flush()
+        # The label index is out of date
+        self._droplabelindex()
+
+    def deleterows(self,rowid):
+        """ Delete rows using ROWID, marks them as deleted in place."""
+        self.finalize()
+        deleted = self._col('DELETED','r+')
+        deleted[np.asarray(rowid)] = True
+        deleted.flush()
+
+    def _droplabelindex(self):
+        if self.meta['labelindex']:
+            self.meta['labelindex'] = False
+            self._savemeta()
+            for k in [('LABEL_SORTED','r'),('LABEL_INDEX','r')]:
+                if k in self._mmap: del self._mmap[k]
+
+    def createindex(self,col):
+        """ Index a column.  RA/DEC are already indexed by HEALPix."""
+        self.finalize()
+        if col.upper()=='OBJLABEL':
+            label = np.asarray(self._col('OBJLABEL'))
+            si = np.argsort(label,kind='stable')
+            np.save(self._file('LABEL_SORTED'),label[si])
+            np.save(self._file('LABEL_INDEX'),si)
+            for k in [('LABEL_SORTED','r'),('LABEL_INDEX','r')]:
+                if k in self._mmap: del self._mmap[k]
+            self.meta['labelindex'] = True
+            self._savemeta()
+
+    def analyze(self):
+        """ Nothing to do for the npy store."""
+        pass
+
+    def remove(self):
+        """ Delete the store directory."""
+        self._mmap = {}
+        if os.path.exists(self.storedir): shutil.rmtree(self.storedir)
+
+
+def dirsize(path):
+    """ Total size of a file or directory in bytes."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root,dirs,files in os.walk(path):
+        for f in files: total += os.path.getsize(os.path.join(root,f))
+    return total
+
+def simchips(nmeas=1000000,nchip=200,seed=0):
+    """ Make a list of synthetic chip catalogs for one pixel."""
+    rnd = np.random.RandomState(seed)
+    dt = np.dtype([(n,dtype_meas[n]) for n in dtype_meas.names if n not in ['ROWID','OBJLABEL']])
+    nper = int(np.ceil(nmeas/nchip))
+    cats = []
+    for i in range(nchip):
+        cat = np.zeros(nper,dtype=dt)
+        cat['MEASID'] = np.char.add('c4d.%d.' % i,np.arange(nper).astype(str))
+        cat['EXPOSURE'] = 'c4d_exp%d' % (i//60)
+        cat['CCDNUM'] = i % 60 + 1
+        cat['FILTER'] = 'g'
+        cat['MJD'] = 57000+i//60
+        # chips cover part of a 0.5x0.5 deg pixel
+        ra0 = 10+rnd.rand()*0.4
+        dec0 = -20+rnd.rand()*0.4
+        cat['RA'] = ra0+rnd.rand(nper)*0.1
+        cat['DEC'] = dec0+rnd.rand(nper)*0.1
+        cat['RAERR'] = 0.05
+        cat['DECERR'] = 0.05
+        cat['MAG_AUTO'] = 16+rnd.rand(nper)*8
+        cat['MAGERR_AUTO'] = 0.01
+        cat['FWHM'] = 1.0
+        cats.append(cat)
+    return cats
+
+def benchmark(nmeas=1000000,nx=4,tmpdir=None,backends=['sqlite','npy']):
+    """ Benchmark the store backends on one synthetic pixel."""
+
+    if tmpdir is None: tmpdir = tempfile.gettempdir()
+    cats = simchips(nmeas)
+    nmeas = np.sum([len(c) for c in cats])
+    print(str(nmeas)+' measurements in '+str(len(cats))+' chips')
+    results = {}
+    for backend in backends:
+        print('---- '+backend+' ----')
+        path = os.path.join(tmpdir,'measstore_bench_'+str(os.getpid())+'_'+backend)
+        if backend=='sqlite': path += '.db'
+        store = openstore(path,backend)
+        store.remove()
+        store = openstore(path,backend)
+        res = {}
+        # Write
+        t0 = time.time()
+        for cat in cats: store.write(cat)
+        store.finalize()
+        res['write'] = time.time()-t0
+        # Range queries over an nx x nx grid, like clusterdata
+        t0 = time.time()
+        store.createindex('ra')
+        store.createindex('dec')
+        store.analyze()
+        ranges = store.radecrange()
+        dx = (ranges[1]-ranges[0]+0.002)/nx
+        dy = (ranges[3]-ranges[2]+0.002)/nx
+        nrange = 0
+        allrows = []
+        for r in range(nx):
+            for d in range(nx):
+                r0 = ranges[0]-0.001+r*dx
+                d0 = ranges[2]-0.001+d*dy
+                cat1 = store.getdata(rar=[r0,r0+dx],decr=[d0,d0+dy])
+                nrange += len(cat1)
+                if len(cat1)>0: allrows.append(cat1['ROWID'])
+        res['range'] = time.time()-t0
+        # Label updates
+        rowid = np.sort(np.hstack(allrows))
+        labels = np.arange(len(rowid))//5
+        t0 = time.time()
+        store.setlabels(rowid,labels)
+        store.createindex('objlabel')
+        res['setlabels'] = time.time()-t0
+        # Label range reads in groups, like the object loop
+        t0 = time.time()
+        nlab = 0
+        step = 10000
+        for lab0 in range(0,int(np.max(labels))+1,step):
+            cat1 = store.getdata(objlabel=[lab0,lab0+step-1])
+            nlab += len(cat1)
+        res['labelread'] = time.time()-t0
+        res['size'] = dirsize(path)
+        # Deletes
+        t0 = time.time()
+        store.deleterows(rowid[0:len(rowid)//10])
+        res['delete'] = time.time()-t0
+        res['count'] = store.count()
+        store.remove()
+        print('write/finalize  %8.2f sec' % res['write'])
+        print('range queries   %8.2f sec  (%d rows)' % (res['range'],nrange))
+        print('label updates   %8.2f sec' % res['setlabels'])
+        print('label reads     %8.2f sec  (%d rows)' % (res['labelread'],nlab))
+        print('deletes         %8.2f sec' % res['delete'])
+        print('disk size       %8.1f MB' % (res['size']/1e6))
+        results[backend] = res
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the measurement store backends.')
+    parser.add_argument('--nmeas', type=int, default=1000000, help='Number of measurements')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Temporary directory')
+    args = parser.parse_args()
+    benchmark(args.nmeas,tmpdir=args.tmpdir)
@@ -11,13 +11,34 @@ from astropy.io import fits
 import sqlite3
 import socket
 from argparse import ArgumentParser
+import idstore
 
 
-def breakup_idstr(dbfile):
-    """ Break-up idstr file into separate measid/objectid lists per exposure on /data0."""
+def breakup_idstr(dbfile,store=None):
+    """ Break-up idstr file into separate measid/objectid lists per exposure on /data0.
+        If STORE is given the idstr files are added to that exposure-partitioned
+        idstr store directory (see idstore.py) instead."""
 
     t00 = time.time()
 
+    # Make sure it's a list
+    if type(dbfile) is str: dbfile=[dbfile]
+
+    if store is not None:
+        print('Adding '+str(len(dbfile))+' database files to '+store)
+        ids = idstore.IdStore(store)
+        for i,dbfile1 in enumerate(dbfile):
+            print(str(i+1)+' '+dbfile1)
+            if os.path.exists(dbfile1):
+                t0 = time.time()
+                nrows = ids.addidstrdb(dbfile1)
+                print('  '+str(nrows)+' rows  dt = %6.1f sec. ' % (time.time()-t0))
+            else:
+                print('  '+dbfile1+' NOT FOUND')
+        ids.close()
+        print('dt = %6.1f sec.' % (time.time()-t00))
+        return
+
     outdir = '/data0/dnidever/nsc/instcal/v3/idstr/'
 
     # Load the exposures table
@@ -83,6 +104,7 @@ def breakup_idstr(dbfile):
 if __name__ == "__main__":
     parser = ArgumentParser(description='Break up idstr into separate lists per exposure.')
     parser.add_argument('dbfile', type=str, nargs=1, help='Database filename')
+    parser.add_argument('--store', type=str, default=None, help='Add to this idstr store directory instead')
     args = parser.parse_args()
 
     hostname = socket.gethostname()
@@ -98,4 +120,4 @@ if __name__ == "__main__":
             print(listfile+' NOT FOUND')
             sys.exit()
 
-    breakup_idstr(dbfile)
+    breakup_idstr(dbfile,store=args.store)
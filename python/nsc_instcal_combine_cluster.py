@@ -9,8 +9,10 @@ from astropy.utils.exceptions import AstropyWarning
 from astropy.table import Table, vstack, Column
 from astropy.time import Time
 import healpy as hp
-from dlnpyutils import utils as dln, coords, bindata, db, job_daemon as jd
+from dlnpyutils import utils as dln, coords, db, job_daemon as jd
 import subprocess
+import shutil
+import tempfile
 import time
 from argparse import ArgumentParser
 import socket
@@ -18,67 +20,51 @@ from dustmaps.sfd import SFDQuery
 from astropy.coordinates import SkyCoord
 from sklearn.cluster import DBSCAN
 from scipy.optimize import least_squares
-from scipy.interpolate import interp1d
 import sqlite3
 import gc
+import multiprocessing
 import psutil
+import aggregate
+import var
+import pmfit
+import measstore
+import dbsession
+import seqclust
+import tiledcluster
+import footprint
+import measload
+import objparent
+import idstore
+import reddening
 
 def writecat2db(cat,dbfile):
     """ Write a catalog to the database """
     ncat = dln.size(cat)
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    #db = sqlite3.connect('test.db')
-    #db.text_factory = lambda x: str(x, 'latin1')
-    #db.row_factory = sqlite3.Row
-    c = db.cursor()
+    sess = dbsession.getsession(dbfile,pragmas=dbsession.SCRATCH_PRAGMAS)
     # Create the table
     #   the primary key ROWID is automatically generated
-    if len(c.execute('SELECT name from sqlite_master where type= "table" and name="meas"').fetchall()) < 1:
-        c.execute('''CREATE TABLE meas(measid TEXT, objlabel INTEGER, exposure TEXT, ccdnum INTEGER, filter TEXT, mjd REAL,
-                     ra REAL, raerr REAL, dec REAL, decerr REAL, mag_auto REAL, magerr_auto REAL, asemi REAL, asemierr REAL,
-                     bsemi REAL, bsemierr REAL, theta REAL, thetaerr REAL, fwhm REAL, flags INTEGER, class_star REAL)''')
-    data = list(zip(cat['measid'],np.zeros(ncat,int)-1,cat['exposure'],cat['ccdnum'],cat['filter'],cat['mjd'],cat['ra'],
-                    cat['raerr'],cat['dec'],cat['decerr'],cat['mag_auto'],cat['magerr_auto'],cat['asemi'],cat['asemierr'],
-                    cat['bsemi'],cat['bsemierr'],cat['theta'],cat['thetaerr'],cat['fwhm'],cat['flags'],cat['class_star']))
-    c.executemany('''INSERT INTO meas(measid,objlabel,exposure,ccdnum,filter,mjd,ra,raerr,dec,decerr,mag_auto,magerr_auto,
-                     asemi,asemierr,bsemi,bsemierr,theta,thetaerr,fwhm,flags,class_star)
-                     VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', data)
-    db.commit()
-    db.close()
+    if sess.tableexists('meas') is False:
+        sess.execute('''CREATE TABLE meas(measid TEXT, objlabel INTEGER, exposure TEXT, ccdnum INTEGER, filter TEXT, mjd REAL,
+                        ra REAL, raerr REAL, dec REAL, decerr REAL, mag_auto REAL, magerr_auto REAL, asemi REAL, asemierr REAL,
+                        bsemi REAL, bsemierr REAL, theta REAL, thetaerr REAL, fwhm REAL, flags INTEGER, class_star REAL)''')
+    cols = ['measid','objlabel','exposure','ccdnum','filter','mjd','ra','raerr','dec','decerr','mag_auto','magerr_auto',
+            'asemi','asemierr','bsemi','bsemierr','theta','thetaerr','fwhm','flags','class_star']
+    sess.insert('meas',cols,[np.zeros(ncat,int)-1 if c=='objlabel' else cat[c] for c in cols])
 
 def getdbcoords(dbfile):
     """ Get the coordinates and ROWID from the database """
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
-    c.execute('''SELECT rowid,ra,dec FROM meas''')
-    data = c.fetchall()
-    db.close()
-
-    # Convert to nump structured array
+    sess = dbsession.getsession(dbfile)
     dtype = np.dtype([('ROWID',int),('RA',np.float64),('DEC',np.float64)])
-    cat = np.zeros(len(data),dtype=dtype)
-    cat[...] = data
-    del data
-
+    cat = sess.queryarray('''SELECT rowid,ra,dec FROM meas''',dtype)
     return cat
 
 def createindexdb(dbfile,col='measid',table='meas',unique=True):
     """ Index a column in the database """
     t0 = time.time()
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
+    sess = dbsession.getsession(dbfile)
     index_name = 'idx_'+col+'_'+table
     # Check if the index exists first
-    c.execute('select name from sqlite_master')
-    d = c.fetchall()
+    d = sess.query('select name from sqlite_master')
     for nn in d:
         if nn[0]==index_name:
             print(index_name+' already exists')
@@ -86,131 +72,76 @@ def createindexdb(dbfile,col='measid',table='meas',unique=True):
     # Create the index
     print('Indexing '+col)
     if unique:
-        c.execute('CREATE UNIQUE INDEX '+index_name+' ON '+table+'('+col+')')
+        sess.execute('CREATE UNIQUE INDEX '+index_name+' ON '+table+'('+col+')')
     else:
-        c.execute('CREATE INDEX '+index_name+' ON '+table+'('+col+')')
-    data = c.fetchall()
-    db.close()
+        sess.execute('CREATE INDEX '+index_name+' ON '+table+'('+col+')')
     print('indexing done after '+str(time.time()-t0)+' sec')
 
 def insertobjlabelsdb(rowid,labels,dbfile):
     """ Insert objectlabel values into the database """
     print('Inserting object labels')
     t0 = time.time()
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
-    data = list(zip(labels,rowid))
-    c.executemany('''UPDATE meas SET objlabel=? WHERE rowid=?''', data) 
-    db.commit() 
-    db.close()
+    sess = dbsession.getsession(dbfile)
+    sess.executemany('''UPDATE meas SET objlabel=? WHERE rowid=?''', zip(np.asarray(labels).tolist(),np.asarray(rowid).tolist()))
     print('inserting done after '+str(time.time()-t0)+' sec')
 
 def updatecoldb(selcolname,selcoldata,updcolname,updcoldata,table,dbfile):
     """ Update column in database """
     print('Updating '+updcolname+' column in '+table+' table using '+selcolname)
     t0 = time.time()
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
-    data = list(zip(updcoldata,selcoldata))
-    c.executemany('''UPDATE '''+table+''' SET '''+updcolname+'''=? WHERE '''+selcolname+'''=?''', data) 
-    db.commit() 
-    db.close()
+    sess = dbsession.getsession(dbfile)
+    sess.executemany('''UPDATE '''+table+''' SET '''+updcolname+'''=? WHERE '''+selcolname+'''=?''',
+                     zip(np.asarray(updcoldata).tolist(),np.asarray(selcoldata).tolist()))
     print('updating done after '+str(time.time()-t0)+' sec')    
 
 def deleterowsdb(colname,coldata,table,dbfile):
     """ Delete rows from the database using rowid"""
     print('Deleting rows from '+table+' table using '+colname)
     t0 = time.time()
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
-    data = list(zip(coldata))
-    c.executemany('''DELETE from '''+table+''' WHERE '''+colname+'''=?''', data) 
-    db.commit() 
-    db.close()
+    sess = dbsession.getsession(dbfile)
+    sess.executemany('''DELETE from '''+table+''' WHERE '''+colname+'''=?''', zip(np.asarray(coldata).tolist()))
     print('deleting done after '+str(time.time()-t0)+' sec')
 
     
 def writeidstr2db(cat,dbfile):
     """ Insert IDSTR database values """
     t0 = time.time()
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
+    sess = dbsession.getsession(dbfile)
     # Create the table
     #   the primary key ROWID is automatically generated
-    if len(c.execute('SELECT name from sqlite_master where type= "table" and name="idstr"').fetchall()) < 1:
-        c.execute('''CREATE TABLE idstr(measid TEXT, exposure TEXT, objectid TEXT, objectindex INTEGER)''')
-    data = list(zip(cat['measid'],cat['exposure'],cat['objectid'],cat['objectindex']))
-    c.executemany('''INSERT INTO idstr(measid,exposure,objectid,objectindex)
-                     VALUES(?,?,?,?)''', data)
-    db.commit() 
-    db.close()
+    if sess.tableexists('idstr') is False:
+        sess.execute('''CREATE TABLE idstr(measid TEXT, exposure TEXT, objectid TEXT, objectindex INTEGER)''')
+    cols = ['measid','exposure','objectid','objectindex']
+    sess.insert('idstr',cols,[cat[c] for c in cols])
     #print('inserting done after '+str(time.time()-t0)+' sec')
 
 def readidstrdb(dbfile):
     """ Get data from IDSTR database"""
-    data = querydb(dbfile,table='idstr',cols='*')
-    # Put in catalog
-    dtype_idstr = np.dtype([('measid',np.str,200),('exposure',np.str,200),('objectid',np.str,200),('objectindex',int)])
-    cat = np.zeros(len(data),dtype=dtype_idstr)
-    cat[...] = data
-    del data    
+    sess = dbsession.getsession(dbfile)
+    dtype_idstr = np.dtype([('measid',str,200),('exposure',str,200),('objectid',str,200),('objectindex',int)])
+    cat = sess.queryarray('SELECT * FROM idstr',dtype_idstr)
     return cat
 
 def querydb(dbfile,table='meas',cols='rowid,*',where=None):
     """ Query database table """
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    cur = db.cursor()
+    sess = dbsession.getsession(dbfile)
     cmd = 'SELECT '+cols+' FROM '+table
     if where is not None: cmd += ' WHERE '+where
-    cur.execute(cmd)
-    data = cur.fetchall()
-    db.close()
+    data = sess.query(cmd)
 
     # Return results
     return data
 
 def executedb(dbfile,cmd):
     """ Execute a database command """
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    cur = db.cursor()
-    cur.execute(cmd)
-    data = cur.fetchall()
-    db.close()
+    sess = dbsession.getsession(dbfile)
+    data = sess.execute(cmd)
     return data    
 
 def getdatadb(dbfile,table='meas',cols='rowid,*',objlabel=None,rar=None,decr=None,verbose=False):
     """ Get measurements for an object(s) from the database """
     t0 = time.time()
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    cur = db.cursor()
+    sess = dbsession.getsession(dbfile)
     cmd = 'SELECT '+cols+' FROM '+table
     # OBJLABEL constraints
     if objlabel is not None:
@@ -237,24 +168,17 @@ def getdatadb(dbfile,table='meas',cols='rowid,*',objlabel=None,rar=None,decr=Non
             cmd += ' AND '
         cmd += 'dec>='+str(decr[0])+' AND dec<'+str(decr[1])
 
-    # Execute the select command
+    # Execute the select command, read directly into numpy structured array
     #print('CMD = '+cmd)
-    cur.execute(cmd)
-    data = cur.fetchall()
-    db.close()
-
-    # No results
-    if len(data)==0:
-        return np.array([])
-
-    # Convert to numpy structured array
-    dtype_hicat = np.dtype([('ROWID',int),('MEASID',np.str,30),('OBJLABEL',int),('EXPOSURE',np.str,40),('CCDNUM',int),('FILTER',np.str,3),
+    dtype_hicat = np.dtype([('ROWID',int),('MEASID',str,30),('OBJLABEL',int),('EXPOSURE',str,40),('CCDNUM',int),('FILTER',str,3),
                             ('MJD',float),('RA',float),('RAERR',float),('DEC',float),('DECERR',float),
                             ('MAG_AUTO',float),('MAGERR_AUTO',float),('ASEMI',float),('ASEMIERR',float),('BSEMI',float),('BSEMIERR',float),
                             ('THETA',float),('THETAERR',float),('FWHM',float),('FLAGS',int),('CLASS_STAR',float)])
-    cat = np.zeros(len(data),dtype=dtype_hicat)
-    cat[...] = data
-    del data
+    cat = sess.queryarray(cmd,dtype_hicat)
+
+    # No results
+    if len(cat)==0:
+        return np.array([])
 
     if verbose: print('got data in '+str(time.time()-t0)+' sec.')
 
@@ -262,16 +186,8 @@ def getdatadb(dbfile,table='meas',cols='rowid,*',objlabel=None,rar=None,decr=Non
 
 def getradecrangedb(dbfile):
     """ Get RA/DEC ranges from database """
-    sqlite3.register_adapter(np.int16, int)
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.float64, float)
-    sqlite3.register_adapter(np.float32, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    c = db.cursor()
-    c.execute('''SELECT MIN(ra),MAX(ra),MIN(dec),MAX(dec) FROM meas''')
-    data = c.fetchall()
-    db.close()
-
+    sess = dbsession.getsession(dbfile)
+    data = sess.query('''SELECT MIN(ra),MAX(ra),MIN(dec),MAX(dec) FROM meas''')
     return data[0]
 
 def add_elements(cat,nnew=300000):
@@ -284,8 +200,10 @@ def add_elements(cat,nnew=300000):
     del old
     return cat    
 
-def seqcluster(cat,dcr=0.5,iter=False,inpobj=None,trim=False):
-    """ Sequential clustering of measurements in exposures.  This was the old method."""
+def seqcluster(cat,dcr=0.5,iter=False,inpobj=None,trim=False,kdtree=True):
+    """ Sequential clustering of measurements in exposures.  This was the old method.
+        With kdtree=True the incremental KD-tree engine in seqclust.py is used,
+        which gives the same labels without rematching against all objects."""
 
     ncat = len(cat)
     labels = np.zeros(ncat)-1
@@ -305,7 +223,7 @@ def seqcluster(cat,dcr=0.5,iter=False,inpobj=None,trim=False):
                 del labels1, obj1
                 inpobj = obj2
             # Cluster
-            labels1,obj1 = seqcluster(cat,dcr=dcr,iter=False,inpobj=inpobj)
+            labels1,obj1 = seqcluster(cat,dcr=dcr,iter=False,inpobj=inpobj,kdtree=kdtree)
             print('Iter='+str(niter)+' '+str(int(np.max(labels1)))+' clusters')
             # Calculate average ra/dec
             obj2 = propermotion(cat,labels1)
@@ -316,6 +234,10 @@ def seqcluster(cat,dcr=0.5,iter=False,inpobj=None,trim=False):
             niter += 1
         return labels1, obj2
 
+    # Incremental KD-tree engine
+    if kdtree:
+        return seqclust.seqcluster(cat,dcr=dcr,inpobj=inpobj,trim=trim)
+
     # Create exposures index
     index = dln.create_index(cat['EXPOSURE'])
     nexp = len(index['value'])
@@ -447,7 +369,7 @@ def meancoords(cat,labels):
     return obj
             
     
-def propermotion(cat,labels):
+def propermotion(cat,labels,batch=False):
     """ Measure proper motions."""
     
     # Make object index
@@ -459,6 +381,12 @@ def propermotion(cat,labels):
     dtype_pm = np.dtype([('pmra',np.float32),('pmdec',np.float32),('pmraerr',np.float32),('pmdecerr',np.float32),('mjd',np.float64)])
     obj = dln.addcatcols(obj,dtype_pm)
 
+    # Use the batched solver for all objects at once
+    if batch:
+        pm = pmfit.pmsolve(labels,cat['MJD'],cat['RA'],cat['DEC'],cat['RAERR'],cat['DECERR'],objdec=obj['dec'])
+        for n in ['pmra','pmraerr','pmdec','pmdecerr']: obj[n]=pm[n]
+        return obj
+
     # Loop over the objects
     for i in range(nobj):
         indx = index['index'][index['lo'][i]:index['hi'][i]+1]
@@ -551,8 +479,21 @@ def ellipsecoords(pars,npoints=100):
     yprime = yc + x*sinang + y*cosang
     return xprime, yprime
 
-def checkboundaryoverlap(metafiles,buffdict,verbose=False):
-    """ Check a list of fits files against a buffer and return metadata of overlapping exposures."""
+def readmeta(mfile,metacache=None):
+    """ Read the exposure and chip-level meta-data of an exposure, kept in METACACHE if given."""
+    if (metacache is not None) and (mfile in metacache):
+        return metacache[mfile]
+    meta = fits.getdata(mfile,1,memmap=False)
+    t = Time(meta['dateobs'], format='isot', scale='utc')
+    meta['mjd'] = t.mjd                    # recompute because some MJD are bad
+    chmeta = fits.getdata(mfile,2,memmap=False)      # chip-level meta-data structure
+    if metacache is not None:
+        metacache[mfile] = (meta,chmeta)
+    return meta, chmeta
+
+def checkboundaryoverlap(metafiles,buffdict,verbose=False,metacache=None,fpindex=None):
+    """ Check a list of fits files against a buffer and return metadata of overlapping exposures.
+        With a footprint index (see footprint.py) the meta files are not read."""
 
     # New meta-data format
     dtype_meta = np.dtype([('file',np.str,500),('base',np.str,200),('instrument',np.str,3),('expnum',int),('ra',np.float64),
@@ -562,17 +503,24 @@ def checkboundaryoverlap(metafiles,buffdict,verbose=False):
                            ('ebv',float),('gaianmatch',int),('zpterm',float),('zptermerr',float),
                            ('zptermsig',float),('refmatch',int)])
 
+    # Use the footprint index
+    if fpindex is not None:
+        expmeta, chips = fpindex.query(buffdict,metafiles)
+        if verbose: print(str(len(expmeta))+' exposures overlap')
+        if len(expmeta)==0:
+            return None
+        allmeta = np.zeros(len(expmeta),dtype=dtype_meta)
+        for n in dtype_meta.names: allmeta[n]=expmeta[n]
+        return allmeta
+
     allmeta = None
     for m,mfile in enumerate(np.atleast_1d(metafiles)):
         noverlap = 0
         if os.path.exists(mfile) is False:
             if verbose: print(mfile+' NOT FOUND')
             continue
-        meta = fits.getdata(mfile,1)
+        meta, chmeta = readmeta(mfile,metacache)
         if verbose: print(str(m+1)+' Loading '+mfile)
-        t = Time(meta['dateobs'], format='isot', scale='utc')
-        meta['mjd'] = t.mjd                    # recompute because some MJD are bad
-        chmeta = fits.getdata(mfile,2)      # chip-level meta-data structure
 
         # Convert META to new format
         newmeta = np.zeros(1,dtype=dtype_meta)
@@ -616,8 +564,14 @@ def checkboundaryoverlap(metafiles,buffdict,verbose=False):
     return allmeta
 
 
-def find_obj_parent(obj):
-    """ Find objects that have other objects "inside" them. """
+def find_obj_parent(obj,vectorized=True):
+    """ Find objects that have other objects "inside" them.
+        With vectorized=True all candidate pairs are tested at once
+        in objparent.py, otherwise each pair is checked with a polygon.
+    """
+
+    if vectorized:
+        return objparent.find_obj_parent(obj)
 
     # Use crossmatch
 
@@ -755,7 +709,7 @@ def hybridcluster(cat):
     return labels, obj
     
 
-def loadmeas(metafile=None,buffdict=None,dbfile=None,verbose=False):
+def loadmeas(metafile=None,buffdict=None,dbfile=None,store=None,verbose=False,metacache=None,fpindex=None,nthreads=4):
 
     t0 = time.time()
 
@@ -789,22 +743,31 @@ def loadmeas(metafile=None,buffdict=None,dbfile=None,verbose=False):
                           ('BSEMI',np.float16),('BSEMIERR',np.float16),('THETA',np.float16),('THETAERR',np.float16),
                           ('FWHM',np.float16),('FLAGS',np.int16),('CLASS_STAR',np.float16)])
 
-    #  Loop over exposures
-    cat = None
-    ncat = 0
+    #  Loop over exposures to get the chip files
     allmeta = None
-    catcount = 0
+    expmeta = []       # meta-data of each exposure
+    allchfiles = []    # chip files to load
+    allchexp = []      # exposure index of each chip file
     metafile = np.atleast_1d(metafile)
+    # Overlapping chips of all the exposures from the footprint index
+    if fpindex is not None:
+        if buffdict is not None:
+            fpexp, fpchips = fpindex.query(buffdict,metafile)
+        else:
+            fpexp = fpindex.getexposures(metafile)
+            fpchips = fpindex.getchips(metafiles=metafile)
     for m,mfile in enumerate(metafile):
-        expcatcount = 0
         if os.path.exists(mfile) is False:
             print(mfile+' NOT FOUND')
             continue
-        meta = fits.getdata(mfile,1)
+        if fpindex is not None:
+            ind, = np.where(fpexp['metafile']==mfile)
+            if len(ind)==0: continue     # no chips overlap
+            meta = fpexp[ind]
+            chips = fpchips[fpchips['metafile']==mfile]
+        else:
+            meta, chmeta = readmeta(mfile,metacache)
         print(str(m+1)+' Loading '+mfile)
-        t = Time(meta['dateobs'], format='isot', scale='utc')
-        meta['mjd'] = t.mjd                    # recompute because some MJD are bad
-        chmeta = fits.getdata(mfile,2)      # chip-level meta-data structure
         print('  FILTER='+meta['filter'][0]+'  EXPTIME='+str(meta['exptime'][0])+' sec')
 
         v = psutil.virtual_memory()
@@ -815,145 +778,108 @@ def loadmeas(metafile=None,buffdict=None,dbfile=None,verbose=False):
         newmeta = np.zeros(1,dtype=dtype_meta)
         # Copy over the meta information
         for n in newmeta.dtype.names:
-            if n.upper() in meta.dtype.names: newmeta[n]=meta[n]
+            if (n.upper() in meta.dtype.names) | (n in meta.dtype.names): newmeta[n]=meta[n]
 
-        # Get the name
-        fdir = os.path.dirname(mfile)
-        fbase, ext = os.path.splitext(os.path.basename(mfile))
-        fbase = fbase[:-5]   # remove _meta at end
-        
-        # Loop over the chip files
-        for j in range(len(chmeta)):
-            # Check that this chip was astrometrically calibrated
-            #   and falls in to HEALPix region
-            # Also check for issues with my astrometric corrections
-            astokay = True
-            if (chmeta['ngaiamatch'][j] == 0) | (np.max(np.abs(chmeta['racoef'][j]))>1) | (np.max(np.abs(chmeta['deccoef'][j]))>1):
-                if verbose: print('This chip was not astrometrically calibrated or has astrometric issues')
-                astokay = False
-
-            # Check that this overlaps the healpix region
-            inside = True
-            if buffdict is not None:
-                vra = chmeta['vra'][j]
-                vdec = chmeta['vdec'][j]
-                vlon, vlat = coords.rotsphcen(vra,vdec,buffdict['cenra'],buffdict['cendec'],gnomic=True)
-                if coords.doPolygonsOverlap(buffdict['lon'],buffdict['lat'],vlon,vlat) is False:
-                    if verbose: print('This chip does NOT overlap the HEALPix region+buffer')
-                    inside = False
-
-            # Check if the chip-level file exists
-            chfile = fdir+'/'+fbase+'_'+str(chmeta['ccdnum'][j])+'_meas.fits'
-            chfile_exists = os.path.exists(chfile)
-            if chfile_exists is False:
-                print(chfile+' NOT FOUND')
-
-            # Load this one
-            if (chfile_exists is True) and (inside is True) and (astokay is True):
-                # Load the chip-level catalog
-                cat1 = fits.getdata(chfile,1)
-                ncat1 = len(cat1)
-                #print('  chip '+str(chmeta[j]['ccdnum'])+'  '+str(ncat1)+' sources')
-
-                # Fix negative FWHM values
-                #  use A_WORLD and B_WORLD which are never negative
-                bd,nbd = dln.where(cat1['FWHM']<0.1)
-                if nbd>0:
-                    cat1['FWHM'][bd] = np.sqrt(cat1['ASEMI'][bd]**2+cat1['BSEMI'][bd]**2)*2.35
-                # Fix RAERR=DECERR=0
-                bd,nbd = dln.where(cat1['RAERR']<0.0001)
-                if nbd>0:
-                    snr = 1.087/cat1['MAGERR_AUTO'][bd]
-                    coorderr = 0.664*cat1['FWHM'][bd]/snr
-                    cat1['RAERR'][bd] = coorderr
-                    cat1['DECERR'][bd] = coorderr
-
-                # Make sure it's in the right format
-                if len(cat1.dtype.fields) != 32:
-                    if verbose: print('  This catalog does not have the right format. Skipping')
-                    del cat1
-                    ncat1 = 0
-
-                # Only include sources inside Boundary+Buffer zone
-                #  -use ROI_CUT
-                #  -reproject to tangent plane first so we don't have to deal
-                #     with RA=0 wrapping or pol issues
+        # Chip files that were astrometrically calibrated and fall in the HEALPix region
+        if fpindex is not None:
+            chfiles = [(c['chfile'],c['ccdnum']) for c in chips if c['astokay']]
+        else:
+            # Get the name
+            fdir = os.path.dirname(mfile)
+            fbase, ext = os.path.splitext(os.path.basename(mfile))
+            fbase = fbase[:-5]   # remove _meta at end
+            chfiles = []
+            for j in range(len(chmeta)):
+                # Check that this chip was astrometrically calibrated
+                #   and falls in to HEALPix region
+                # Also check for issues with my astrometric corrections
+                astokay = True
+                if (chmeta['ngaiamatch'][j] == 0) | (np.max(np.abs(chmeta['racoef'][j]))>1) | (np.max(np.abs(chmeta['deccoef'][j]))>1):
+                    if verbose: print('This chip was not astrometrically calibrated or has astrometric issues')
+                    astokay = False
+
+                # Check that this overlaps the healpix region
+                inside = True
                 if buffdict is not None:
-                    lon, lat = coords.rotsphcen(cat1['ra'],cat1['dec'],buffdict['cenra'],buffdict['cendec'],gnomic=True)
-                    ind_out, ind_in = dln.roi_cut(buffdict['lon'],buffdict['lat'],lon,lat)
-                    nmatch = dln.size(ind_in)
-                    # Only want source inside this pixel
-                    if nmatch>0:
-                        cat1 = cat1[ind_in]
-                        ncat1 = len(cat1)
-                    else:
-                        cat1 = None
-                        ncat1 = 0
-                    #if verbose: print('  '+str(nmatch)+' sources are inside this pixel')
-
-                # Combine the catalogs
-                if ncat1 > 0:
-                    # Keep it all in memory
-                    if dbfile is None:
-                        if cat is None:
-                            #dtype_cat = cat1.dtype
-                            #ncat_init = np.sum(chmeta['nsources'])*dln.size(metafile)
-                            ncat_init = np.maximum(100000,ncat1)
-                            cat = np.zeros(ncat_init,dtype=dtype_cat)
-                            catcount = 0
-                        # Add more elements if necessary
-                        if (catcount+ncat1)>ncat:
-                            cat = add_elements(cat,np.maximum(100000,ncat1))
-                            ncat = len(cat)
-
-                        # Add it to the main CAT catalog
-                        for n in dtype_cat.names: cat[n][catcount:catcount+ncat1] = cat1[n.upper()]
-                    # Use the database
-                    else:
-                        writecat2db(cat1,dbfile)
-
-                    if verbose: print('  chip '+str(chmeta['ccdnum'][j])+'  '+str(ncat1)+' measurements')
-
-                    catcount += ncat1
-                    expcatcount += ncat1
-
-        # Add metadata to ALLMETA, only if some measurements overlap
-        if expcatcount>0:
+                    vra = chmeta['vra'][j]
+                    vdec = chmeta['vdec'][j]
+                    vlon, vlat = coords.rotsphcen(vra,vdec,buffdict['cenra'],buffdict['cendec'],gnomic=True)
+                    if coords.doPolygonsOverlap(buffdict['lon'],buffdict['lat'],vlon,vlat) is False:
+                        if verbose: print('This chip does NOT overlap the HEALPix region+buffer')
+                        inside = False
+
+                if (inside is True) and (astokay is True):
+                    chfiles.append((fdir+'/'+fbase+'_'+str(chmeta['ccdnum'][j])+'_meas.fits',chmeta['ccdnum'][j]))
+
+        # Chip files that exist
+        for chfile,ccdnum in chfiles:
+            if os.path.exists(chfile) is False:
+                print(chfile+' NOT FOUND')
+            else:
+                allchfiles.append(chfile)
+                allchexp.append(len(expmeta))
+        expmeta.append(newmeta)
+
+    # Load the chips, preallocated and in parallel
+    if (dbfile is None) & (store is None):
+        writer = None
+    # Use the measurement store
+    elif store is not None:
+        writer = store.write
+    # Use the database
+    else:
+        writer = lambda cat1: writecat2db(cat1,dbfile)
+    cat, chcount, loadstats = measload.loadchips(allchfiles,dtype_cat,buffdict,writer=writer,nthreads=nthreads,verbose=verbose)
+    catcount = len(cat) if writer is None else int(np.sum(chcount))
+
+    # Add metadata to ALLMETA, only if some measurements overlap
+    expcount = np.bincount(np.array(allchexp,int),chcount,minlength=len(expmeta)).astype(int)
+    for m in range(len(expmeta)):
+        if expcount[m]>0:
             if allmeta is None:
-                allmeta = newmeta
+                allmeta = expmeta[m]
             else:
-                allmeta = np.hstack((allmeta,newmeta))
+                allmeta = np.hstack((allmeta,expmeta[m]))
         # Total measurements for this exposure
-        print('  '+str(expcatcount)+' measurements')
-        print(str(catcount)+' measurements total so far')
+        print(expmeta[m]['base'][0]+'  '+str(expcount[m])+' measurements')
+    print(str(catcount)+' measurements total')
 
-    #print('all exposures loaded. trimming now')
-    if (cat is not None) & (catcount<ncat): cat=cat[0:catcount]   # delete excess elements
-    if cat is None: cat=np.array([])         # empty cat
     if allmeta is None: allmeta=np.array([])
 
     print('loading measurements done after '+str(time.time()-t0))
 
     return cat, catcount, allmeta
 
-def clusterdata(cat,ncat,dbfile=None):
-    """ Perform spatial clustering """
+def clusterdata(cat,ncat,dbfile=None,store=None,nproc=1):
+    """ Perform spatial clustering.  With nproc>1 the subregions are clustered
+        in parallel tiles and stitched together (see tiledcluster.py)."""
 
     t00 = time.time()
     print('Spatial clustering')    
+    # Use the sqlite measurement store for the database file
+    if (store is None) & (dbfile is not None):
+        store = measstore.SqliteMeasStore(dbfile)
     # Divide into subregions
-    if (ncat>1000000) & (dbfile is not None):
+    if (ncat>1000000) & (store is not None):
         print('Dividing clustering problem into subregions')
         # Index RA and DEC
-        createindexdb(dbfile,'ra',unique=False)
-        createindexdb(dbfile,'dec',unique=False)
-        db.analyzetable(dbfile,'meas')
+        store.createindex('ra')
+        store.createindex('dec')
+        store.analyze()
+        # Parallel tiles
+        if nproc>1:
+            rowid, objlabels, objstr, tilestats = tiledcluster.tiledcluster(store,ncat,hybridcluster,nproc=nproc)
+            store.setlabels(rowid,objlabels)
+            print(str(len(objstr))+' final objects')
+            store.createindex('objlabel')
+            print('clustering done after '+str(time.time()-t00)+' sec.')
+            return objstr, cat
         # Subdivide
         nsub = int(np.ceil(ncat/100000))
         print(str(nsub)+' sub regions')
         nx = int(np.ceil(np.sqrt(nsub)))  # divide RA and DEC intro nx regions
         # Get RA/DEC ranges from the database
-        ranges = getradecrangedb(dbfile)  # [min(ra),max(ra),min(dec),max(dec)]
+        ranges = store.radecrange()  # [min(ra),max(ra),min(dec),max(dec)]
         xr = [ranges[0]-0.001, ranges[1]+0.001]  # extend slightly 
         print('RA: '+str(xr[0])+' '+str(xr[1]))
         dx = (xr[1]-xr[0])/nx
@@ -980,7 +906,7 @@ def clusterdata(cat,ncat,dbfile=None):
                 d1 = yr[0]+(d+1)*dy
                 print(str(r+1)+' '+str(d+1))
                 print('RA: '+str(r0)+' '+str(r1)+'  DEC: '+str(d0)+' '+str(d1))
-                cat1 = getdatadb(dbfile,rar=[r0-rabuff,r1+rabuff],decr=[d0-buff,d1+buff],verbose=True)
+                cat1 = store.getdata(rar=[r0-rabuff,r1+rabuff],decr=[d0-buff,d1+buff],verbose=True)
                 ncat1 = len(cat1)
                 if ncat1>0:
                     gcat1,ngcat1 = dln.where(cat1['OBJLABEL']==-1)  # only want ones that haven't been taken yet
@@ -1035,7 +961,7 @@ def clusterdata(cat,ncat,dbfile=None):
                         # Add the object labels into the database
                         #  much faster if in rowid order
                         si = np.argsort(add_rowid1)
-                        insertobjlabelsdb(add_rowid1[si],add_objlabels1[si],dbfile)
+                        store.setlabels(add_rowid1[si],add_objlabels1[si])
 
                         # Add OBJ1 to OBJSTR
                         if (objcount+nobj1>nobjstr):    # add new elements
@@ -1059,9 +985,9 @@ def clusterdata(cat,ncat,dbfile=None):
     # No subdividing
     else:
         # Get MEASID, RA, DEC from database
-        if dbfile is not None:
+        if store is not None:
             #cat = getdbcoords(dbfile)
-            cat = getdatadb(dbfile,verbose=True)
+            cat = store.getdata(verbose=True)
         objlabels, initobj = hybridcluster(cat)
         labelindex = dln.create_index(objlabels)   # create index
         nobj = len(labelindex['value'])
@@ -1072,8 +998,8 @@ def clusterdata(cat,ncat,dbfile=None):
         objstr['NMEAS'] = labelindex['num']
         nobjstr = len(objstr)
         # Insert object label into database
-        if dbfile is not None:
-            insertobjlabelsdb(cat['ROWID'],objlabels,dbfile)
+        if store is not None:
+            store.setlabels(cat['ROWID'],objlabels)
         # Resort CAT, and use index LO/HI
         cat = cat[labelindex['index']]
         objstr['LO'] = labelindex['lo']
@@ -1082,8 +1008,8 @@ def clusterdata(cat,ncat,dbfile=None):
     print(str(len(objstr))+' final objects')
 
     # Index objlabel in database
-    if dbfile is not None:
-        createindexdb(dbfile,'objlabel',unique=False)
+    if store is not None:
+        store.createindex('objlabel')
 
     print('clustering done after '+str(time.time()-t00)+' sec.')
 
@@ -1158,39 +1084,293 @@ def breakup_idstr(dbfile):
     print('dt = %6.1f sec.' % (time.time()-t00))
 
 
+def loadhlist(listfile,pix,nside=128):
+    """ Get the exposures of a healpix and its neighbors from the nside=128 healpix list."""
 
+    # nside>128, use the nside=128 parent pixel
+    if nside > 128:
+        pra,pdec = hp.pix2ang(nside,pix,lonlat=True)
+        pix128 = hp.ang2pix(128,pra,pdec,lonlat=True)
+    else:
+        pix128 = pix
+
+    # Find our pixel
+    hlist = db.query(listfile,'hlist',where='PIX='+str(pix128))
+    nlist = len(hlist)
+    if nlist == 0:
+        print("No entries for Healpix pixel '"+str(pix128)+"' in the list")
+        return None
+    hlist = Table(hlist)
+    # GET EXPOSURES FOR NEIGHBORING PIXELS AS WELL
+    #  so we can deal with the edge cases
+    neipix = hp.get_all_neighbours(128,pix128)
+    for neip in neipix:
+        hlist1 = db.query(listfile,'hlist',where='PIX='+str(neip))
+        nhlist1 = len(hlist1)
+        if nhlist1>0:
+            hlist1 = Table(hlist1)
+            hlist = vstack([hlist,hlist1])
 
-# Combine data for one NSC healpix region
-if __name__ == "__main__":
-    parser = ArgumentParser(description='Combine NSC data for one healpix region.')
-    parser.add_argument('pix', type=str, nargs=1, help='HEALPix pixel number')
-    parser.add_argument('version', type=str, nargs=1, help='Version number')
-    parser.add_argument('--nside', type=int, default=128, help='HEALPix Nside')
-    parser.add_argument('-r','--redo', action='store_true', help='Redo this HEALPIX')
-    parser.add_argument('-v','--verbose', action='store_true', help='Verbose output')
-    parser.add_argument('-m','--multilevel', action='store_true', help='Break into smaller healpix')
-    parser.add_argument('--outdir', type=str, default='', help='Output directory')
-    parser.add_argument('-nm','--nmulti', type=int, nargs=1, default=1, help='Number of jobs')
+    # Rename to be consistent with the FITS file
+    hlist['file'].name = 'FILE'
+    hlist['base'].name = 'BASE'
+    hlist['pix'].name = 'PIX'
 
-    args = parser.parse_args()
+    # Use entire exposure files
+    # Get unique values
+    u, ui = np.unique(hlist['FILE'],return_index=True)
+    hlist = hlist[ui]
+
+    return hlist
+
+
+def pixelchips(metafiles,buffdict,metacache=None,fpindex=None):
+    """ Chip polygons around a pixel with the source density (per deg^2) of their exposure,
+        from the footprint index or from the meta-data in METACACHE.  Returns DENSITY, VRA and VDEC."""
+    areadict = {'c4d':3.0, 'k4m':0.3, 'ksb':1.0}  # total area
+    density, vra, vdec = [], [], []
+    if fpindex is not None:
+        expmeta, chips = fpindex.query(buffdict,metafiles)
+        expdens = dict([(m,n/areadict[i]) for m,n,i in zip(expmeta['metafile'],expmeta['nsources'],expmeta['instrument'])])
+        density = [expdens[m] for m in chips['metafile']]
+        vra = chips['vra']
+        vdec = chips['vdec']
+    else:
+        for mfile in metafiles:
+            if (metacache is None) or (mfile not in metacache): continue
+            meta, chmeta = metacache[mfile]
+            density += [meta['nsources'][0]/areadict[meta['instrument'][0]]]*len(chmeta)
+            vra += [np.asarray(v,float) for v in chmeta['vra']]
+            vdec += [np.asarray(v,float) for v in chmeta['vdec']]
+    return np.array(density,float), np.array(vra,float).reshape(-1,4), np.array(vdec,float).reshape(-1,4)
+
+def subpixmeasest(dopix,hinside,cenra,cendec,density,vra,vdec,nsamp=4):
+    """ Estimated number of measurements in each subpixel (RING, nside=HINSIDE): the source density of
+        each chip times the fraction of NSAMPxNSAMP points of the subpixel that the chip covers, summed."""
+    dopix = np.atleast_1d(dopix)
+    npix = len(dopix)
+    nest = hp.ring2nest(hinside,dopix)
+    children = (nest[:,None]*nsamp**2+np.arange(nsamp**2)[None,:]).ravel()
+    pra, pdec = hp.pix2ang(hinside*nsamp,children,nest=True,lonlat=True)
+    plon, plat = coords.rotsphcen(pra,pdec,cenra,cendec,gnomic=True)
+    nmeasest = np.zeros(npix,float)
+    if len(density)==0: return nmeasest
+    vlon, vlat = coords.rotsphcen(vra.ravel(),vdec.ravel(),cenra,cendec,gnomic=True)
+    vlon = vlon.reshape(-1,4)
+    vlat = vlat.reshape(-1,4)
+    # Only the chips near the subpixels
+    near = ((np.max(vlon,axis=1)>=np.min(plon)) & (np.min(vlon,axis=1)<=np.max(plon)) &
+            (np.max(vlat,axis=1)>=np.min(plat)) & (np.min(vlat,axis=1)<=np.max(plat)))
+    area = hp.nside2pixarea(hinside,degrees=True)
+    for i in range(0,np.sum(near),1000):
+        ind = np.where(near)[0][i:i+1000]
+        # Inside the convex chip if the point is on the same side of all edges
+        cross = np.zeros((len(ind),len(plon),4))
+        for k in range(4):
+            x0, y0 = vlon[ind,k][:,None], vlat[ind,k][:,None]
+            x1, y1 = vlon[ind,(k+1)%4][:,None], vlat[ind,(k+1)%4][:,None]
+            cross[:,:,k] = (x1-x0)*(plat[None,:]-y0)-(y1-y0)*(plon[None,:]-x0)
+        inside = np.all(cross>=0,axis=2) | np.all(cross<=0,axis=2)
+        frac = inside.reshape(len(ind),npix,nsamp**2).mean(axis=2)
+        nmeasest += area*np.sum(density[ind][:,None]*frac,axis=0)
+    return nmeasest
+
+
+# Rough memory use per measurement of one pixel combine in bytes,
+#  the loaded catalog plus clustering and aggregation
+MEASMEM = 1000
+
+# The healpix list and meta-data shared with the subpixel worker processes,
+#  set before the pool is started so the forked workers inherit them
+_subpixshared = {}
+
+def _combinesubpix(args):
+    pix1, kwargs = args
+    t0 = time.time()
+    outfile1 = combine(pix1,hlist=_subpixshared['hlist'],metacache=_subpixshared['metacache'],**kwargs)
+    return pix1, outfile1, time.time()-t0
+
+def runsubpix(dopix,version,hinside,hlist,metacache,nmeasest,nmulti=1,maxmem=None,**kwargs):
+    """ Run the smaller healpix of a pixel that was broken up without re-running the script.
+
+    The healpix list and the exposure meta-data are loaded once by the parent
+    pixel and shared with the subpixels.  With nmulti>1 the subpixels run on a
+    multiprocessing pool, largest first, and a subpixel is only started when its
+    estimated memory (NMEASEST*MEASMEM) fits in MAXMEM together with the ones
+    that are already running.
+
+    Parameters
+    ----------
+    dopix : list
+       The nside=HINSIDE healpix to run.
+    version : str
+       Version number.
+    hinside : int
+       HEALPix Nside of the subpixels.
+    hlist : astropy table
+       The healpix list of exposures of the parent pixel and its neighbors.
+    metacache : dict
+       Cache of the exposure meta-data.
+    nmeasest : numpy array
+       Estimated number of measurements in each subpixel.
+    nmulti : int, optional
+       Number of processes.  Default is 1.
+    maxmem : float, optional
+       Memory budget in bytes.  Default is 80% of the available memory.
+    **kwargs
+       Other keywords for combine().
+
+    Returns
+    -------
+    dt : numpy array
+       Time to run each subpixel in seconds.
+
+    """
+
+    t00 = time.time()
+    npix = len(dopix)
+    kw = dict(kwargs)
+    kw['version'] = version
+    kw['nside'] = hinside
+    kw['multilevel'] = False
+    dt = np.zeros(npix,float)
+
+    # Single process
+    if nmulti==1:
+        for i in range(npix):
+            print('')
+            print('########### '+str(i+1)+' '+str(dopix[i])+' ###########')
+            print('')
+            t0 = time.time()
+            combine(dopix[i],hlist=hlist,metacache=metacache,**kw)
+            dt[i] = time.time()-t0
+        print('subpixels done after '+str(time.time()-t00)+' sec.')
+        return dt
+
+    # Pool workers are daemonic and cannot start their own tiled clustering pool
+    kw['nproc'] = 1
+    if maxmem is None:
+        maxmem = 0.8*psutil.virtual_memory().available
+    memest = np.asarray(nmeasest,float)*MEASMEM
+    print('Running '+str(npix)+' subpixels with '+str(nmulti)+' processes and a '+str(maxmem/1e9)+' GB memory budget')
+    _subpixshared['hlist'] = hlist
+    _subpixshared['metacache'] = metacache
+    # new process for each subpixel so the memory is released
+    pool = multiprocessing.Pool(nmulti,maxtasksperchild=1)
+    try:
+        todo = list(np.argsort(-memest,kind='stable'))   # largest first
+        running = {}
+        while (len(todo)>0) | (len(running)>0):
+            # Start subpixels while they fit in the memory budget
+            while (len(todo)>0) & (len(running)<nmulti):
+                used = np.sum([memest[j] for j in running])
+                fits1 = [j for j in todo if used+memest[j]<=maxmem]
+                if len(fits1)==0:
+                    if len(running)>0: break
+                    fits1 = [todo[0]]         # always run at least one
+                i = fits1[0]
+                todo.remove(i)
+                running[i] = pool.apply_async(_combinesubpix,((dopix[i],kw),))
+            time.sleep(1)
+            # Collect finished subpixels
+            for i in [j for j in running if running[j].ready()]:
+                pix1, outfile1, dt1 = running.pop(i).get()
+                dt[i] = dt1
+                v = psutil.virtual_memory()
+                print('subpixel %d done in %8.1f sec.  %6.1f GB available' % (pix1,dt1,v.available/1e9))
+    finally:
+        pool.close()
+        pool.join()
+        _subpixshared.clear()
+    print('subpixels done after '+str(time.time()-t00)+' sec.')
+
+    return dt
+
+
+def benchmarkmultilevel(pix,version,nmulti=1,extra=[],tmpdir=None):
+    """ Total wall time of a pixel that is broken up, re-running the script for each subpixel
+        and running them in one process.  The outputs and idstr files go to a temporary
+        directory that is removed afterwards, the real outputs are not touched."""
+    script = os.path.abspath(__file__)
+    outroot = tempfile.mkdtemp(prefix='benchmarkmultilevel',dir=tmpdir)
+    res = {}
+    try:
+        for name,flags in [('spawn',['--spawn']),('inprocess',[])]:
+            outdir = os.path.join(outroot,name,'combine')+'/'
+            iddir = os.path.join(outroot,name,'idstr')+'/'
+            os.makedirs(outdir)
+            os.makedirs(iddir)
+            cmd = ['python',script,str(pix),version,'-r','-nm',str(nmulti),'--outdir',outdir,'--iddir',iddir]+flags+list(extra)
+            t0 = time.time()
+            retcode = subprocess.call(cmd,shell=False)
+            res[name] = time.time()-t0
+            print('%-10s %10.1f sec.  (return code %d)' % (name,res[name],retcode))
+    finally:
+        shutil.rmtree(outroot)
+    print('speed-up %6.2f' % (res['spawn']/res['inprocess']))
+    return res
+
+
+def combine(pix,version,nside=128,redo=False,multilevel=True,outdir='',nmulti=1,batchpm=False,storetype='sqlite',
+            nproc=1,spawn=False,maxmem=None,hlist=None,metacache=None,fpindex=None,nthreads=4,iddir=None,ebvmap=None):
+    """ Combine NSC data for one healpix region.
+
+    Parameters
+    ----------
+    pix : int
+       HEALPix pixel number.
+    version : str
+       Version number.
+    nside : int, optional
+       HEALPix Nside.  Default is 128.
+    redo : bool, optional
+       Redo this HEALPix.  Default is False.
+    multilevel : bool, optional
+       Break into smaller healpix if there are too many measurements.  Default is True.
+    outdir : str, optional
+       Output directory.  Default is the combine directory of the version.
+    nmulti : int, optional
+       Number of jobs for the smaller healpix.  Default is 1.
+    batchpm : bool, optional
+       Use the batched proper motion solver.  Default is False.
+    storetype : str, optional
+       Temporary measurement store backend (sqlite or npy).  Default is sqlite.
+    nproc : int, optional
+       Number of processes for tiled clustering.  Default is 1.
+    spawn : bool, optional
+       Run the smaller healpix by re-running this script in a new process for each
+       (the old method).  Default is False, run them with runsubpix().
+    maxmem : float, optional
+       Memory budget in bytes for the smaller healpix running at the same time.
+    hlist : astropy table, optional
+       The healpix list of exposures, passed in by a parent pixel.
+    metacache : dict, optional
+       Cache of the exposure meta-data, passed in by a parent pixel.
+    fpindex : str, optional
+       Chip-footprint index file (see footprint.py), only queried here.  It is
+       kept up to date by nsc_instcal_combine_main.py.  The meta files are read
+       directly if some of this pixel's exposures are not in it.
+    nthreads : int, optional
+       Number of threads to read the chip catalogs.  Default is 4.
+    iddir : str, optional
+       Directory of the exposure-partitioned idstr store (see idstore.py).  The idstr
+       of this pixel is written straight to it instead of to PIX_idstr.db and then
+       broken up into .npy files.
+    ebvmap : str, optional
+       HEALPix E(B-V) map file (see reddening.py) to use instead of dustmaps SFDQuery.
+
+    Returns
+    -------
+    outfile : str
+       The output file name.  None if the pixel could not be combined.
+
+    """
 
     t0 = time.time()
     hostname = socket.gethostname()
     host = hostname.split('.')[0]
     radeg = np.float64(180.00) / np.pi
 
-    # Inputs
-    pix = int(args.pix[0])
-    version = args.version[0]
-    verbose = args.verbose
-    nside = args.nside
-    redo = args.redo
-    multilevel = args.multilevel
-    nmulti = dln.first_el(args.nmulti)
-    print('KLUDGE!!!  FORCING --MULTILEVEL')
-    multilevel = True
-    outdir = args.outdir
-    
     tmpdir = '/tmp/'  # default
     # on thing/hulk use
     if (host == "thing") or (host == "hulk"):
@@ -1206,14 +1386,14 @@ if __name__ == "__main__":
         tmproot = localdir+"dnidever/nsc/instcal/"+version+"/tmp/"
 
     t0 = time.time()
-
     # Only nside>=128 supported right now
     if nside<128:
         print('Only nside=>128 supported')
-        sys.exit()
+        return
 
-    print('*** KLUDGE: Forcing output to /net/dl2 ***')
-    outdir = '/net/dl2/dnidever/nsc/instcal/'+version+'/combine/'
+    if outdir=='':
+        print('*** KLUDGE: Forcing output to /net/dl2 ***')
+        outdir = '/net/dl2/dnidever/nsc/instcal/'+version+'/combine/'
     if os.path.exists(outdir) is False: os.mkdir(outdir)
 
     # nside>128
@@ -1230,6 +1410,7 @@ if __name__ == "__main__":
 
     # nside=128
     else:
+        parentpix = pix
         # Output filenames
         outbase = str(pix)
         subdir = str(int(pix)//1000)    # use the thousands to create subdirectory grouping
@@ -1239,66 +1420,21 @@ if __name__ == "__main__":
     # Check if output file already exists
     if (os.path.exists(outfile) or os.path.exists(outfile+'.gz')) & (not redo):
         print(outfile+' EXISTS already and REDO not set')
-        sys.exit()
+        return outfile
 
     print("Combining InstCal SExtractor catalogs for Healpix pixel = "+str(pix))
 
 
     # Use the healpix list, nside=128
-    listfile = localdir+'dnidever/nsc/instcal/'+version+'/nsc_instcal_combine_healpix_list.db'
-    if os.path.exists(listfile) is False:
-        print(listfile+" NOT FOUND")
-        sys.exit()
-
-
-    # nside>128
-    if nside > 128:
-        # Find our pixel
-        hlist = db.query(listfile,'hlist',where='PIX='+str(parentpix))
-        nlist = len(hlist)
-        if nlist == 0:
-            print("No entries for Healpix pixel '"+str(parentpix)+"' in the list")
-            sys.exit()
-        hlist = Table(hlist)
-        # GET EXPOSURES FOR NEIGHBORING PIXELS AS WELL
-        #  so we can deal with the edge cases
-        neipix = hp.get_all_neighbours(128,parentpix)
-        for neip in neipix:
-            hlist1 = db.query(listfile,'hlist',where='PIX='+str(neip))
-            nhlist1 = len(hlist1)
-            if nhlist1>0:
-                hlist1 = Table(hlist1)
-                hlist = vstack([hlist,hlist1])
-
-    # nside=128
-    else:
-        parentpix = pix
-        # Find our pixel
-        hlist = db.query(listfile,'hlist',where='PIX='+str(pix))
-        nlist = len(hlist)
-        if nlist == 0:
-            print("No entries for Healpix pixel '"+str(pix)+"' in the list")
-            sys.exit()
-        hlist = Table(hlist)
-        # GET EXPOSURES FOR NEIGHBORING PIXELS AS WELL
-        #  so we can deal with the edge cases
-        neipix = hp.get_all_neighbours(nside,pix)
-        for neip in neipix:
-            hlist1 = db.query(listfile,'hlist',where='PIX='+str(neip))
-            nhlist1 = len(hlist1)
-            if nhlist1>0:
-                hlist1 = Table(hlist1)
-                hlist = vstack([hlist,hlist1])
-
-    # Rename to be consistent with the FITS file
-    hlist['file'].name = 'FILE'
-    hlist['base'].name = 'BASE'
-    hlist['pix'].name = 'PIX'
-
-    # Use entire exposure files
-    # Get unique values
-    u, ui = np.unique(hlist['FILE'],return_index=True)
-    hlist = hlist[ui]
+    #  a parent pixel that was broken up passes its list in
+    if hlist is None:
+        listfile = localdir+'dnidever/nsc/instcal/'+version+'/nsc_instcal_combine_healpix_list.db'
+        if os.path.exists(listfile) is False:
+            print(listfile+" NOT FOUND")
+            return
+        hlist = loadhlist(listfile,pix,nside)
+        if hlist is None:
+            return
     nhlist = len(hlist)
     print(str(nhlist)+' exposures that overlap this pixel and neighbors')
 
@@ -1358,7 +1494,17 @@ if __name__ == "__main__":
 
     # Estimate number of measurements in pixel
     metafiles = [m.replace('_cat','_meta').strip() for m in hlist['FILE']]
-    metastr = checkboundaryoverlap(metafiles,buffdict,verbose=False)
+    #  the exposure meta-data are kept in METACACHE for loadmeas and the subpixels
+    if metacache is None: metacache = {}
+    fpfile = fpindex
+    if fpfile is not None:
+        fpindex = footprint.FootprintIndex(fpfile)
+        nmissing = len(fpindex.missing(metafiles))
+        if nmissing>0:
+            print(str(nmissing)+' exposures are not in the footprint index '+fpfile+'.  Reading the meta files')
+            fpindex.close()
+            fpindex = None
+    metastr = checkboundaryoverlap(metafiles,buffdict,verbose=False,metacache=metacache,fpindex=fpindex)
     nmeasperarea = np.zeros(dln.size(metastr),int)
     areadict = {'c4d':3.0, 'k4m':0.3, 'ksb':1.0}  # total area
     for j in range(dln.size(metastr)):
@@ -1395,8 +1541,18 @@ if __name__ == "__main__":
 
             # Some healpix to run
             if len(dopix)>0:
+                # Run in this process or on a process pool, sharing the list and meta-data
+                if spawn is False:
+                    # Estimated number of measurements per subpixel, from the chips that cover it
+                    density, vra, vdec = pixelchips(metafiles,buffdict,metacache=metacache,fpindex=fpindex)
+                    nmeasest = subpixmeasest(dopix,hinside,cenra,cendec,density,vra,vdec)
+                    if np.sum(nmeasest)==0:
+                        nmeasest = np.zeros(len(dopix))+totmeasest*hp.nside2pixarea(hinside)/hp.nside2pixarea(nside)
+                    runsubpix(dopix,version,hinside,hlist,metacache,nmeasest,nmulti=nmulti,maxmem=maxmem,
+                              redo=redo,outdir=outdir,batchpm=batchpm,storetype=storetype,nproc=nproc,fpindex=fpfile,
+                              nthreads=nthreads,iddir=iddir,ebvmap=ebvmap)
                 # Single process, just use subprocess
-                if nmulti==1:
+                elif nmulti==1:
                     for i in range(len(dopix)):
                         pix1 = dopix[i]
                         print('')
@@ -1406,16 +1562,25 @@ if __name__ == "__main__":
                         outbase1 = str(parentpix)+'_n'+str(int(hinside))+'_'+str(pix1)
                         subdir1 = str(int(parentpix)//1000)    # use the thousands to create subdirectory grouping
                         outfile1 = outdir+'/'+subdir1+'/'+outbase1+'.fits.gz'
-                        if redo is True:
-                            retcode = subprocess.call(['python',os.path.abspath(__file__),str(pix1),version,'--nside',str(hinside),'-r'],shell=False)
-                        else:
-                            retcode = subprocess.call(['python',os.path.abspath(__file__),str(pix1),version,'--nside',str(hinside)],shell=False)
+                        cmd1 = ['python',os.path.abspath(__file__),str(pix1),version,'--nside',str(hinside)]
+                        if redo is True: cmd1.append('-r')
+                        if batchpm: cmd1.append('--batchpm')
+                        cmd1 += ['--store',storetype,'--nproc',str(nproc),'--nthreads',str(nthreads),'--outdir',outdir]
+                        if fpfile is not None: cmd1 += ['--fpindex',fpfile]
+                        if iddir is not None: cmd1 += ['--iddir',iddir]
+                        if ebvmap is not None: cmd1 += ['--ebvmap',ebvmap]
+                        retcode = subprocess.call(cmd1,shell=False)
                 # Multiple parallel processes, Running job daemon
                 else:
                     cmd = []
                     for i in range(len(dopix)):
                         cmd1 = os.path.abspath(__file__)+' '+str(dopix[i])+' '+version+' --nside '+str(hinside)
                         if redo: cmd1 = cmd1+' -r'
+                        if batchpm: cmd1 = cmd1+' --batchpm'
+                        cmd1 = cmd1+' --store '+storetype+' --nproc '+str(nproc)+' --nthreads '+str(nthreads)+' --outdir '+outdir
+                        if fpfile is not None: cmd1 = cmd1+' --fpindex '+fpfile
+                        if iddir is not None: cmd1 = cmd1+' --iddir '+iddir
+                        if ebvmap is not None: cmd1 = cmd1+' --ebvmap '+ebvmap
                         cmd.append(cmd1)
                     dirs = np.zeros(len(dopix),(np.str,200))
                     dirs[:] = tmpdir
@@ -1432,7 +1597,7 @@ if __name__ == "__main__":
                 outfile1 = outfiles[i]
                 if os.path.exists(outfile1) is False:
                     print(outfile1+' NOT FOUND')
-                    sys.exit()
+                    return
                 # meta columns different: nobjects   there'll be repeats
                 meta1 = fits.getdata(outfile1,1)
                 if allmeta is None:
@@ -1445,11 +1610,17 @@ if __name__ == "__main__":
                 nobj1 = len(obj1)
 
                 # Update the objectIDs
-                dbfile_idstr1 = outfile1.replace('.fits.gz','_idstr.db')
                 objectid_orig = obj1['objectid']
                 objectid_new = dln.strjoin( str(parentpix)+'.', ((np.arange(nobj1)+1+totobjects).astype(np.str)) )
-                #updatecoldb(selcolname,selcoldata,updcolname,updcoldata,table,dbfile):
-                updatecoldb('objectid',objectid_orig,'objectid',objectid_new,'idstr',dbfile_idstr1)
+                if iddir is not None:
+                    ids = idstore.IdStore(iddir)
+                    ids.renumber(os.path.basename(outfile1)[0:-8],objectid_orig,objectid_new)
+                    ids.close()
+                else:
+                    dbfile_idstr1 = outfile1.replace('.fits.gz','_idstr.db')
+                    #updatecoldb(selcolname,selcoldata,updcolname,updcoldata,table,dbfile):
+                    updatecoldb('objectid',objectid_orig,'objectid',objectid_new,'idstr',dbfile_idstr1)
+                    dbsession.closesession(dbfile_idstr1)
                 # Update objectIDs in catalog
                 obj1['objectid'] = objectid_new
 
@@ -1503,56 +1674,65 @@ if __name__ == "__main__":
             dt = time.time()-t0
             print('dt = '+str(dt)+' sec.')
 
-            print('Breaking-up IDSTR information')
-            dbfiles_idstr = []
-            for i in range(len(allpix)):
-                outfile1 = outfiles[i]
-                dbfile_idstr1 = outfile1.replace('.fits.gz','_idstr.db')
-                dbfiles_idstr.append(dbfile_idstr1)
-            breakup_idstr(dbfiles_idstr)            
+            # The subpixels wrote their idstr to the ID store themselves
+            if iddir is None:
+                dbfiles_idstr = []
+                for i in range(len(allpix)):
+                    outfile1 = outfiles[i]
+                    dbfile_idstr1 = outfile1.replace('.fits.gz','_idstr.db')
+                    dbfiles_idstr.append(dbfile_idstr1)
+                print('Breaking-up IDSTR information')
+                breakup_idstr(dbfiles_idstr)            
 
-            sys.exit()
+            return outfile
 
 
     # Decide whether to load everything into RAM or use temporary database
     usedb = False
     if totmeasest>500000: usedb=True
     dbfile = None
+    store = None
     if usedb:
-        dbfile = tmproot+outbase+'_combine.db'
-        print('Using temporary database file = '+dbfile)
-        if os.path.exists(dbfile): os.remove(dbfile)
+        if storetype=='npy':
+            dbfile = tmproot+outbase+'_combine_store'
+            print('Using temporary measurement store = '+dbfile)
+        else:
+            dbfile = tmproot+outbase+'_combine.db'
+            print('Using temporary database file = '+dbfile)
+        store = measstore.openstore(dbfile,storetype)
+        store.remove()
+        store = measstore.openstore(dbfile,storetype)
     else:
         print('Keeping all measurement data in memory')
 
     #import pdb; pdb.set_trace()
 
-    # IDSTR database file
+    # IDSTR database file, with IDDIR the idstr is kept here and written to the ID store
     dbfile_idstr = outdir+'/'+subdir+'/'+outbase+'_idstr.db'
     if os.path.exists(dbfile_idstr): os.remove(dbfile_idstr)
+    idchunks = []
 
     # Load the measurement catalog
     #  this will contain excess rows at the end, if all in RAM
     #  if using database, CAT is empty
-    cat, catcount, allmeta = loadmeas(metafiles,buffdict,dbfile=dbfile)
+    cat, catcount, allmeta = loadmeas(metafiles,buffdict,store=store,metacache=metacache,fpindex=fpindex,nthreads=nthreads)
     ncat = catcount
     print(str(ncat))
 
     # No measurements
     if ncat==0:
         print('No measurements for this healpix')
-        if (dbfile is not None):
-            if os.path.exists(dbfile): os.remove(dbfile)
+        if (store is not None): store.remove()
         if os.path.exists(dbfile_idstr): os.remove(dbfile_idstr)
         print('Writing blank output file to '+outfile)
         fits.PrimaryHDU().writeto(outfile)
         if os.path.exists(outfile+'.gz'): os.remove(outfile+'.gz')
         ret = subprocess.call(['gzip',outfile])    # compress final catalog
-        sys.exit()
+        return outfile
 
     # Spatially cluster the measurements with DBSCAN
     #   this might also resort CAT
-    objstr, cat = clusterdata(cat,ncat,dbfile=dbfile)
+    objstr, cat = clusterdata(cat,ncat,store=store,nproc=nproc)
     nobj = dln.size(objstr)
     meascumcount = np.cumsum(objstr['NMEAS'])
     print(str(nobj)+' unique objects clustered')
@@ -1581,10 +1761,6 @@ if __name__ == "__main__":
     obj['nsigvar'] = np.nan
     #idstr = np.zeros(ncat,dtype=dtype_idstr)
 
-    # Initialize temporary IDSTR structure
-    idstr = np.zeros(100000,dtype=dtype_idstr)
-    nidstr = dln.size(idstr)
-
     # Higher precision catalog
     dtype_hicat = np.dtype([('MEASID',np.str,30),('EXPOSURE',np.str,40),('CCDNUM',int),('FILTER',np.str,3),
                             ('MJD',float),('RA',float),('RAERR',float),('DEC',float),('DECERR',float),
@@ -1599,312 +1775,126 @@ if __name__ == "__main__":
 
     t1 = time.time()
 
-    # Loop over the objects
-    meascount = 0
-    ngroup = -1
-    grpcount = 0
+    # Loop over groups of objects
+    #  all the objects in a group are aggregated at once with the
+    #  columnar aggregation engine
     maxmeasload = 50000
-    ngrpcat = 0
-    ncat1 = 0
-    idstr_count = 0
-    idstr_grpcount = 0
     fidmag = np.zeros(nobj,float)+np.nan  # fiducial magnitude
-    for i,lab in enumerate(objstr['OBJLABEL']):
-        if (i % 1000)==0: print(i)
+    i0 = 0
+    while (i0<nobj):
+        # Use maxmeasload to figure out how many objects we can load
+        if i0==0:
+            ngroup = np.sum(meascumcount<=maxmeasload)
+        else:
+            ngroup = np.sum((meascumcount[i0:]-meascumcount[i0-1])<=maxmeasload)
+        ngroup = np.max([1,ngroup])   # need to load at least 1
+        i1 = np.min([i0+ngroup,nobj])
+        print(str(i0)+' '+str(i1))
 
-        if (i % 1000)==0:
-            v = psutil.virtual_memory()
-            process = psutil.Process(os.getpid())
-            print('%6.1f Percent of memory used. %6.1f GB available.  Process is using %6.2f GB of memory.' % (v.percent,v.available/1e9,process.memory_info()[0]/1e9))
+        v = psutil.virtual_memory()
+        process = psutil.Process(os.getpid())
+        print('%6.1f Percent of memory used. %6.1f GB available.  Process is using %6.2f GB of memory.' % (v.percent,v.available/1e9,process.memory_info()[0]/1e9))
 
-        # Get meas data for this object
+        # Get meas data for this group of objects
         if usedb is False:
-            oindx = np.arange(objstr['LO'][i],objstr['HI'][i]+1)  # this fails if start,stop are the same
-            if objstr['NMEAS'][i]==1: oindx=np.atleast_1d(objstr['LO'][i])
-            ncat1 = dln.size(oindx)
-            cat1_orig = cat[oindx]
+            lo = objstr['LO'][i0]
+            hi = objstr['HI'][i1-1]
             # Upgrade precisions of catalog
-            cat1 = np.zeros(ncat1,dtype=dtype_hicat)
-            cat1[...] = cat1_orig   # stuff in the data
-            #for n in dtype_hicat.names: cat1[n] = cat1_orig[n]
-            del cat1_orig
+            cat1 = np.zeros(hi-lo+1,dtype=dtype_hicat)
+            cat1[...] = cat[lo:hi+1]   # stuff in the data
+            labels1 = np.repeat(objstr['OBJLABEL'][i0:i1],objstr['NMEAS'][i0:i1])
         # Get from the database
-        else:            
-            # Get next group of object measurements
-            if grpcount>=ngroup:
-                # Use maxmeasload to figure out how many objects we can load
-                if i==0:
-                    ngroup = np.max(np.where(meascumcount[i:]<=maxmeasload)[0])+1
-                else:
-                    ngroup = np.max(np.where((meascumcount[i:]-meascumcount[i-1])<=maxmeasload)[0])+1
-                ngroup = np.max([1,ngroup])   # need to load at least 1
-                lab0 = lab
-                lab1 = objstr['OBJLABEL'][np.min([i+ngroup-1,nobj-1])]
-                #lab1 = labelindex['value'][np.min([i+ngroup-1,nobj-1])]
-                if ngrpcat>0: del grpcat
-                if ncat1>0: del cat1
-                grpcat = getdatadb(dbfile,objlabel=[lab0,lab1])
-                ngrpcat = dln.size(grpcat)
-                grpindex = dln.create_index(grpcat['OBJLABEL'])                
-                #ngroup = len(grpindex['value'])
-                grpcount = 0
-            # Get the measurement data for this object
-            gindx = grpindex['index'][grpindex['lo'][grpcount]:grpindex['hi'][grpcount]+1]
-            cat1 = np.atleast_1d(grpcat[gindx])
-            ncat1 = len(cat1)
-            grpcount += 1
-            oindx = np.arange(ncat1)+meascount
-            meascount += ncat1            
-
-        obj['ndet'][i] = ncat1
-
-
-        # Add IDSTR information to IDSTR structure/database
-        #  update in groups to database so it takes less time
-        if idstr_count+ncat1 > nidstr:
-            print('  Adding more elements to temporary IDSTR structure')
-            idstr = add_elements(idstr,50000)  # add more elements if necessary
-        # Add information to temporary IDSTR structure for this object
-        idstr['measid'][idstr_count:idstr_count+ncat1] = cat1['MEASID']
-        idstr['exposure'][idstr_count:idstr_count+ncat1] = cat1['EXPOSURE']
-        idstr['objectid'][idstr_count:idstr_count+ncat1] = obj['objectid'][i]
-        idstr['objectindex'][idstr_count:idstr_count+ncat1] = i
-        idstr_count += ncat1
-        idstr_grpcount += 1
-        # Write to database and reinitialize the temporary IDSTR structure
-        if (idstr_grpcount>5000) | (idstr_count>30000) |  (i==(nobj-1)):
-            print('  Writing data to IDSTR database')
-            writeidstr2db(idstr[0:idstr_count],dbfile_idstr)
-            idstr = np.zeros(100000,dtype=dtype_idstr)
-            nidstr = dln.size(idstr)
-            idstr_count = 0
-            idstr_grpcount = 0
-
-        # Computing quantities
-        # Mean RA/DEC, RAERR/DECERR
-        if ncat1>1:
-            wt_ra = 1.0/cat1['RAERR']**2
-            wt_dec = 1.0/cat1['DECERR']**2
-            obj['ra'][i] = np.sum(cat1['RA']*wt_ra)/np.sum(wt_ra)
-            obj['raerr'][i] = np.sqrt(1.0/np.sum(wt_ra))
-            obj['dec'][i] = np.sum(cat1['DEC']*wt_dec)/np.sum(wt_dec)
-            obj['decerr'][i] = np.sqrt(1.0/np.sum(wt_dec))
-            obj['mjd'][i] = np.mean(cat1['MJD'])
-            obj['deltamjd'][i] = np.max(cat1['MJD'])-np.min(cat1['MJD'])
         else:
-            obj['ra'][i] = cat1['RA']
-            obj['dec'][i] = cat1['DEC']
-            obj['raerr'][i] = cat1['RAERR']
-            obj['decerr'][i] = cat1['DECERR']
-            obj['mjd'][i] = cat1['MJD']
-            obj['deltamjd'][i] = 0
+            lab0 = objstr['OBJLABEL'][i0]
+            lab1 = objstr['OBJLABEL'][i1-1]
+            cat1 = store.getdata(objlabel=[lab0,lab1])
+            labels1 = cat1['OBJLABEL']
+        ncat1 = len(cat1)
+        # Object index for each measurement
+        objindex1 = i0+np.searchsorted(objstr['OBJLABEL'][i0:i1],labels1)
 
-        # Mean proper motion and errors
-        if ncat1>1:
-            raerr = np.array(cat1['RAERR']*1e3,np.float64)    # milli arcsec
-            ra = np.array(cat1['RA'],np.float64)
-            ra -= np.mean(ra)
-            ra *= 3600*1e3 * np.cos(obj['dec'][i]/radeg)     # convert to true angle, milli arcsec
-            t = cat1['MJD'].copy()
-            t -= np.mean(t)
-            t /= 365.2425                          # convert to year
-            # Calculate robust slope
-            pmra, pmraerr = dln.robust_slope(t,ra,raerr,reweight=True)
-            obj['pmra'][i] = pmra                 # mas/yr
-            obj['pmraerr'][i] = pmraerr           # mas/yr
+        # Computing quantities for all objects in the group
+        obj1 = obj[i0:i1]    # a view, filled in place
+        value1, fidmag1 = aggregate.aggregate(cat1,labels1,obj1)
+        fidmag[i0:i1] = fidmag1
 
-            decerr = np.array(cat1['DECERR']*1e3,np.float64)   # milli arcsec
-            dec = np.array(cat1['DEC'],np.float64)
-            dec -= np.mean(dec)
-            dec *= 3600*1e3                         # convert to milli arcsec
-            # Calculate robust slope
-            pmdec, pmdecerr = dln.robust_slope(t,dec,decerr,reweight=True)
-            obj['pmdec'][i] = pmdec               # mas/yr
-            obj['pmdecerr'][i] = pmdecerr         # mas/yr
+        # Mean proper motion and errors
+        if batchpm:
+            pm1 = pmfit.pmsolve(labels1,cat1['MJD'],cat1['RA'],cat1['DEC'],cat1['RAERR'],cat1['DECERR'],objdec=obj1['dec'])
+            for n in ['pmra','pmraerr','pmdec','pmdecerr']: obj1[n]=pm1[n]
+        else:
+            lindex1 = aggregate.segindex(labels1)
+            for k in np.where(lindex1['num']>1)[0]:
+                indx = lindex1['index'][lindex1['lo'][k]:lindex1['hi'][k]+1]
+                raerr = np.array(cat1['RAERR'][indx]*1e3,np.float64)    # milli arcsec
+                ra = np.array(cat1['RA'][indx],np.float64)
+                ra -= np.mean(ra)
+                ra *= 3600*1e3 * np.cos(obj1['dec'][k]/radeg)     # convert to true angle, milli arcsec
+                t = cat1['MJD'][indx].copy()
+                t -= np.mean(t)
+                t /= 365.2425                          # convert to year
+                # Calculate robust slope
+                pmra, pmraerr = dln.robust_slope(t,ra,raerr,reweight=True)
+                obj1['pmra'][k] = pmra                 # mas/yr
+                obj1['pmraerr'][k] = pmraerr           # mas/yr
+
+                decerr = np.array(cat1['DECERR'][indx]*1e3,np.float64)   # milli arcsec
+                dec = np.array(cat1['DEC'][indx],np.float64)
+                dec -= np.mean(dec)
+                dec *= 3600*1e3                         # convert to milli arcsec
+                # Calculate robust slope
+                pmdec, pmdecerr = dln.robust_slope(t,dec,decerr,reweight=True)
+                obj1['pmdec'][k] = pmdec               # mas/yr
+                obj1['pmdecerr'][k] = pmdecerr         # mas/yr
+
+        # Add IDSTR information to the IDSTR database, or keep it for the ID store
+        if iddir is not None:
+            idchunks.append((np.asarray(cat1['MEASID']).astype(bytes),np.asarray(cat1['EXPOSURE']).astype(bytes),objindex1))
+        else:
+            idstr = np.zeros(ncat1,dtype=dtype_idstr)
+            idstr['measid'] = cat1['MEASID']
+            idstr['exposure'] = cat1['EXPOSURE']
+            idstr['objectid'] = obj['objectid'][objindex1]
+            idstr['objectindex'] = objindex1
+            print('  Writing data to IDSTR database')
+            writeidstr2db(idstr,dbfile_idstr)
+            del idstr
 
-        # Mean magnitudes
-        # Convert totalwt and totalfluxwt to MAG and ERR
-        #  and average the morphology parameters PER FILTER
-        filtindex = dln.create_index(cat1['FILTER'].astype(np.str))
-        nfilters = len(filtindex['value'])
-        resid = np.zeros(ncat1)+np.nan     # residual mag
-        relresid = np.zeros(ncat1)+np.nan  # residual mag relative to the uncertainty
-        for f in range(nfilters):
-            filt = filtindex['value'][f].lower()
-            findx = filtindex['index'][filtindex['lo'][f]:filtindex['hi'][f]+1]
-            obj['ndet'+filt][i] = filtindex['num'][f]
-            gph,ngph = dln.where(cat1['MAG_AUTO'][findx]<50)
-            obj['nphot'+filt][i] = ngph
-            if ngph==1:
-                obj[filt+'mag'][i] = cat1['MAG_AUTO'][findx[gph]]
-                obj[filt+'err'][i] = cat1['MAGERR_AUTO'][findx[gph]]
-            if ngph>1:
-                newmag, newerr = dln.wtmean(cat1['MAG_AUTO'][findx[gph]], cat1['MAGERR_AUTO'][findx[gph]],magnitude=True,reweight=True,error=True)
-                obj[filt+'mag'][i] = newmag
-                obj[filt+'err'][i] = newerr
-                # Calculate RMS
-                obj[filt+'rms'][i] = np.sqrt(np.mean((cat1['MAG_AUTO'][findx[gph]]-newmag)**2))
-                # Residual mag
-                resid[findx[gph]] = cat1['MAG_AUTO'][findx[gph]]-newmag
-                # Residual mag relative to the uncertainty
-                #  set a lower threshold of 0.02 in the uncertainty
-                relresid[findx[gph]] = np.sqrt(ngph/(ngph-1)) * (cat1['MAG_AUTO'][findx[gph]]-newmag)/np.maximum(cat1['MAGERR_AUTO'][findx[gph]],0.02)
-
-            # Calculate mean morphology parameters
-            obj[filt+'asemi'][i] = np.mean(cat1['ASEMI'][findx])
-            obj[filt+'bsemi'][i] = np.mean(cat1['BSEMI'][findx])
-            obj[filt+'theta'][i] = np.mean(cat1['THETA'][findx])
-
-        # Calculate variability indices
-        gdresid = np.isfinite(resid)
-        ngdresid = np.sum(gdresid)
-        if ngdresid>0:
-            resid2 = resid[gdresid]
-            sumresidsq = np.sum(resid2**2)
-            tsi = np.argsort(cat1['MJD'][gdresid])
-            resid2tsi = resid2[tsi]
-            quartiles = np.percentile(resid2,[25,50,75])
-            # RMS
-            rms = np.sqrt(sumresidsq/ngdresid)
-            # MAD
-            madvar = 1.4826*np.median(np.abs(resid2-quartiles[1]))
-            # IQR
-            iqrvar = 0.741289*(quartiles[2]-quartiles[0])
-            # 1/eta
-            etavar = sumresidsq / np.sum((resid2tsi[1:]-resid2tsi[0:-1])**2)
-            obj['rmsvar'][i] = rms
-            obj['madvar'][i] = madvar
-            obj['iqrvar'][i] = iqrvar
-            obj['etavar'][i] = etavar
-
-        # Calculate variability indices wrt to uncertainties
-        gdrelresid = np.isfinite(relresid)
-        ngdrelresid = np.sum(gdrelresid)
-        if ngdrelresid>0:
-            relresid2 = relresid[gdrelresid]
-            pk = relresid2**2-1
-            jvar = np.sum( np.sign(pk)*np.sqrt(np.abs(pk)) )/ngdrelresid
-            #avgrelvar = np.mean(np.abs(relresid2))    # average of absolute relative residuals
-            chivar = np.sqrt(np.sum(relresid2**2))/ngdrelresid
-            kdenom = np.sqrt(np.sum(relresid2**2)/ngdrelresid)
-            if kdenom!=0:
-                kvar = (np.sum(np.abs(relresid2))/ngdrelresid) / kdenom
-            else:
-                kvar = np.nan
-            # RoMS
-            romsvar = np.sum(np.abs(relresid2))/(ngdrelresid-1)
-            obj['jvar'][i] = jvar
-            obj['kvar'][i] = kvar
-            #obj['avgrelvar'][i] = avgrelvar
-            obj['chivar'][i] = chivar
-            obj['romsvar'][i] = romsvar
-            #if chivar>50: import pdb; pdb.set_trace()
-
-        # Make NPHOT from NPHOTX
-        obj['nphot'][i] = obj['nphotu'][i]+obj['nphotg'][i]+obj['nphotr'][i]+obj['nphoti'][i]+obj['nphotz'][i]+obj['nphoty'][i]+obj['nphotvr'][i]
-
-        # Fiducial magnitude, used to select variables below
-        #  order of priority: r,g,i,z,Y,VR,u
-        if obj['nphot'][i]>0:
-            magarr = np.zeros(7,float)
-            for ii,nn in enumerate(['rmag','gmag','imag','zmag','ymag','vrmag','umag']): magarr[ii]=obj[nn][i]
-            gfid,ngfid = dln.where(magarr<50)
-            if ngfid>0: fidmag[i]=magarr[gfid[0]]
-
-        # Mean morphology parameters
-        obj['asemi'][i] = np.mean(cat1['ASEMI'])
-        obj['bsemi'][i] = np.mean(cat1['BSEMI'])
-        obj['theta'][i] = np.mean(cat1['THETA'])
-        obj['asemierr'][i] = np.sqrt(np.sum(cat1['ASEMIERR']**2)) / ncat1
-        obj['bsemierr'][i] = np.sqrt(np.sum(cat1['BSEMIERR']**2)) / ncat1
-        obj['thetaerr'][i] = np.sqrt(np.sum(cat1['THETAERR']**2)) / ncat1
-        obj['fwhm'][i] = np.mean(cat1['FWHM'])
-        obj['class_star'][i] = np.mean(cat1['CLASS_STAR'])
-        obj['flags'][i] = np.bitwise_or.reduce(cat1['FLAGS'])  # OR combine
+        del cat1
+        i0 = i1
 
 
     v = psutil.virtual_memory()
     process = psutil.Process(os.getpid())
     print('%6.1f Percent of memory used. %6.1f GB available.  Process is using %6.2f GB of memory.' % (v.percent,v.available/1e9,process.memory_info()[0]/1e9))
 
-    # Created OBJECTID index in IDSTR database
-    createindexdb(dbfile_idstr,'objectid',table='idstr',unique=False)
-    createindexdb(dbfile_idstr,'exposure',table='idstr',unique=False)
-    db.analyzetable(dbfile_idstr,'idstr')
+    if iddir is not None:
+        idmeasid = np.hstack([c[0] for c in idchunks])
+        idexposure = np.hstack([c[1] for c in idchunks])
+        idobjindex = np.hstack([c[2] for c in idchunks])
+        del idchunks
+    else:
+        # Created OBJECTID index in IDSTR database
+        createindexdb(dbfile_idstr,'objectid',table='idstr',unique=False)
+        createindexdb(dbfile_idstr,'exposure',table='idstr',unique=False)
+        dbsession.closesession(dbfile_idstr)
+        db.analyzetable(dbfile_idstr,'idstr')
 
 
     # Select Variables
-    #  1) Construct fiducial magnitude (done in loop above)
-    #  2) Construct median VAR and sigma VAR versus magnitude
-    #  3) Find objects that Nsigma above the median VAR line
-    si = np.argsort(fidmag)   # NaNs are at end
-    varcol = 'madvar'
-    gdvar,ngdvar,bdvar,nbdvar = dln.where(np.isfinite(obj[varcol]) & np.isfinite(fidmag),comp=True)
-    if ngdvar>0:
-        nbins = np.ceil((np.max(fidmag[gdvar])-np.min(fidmag[gdvar]))/0.25)
-        nbins = int(np.max([2,nbins]))
-        fidmagmed, bin_edges1, binnumber1 = bindata.binned_statistic(fidmag[gdvar],fidmag[gdvar],statistic='nanmedian',bins=nbins)
-        numhist, _, _ = bindata.binned_statistic(fidmag[gdvar],fidmag[gdvar],statistic='count',bins=nbins)
-        # Fix NaNs in fidmagmed
-        bdfidmagmed,nbdfidmagmed = dln.where(np.isfinite(fidmagmed)==False)
-        if nbdfidmagmed>0:
-            fidmagmed_bins = 0.5*(bin_edges1[0:-1]+bin_edges1[1:])
-            fidmagmed[bdfidmagmed] = fidmagmed_bins[bdfidmagmed]
-        # Median metric
-        varmed, bin_edges2, binnumber2 = bindata.binned_statistic(fidmag[gdvar],obj[varcol][gdvar],statistic='nanmedian',bins=nbins)
-        # Smooth, it handles NaNs well
-        smlen = 5
-        smvarmed = dln.gsmooth(varmed,smlen)
-        bdsmvarmed,nbdsmvarmed = dln.where(np.isfinite(smvarmed)==False)
-        if nbdsmvarmed>0:
-            smvarmed[bdsmvarmed] = np.nanmedian(smvarmed)
-        # Interpolate to all the objects
-        gv,ngv,bv,nbv = dln.where(np.isfinite(smvarmed),comp=True)
-        fvarmed = interp1d(fidmagmed[gv],smvarmed[gv],kind='linear',bounds_error=False,
-                           fill_value=(smvarmed[0],smvarmed[-1]),assume_sorted=True)
-        objvarmed = np.zeros(nobj,float)
-        objvarmed[gdvar] = fvarmed(fidmag[gdvar])
-        objvarmed[gdvar] = np.maximum(np.min(smvarmed[gv]),objvarmed[gdvar])   # lower limit
-        if nbdvar>0: objvarmed[bdvar]=smvarmed[gv[-1]]   # objects with bad fidmag, set to last value
-        # Scatter in metric around median
-        #  calculate MAD ourselves so that it's around our computed median metric line
-        varsig, bin_edges3, binnumber3 = bindata.binned_statistic(fidmag[gdvar],np.abs(obj[varcol][gdvar]-objvarmed[gdvar]),
-                                                                  statistic='nanmedian',bins=nbins)
-        varsig *= 1.4826   # scale MAD to stddev
-        # Fix values for bins with few points
-        bdhist,nbdhist,gdhist,ngdhist = dln.where(numhist<3,comp=True)
-        if nbdhist>0:
-            if ngdhist>0:
-                varsig[bdhist] = np.nanmedian(varsig[gdhist])
-            else:
-                varsig[:] = 0.02
-            
-        # Smooth
-        smvarsig = dln.gsmooth(varsig,smlen)
-        # Interpolate to all the objects
-        gv,ngv,bv,nbv = dln.where(np.isfinite(smvarsig),comp=True)
-        fvarsig = interp1d(fidmagmed[gv],smvarsig[gv],kind='linear',bounds_error=False,
-                           fill_value=(smvarsig[gv[0]],smvarsig[gv[-1]]),assume_sorted=True)
-        objvarsig = np.zeros(nobj,float)
-        objvarsig[gdvar] = fvarsig(fidmag[gdvar])
-        objvarsig[gdvar] = np.maximum(np.min(smvarsig[gv]),objvarsig[gdvar])   # lower limit
-        if nbdvar>0: objvarsig[bdvar]=smvarsig[gv[-1]]   # objects with bad fidmag, set to last value
-        # Detect positive outliers
-        nsigvarthresh = 10.0
-        nsigvar = (obj[varcol]-objvarmed)/objvarsig
-        obj['nsigvar'][gdvar] = nsigvar[gdvar]
-        isvar,nisvar = dln.where(nsigvar[gdvar]>nsigvarthresh)
-        print(str(nisvar)+' variables detected')
-        if nisvar>0:
-            obj['variable10sig'][gdvar[isvar]] = 1
+    #  the fiducial magnitudes were computed with the metrics in the loop above
+    obj = var.selectvariables(obj,fidmag)
 
     # Add E(B-V)
     print('Getting E(B-V)')
-    sfd = SFDQuery()
-    c = SkyCoord(obj['ra'],obj['dec'],frame='icrs',unit='deg')
-    #c = SkyCoord('05h00m00.00000s','+30d00m00.0000s', frame='icrs') 
-    ebv = sfd(c)
-    obj['ebv'] = ebv
+    if ebvmap is not None:
+        obj['ebv'] = reddening.ebv(obj['ra'],obj['dec'],mapfile=ebvmap)
+    else:
+        sfd = SFDQuery()
+        c = SkyCoord(obj['ra'],obj['dec'],frame='icrs',unit='deg')
+        #c = SkyCoord('05h00m00.00000s','+30d00m00.0000s', frame='icrs') 
+        ebv = sfd(c)
+        obj['ebv'] = ebv
 
     
     # FIGURE OUT IF THERE ARE OBJECTS **INSIDE** OTHER OBJECTS!!
@@ -1920,14 +1910,14 @@ if __name__ == "__main__":
     ind1,nmatch = dln.where(ipring == pix)
     if nmatch==0:
         print('None of the final objects fall inside the pixel')
-        if (dbfile is not None):
-            if os.path.exists(dbfile): os.remove(dbfile)
+        if (store is not None): store.remove()
+        dbsession.closesession(dbfile_idstr)
         if os.path.exists(dbfile_idstr): os.remove(dbfile_idstr)
         print('Writing blank output file to '+outfile)
         fits.PrimaryHDU().writeto(outfile)
         if os.path.exists(outfile+'.gz'): os.remove(outfile+'.gz')
         ret = subprocess.call(['gzip',outfile])    # compress final catalog
-        sys.exit()
+        return outfile
     # Get trimmed objects and indices
     objtokeep = np.zeros(nobj,bool)         # boolean to keep or trim objects
     objtokeep[ind1] = True
@@ -1944,7 +1934,13 @@ if __name__ == "__main__":
     #import pdb; pdb.set_trace()
 
     # Remove trimmed objects from IDSTR database
-    if nmatch<nobj:
+    if (nmatch<nobj) & (iddir is not None):
+        keep = newobjindex[idobjindex]>=0
+        idmeasid = idmeasid[keep]
+        idexposure = idexposure[keep]
+        idobjindex = newobjindex[idobjindex[keep]]
+        del keep
+    elif nmatch<nobj:
         # Delete measurements for the objects that we are trimming
         deleterowsdb('objectid',trimobj['objectid'],'idstr',dbfile_idstr)
         # Update OBJECTINDEX for the objects that we are keeping
@@ -1955,9 +1951,13 @@ if __name__ == "__main__":
     print('%6.1f Percent of memory used. %6.1f GB available.  Process is using %6.2f GB of memory.' % (v.percent,v.available/1e9,process.memory_info()[0]/1e9))
 
     # Get unique exposures in IDSTR database
-    uexposure = executedb(dbfile_idstr,'SELECT DISTINCT exposure from idstr')
-    # this returns a list of tuples, unpack
-    uexposure = [i[0] for i in uexposure]
+    if iddir is not None:
+        uexp,expind = np.unique(idexposure,return_inverse=True)
+        uexposure = list(uexp.astype(str))
+    else:
+        uexposure = executedb(dbfile_idstr,'SELECT DISTINCT exposure from idstr')
+        # this returns a list of tuples, unpack
+        uexposure = [i[0] for i in uexposure]
     # create sumstr for these using allmeta
     nuexposure = len(uexposure)
     ind1,ind2 = dln.match(allmeta['base'],uexposure)
@@ -1969,7 +1969,15 @@ if __name__ == "__main__":
     sumstr['nobjects'] = 0
     sumstr['healpix'] = parentpix   # use PARENTPIX
     # get number of objects per exposure
-    data = executedb(dbfile_idstr,'SELECT exposure, count(DISTINCT objectid) from idstr GROUP BY exposure')
+    if iddir is not None:
+        nkeep = len(obj)
+        expobj = np.unique(expind*np.int64(nkeep)+idobjindex)
+        data = list(zip(uexposure,np.bincount(expobj//nkeep,minlength=len(uexposure))))
+        del expind, expobj
+        idobjectid = obj['objectid'][idobjindex]
+        del idobjindex
+    else:
+        data = executedb(dbfile_idstr,'SELECT exposure, count(DISTINCT objectid) from idstr GROUP BY exposure')
     out = np.zeros(len(data),dtype=np.dtype([('exposure',np.str,40),('nobjects',int)]))
     out[...] = data
     ind1,ind2 = dln.match(sumstr['base'],out['exposure'])
@@ -2005,9 +2013,9 @@ if __name__ == "__main__":
     print('dt = '+str(dt)+' sec.')
     print('dt = ',str(time.time()-t1)+' sec. after loading the catalogs')
 
-    if dbfile is not None:
-        print('Deleting temporary database file '+dbfile)
-        os.remove(dbfile)
+    if store is not None:
+        print('Deleting temporary measurement store '+dbfile)
+        store.remove()
 
     # Delete all arrays before we quit
     del sumstr
@@ -2015,7 +2023,66 @@ if __name__ == "__main__":
     # garbage collection
     gc.collect()
 
-    # Breaking up idstr information
-    if nside==128:
-        print('Breaking-up IDSTR information')
-        breakup_idstr(dbfile_idstr)
+    # Add the idstr information to the ID store or break it up
+    if iddir is not None:
+        print('Adding IDSTR information to '+iddir)
+        ids = idstore.IdStore(iddir)
+        ids.append(outbase,idmeasid,idexposure,idobjectid)
+        ids.close()
+    else:
+        dbsession.closesession(dbfile_idstr)
+        if nside==128:
+            print('Breaking-up IDSTR information')
+            breakup_idstr(dbfile_idstr)
+
+    return outfile
+
+
+# Combine data for one NSC healpix region
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Combine NSC data for one healpix region.')
+    parser.add_argument('pix', type=str, nargs=1, help='HEALPix pixel number')
+    parser.add_argument('version', type=str, nargs=1, help='Version number')
+    parser.add_argument('--nside', type=int, default=128, help='HEALPix Nside')
+    parser.add_argument('-r','--redo', action='store_true', help='Redo this HEALPIX')
+    parser.add_argument('-v','--verbose', action='store_true', help='Verbose output')
+    parser.add_argument('-m','--multilevel', action='store_true', help='Break into smaller healpix')
+    parser.add_argument('--outdir', type=str, default='', help='Output directory')
+    parser.add_argument('-nm','--nmulti', type=int, nargs=1, default=1, help='Number of jobs')
+    parser.add_argument('--batchpm', action='store_true', help='Use the batched proper motion solver')
+    parser.add_argument('--store', type=str, default='sqlite', help='Temporary measurement store backend (sqlite or npy)')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of processes for tiled clustering')
+    parser.add_argument('--spawn', action='store_true', help='Re-run this script for each smaller healpix')
+    parser.add_argument('--maxmem', type=float, default=None, help='Memory budget for the smaller healpix in GB')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark the smaller healpix with and without --spawn')
+    parser.add_argument('--fpindex', type=str, default=None, help='Chip-footprint index file')
+    parser.add_argument('--nthreads', type=int, default=4, help='Number of threads to read the chip catalogs')
+    parser.add_argument('--iddir', type=str, default=None, help='Exposure-partitioned idstr store directory')
+    parser.add_argument('--ebvmap', type=str, default=None, help='HEALPix E(B-V) map file')
+
+    args = parser.parse_args()
+
+    # Inputs
+    pix = int(args.pix[0])
+    version = args.version[0]
+    verbose = args.verbose
+    nside = args.nside
+    redo = args.redo
+    multilevel = args.multilevel
+    nmulti = dln.first_el(args.nmulti)
+    batchpm = args.batchpm
+    storetype = args.store
+    nproc = args.nproc
+    spawn = args.spawn
+    maxmem = args.maxmem*1e9 if args.maxmem is not None else None
+    print('KLUDGE!!!  FORCING --MULTILEVEL')
+    multilevel = True
+    outdir = args.outdir
+
+    if args.benchmark:
+        benchmarkmultilevel(pix,version,nmulti=nmulti,extra=['--store',storetype])
+        sys.exit()
+
+    combine(pix,version,nside=nside,redo=redo,multilevel=multilevel,outdir=outdir,nmulti=nmulti,batchpm=batchpm,
+            storetype=storetype,nproc=nproc,spawn=spawn,maxmem=maxmem,fpindex=args.fpindex,
+            nthreads=args.nthreads,iddir=args.iddir,ebvmap=args.ebvmap)
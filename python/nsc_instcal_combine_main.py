@@ -17,6 +17,9 @@ from argparse import ArgumentParser
 import socket
 import logging
 import healpy as hp
+import scheduler
+import costmodel
+import footprint
 
 # Combine data for one NSC healpix region
 if __name__ == "__main__":
@@ -26,6 +29,14 @@ if __name__ == "__main__":
     parser.add_argument('-l','--list', type=str, nargs=1, default='', help='List of HEALPix to run')
     parser.add_argument('-nm','--nmulti', type=int, nargs=1, default=15, help='Number of jobs')
     parser.add_argument('-r','--redo', action='store_true', help='Redo this HEALPIX')
+    parser.add_argument('--manifest', type=str, nargs=1, default='', help='Manifest database to run the pixels from (on a local disk, or shared by all hosts over NFS with --balance)')
+    parser.add_argument('--maxattempts', type=int, nargs=1, default=1, help='Number of times to try a pixel with --manifest')
+    parser.add_argument('--balance', action='store_true', help='Run the pixels longest predicted time first from a manifest shared by all hosts')
+    parser.add_argument('--history', type=str, nargs='+', default=None, help='Manifest databases of previous runs for the cost model')
+    parser.add_argument('--maxmem', type=float, nargs=1, default=None, help='Memory cap per host in GB for the predicted memory of the running pixels with --balance')
+    parser.add_argument('--fpindex', type=str, nargs=1, default='', help='Chip-footprint index, updated here and queried by the pixel jobs')
+    parser.add_argument('--iddir', type=str, nargs=1, default='', help='Exposure-partitioned idstr store directory for the pixel jobs')
+    parser.add_argument('--ebvmap', type=str, nargs=1, default='', help='HEALPix E(B-V) map file for the pixel jobs')
     args = parser.parse_args()
 
     t0 = time.time()
@@ -41,6 +52,20 @@ if __name__ == "__main__":
     else:
         hosts = [host]
     inplistfile = dln.first_el(args.list)
+    manifest = dln.first_el(args.manifest)
+    if manifest == '': manifest = None
+    maxattempts = dln.first_el(args.maxattempts)
+    balance = args.balance
+    history = args.history
+    maxmem = dln.first_el(args.maxmem)*1e9 if args.maxmem is not None else None
+    fpfile = dln.first_el(args.fpindex)
+    if fpfile == '': fpfile = None
+    iddir = dln.first_el(args.iddir)
+    if iddir == '': iddir = None
+    ebvmap = dln.first_el(args.ebvmap)
+    if ebvmap == '': ebvmap = None
+    if balance and manifest is None:
+        parser.error('--balance needs a --manifest that all of the hosts share')
     if inplistfile == '': inplistfile = None
     nside = 128
     radeg = 180 / np.pi
@@ -142,17 +167,31 @@ if __name__ == "__main__":
     shutil.copyfile(listfile,localdir+'dnidever/nsc/instcal/'+version+'/'+os.path.basename(listfile))
     #file_copy,listfile,localdir+'dnidever/nsc/instcal/'+version+'/',/over
 
+    # Bring the chip-footprint index up to date once here, the pixel jobs only query it.
+    #  Only the meta files that are new or changed are read.
+    fpindex = None
+    if fpfile is not None:
+        if inplistfile is not None:
+            healstr = fits.getdata(listfile,1)
+        fpindex = footprint.FootprintIndex(fpfile)
+        metafiles = np.unique(np.char.replace(np.char.strip(np.asarray(healstr['FILE']).astype(str)),'_cat','_meta'))
+        nadd = fpindex.update(metafiles)
+        rootLogger.info(str(nadd)+' meta files (re)indexed in '+fpfile+'  '+str(fpindex.count()[0])+' exposures')
+
     # Create the commands
     allpix = upix.copy()
     allcmd = dln.strjoin("/home/dnidever/projects/noaosourcecatalog/python/nsc_instcal_combine_cluster.py ",allpix.astype(np.str))
     allcmd = dln.strjoin(allcmd," "+version+" --nside "+str(nside))
     if redo: allcmd = dln.strjoin(allcmd,' -r')
+    if fpfile is not None: allcmd = dln.strjoin(allcmd,' --fpindex '+fpfile)
+    if iddir is not None: allcmd = dln.strjoin(allcmd,' --iddir '+iddir)
+    if ebvmap is not None: allcmd = dln.strjoin(allcmd,' --ebvmap '+ebvmap)
     alldirs = np.zeros(npix,(np.str,200))
     alldirs[:] = tmpdir
     nallcmd = len(allcmd)        
 
-    # Check what's been done already
-    if not redo:
+    # Check what's been done already, the manifest keeps track of that itself
+    if not redo and manifest is None:
         rootLogger.info("Checking if any have already been done")
         exists = np.zeros(dln.size(allpix),bool)+False
         for ip,p in enumerate(allpix):
@@ -187,25 +226,72 @@ if __name__ == "__main__":
     #alldirs = alldirs[gd]
     #nallcmd = ngd
 
-    # RANDOMIZE
-    np.random.seed(0)
-    rnd = np.argsort(np.random.rand(nallcmd))
-    allpix = allpix[rnd]
-    allcmd = allcmd[rnd]
-    alldirs = alldirs[rnd]
-
-    # Parcel out the jobs
-    nhosts = dln.size(hosts)
-    torun = np.arange(nallcmd)
-    nperhost = int(np.ceil(nallcmd/nhosts))
-    for i in range(nhosts):
-        if host==hosts[i]: torun=torun[i*nperhost:(i+1)*nperhost]
-    ntorun = len(torun)
-    pix = allpix[torun]
-    cmd = allcmd[torun]
-    dirs = alldirs[torun]
+    # All hosts run the pixels from one shared queue, longest predicted time first
+    if balance:
+        if (inplistfile is not None) and (fpindex is None):
+            healstr = fits.getdata(listfile,1)
+        rootLogger.info('Computing the pixel costs')
+        feat = costmodel.pixelfeatures(healstr,nside=nside,fpindex=fpindex)
+        ind = np.minimum(np.searchsorted(feat['pix'],allpix),len(feat)-1)
+        missing = feat['pix'][ind]!=allpix
+        feat = feat[ind]
+        feat['pix'] = allpix
+        feat['nexp'][missing] = 0
+        feat['nmeas'][missing] = 0
+        model = costmodel.CostModel()
+        if history is not None:
+            hist = costmodel.history(history,feat)
+            hind = np.argsort(feat['pix'])
+            hind = hind[np.searchsorted(feat['pix'],hist['pix'],sorter=hind)]
+            model.fit(feat[hind],hist['runtime'],hist['maxrss'])
+        rootLogger.info(str(model))
+        torun, pred = costmodel.balance(feat,model,dln.size(hosts),nmulti,maxmem)
+        predcost, predmem = model.predict(feat)
+        rootLogger.info('Predicted makespan %.2f h, random split %.2f h, lower bound %.2f h' %
+                        (pred['shared']/3600,pred['random']/3600,pred['lower']/3600))
+        ntorun = len(torun)
+        pix = allpix[torun]
+        cmd = allcmd[torun]
+        dirs = alldirs[torun]
+        priority = np.arange(ntorun)
+        mem = predmem[torun]
+    else:
+        # RANDOMIZE
+        np.random.seed(0)
+        rnd = np.argsort(np.random.rand(nallcmd))
+        allpix = allpix[rnd]
+        allcmd = allcmd[rnd]
+        alldirs = alldirs[rnd]
+
+        # Parcel out the jobs
+        nhosts = dln.size(hosts)
+        torun = np.arange(nallcmd)
+        nperhost = int(np.ceil(nallcmd/nhosts))
+        for i in range(nhosts):
+            if host==hosts[i]: torun=torun[i*nperhost:(i+1)*nperhost]
+        ntorun = len(torun)
+        pix = allpix[torun]
+        cmd = allcmd[torun]
+        dirs = alldirs[torun]
+    if fpindex is not None: fpindex.close()
     rootLogger.info('Running '+str(len(torun))+' on '+host)
 
+    # Run from the manifest database.  Only the outputs of pixels that
+    # are new to the manifest are checked, and a crashed run resumes.
+    # With --balance the hosts share the manifest over NFS (no WAL) and
+    # each one keeps the predicted memory of its running pixels under MAXMEM.
+    if manifest is not None:
+        man = scheduler.Manifest(manifest,maxattempts=maxattempts,shared=balance)
+        outfiles = [basedir+'combine/'+str(p//1000)+'/'+str(p)+'.fits.gz' for p in pix]
+        nnew = man.add(pix,cmd,dirs,outputs=outfiles,priority=(priority if balance else None),
+                       mem=(mem if balance else None),checkdone=(not redo),redo=redo)
+        if balance: man.setvalue('maxmem',maxmem)
+        rootLogger.info(str(nnew)+' new pixels added to '+manifest+'  '+str(man.counts()))
+        man.close()
+        counts = scheduler.runworker(manifest,nmulti,maxattempts=maxattempts,logger=rootLogger,shared=balance)
+        rootLogger.info('dt = '+str(time.time()-t0)+' sec.')
+        sys.exit()
+
     ## Check what's been done already
     #if not redo:
     #    exists = np.zeros(dln.size(pix),bool)+False
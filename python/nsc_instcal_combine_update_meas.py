@@ -17,9 +17,57 @@ import logging
 from glob import glob
 import subprocess
 import healpy as hp
-
-def exposure_update(exposure,redo=False):
-    """ Update the measurement table using the broken up measid/objectid lists."""
+import idstore
+
+def loadidfiles(edir,exp,rootLogger):
+    """ Load the broken up measid/objectid lists of an exposure."""
+
+    # Look for the id files
+    allfiles = glob(edir+exp+'__*.npy')
+    # check for duplicates, single and split into high-res healpix idstr files
+    #  always use the split ones
+    base = [os.path.splitext(os.path.basename(f))[0] for f in allfiles]
+    hfile = [f.split('__')[-1] for f in base]
+    hh = [f.split('_')[0] for f in hfile]  # the healpix portion
+    hindex = dln.create_index(hh)
+    files = []
+    for j in range(len(hindex['value'])):
+        hpix1 = hindex['value'][j]
+        hind = hindex['index'][hindex['lo'][j]:hindex['hi'][j]+1]
+        files1 = np.array(allfiles)[hind]
+        # duplicates, use the split/hires ones
+        if hindex['num'][j]>1:
+            gd = dln.grep(files1,str(hpix1)+'_n',index=True)
+            if len(gd)==0:
+                raise ValueError('Something is wrong with the idstr files, duplicates')
+            files += list(files1[gd])
+        else:
+            files += list(files1)
+    nfiles = len(files)
+    rootLogger.info(str(nfiles)+' ID files to load')
+
+    # Loop over ID files and load them up
+    df = np.dtype([('measid',np.str,50),('objectid',np.str,50)])
+    idcat = np.zeros(10000,dtype=df)
+    count = 0
+    for k in range(nfiles):
+        idcat1 = np.load(files[k])
+        nidcat1 = len(idcat1)
+        # Add more elements
+        if count+nidcat1 > len(idcat):
+            idcat = dln.add_elements(idcat,np.maximum(100000,nidcat1))
+        # Stuff in the data
+        idcat[count:count+nidcat1] = idcat1
+        count += nidcat1
+    # Trim extra elements
+    if len(idcat)>count: idcat=idcat[0:count]
+    rootLogger.info('IDs for '+str(len(idcat))+' measurements')
+    return idcat
+
+def exposure_update(exposure,redo=False,store=None):
+    """ Update the measurement table using the broken up measid/objectid lists.
+        If STORE is given the lists are read from that exposure-partitioned
+        idstr store directory (see idstore.py) instead."""
 
     t00 = time.time()
     hostname = socket.gethostname()
@@ -46,6 +94,9 @@ def exposure_update(exposure,redo=False):
 
     print('Updating measid for '+str(len(exposure))+' exposures')
 
+    if store is not None:
+        ids = idstore.IdStore(store)
+
     # Loop over files
     for i in range(len(exposure)):
         t0 = time.time()
@@ -162,46 +213,12 @@ def exposure_update(exposure,redo=False):
         rootLogger.info(str(nmeas)+' measurements')
 
 
-        # Look for the id files
-        allfiles = glob(edir+exp+'__*.npy')
-        # check for duplicates, single and split into high-res healpix idstr files
-        #  always use the split ones
-        base = [os.path.splitext(os.path.basename(f))[0] for f in allfiles]
-        hfile = [f.split('__')[-1] for f in base]
-        hh = [f.split('_')[0] for f in hfile]  # the healpix portion
-        hindex = dln.create_index(hh)
-        files = []
-        for j in range(len(hindex['value'])):
-            hpix1 = hindex['value'][j]
-            hind = hindex['index'][hindex['lo'][j]:hindex['hi'][j]+1]
-            files1 = np.array(allfiles)[hind]
-            # duplicates, use the split/hires ones
-            if hindex['num'][j]>1:
-                gd = dln.grep(files1,str(hpix1)+'_n',index=True)
-                if len(gd)==0:
-                    raise ValueError('Something is wrong with the idstr files, duplicates')
-                files += list(files1[gd])
-            else:
-                files += list(files1)
-        nfiles = len(files)
-        rootLogger.info(str(nfiles)+' ID files to load')
-
-        # Loop over ID files and load them up
-        df = np.dtype([('measid',np.str,50),('objectid',np.str,50)])
-        idcat = np.zeros(10000,dtype=df)
-        count = 0
-        for k in range(nfiles):
-            idcat1 = np.load(files[k])
-            nidcat1 = len(idcat1)
-            # Add more elements
-            if count+nidcat1 > len(idcat):
-                idcat = dln.add_elements(idcat,np.maximum(100000,nidcat1))
-            # Stuff in the data
-            idcat[count:count+nidcat1] = idcat1
-            count += nidcat1
-        # Trim extra elements
-        if len(idcat)>count: idcat=idcat[0:count]
-        rootLogger.info('IDs for '+str(len(idcat))+' measurements')
+        # Get the IDs from the store, already de-duplicated
+        if store is not None:
+            idcat = ids.getexposure(exp)
+            rootLogger.info('IDs for '+str(len(idcat))+' measurements')
+        else:
+            idcat = loadidfiles(edir,exp,rootLogger)
 
         # Match up with measid
         idcat_measid = np.char.array(idcat['measid']).strip()
@@ -267,6 +284,7 @@ if __name__ == "__main__":
     parser = ArgumentParser(description='Update measid in exposure.')
     parser.add_argument('exposure', type=str, nargs=1, help='Exposure name')
     parser.add_argument('-r','--redo', action='store_true', help='Redo this exposure')
+    parser.add_argument('--store', type=str, default=None, help='Read the IDs from this idstr store directory')
     args = parser.parse_args()
 
     hostname = socket.gethostname()
@@ -284,4 +302,4 @@ if __name__ == "__main__":
             sys.exit()
 
     # Update the measurement files
-    exposure_update(exposure,redo=redo)
+    exposure_update(exposure,redo=redo,store=args.store)
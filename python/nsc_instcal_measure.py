@@ -13,20 +13,34 @@ import subprocess
 import glob
 import logging
 import socket
+from argparse import ArgumentParser
 #from scipy.signal import convolve2d
 from scipy.ndimage.filters import convolve
+import chipcache
+import sexconfig
+import maskprep
 
 if __name__ == "__main__":
 
 # Run SExtractor on one FULL DECam/Mosaic3/Bok InstCal image
 
+    parser = ArgumentParser(description='Run SExtractor on one InstCal exposure.')
+    parser.add_argument('fluxfile', type=str, help='Flux file')
+    parser.add_argument('wtfile', type=str, help='Weight file')
+    parser.add_argument('maskfile', type=str, help='Mask file')
+    parser.add_argument('version', type=str, nargs='?', default=None, help='Version number')
+    parser.add_argument('--cachedir', type=str, default=None, help='Decompress-once chip cache directory')
+    parser.add_argument('--notemplate', action='store_true', help='Rewrite default.config for every chip instead of using the configuration template')
+    parser.add_argument('--oldmask', action='store_true', help='Convert the mask bit by bit and grow it with a convolution')
+    args = parser.parse_args()
+
     hostname = socket.gethostname()
     host = hostname.split('.')[0]
 
     # Version
     verdir = ""
-    if len(sys.argv) > 4:
-       version = sys.argv[4]
+    if args.version is not None:
+       version = args.version
        verdir = version if version.endswith('/') else version+"/"
 
     # on thing/hulk use
@@ -49,16 +63,21 @@ if __name__ == "__main__":
 
     print(sys.argv)
 
-    # Not enough inputs
-    n = len(sys.argv)
-    if n < 4:
-        print("Syntax - nsc_instcal_measure.py fluxfile wtfile maskfile version")
-        sys.exit()
+    # SExtractor configuration templates with command-line overrides, see sexconfig.py
+    usetemplate = not args.notemplate
+
+    # Mask conversion with one lookup table and separable growing, see maskprep.py
+    fastmask = not args.oldmask
+
+    # Decompress-once chip cache directory, see chipcache.py
+    cache = None
+    if args.cachedir is not None:
+        cache = chipcache.ChipCache(args.cachedir)
 
     # File names
-    fluxfile = sys.argv[1]
-    wtfile = sys.argv[2]
-    maskfile = sys.argv[3]
+    fluxfile = args.fluxfile
+    wtfile = args.wtfile
+    maskfile = args.maskfile
     # Check that the files exist
     if os.path.exists(fluxfile) == False:
         print(fluxfile+"file NOT FOUND")
@@ -67,7 +86,7 @@ if __name__ == "__main__":
         print(wtfile+"file NOT FOUND")
         sys.exit()
     if os.path.exists(maskfile) == False:
-        print(maskile+"file NOT FOUND")
+        print(maskfile+"file NOT FOUND")
         sys.exit()
 
     base = os.path.basename(fluxfile)
@@ -109,16 +128,24 @@ if __name__ == "__main__":
 
     # 2) Copy over images from zeus1:/mss
     #-------------------------------------
-    rootLogger.info("Step #2: Copying InstCal images from mass store archive")
-    shutil.copyfile(fluxfile,tmpdir+"/"+os.path.basename(fluxfile))
-    rootLogger.info("  "+fluxfile)
-    os.symlink(os.path.basename(fluxfile),"bigflux.fits.fz")
-    shutil.copyfile(wtfile,tmpdir+"/"+os.path.basename(wtfile))
-    rootLogger.info("  "+wtfile)
-    os.symlink(os.path.basename(wtfile),"bigwt.fits.fz")
-    shutil.copyfile(maskfile,tmpdir+"/"+os.path.basename(maskfile))
-    rootLogger.info("  "+maskfile)
-    os.symlink(os.path.basename(maskfile),"bigmask.fits.fz")
+    if cache is None:
+        rootLogger.info("Step #2: Copying InstCal images from mass store archive")
+        shutil.copyfile(fluxfile,tmpdir+"/"+os.path.basename(fluxfile))
+        rootLogger.info("  "+fluxfile)
+        os.symlink(os.path.basename(fluxfile),"bigflux.fits.fz")
+        shutil.copyfile(wtfile,tmpdir+"/"+os.path.basename(wtfile))
+        rootLogger.info("  "+wtfile)
+        os.symlink(os.path.basename(wtfile),"bigwt.fits.fz")
+        shutil.copyfile(maskfile,tmpdir+"/"+os.path.basename(maskfile))
+        rootLogger.info("  "+maskfile)
+        os.symlink(os.path.basename(maskfile),"bigmask.fits.fz")
+    # The chips are decompressed once from the archive files into the cache
+    else:
+        rootLogger.info("Step #2: Using chip cache "+cache.cachedir)
+        fluxfile,wtfile,maskfile = [os.path.join(origdir,f) for f in [fluxfile,wtfile,maskfile]]
+        os.symlink(fluxfile,"bigflux.fits.fz")
+        os.symlink(wtfile,"bigwt.fits.fz")
+        os.symlink(maskfile,"bigmask.fits.fz")
 
     # Get number of extensions
     hdulist = fits.open("bigflux.fits.fz")
@@ -160,10 +187,17 @@ if __name__ == "__main__":
         rootLogger.info(" Processing subimage "+str(i))
 
         try:
-            flux,fhead = fits.getdata("bigflux.fits.fz",i,header=True)
-            extname = fhead['EXTNAME']
-            wt,whead = fits.getdata("bigwt.fits.fz",extname,header=True)
-            mask,mhead = fits.getdata("bigmask.fits.fz",extname,header=True)
+            if cache is None:
+                flux,fhead = fits.getdata("bigflux.fits.fz",i,header=True)
+                extname = fhead['EXTNAME']
+                wt,whead = fits.getdata("bigwt.fits.fz",extname,header=True)
+                mask,mhead = fits.getdata("bigmask.fits.fz",extname,header=True)
+            else:
+                # memory-mapped, copy-on-write
+                flux,fhead = cache.getdata(fluxfile,i,header=True)
+                extname = fhead['EXTNAME']
+                wt,whead = cache.getdata(wtfile,extname,header=True)
+                mask,mhead = cache.getdata(maskfile,extname,header=True)
         except:
             rootLogger.info("No extension "+str(i))
 
@@ -178,12 +212,18 @@ if __name__ == "__main__":
         fwhm = fwhm_map[instcode]
 
         # 3a) Make subimages for flux, weight, mask
-        if os.path.exists("flux.fits"):
+        if os.path.lexists("flux.fits"):
             os.remove("flux.fits")
-        fits.writeto("flux.fits",flux,header=fhead,output_verify='warn')
+        if cache is None:
+            fits.writeto("flux.fits",flux,header=fhead,output_verify='warn')
+        else:
+            cache.link(fluxfile,i,"flux.fits")
 
+        # Turn the mask from integer to bitmask with one table lookup
+        if fastmask:
+            mask = maskprep.convert(mask,instcode,plver)
         # Turn the mask from integer to bitmask
-        if ((instcode=='c4d') & (plver>='V3.5.0')) | (instcode=='k4m') | (instcode=='ksb'):
+        elif ((instcode=='c4d') & (plver>='V3.5.0')) | (instcode=='k4m') | (instcode=='ksb'):
              #  1 = bad (in static bad pixel mask) -> 1
              #  2 = no value (for stacks)          -> 2
              #  3 = saturated                      -> 4
@@ -196,7 +236,7 @@ if __name__ == "__main__":
              nonzero = (omask>0)
              mask[nonzero] = 2**((omask-1)[nonzero])    # This takes about 1 sec
         # Fix the DECam Pre-V3.5.0 masks
-        if (instcode=='c4d') & (plver<'V3.5.0'):
+        if (not fastmask) & (instcode=='c4d') & (plver<'V3.5.0'):
           # --CP bit masks, Pre-V3.5.0 (PLVER)
           # Bit   DQ Type  PROCTYPE
           # 1  detector bad pixel          ->  1 
@@ -229,22 +269,14 @@ if __name__ == "__main__":
             os.remove("wt.fits")
         fits.writeto("wt.fits",wt,header=whead,output_verify='warn')
 
-        if os.path.exists("mask.fits"):
-            os.remove("mask.fits")
-        fits.writeto("mask.fits",mask,header=mhead,output_verify='warn')
+        # the grown mask is written once below
+        if not fastmask:
+            if os.path.exists("mask.fits"):
+                os.remove("mask.fits")
+            fits.writeto("mask.fits",mask,header=mhead,output_verify='warn')
 
 
         # 3b) Make SExtractor config files
-        # Copy the default files
-        shutil.copyfile(dir+"config/default.conv",tmpdir+"/default.conv")
-        shutil.copyfile(dir+"config/default.nnw",tmpdir+"/default.nnw")
-        shutil.copyfile(dir+"config/default.param",tmpdir+"/default.param")
-
-        # Read in configuration file and modify for this image
-        f = open(dir+'config/default.config', 'r') # 'r' = read
-        lines = f.readlines()
-        f.close()
-
         # Gain, saturation, pixscale
         try:
             gainmap = { 'c4d': lambda x: 0.5*(x.get('gaina')+x.get('gainb')),
@@ -261,71 +293,99 @@ if __name__ == "__main__":
         pixmap = { 'c4d': 0.27, 'k4m': 0.258, 'ksb': 0.45 }
         pixscale = pixmap[instcode]
 
-        # Things to change
-        # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
-        # GAIN            43.52             # detector gain in e-/ADU.
-        # SEEING_FWHM     1.46920            # stellar FWHM in arcsec
-        # WEIGHT_IMAGE  F4-00507860_01_comb.mask.fits
-
-        filter_name = ''
-        cnt = 0
-        for l in lines:
-            # SATUR_LEVEL
-            m = re.search('^SATUR_LEVEL',l)
-            if m != None:
-                lines[cnt] = "SATUR_LEVEL     "+str(saturate)+"         # level (in ADUs) at which arises saturation\n"
-                #print "SATUR line ", cnt
-            # Gain
-            m = re.search('^GAIN',l)
-            if m != None:
-                lines[cnt] = "GAIN            "+str(gain)+"            # detector gain in e-/ADU.\n"
-                #print "GAIN line ", cnt
-            # SEEING_FWHM
-            m = re.search('^SEEING_FWHM',l)
-            if m != None:
-                lines[cnt] = "SEEING_FWHM     "+str(fwhm)+"            # stellar FWHM in arcsec\n"
-                #print "FWHM line ", cnt
-            # WEIGHT_IMAGE
-            m = re.search('^WEIGHT_IMAGE',l)
-            if m != None:
-                lines[cnt] = "WEIGHT_IMAGE  wt.fits    # Weight image name.\n"
-                #print "WEIGHT line ", cnt
-            # PHOT_APERTURES, aperture diameters in pixels
-            m = re.search('^PHOT_APERTURES',l)
-            if m != None:
-                #aper_world = np.array([ 0.5, 0.75, 1.0, 1.5, 2.0, 3.5, 5.0, 7.0]) * 2  # radius->diameter
-                aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
-                aper_pix = aper_world / pixscale
-                lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
-            # Filter name
-            m = re.search('^FILTER_NAME',l)
-            if m != None:
-                filter_name = (l.split())[1]
-            cnt = cnt+1
-        # Write out the new config file
-        if os.path.exists("default.config"):
-            os.remove("default.config")
-        fo = open('default.config', 'w')
-        fo.writelines(lines)
-        fo.close()
+        # Instrument template parsed once, chip values on the command line
+        if usetemplate:
+            tmpl = sexconfig.gettemplate(dir+"config/",instcode,pixscale,tmproot+"sexconfig/")
+            overrides = {'SATUR_LEVEL':saturate, 'GAIN':gain, 'SEEING_FWHM':fwhm, 'WEIGHT_IMAGE':'wt.fits'}
+            sexcmd = tmpl.command("flux.fits",overrides)
+            filter = tmpl.kernel
+        # Rewrite the config files for this chip
+        else:
+            # Copy the default files
+            shutil.copyfile(dir+"config/default.conv",tmpdir+"/default.conv")
+            shutil.copyfile(dir+"config/default.nnw",tmpdir+"/default.nnw")
+            shutil.copyfile(dir+"config/default.param",tmpdir+"/default.param")
+
+            # Read in configuration file and modify for this image
+            f = open(dir+'config/default.config', 'r') # 'r' = read
+            lines = f.readlines()
+            f.close()
 
+            # Things to change
+            # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
+            # GAIN            43.52             # detector gain in e-/ADU.
+            # SEEING_FWHM     1.46920            # stellar FWHM in arcsec
+            # WEIGHT_IMAGE  F4-00507860_01_comb.mask.fits
+
+            filter_name = ''
+            cnt = 0
+            for l in lines:
+                # SATUR_LEVEL
+                m = re.search('^SATUR_LEVEL',l)
+                if m != None:
+                    lines[cnt] = "SATUR_LEVEL     "+str(saturate)+"         # level (in ADUs) at which arises saturation\n"
+                    #print "SATUR line ", cnt
+                # Gain
+                m = re.search('^GAIN',l)
+                if m != None:
+                    lines[cnt] = "GAIN            "+str(gain)+"            # detector gain in e-/ADU.\n"
+                    #print "GAIN line ", cnt
+                # SEEING_FWHM
+                m = re.search('^SEEING_FWHM',l)
+                if m != None:
+                    lines[cnt] = "SEEING_FWHM     "+str(fwhm)+"            # stellar FWHM in arcsec\n"
+                    #print "FWHM line ", cnt
+                # WEIGHT_IMAGE
+                m = re.search('^WEIGHT_IMAGE',l)
+                if m != None:
+                    lines[cnt] = "WEIGHT_IMAGE  wt.fits    # Weight image name.\n"
+                    #print "WEIGHT line ", cnt
+                # PHOT_APERTURES, aperture diameters in pixels
+                m = re.search('^PHOT_APERTURES',l)
+                if m != None:
+                    #aper_world = np.array([ 0.5, 0.75, 1.0, 1.5, 2.0, 3.5, 5.0, 7.0]) * 2  # radius->diameter
+                    aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
+                    aper_pix = aper_world / pixscale
+                    lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
+                # Filter name
+                m = re.search('^FILTER_NAME',l)
+                if m != None:
+                    filter_name = (l.split())[1]
+                cnt = cnt+1
+            # Write out the new config file
+            if os.path.exists("default.config"):
+                os.remove("default.config")
+            fo = open('default.config', 'w')
+            fo.writelines(lines)
+            fo.close()
+
+            filter = None
+            if (filter_name != ''):
+                # Load the filter array
+                f = open(filter_name,'r')
+                linenum = 0
+                for line in f:
+                    if (linenum == 1):
+                        shape = line.split(' ')[1]
+                        # Make it two pixels larger
+                        filter = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
+                        #filter = np.zeros(np.array(shape.split('x'),dtype='i'),dtype='f')
+                    #if (linenum > 1):
+                    #    linedata = np.array(line.split(' '),dtype='f')
+                    #    filter[:,linenum-2] = linedata
+                    linenum += 1
+                f.close()
+            sexcmd = ["sex","flux.fits","-c","default.config"]
+
+        # Grow the regions around bad pixels with a separable dilation
+        if fastmask:
+            newmask = maskprep.grow(mask,filter.shape) if filter is not None else mask
+            if os.path.exists("mask.fits"):
+                os.remove("mask.fits")
+            fits.writeto("mask.fits",newmask,header=mhead,output_verify='warn')
         # Convolve the mask file with the convolution kernel to "grow" the regions
         # around bad pixels the SE already does to the weight map
-        if (filter_name != ''):
-            # Load the filter array
-            f = open(filter_name,'r')
-            linenum = 0
-            for line in f:
-                if (linenum == 1):
-                    shape = line.split(' ')[1]
-                    # Make it two pixels larger
-                    filter = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
-                    #filter = np.zeros(np.array(shape.split('x'),dtype='i'),dtype='f')
-                #if (linenum > 1):
-                #    linedata = np.array(line.split(' '),dtype='f')
-                #    filter[:,linenum-2] = linedata
-                linenum += 1
-            f.close()
+        elif filter is not None:
             # Normalize the filter array
             #filter /= np.sum(filter)
             # Convolve with mask
@@ -351,7 +411,7 @@ if __name__ == "__main__":
             # Save the SExtractor info to a logfile
             slogfile = tmpdir+"/"+base+"_"+str(ccdnum)+".sex.log"
             sf = open(slogfile,'w')
-            retcode = subprocess.call(["sex","flux.fits","-c","default.config"],stdout=sf,stderr=subprocess.STDOUT)
+            retcode = subprocess.call(sexcmd,stdout=sf,stderr=subprocess.STDOUT)
             sf.close()
             sf = open(slogfile,'r')
             slines = sf.readlines()
@@ -385,7 +445,12 @@ if __name__ == "__main__":
                 rootLogger.info("  Copying final catalog to "+outcatfile)
             # Copy to final directory
             shutil.copyfile("cat.fits",outcatfile)
-            shutil.copyfile("default.config",outconfigfile)
+            if usetemplate:
+                if os.path.exists(outconfigfile): os.remove(outconfigfile)
+                with open(outconfigfile,'w') as fo:
+                    fo.write(tmpl.render(overrides))
+            else:
+                shutil.copyfile("default.config",outconfigfile)
             # Copy check files
             #shutil.copyfile("miniback.fits",dir+instcode+"/"+night+"/"+base+"/"+base+"_"+str(ccdnum)+"_miniback.fits")
             #shutil.copyfile("objects.fits",dir+instcode+"/"+night+"/"+base+"/"+base+"_"+str(ccdnum)+"_objects.fits")
@@ -16,6 +16,7 @@ import time
 from argparse import ArgumentParser
 import socket
 import logging
+import scheduler
 
 
 # Run Source Extractor on many NSC exposures
@@ -27,6 +28,9 @@ if __name__ == "__main__":
     parser.add_argument('-r','--redo', action='store_true', help='Redo exposure that were previously processed')
     parser.add_argument('--maxjobs', type=int, nargs=1, default=70000, help='The maximum number of exposures to attempt to process per host')
     parser.add_argument('--list',type=str,nargs=1,default=None,help='Input list of exposures to use')
+    parser.add_argument('--manifest', type=str, nargs=1, default='', help='Manifest database to run the exposures from (on a local disk)')
+    parser.add_argument('--maxattempts', type=int, nargs=1, default=1, help='Number of times to try an exposure with --manifest')
+    parser.add_argument('--cachedir', type=str, nargs=1, default='', help='Decompress-once chip cache directory (on a local disk)')
     args = parser.parse_args()
 
     t0 = time.time()
@@ -45,6 +49,10 @@ if __name__ == "__main__":
     inputlist = args.list
     if inputlist is not None:
         inputlist = inputlist[0]
+    manifest = dln.first_el(args.manifest)
+    if manifest == '': manifest = None
+    maxattempts = dln.first_el(args.maxattempts)
+    cachedir = dln.first_el(args.cachedir)
     nside = 128
     radeg = 180 / np.pi
     t0 = time.time()
@@ -198,7 +206,8 @@ if __name__ == "__main__":
         #if file_test(outfile) eq 1 or file_test(outfile+'.gz') eq 1 then expstr[i].done = 1
         #expstr[i].done = 0
         expstr['done'][i] = False
-        if os.path.exists(outfile): expstr['done'][i] = True
+        # the manifest keeps track of what's been done
+        if manifest is None and os.path.exists(outfile): expstr['done'][i] = True
 
         # Not all three files exist
         if expstr['allexist'][i] is False:
@@ -220,6 +229,7 @@ if __name__ == "__main__":
             #if file_test(file_dirname(outfile),/directory) eq 0 then file_mkdir,file_dirname(outfile)  ; make directory
             #if testlock eq 0 then touchzero,outfile+'.lock'  ; this is fast
             expstr['cmd'][i] = '/home/dnidever/projects/noaosourcecatalog/python/nsc_instcal_measure.py '+fluxfile+' '+wtfile+' '+maskfile+' '+version
+            if cachedir != '': expstr['cmd'][i] += ' --cachedir '+cachedir
             expstr['cmddir'][i] = tmpdir
             expstr['torun'][i] = True
         # Lock file exists
@@ -253,6 +263,18 @@ if __name__ == "__main__":
     cmd = expstr[tosubmit]['cmd']
     cmddir = expstr[tosubmit]['cmddir']
 
+    # Run from the manifest database.  Only the outputs of exposures that
+    # are new to the manifest are checked, and a crashed run resumes.
+    if manifest is not None:
+        man = scheduler.Manifest(manifest,maxattempts=maxattempts)
+        outfiles = expstr[tosubmit]['outfile']
+        names = [os.path.dirname(o)[len(basedir):] for o in outfiles]
+        nnew = man.add(names,cmd,cmddir,outputs=outfiles,checkdone=(not redo),redo=redo)
+        rootLogger.info(str(nnew)+' new exposures added to '+manifest+'  '+str(man.counts()))
+        man.close()
+        counts = scheduler.runworker(manifest,nmulti,maxattempts=maxattempts,waittime=5,logger=rootLogger)
+        rootLogger.info('dt='+str(time.time()-t0)+' sec')
+        sys.exit()
 
     # Lock the files that will be submitted
     dolock = False
@@ -17,6 +17,7 @@ import socket
 from argparse import ArgumentParser
 import logging
 import subprocess
+import idstore
 
 def querydb(dbfile,table='meas',cols='rowid,*',where=None):
     """ Query database table """
@@ -46,7 +47,11 @@ def readidstrdb(dbfile,where=None):
     del data
     return cat
 
-def measurement_update(expdir):
+def measurement_update(expdir,store=None):
+    """ Update the measurement catalogs of an exposure with OBJECTID.
+        If STORE is given the IDs are read from that exposure-partitioned
+        idstr store directory (see idstore.py) instead of querying the
+        idstr database of every HEALPix pixel."""
 
     t0 = time.time()
     hostname = socket.gethostname()
@@ -147,6 +152,17 @@ def measurement_update(expdir):
     idstr_dtype = np.dtype([('measid',np.str,200),('objectid',np.str,200),('pix',int)])
     idstr = np.zeros(nmeas,dtype=idstr_dtype)
     cnt = 0
+    if store is not None:
+        # All pixels of this exposure in one lookup
+        ids = idstore.IdStore(store)
+        idstr1 = ids.getexposure(base)
+        ids.close()
+        idstr1 = idstr1[np.isin(idstr1['pix'],upix)]
+        idstr = np.zeros(len(idstr1),dtype=idstr_dtype)
+        for c in idstr_dtype.names: idstr[c] = idstr1[c]
+        cnt = len(idstr)
+        rootLogger.info(str(cnt)+' IDs from '+store)
+        npix = 0    # skip the per-pixel database queries
     for i in range(npix):
         fitsfile = cmbdir+'combine/'+str(int(upix[i])//1000)+'/'+str(upix[i])+'.fits.gz'
         dbfile = cmbdir+'combine/'+str(int(upix[i])//1000)+'/'+str(upix[i])+'_idstr.db'
@@ -263,6 +279,7 @@ if __name__ == "__main__":
     parser = ArgumentParser(description='Update NSC exposure measurement catalogs with OBJECTID.')
     parser.add_argument('expdir', type=str, nargs=1, help='Exposure directory')
     parser.add_argument('-r','--redo', action='store_true', help='Redo this exposure catalog')
+    parser.add_argument('--store', type=str, default=None, help='Read the IDs from this idstr store directory')
     #parser.add_argument('-v','--verbose', action='store_true', help='Verbose output')
     args = parser.parse_args()
 
@@ -277,4 +294,4 @@ if __name__ == "__main__":
         print(expdir+' has already been updated and REDO not set')
         sys.exit()
 
-    measurement_update(expdir)
+    measurement_update(expdir,store=args.store)
@@ -17,6 +17,7 @@ from argparse import ArgumentParser
 import socket
 import logging
 import healpy as hp
+import scheduler
 
 # Driver for nsc_instcal_measure_update.py to update OBJECTIDs in exposure measurement catalogs
 if __name__ == "__main__":
@@ -26,6 +27,8 @@ if __name__ == "__main__":
     parser.add_argument('-l','--list', type=str, nargs=1, default='', help='List of exposures to run')
     parser.add_argument('-nm','--nmulti', type=int, nargs=1, default=12, help='Number of jobs')
     #parser.add_argument('-r','--redo', action='store_true', help='Redo this HEALPIX')
+    parser.add_argument('--manifest', type=str, nargs=1, default='', help='Manifest database to run the exposures from (on a local disk)')
+    parser.add_argument('--maxattempts', type=int, nargs=1, default=1, help='Number of times to try an exposure with --manifest')
     args = parser.parse_args()
 
     t0 = time.time()
@@ -43,6 +46,9 @@ if __name__ == "__main__":
         hosts = [host]
     inplistfile = dln.first_el(args.list)
     if inplistfile == '': inplistfile = None
+    manifest = dln.first_el(args.manifest)
+    if manifest == '': manifest = None
+    maxattempts = dln.first_el(args.maxattempts)
     nside = 128
 
     # on thing/hulk use
@@ -147,7 +153,7 @@ if __name__ == "__main__":
     # Check what's been done already
     check = False
     #if not redo:
-    if check:
+    if check and manifest is None:
         rootLogger.info("Checking if any have already been done")
         exists = np.zeros(dln.size(allexpdir),bool)+False
         for ip,p in enumerate(allexpdir):
@@ -187,6 +193,19 @@ if __name__ == "__main__":
     dirs = alldirs[torun]
     rootLogger.info('Running '+str(len(torun))+' on '+host)
 
+    # Run from the manifest database.  Exposures that were already run
+    # are skipped without looking at their directories, and a crashed
+    # run resumes.
+    if manifest is not None:
+        man = scheduler.Manifest(manifest,maxattempts=maxattempts)
+        outfiles = [e+'/'+os.path.basename(e)+'.updated' for e in expdir]
+        nnew = man.add(expdir,cmd,dirs,outputs=outfiles,checkdone=check)
+        rootLogger.info(str(nnew)+' new exposures added to '+manifest+'  '+str(man.counts()))
+        man.close()
+        counts = scheduler.runworker(manifest,nmulti,maxattempts=maxattempts,logger=rootLogger)
+        rootLogger.info('dt='+str(time.time()-t0)+' sec')
+        sys.exit()
+
     # Saving the structure of jobs to run
     runfile = basedir+'lists/nsc_instcal_measure_update_main.'+host+'.'+logtime+'_run.fits'
     rootLogger.info('Writing running information to '+runfile)
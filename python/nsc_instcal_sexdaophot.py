@@ -23,12 +23,19 @@ import subprocess
 import glob
 import logging
 import socket
+from argparse import ArgumentParser
 #from scipy.signal import convolve2d
 from scipy.ndimage.filters import convolve
 import astropy.stats
 import struct
 from utils import *
 from phot import *
+import chippool
+import chipcache
+import daosession
+import psfcache
+import stagelog
+import batchapcor
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -58,7 +65,10 @@ def getnscdirs(version=None):
 class Exposure:
 
     # Initialize Exposure object
-    def __init__(self,fluxfile,wtfile,maskfile,nscversion="t3a"):
+    def __init__(self,fluxfile,wtfile,maskfile,nscversion="t3a",cachedir=None,cachesize=20e9,psfcachedir=None,
+                 apcormode="chip",usesession=False):
+        if apcormode not in batchapcor.APCORMODES:
+            raise ValueError("apcormode must be one of "+", ".join(batchapcor.APCORMODES)+", not "+repr(apcormode))
         # Check that the files exist
         if os.path.exists(fluxfile) is False:
             print(fluxfile+" NOT found")
@@ -86,6 +96,16 @@ class Exposure:
         self.wdir = None     # the temporary working directory
         self.outdir = None
         self.chip = None
+        self.chipstats = None    # per-chip timing and status with nproc>1
+        self.cachedir = cachedir  # decompress-once chip cache, see chipcache.py
+        self.cachesize = cachesize
+        self.cache = None
+        self.psfcachedir = psfcachedir  # PSF warm starts, see psfcache.py
+        self.psfcache = None
+        self.stagelogfile = None  # per-stage records of the chips, see stagelog.py
+        self.apcormode = apcormode  # "chip", or "exposure"/"focalplane" for batchapcor.py
+        self.growdir = None       # growth-curve stars of the chips with apcormode!="chip"
+        self.usesession = usesession  # persistent DAOPHOT/ALLSTAR (daosession.py), off until checked against the real programs
 
         # Get instrument
         head0 = fits.getheader(fluxfile,0)
@@ -145,11 +165,34 @@ class Exposure:
         self.logger = rootLogger
         self.logger.info("Setting up in temporary directory "+tmpdir)
         self.logger.info("Starting logfile at "+self.logfile)
+        self.stagelogfile = os.path.abspath(self.base+".stages.jsonl")
+        if self.apcormode != "chip":
+            self.logger.info("Aperture correction mode: "+self.apcormode)
+            self.growdir = os.getcwd()
+
+        # PSFs of earlier chips and exposures
+        if self.psfcachedir is not None:
+            self.logger.info("Using PSF cache "+self.psfcachedir)
+            self.psfcache = psfcache.PsfCache(self.psfcachedir,logger=self.logger)
 
         # Copy over images from zeus1:/mss
         fluxfile = "bigflux.fits.fz"
         wtfile = "bigwt.fits.fz"
         maskfile = "bigmask.fits.fz"
+
+        # With the chip cache the chips are decompressed straight from the
+        #  mass store files, no copy needed
+        if self.cachedir is not None:
+            self.logger.info("Using chip cache "+self.cachedir)
+            self.cache = chipcache.ChipCache(self.cachedir,maxbytes=self.cachesize,logger=self.logger)
+            self.fluxfile = self.origfluxfile
+            self.wtfile = self.origwtfile
+            self.maskfile = self.origmaskfile
+            if not os.path.exists(self.outdir):
+                os.makedirs(self.outdir)
+                self.logger.info("Making output directory: "+self.outdir)
+            return
+
         self.logger.info("Copying InstCal images from mass store archive")
         shutil.copyfile(self.origfluxfile,tmpdir+"/"+os.path.basename(self.origfluxfile))
         self.logger.info("  "+self.origfluxfile)
@@ -177,46 +220,36 @@ class Exposure:
 
     # Load chip
     def loadchip(self,extension,fluxfile="flux.fits",wtfile="wt.fits",maskfile="mask.fits"):
-        # Load the data
-        self.logger.info(" Loading chip "+str(extension))
         # Check that the working files set by "setup"
         if (self.fluxfile is None) | (self.wtfile is None) | (self.maskfile is None):
             self.logger.warning("Local working filenames not set.  Make sure to run setup() first")
             return
-        try:
-            flux,fhead = fits.getdata(self.fluxfile,extension,header=True)
-            fhead0 = fits.getheader(self.fluxfile,0)  # add PDU info
-            fhead.extend(fhead0,unique=True)
-            wt,whead = fits.getdata(self.wtfile,extension,header=True)
-            mask,mhead = fits.getdata(self.maskfile,extension,header=True)
-        except:
-            self.logger.error("No extension "+str(extension))
-            return
-        # Write the data to the appropriate files
-        if os.path.exists(fluxfile):
-            os.remove(fluxfile)
-        fits.writeto(fluxfile,flux,header=fhead,output_verify='warn')
-        if os.path.exists(wtfile):
-            os.remove(wtfile)
-        fits.writeto(wtfile,wt,header=whead,output_verify='warn')
-        if os.path.exists(maskfile):
-            os.remove(maskfile)
-        fits.writeto(maskfile,mask,header=mhead,output_verify='warn')        
-        # Create the chip object
-        self.chip = Chip(fluxfile,wtfile,maskfile,self.base)
-        self.chip.bigextension = extension
-        self.chip.nscversion = self.nscversion
-        self.chip.outdir = self.outdir
-        # Add logger information
-        self.chip.logger = self.logger
+        self.chip = getchip(extension,self.fluxfile,self.wtfile,self.maskfile,self.base,self.nscversion,
+                            self.outdir,fluxfile=fluxfile,wtfile=wtfile,maskfile=maskfile,logger=self.logger,
+                            cache=self.cache,psfcache=self.psfcache,stagelogfile=self.stagelogfile,
+                            growdir=self.growdir,usesession=self.usesession)
 
 
     # Process all chips
-    def process(self):
+    def process(self,nproc=1):
         self.logger.info("-------------------------------------------------")
         self.logger.info("Processing ALL extension images")
         self.logger.info("-------------------------------------------------")
 
+        # Process the chips in parallel, each in its own directory
+        #---------------------------------------------------------
+        if nproc > 1:
+            self.logger.info("Processing the chips with "+str(nproc)+" processes")
+            self.chipstats = chippool.processchips(processchip,range(1,self.nexten),self.wdir,nproc=nproc,
+                                                   logger=self.logger,fluxfile=os.path.abspath(self.fluxfile),
+                                                   wtfile=os.path.abspath(self.wtfile),maskfile=os.path.abspath(self.maskfile),
+                                                   base=self.base,nscversion=self.nscversion,outdir=self.outdir,
+                                                   cachedir=self.cachedir,cachesize=self.cachesize,
+                                                   psfcachedir=self.psfcachedir,stagelogfile=self.stagelogfile,
+                                                   growdir=self.growdir,usesession=self.usesession)
+            if self.growdir is not None: self.exposureapcor()
+            return
+
         # LOOP through the HDUs/chips
         #----------------------------
         for i in xrange(1,self.nexten):
@@ -232,6 +265,34 @@ class Exposure:
             self.chip.cleanup()
             self.logger.info("dt = "+str(time.time()-t0)+" seconds")
 
+        # Aperture correction from the growth-curve stars of all chips
+        if self.growdir is not None: self.exposureapcor()
+
+
+    # Exposure-level aperture correction
+    def exposureapcor(self):
+        self.logger.info("-- Calculating exposure-level aperture correction --")
+        slog = stagelog.StageLog(self.stagelogfile,logger=self.logger,exposure=self.base,instrument=self.instrument)
+        with slog.stage('exposureapcor') as rec:
+            growfiles = sorted(glob.glob(os.path.join(self.growdir,self.base+"_*.grow.fits")))
+            # All the chip catalogs, also of the chips with no growth-curve stars or file
+            ccdnums = []
+            for catfile in glob.glob(self.outdir+self.base+"_*.fits"):
+                m = re.match(re.escape(self.base)+r"_(\d+)\.fits$",os.path.basename(catfile))
+                if m is not None: ccdnums.append(int(m.group(1)))
+            apcors, curve = batchapcor.exposureapcor(growfiles,mode=self.apcormode,ccdnums=ccdnums,logger=self.logger)
+            for ccdnum in sorted(set(ccdnums) | set(apcors.keys())):
+                catfile = self.outdir+self.base+"_"+str(ccdnum)+".fits"
+                if os.path.exists(catfile) is False:
+                    self.logger.warning(catfile+" NOT found")
+                    continue
+                if ccdnum not in apcors:
+                    self.logger.warning("No aperture correction for CCDNUM "+str(ccdnum)+", "+catfile+" left uncorrected")
+                    continue
+                batchapcor.updatecat(catfile,apcors[ccdnum][0],mode=self.apcormode)
+            rec['nchips'] = len(apcors)
+            rec['ngrow'] = curve.nstars if curve is not None else 0
+
     
     # Teardown
     def teardown(self):
@@ -239,6 +300,9 @@ class Exposure:
         self.logger.info("Deleting files and temporary directory.")
         # Move the final log file
         shutil.move(self.logfile,self.outdir+self.base+".log")
+        # Move the stage records
+        if os.path.exists(self.stagelogfile):
+            shutil.move(self.stagelogfile,self.outdir+self.base+".stages.jsonl")
         # Delete temporary files and directory
         tmpfiles = glob.glob("*")
         for f in tmpfiles: os.remove(f)
@@ -248,11 +312,90 @@ class Exposure:
         
 
     # RUN all steps to process this exposure
-    def run(self):
+    def run(self,nproc=1):
         self.setup()
-        self.process()
+        self.process(nproc=nproc)
         self.teardown()
 
+
+# Load a chip from the big multi-extension files into the current directory
+def getchip(extension,bigfluxfile,bigwtfile,bigmaskfile,bigbase,nscversion,outdir,
+            fluxfile="flux.fits",wtfile="wt.fits",maskfile="mask.fits",logger=None,cache=None,psfcache=None,
+            stagelogfile=None,growdir=None,usesession=False):
+    # Load the data
+    logger.info(" Loading chip "+str(extension))
+    # Link to the uncompressed chips in the cache
+    if cache is not None:
+        try:
+            cache.link(bigfluxfile,extension,fluxfile,addpdu=True)   # add PDU info
+            cache.link(bigwtfile,extension,wtfile)
+            cache.link(bigmaskfile,extension,maskfile)
+        except:
+            logger.error("No extension "+str(extension))
+            return
+        chip = Chip(fluxfile,wtfile,maskfile,bigbase)
+        chip.bigextension = extension
+        chip.nscversion = nscversion
+        chip.outdir = outdir
+        chip.logger = logger
+        chip.psfcache = psfcache
+        chip.stagelogfile = stagelogfile
+        chip.growdir = growdir
+        chip.usesession = usesession
+        return chip
+    try:
+        flux,fhead = fits.getdata(bigfluxfile,extension,header=True)
+        fhead0 = fits.getheader(bigfluxfile,0)  # add PDU info
+        fhead.extend(fhead0,unique=True)
+        wt,whead = fits.getdata(bigwtfile,extension,header=True)
+        mask,mhead = fits.getdata(bigmaskfile,extension,header=True)
+    except:
+        logger.error("No extension "+str(extension))
+        return
+    # Write the data to the appropriate files
+    if os.path.exists(fluxfile):
+        os.remove(fluxfile)
+    fits.writeto(fluxfile,flux,header=fhead,output_verify='warn')
+    if os.path.exists(wtfile):
+        os.remove(wtfile)
+    fits.writeto(wtfile,wt,header=whead,output_verify='warn')
+    if os.path.exists(maskfile):
+        os.remove(maskfile)
+    fits.writeto(maskfile,mask,header=mhead,output_verify='warn')        
+    # Create the chip object
+    chip = Chip(fluxfile,wtfile,maskfile,bigbase)
+    chip.bigextension = extension
+    chip.nscversion = nscversion
+    chip.outdir = outdir
+    chip.psfcache = psfcache
+    chip.stagelogfile = stagelogfile
+    chip.growdir = growdir
+    chip.usesession = usesession
+    # Add logger information
+    chip.logger = logger
+    return chip
+
+
+# Process one chip in the current directory, run by the chip pool
+def processchip(extension,fluxfile=None,wtfile=None,maskfile=None,base=None,nscversion=None,outdir=None,
+                cachedir=None,cachesize=20e9,psfcachedir=None,stagelogfile=None,growdir=None,usesession=False):
+    logger = logging.getLogger()
+    logger.info("=== Processing subimage "+str(extension)+" ===")
+    cache = None
+    if cachedir is not None:
+        cache = chipcache.ChipCache(cachedir,maxbytes=cachesize)
+    pcache = None
+    if psfcachedir is not None:
+        pcache = psfcache.PsfCache(psfcachedir,logger=logger)
+    chip = getchip(extension,fluxfile,wtfile,maskfile,base,nscversion,outdir,logger=logger,cache=cache,psfcache=pcache,
+                   stagelogfile=stagelogfile,growdir=growdir,usesession=usesession)
+    if chip is None:
+        raise ValueError("No extension "+str(extension))
+    logger.info("CCDNUM = "+str(chip.ccdnum))
+    chip.process()
+    chip.cleanup()
+    return chip.ccdnum
+
         
 # Class to represent a single chip of an exposure
 class Chip:
@@ -289,6 +432,12 @@ class Chip:
         self._sexmaglim = None    # set by runsex()
         # Logger
         self.logger = None
+        self.session = None       # DaoSession while the DAOPHOT steps run
+        self.psfcache = None      # PsfCache for warm starts of createpsf()
+        self.stagelogfile = None  # JSON-lines file for the stage records
+        self.stagelog = None      # StageLog of process()
+        self.growdir = None       # write the growth-curve stars here instead of getapcor()
+        self.usesession = False   # run the DAOPHOT steps in a DaoSession, else with the scripts
 
     
     def __repr__(self):
@@ -509,7 +658,8 @@ class Chip:
         basedir, tmpdir = getnscdirs(self.nscversion)
         configdir = basedir+"config/"
         sexcatfile = "flux_sex.cat.fits"
-        sexcat, maglim = runsex(self.fluxfile,self.wtfile,self.maskfile,self.meta,sexcatfile,configdir,logger=self.logger)
+        sexcat, maglim = runsex(self.fluxfile,self.wtfile,self.maskfile,self.meta,sexcatfile,configdir,logger=self.logger,
+                               configfile="default.config")
         self.sexcat = sexcatfile
         self.sexcat = sexcat
         self._sexmaglim = maglim
@@ -549,14 +699,14 @@ class Chip:
     def daofind(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        cat = daofind(self.daofile,outfile=daobase+".coo",logger=self.logger)
+        cat = daofind(self.daofile,outfile=daobase+".coo",logger=self.logger,session=self.session)
 
     # DAOPHOT aperture photometry
     #----------------------------
     def daoaperphot(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        apcat, maglim = daoaperphot(self.daofile,daobase+".coo",outfile=daobase+".ap",logger=self.logger)
+        apcat, maglim = daoaperphot(self.daofile,daobase+".coo",outfile=daobase+".ap",logger=self.logger,session=self.session)
         self._daomaglim = maglim
 
     # Pick PSF stars using DAOPHOT
@@ -565,45 +715,65 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         if maglim is None: maglim=self.maglim
-        psfcat = daopickpsf(self.daofile,daobase+".ap",maglim,daobase+".lst",nstars,logger=self.logger)
+        psfcat = daopickpsf(self.daofile,daobase+".ap",maglim,daobase+".lst",nstars,logger=self.logger,session=self.session)
 
     # Run DAOPHOT PSF
     #-------------------
     def daopsf(self,verbose=False):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        psfcat = daopsf(self.daofile,daobase+".lst",outfile=daobase+".psf",verbose=verbose,logger=self.logger)
+        psfcat = daopsf(self.daofile,daobase+".lst",outfile=daobase+".psf",verbose=verbose,logger=self.logger,session=self.session)
 
     # Subtract neighbors of PSF stars
     #--------------------------------
     def subpsfnei(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        psfcat = subpsfnei(self.daofile,daobase+".lst",daobase+".nei",daobase+"a.fits",logger=self.logger)
+        psfcat = subpsfnei(self.daofile,daobase+".lst",daobase+".nei",daobase+"a.fits",logger=self.logger,session=self.session)
 
     # Create DAOPHOT PSF
     #-------------------
     def createpsf(self,listfile=None,apfile=None,doiter=True,maxiter=5,minstars=6,subneighbors=True,verbose=False):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger)
+        cachekey = None
+        if (self.psfcache is not None) & (self.meta.get('FWHM') is not None):
+            cachekey = (self.instrument,self.ccdnum,self.meta['FWHM'])
+        createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger,session=self.session,
+                  psfcache=self.psfcache,cachekey=cachekey)
         
     # Run ALLSTAR
     #-------------
     def allstar(self,psffile=None,apfile=None,subfile=None):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        alscat = allstar(daobase+".fits",daobase+".psf",daobase+".ap",outfile=daobase+".als",meta=self.meta,logger=self.logger)
+        alscat = allstar(daobase+".fits",daobase+".psf",daobase+".ap",outfile=daobase+".als",meta=self.meta,logger=self.logger,session=self.session)
         
     # Get aperture correction
     #------------------------
     def getapcor(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        apcorr = apcor(daobase+"a.fits",daobase+".lst",daobase+".psf",self.meta,optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger)
+        apcorr = apcor(daobase+"a.fits",daobase+".lst",daobase+".psf",self.meta,optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger,session=self.session)
         self.apcorr = apcorr
         self.meta['apcor'] = (apcorr,"Aperture correction in mags")
 
+    # Stars for the exposure-level aperture correction
+    #-------------------------------------------------
+    def growstars(self):
+        daobase = os.path.basename(self.daofile)
+        daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
+        fwhm = self.meta['FWHM']/self.pixscale if self.meta.get('FWHM') is not None else 4.0
+        cat = batchapcor.growstars(daobase+".ap",daobase+".als",daobase+".apers",fwhm=fwhm)
+        batchapcor.addcoords(cat,self.wcs,self.ccdnum,self.meta['NAXIS1'],self.meta['NAXIS2'])
+        growfile = os.path.join(self.growdir,self.bigbase+"_"+str(self.ccdnum)+".grow.fits")
+        self.logger.info(str(len(cat))+" growth-curve stars in "+growfile)
+        cat.write(growfile,overwrite=True)
+        # The correction is applied to the final catalog by Exposure.exposureapcor()
+        self.apcorr = 0.0
+        self.meta['apcor'] = (0.0,"Aperture correction in mags")
+        return len(cat)
+
     # Combine SE and DAOPHOT catalogs
     #--------------------------------
     def finalcat(self,outfile=None,both=True,sexdetect=True):
@@ -689,20 +859,60 @@ class Chip:
     # Process a single chip
     #----------------------
     def process(self):
-        self.runsex()
+        # Time, CPU, memory and I/O of each stage, see stagelog.py
+        self.stagelog = stagelog.StageLog(self.stagelogfile,logger=self.logger,exposure=self.bigbase,
+                                          extension=self.bigextension,ccdnum=self.ccdnum,instrument=self.instrument)
+        slog = self.stagelog
+        with slog.stage('runsex') as rec:
+            self.runsex()
+            rec.update(stagelog.metavalues(self.meta,['FWHM']))
         self.logger.info("-- Getting ready to run DAOPHOT --")
-        self.mkopt()
-        self.mkdaoim()
+        with slog.stage('mkopt'):
+            self.mkopt()
+        with slog.stage('mkdaoim'):
+            self.mkdaoim()
         #self.daodetect()
         # Create DAOPHOT-style coo file
         # Need to use SE positions
-        self.sextodao(outfile="flux_dao.coo")
-        self.daoaperphot()
-        self.daopickpsf()
-        self.createpsf()
-        self.allstar()
-        self.getapcor()
-        self.finalcat()
+        with slog.stage('sextodao'):
+            self.sextodao(outfile="flux_dao.coo")
+        # With usesession keep one DAOPHOT and one ALLSTAR running for all the
+        #  DAOPHOT steps, the intermediate files stay on the RAM disk.  The
+        #  session has only been run against the stub programs of daostub.py,
+        #  so by default every step runs its own script in the chip directory.
+        daobase = os.path.basename(self.daofile)
+        daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
+        if self.usesession:
+            self.session = daosession.DaoSession(ramdisk=True,inputs=[self.daofile,"flux_dao.coo",daobase+".opt",daobase+".als.opt"],
+                                                 exports=[daobase+".ap",daobase+".apers",daobase+".lst",daobase+".psf",daobase+".als","*.log"],
+                                                 logger=self.logger)
+            self.session.open()
+        try:
+            with slog.stage('daoaperphot',session=self.session):
+                self.daoaperphot()
+            with slog.stage('daopickpsf',session=self.session):
+                self.daopickpsf()
+            with slog.stage('createpsf',session=self.session) as rec:
+                self.createpsf()
+                rec.update(stagelog.metavalues(self.meta,['PSFITER','PSFCHI','PSFSTARS','PSFWARM']))
+            with slog.stage('allstar',session=self.session):
+                self.allstar()
+            if self.growdir is None:
+                with slog.stage('getapcor',session=self.session) as rec:
+                    self.getapcor()
+                    if self.apcorr is not None: rec['apcor'] = float(self.apcorr)
+        finally:
+            if self.session is not None:
+                self.session.close()
+                self.logger.info(self.session.summary())
+                self.session = None
+        # Only pick the growth-curve stars, the aperture correction is done for all chips
+        if self.growdir is not None:
+            with slog.stage('growstars') as rec:
+                rec['ngrow'] = self.growstars()
+        with slog.stage('finalcat'):
+            self.finalcat()
+        slog.total()
 
         # Do I need to rerun daoaperphot to get aperture
         # photometry at the FINAL allstar positions??
@@ -779,11 +989,22 @@ class Chip:
 # Main command-line program
 if __name__ == "__main__":
 
+    parser = ArgumentParser(description='Run SExtractor and DAOPHOT on an exposure.')
+    parser.add_argument('fluxfile', type=str, help='Flux file')
+    parser.add_argument('wtfile', type=str, help='Weight file')
+    parser.add_argument('maskfile', type=str, help='Mask file')
+    parser.add_argument('version', type=str, nargs='?', default=None, help='Version number')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of chips to process at the same time')
+    parser.add_argument('--cachedir', type=str, default=None, help='Decompress-once chip cache directory')
+    parser.add_argument('--psfcachedir', type=str, default=None, help='PSF cache directory, shared by the exposures')
+    parser.add_argument('--apcormode', type=str, default='chip', choices=batchapcor.APCORMODES,
+                        help='Aperture correction per chip (default), or for the exposure with the focal-plane term '+
+                             '(focalplane) or without it (exposure, coarse)')
+    parser.add_argument('--session', action='store_true', help='Run the DAOPHOT steps in one persistent DAOPHOT/ALLSTAR (experimental)')
+    args = parser.parse_args()
+
     # Version
-    verdir = ""
-    if len(sys.argv) > 4:
-       version = sys.argv[4]
-       verdir = version if version.endswith('/') else version+"/"
+    version = args.version
 
     # Get NSC directories
     basedir, tmpdir = getnscdirs(version)
@@ -797,16 +1018,10 @@ if __name__ == "__main__":
     t0 = time.time()
     print(sys.argv)
 
-    # Not enough inputs
-    n = len(sys.argv)
-    if n < 4:
-        print("Syntax - nsc_instcal_sexdaophot.py fluxfile wtfile maskfile version")
-        sys.exit()
-
     # File names
-    fluxfile = sys.argv[1]
-    wtfile = sys.argv[2]
-    maskfile = sys.argv[3]
+    fluxfile = args.fluxfile
+    wtfile = args.wtfile
+    maskfile = args.maskfile
     # Check that the files exist
     if os.path.exists(fluxfile) is False:
         print(fluxfile+" file NOT FOUND")
@@ -815,12 +1030,13 @@ if __name__ == "__main__":
         print(wtfile+" file NOT FOUND")
         sys.exit()
     if os.path.exists(maskfile) is False:
-        print(maskile+" file NOT FOUND")
+        print(maskfile+" file NOT FOUND")
         sys.exit()
 
     # Create the Exposure object
-    exp = Exposure(fluxfile,wtfile,maskfile,nscversion=version)
+    exp = Exposure(fluxfile,wtfile,maskfile,nscversion=version,cachedir=args.cachedir,psfcachedir=args.psfcachedir,
+                   apcormode=args.apcormode,usesession=args.session)
     # Run
-    exp.run()
+    exp.run(nproc=args.nproc)
 
     print("Total time = "+str(time.time()-t0)+" seconds")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# Vectorized search for objects that have other objects "inside" them.
+#
+# find_obj_parent() in nsc_instcal_combine_cluster.py finds the nearest
+# neighbor of every object and then, for each object whose neighbor is
+# closer than min(0.5*FWHM,ASEMI), builds a 10-point polygon of its ellipse
+# and runs coords.doPolygonsOverlap() on the neighbor in a Python loop.
+#
+# Here all of the candidate pairs are done at once.  The neighbors are put
+# on the tangent plane of their objects with one rotsphcen() call and
+# rotated into the frame of the ellipse.  The polygon is the 9-gon inscribed
+# in the ellipse, so it contains the ellipse scaled by cos(pi/9) and is
+# contained in the ellipse itself.  Neighbors well inside the inner ellipse
+# are parents, neighbors outside the ellipse are not, and only the small
+# residual in between gets the exact test: the bounding-box and winding
+# number test of doPolygonsOverlap(), evaluated in bulk on the same polygon
+# vertices.  That gives the same flags as the loop.  (The loop raises an
+# error for a neighbor in the bounding box of the polygon but outside of it,
+# because doPolygonsOverlap() then goes on to compare line segments of the
+# single-point "polygon"; here that neighbor is simply not inside.)
+
+import numpy as np
+import time
+from argparse import ArgumentParser
+from dlnpyutils import utils as dln, coords
+
+# Number of points of the ellipse polygon
+NPOLYGON = 10
+
+# Fractional margin around the inner and outer ellipse for the residual set
+MARGIN = 1e-6
+
+def neighbors(obj):
+    """ Nearest neighbor of every object and its distance in arcsec, like find_obj_parent()."""
+
+    X1 = np.vstack((obj['ra'],obj['dec'])).T
+    X2 = np.vstack((obj['ra'],obj['dec'])).T
+
+    X1 = X1 * (np.pi / 180.)
+    X2 = X2 * (np.pi / 180.)
+    max_distance = (np.max(obj['fwhm']) / 3600) * (np.pi / 180.)
+
+    # Convert 2D RA/DEC to 3D cartesian coordinates
+    Y1 = np.transpose(np.vstack([np.cos(X1[:, 0]) * np.cos(X1[:, 1]),
+                                 np.sin(X1[:, 0]) * np.cos(X1[:, 1]),
+                                 np.sin(X1[:, 1])]))
+    Y2 = np.transpose(np.vstack([np.cos(X2[:, 0]) * np.cos(X2[:, 1]),
+                                 np.sin(X2[:, 0]) * np.cos(X2[:, 1]),
+                                 np.sin(X2[:, 1])]))
+
+    # law of cosines to compute 3D distance
+    max_y = np.sqrt(2 - 2 * np.cos(max_distance))
+    dist, ind = coords.crossmatch(Y1, Y2, max_y, k=2)
+
+    # convert distances back to angles using the law of tangents
+    not_inf = ~np.isinf(dist)
+    x = 0.5 * dist[not_inf]
+    dist[not_inf] = (180. / np.pi * 2 * np.arctan2(x,
+                                  np.sqrt(np.maximum(0, 1 - x ** 2))))
+    dist[not_inf] *= 3600.0      # in arcsec
+
+    # the closest object will be itself, so return the second one
+    return dist[:,1], ind[:,1]
+
+def ellipsepolygons(asemi,bsemi,theta,npoints=NPOLYGON):
+    """ Vertices of the ellipse polygons centered on zero, computed exactly like ellipsecoords()."""
+    phi = 2*np.pi*(np.arange(npoints,dtype=float)/(npoints-1))   # Divide circle into Npoints
+    ang = np.deg2rad(theta)                                      # Position angle in radians
+    cosang = np.cos(ang).reshape(-1,1)
+    sinang = np.sin(ang).reshape(-1,1)
+    x = asemi.reshape(-1,1)*np.cos(phi)                          # Parameterized equation of ellipse
+    y = bsemi.reshape(-1,1)*np.sin(phi)
+    xprime = 0.0 + x*cosang - y*sinang                           # Rotate to desired position angle
+    yprime = 0.0 + x*sinang + y*cosang
+    return xprime, yprime
+
+def pointsinpolygons(xpoly,ypoly,xpt,ypt):
+    """ Bounding-box and winding number test of points in polygons, in bulk.
+
+    This is the test of coords.doPolygonsOverlap() for a single-point second
+    polygon, one row of XPOLY/YPOLY per point.
+    """
+    # If ranges don't overlap, then polygons don't overlap
+    inbox = ((np.max(xpoly,axis=1) >= xpt) & (np.min(xpoly,axis=1) <= xpt) &
+             (np.max(ypoly,axis=1) >= ypt) & (np.min(ypoly,axis=1) <= ypt))
+    # Winding number, add first vertex to the end
+    x1 = xpoly
+    y1 = ypoly
+    x2 = np.roll(xpoly,-1,axis=1)
+    y2 = np.roll(ypoly,-1,axis=1)
+    xp = xpt.reshape(-1,1)
+    yp = ypt.reshape(-1,1)
+    isleft = (x2 - x1) * (yp - y1) - (xp - x1) * (y2 - y1)
+    up = (y1 <= yp) & (y2 > yp) & (isleft > 0)
+    down = (y1 > yp) & (y2 <= yp) & (isleft < 0)
+    wn = np.sum(up,axis=1) - np.sum(down,axis=1)
+    return inbox & (wn != 0)
+
+def insideellipse(obj,ind1,ind2,npoints=NPOLYGON):
+    """ Are the objects IND2 inside the ellipse polygons of the objects IND1.
+
+    Returns the boolean flags and the number of pairs that needed the exact test.
+    """
+    npairs = len(ind1)
+    inside = np.zeros(npairs,bool)
+    if npairs==0:
+        return inside, 0
+    # Neighbors on the tangent planes of the objects, in arcsec
+    lon2,lat2 = coords.rotsphcen(obj['ra'][ind2],obj['dec'][ind2],obj['ra'][ind1],obj['dec'][ind1],gnomic=True)
+    xpt = lon2*3600
+    ypt = lat2*3600
+    asemi = obj['asemi'][ind1]
+    bsemi = obj['bsemi'][ind1]
+    theta = obj['theta'][ind1]
+    # Radius in the frame of the ellipse, 1 on the ellipse
+    ang = np.deg2rad(theta.astype(float))
+    u = xpt*np.cos(ang) + ypt*np.sin(ang)
+    v = -xpt*np.sin(ang) + ypt*np.cos(ang)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rad = np.sqrt((u/asemi)**2 + (v/bsemi)**2)
+    rin = np.cos(np.pi/(npoints-1))
+    good = (asemi > 0) & (bsemi > 0) & np.isfinite(rad)
+    inside[good] = rad[good] < rin*(1-MARGIN)
+    resid, = np.where(~good | ((rad >= rin*(1-MARGIN)) & (rad <= 1+MARGIN)))
+    # Exact test on the residual
+    if len(resid)>0:
+        xpoly,ypoly = ellipsepolygons(asemi[resid],bsemi[resid],theta[resid],npoints)
+        inside[resid] = pointsinpolygons(xpoly,ypoly,xpt[resid],ypt[resid])
+    return inside, len(resid)
+
+def find_obj_parent(obj):
+    """ Find objects that have other objects "inside" them, vectorized. """
+
+    dist, ind = neighbors(obj)
+
+    # Add "parent" column if necessary
+    if 'parent' not in obj.dtype.names:
+        obj = dln.addcatcols(obj,np.dtype([('parent',bool)]))
+
+    # Check if there are any objects within FWHM
+    bd,nbd = dln.where( dist <= np.minimum(0.5*obj['fwhm'],obj['asemi']))
+
+    # Check that they are inside their ellipse footprint
+    obj['parent'] = False    # all false to start
+    if nbd>0:
+        inside, nresid = insideellipse(obj,bd,ind[bd])
+        obj['parent'][bd] = inside
+
+    return obj
+
+def loopparent(obj):
+    """ The polygon loop of find_obj_parent(), kept as a reference.
+
+    Returns the parent flags and the number of pairs for which
+    coords.doPolygonsOverlap() raised an error (those are left False).
+    """
+    dist, ind = neighbors(obj)
+    parent = np.zeros(len(obj),bool)
+    nerror = 0
+    bd,nbd = dln.where( dist <= np.minimum(0.5*obj['fwhm'],obj['asemi']))
+    for i in range(nbd):
+        ind1 = bd[i]
+        ind2 = ind[bd[i]]
+        cenra = obj['ra'][ind1]
+        cendec = obj['dec'][ind1]
+        lon2,lat2 = coords.rotsphcen(obj['ra'][ind2],obj['dec'][ind2],cenra,cendec,gnomic=True)
+        ll,bb = ellipsepolygons(np.atleast_1d(obj['asemi'][ind1]),np.atleast_1d(obj['bsemi'][ind1]),
+                                np.atleast_1d(obj['theta'][ind1]))
+        try:
+            parent[ind1] = coords.doPolygonsOverlap(ll[0],bb[0],np.atleast_1d(lon2*3600),np.atleast_1d(lat2*3600))
+        except (ValueError,IndexError):
+            nerror += 1
+    return parent, nerror
+
+def simobj(nobj=100000,size=0.2,cenra=180.0,cendec=30.0,seed=0):
+    """ Simulate a crowded field of objects with shapes."""
+    rnd = np.random.RandomState(seed)
+    dtype = np.dtype([('ra',float),('dec',float),('asemi',np.float32),('bsemi',np.float32),
+                      ('theta',np.float32),('fwhm',np.float32)])
+    obj = np.zeros(nobj,dtype=dtype)
+    obj['ra'] = cenra+(rnd.rand(nobj)-0.5)*size/np.cos(np.deg2rad(cendec))
+    obj['dec'] = cendec+(rnd.rand(nobj)-0.5)*size
+    obj['fwhm'] = 0.8+rnd.rand(nobj)*1.5
+    obj['asemi'] = obj['fwhm']*(0.3+rnd.rand(nobj)*0.8)
+    obj['bsemi'] = obj['asemi']*(0.2+rnd.rand(nobj)*0.8)
+    obj['theta'] = rnd.rand(nobj)*180-90
+    # Close companions, some inside and some just outside of the ellipses
+    ncomp = nobj//5
+    ind = rnd.choice(nobj,ncomp,replace=False)
+    r = obj['asemi'][ind]*(0.5+rnd.rand(ncomp))/3600
+    ang = rnd.rand(ncomp)*2*np.pi
+    obj['ra'][ind[0:ncomp//2]] = obj['ra'][ind[ncomp//2:2*(ncomp//2)]]+r[0:ncomp//2]*np.cos(ang[0:ncomp//2])/np.cos(np.deg2rad(cendec))
+    obj['dec'][ind[0:ncomp//2]] = obj['dec'][ind[ncomp//2:2*(ncomp//2)]]+r[0:ncomp//2]*np.sin(ang[0:ncomp//2])
+    return obj
+
+def benchmark(nobj=[10000,50000,200000],seed=0):
+    """ Benchmark the vectorized parent search against the polygon loop."""
+    results = []
+    for n in nobj:
+        obj = simobj(n,size=0.2*np.sqrt(n/1e5),seed=seed)
+        t0 = time.time()
+        parent0, nerror = loopparent(obj)
+        dt0 = time.time()-t0
+        t0 = time.time()
+        out = find_obj_parent(obj.copy())
+        dt = time.time()-t0
+        dist, ind = neighbors(obj)
+        bd, = np.where(dist <= np.minimum(0.5*obj['fwhm'],obj['asemi']))
+        inside, nresid = insideellipse(obj,bd,ind[bd])
+        same = np.array_equal(out['parent'],parent0)
+        print('%7d objects %6d pairs %5d residual %5d loop errors  loop %7.2f sec  vectorized %6.3f sec  speed-up %6.1f  same=%s' %
+              (n,len(bd),nresid,nerror,dt0,dt,dt0/dt,same))
+        results.append({'nobj':n,'npairs':len(bd),'nresid':nresid,'nerror':nerror,'loop':dt0,'vectorized':dt,'same':same})
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the vectorized parent search on simulated objects.')
+    parser.add_argument('--nobj', type=str, default='10000,50000,200000', help='Comma-separated list of number of objects')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    benchmark([int(n) for n in args.nobj.split(',')],args.seed)
@@ -26,6 +26,10 @@ import astropy.stats
 import struct
 import tempfile
 from dlnpyutils.utils import *
+import daoio
+import sexconfig
+import maskprep
+from psfcache import Convergence
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -151,7 +155,7 @@ def parsepars(lines):
 
 
 # Write DAOPHOT apertures files
-def aperswrite(filename=None,apertures=None):
+def aperswrite(filename=None,apertures=None,fast=True):
     '''
     This program creates a DAOPHOT file with apertures with an array/list of apertures.
     The last two are assumed to be the inner and outer sky apertures.
@@ -162,6 +166,8 @@ def aperswrite(filename=None,apertures=None):
         The filename for the apertures.
     apertures : list or array
         The array of apertures.
+    fast : bool, optional
+        Use the bulk writer in daoio.py.  Default is True.
 
     Returns
     -------
@@ -175,6 +181,9 @@ def aperswrite(filename=None,apertures=None):
         aperswrite("photo.opt",apertures)
 
     '''
+    # Bulk writer
+    if fast: return daoio.aperswrite(filename,apertures)
+
     # Not enough inputs
     if filename is None:
         print("No file name input")
@@ -200,7 +209,7 @@ def aperswrite(filename=None,apertures=None):
 
 
 # Read DAOPHOT files
-def daoread(fil):
+def daoread(fil,fast=True):
     '''
     This program reads in DAOPHOT-style files and return an astropy table.
     The supported types are .coo, .lst, .ap (in development), and .als.
@@ -209,6 +218,8 @@ def daoread(fil):
     ----------
     fil : str
         The filename of the DAOPHOT catalog file.
+    fast : bool, optional
+        Use the bulk reader in daoio.py.  Default is True.
 
     Returns
     -------
@@ -226,6 +237,9 @@ def daoread(fil):
 
     '''
 
+    # Bulk reader
+    if fast: return daoio.daoread(fil)
+
     # Not enough inputs
     if fil is None:
         print("No file name input")
@@ -266,7 +280,7 @@ def daoread(fil):
             for j in range(len(names)):
                 cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
     # NL = 1  tot file
-    if (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
+    elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
         # NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
         #  1  2046  4094   117.7 38652.0   13.12    3.00    3.91    1.55    6.00
         #  
@@ -483,7 +497,7 @@ def makemeta(fluxfile=None,header=None):
 
 
 # Write SE catalog in DAO format
-def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=None,saturate=None,rdnoise=None,gain=None,lowbad=None,thresh=None,logger=None):
+def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=None,saturate=None,rdnoise=None,gain=None,lowbad=None,thresh=None,logger=None,fast=True):
     '''
     This writes out a Source Extractor catalog in a DAOPHOT format.
 
@@ -514,6 +528,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
            The detection threshold.
     logger : logger object, optional
            The Logger to use for logging output.
+    fast : bool, optional
+           Use the bulk writer in daoio.py.  Default is True.
 
     Returns
     -------
@@ -529,6 +545,10 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
     '''
 
     if logger is None: logger = basiclogger('phot')   # set up basic logger if necessary
+    # Bulk writer
+    if fast:
+        return daoio.sextodao(cat,meta,outfile,format=format,naxis1=naxis1,naxis2=naxis2,saturate=saturate,
+                              rdnoise=rdnoise,gain=gain,lowbad=lowbad,thresh=thresh,logger=logger)
     # Not enough inputs
     if cat is None:
         logger.warning("No catalog input")
@@ -654,7 +674,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
 
 # Run Source Extractor
 #---------------------
-def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,configdir=None,logfile=None,logger=None):
+def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,configdir=None,logfile=None,logger=None,
+           usetemplate=True,configfile=None,fastmask=True):
     '''
     Run Source Extractor on an exposure.  The program is configured to work with files
     created by the NOAO Community Pipeline.
@@ -679,6 +700,16 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
             be the base name of `fluxfile` with the suffix "_sex.log".
     logger : logger object, optional
            The Logger to use for logging output.
+    usetemplate : bool, optional
+           Use the instrument configuration template of sexconfig.py and pass the chip
+           values as command-line overrides instead of rewriting the config files.
+           Default is True.
+    configfile : str, optional
+           With `usetemplate`, write the equivalent config for this chip to this file
+           (a record only, SExtractor does not read it).
+    fastmask : bool, optional
+           Convert and grow the mask with the lookup table and separable dilation of
+           maskprep.py.  Default is True.
 
     Returns
     -------
@@ -750,8 +781,11 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
 
     # 3a) Make subimages for flux, weight, mask
 
+    # Turn the mask from integer to bitmask with one table lookup
+    if fastmask:
+        mask = maskprep.convert(mask,meta["INSTCODE"],meta["plver"])
     # Turn the mask from integer to bitmask
-    if ((meta["INSTCODE"]=='c4d') & (meta["plver"]>='V3.5.0')) | (meta["INSTCODE"]=='k4m') | (meta["INSTCODE"]=='ksb'):
+    elif ((meta["INSTCODE"]=='c4d') & (meta["plver"]>='V3.5.0')) | (meta["INSTCODE"]=='k4m') | (meta["INSTCODE"]=='ksb'):
          #  1 = bad (in static bad pixel mask) -> 1
          #  2 = no value (for stacks)          -> 2
          #  3 = saturated                      -> 4
@@ -764,7 +798,7 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
          nonzero = (omask>0)
          mask[nonzero] = 2**((omask-1)[nonzero])    # This takes about 1 sec
     # Fix the DECam Pre-V3.5.0 masks
-    if (meta["INSTCODE"]=='c4d') & (meta["plver"]<'V3.5.0'):
+    if (not fastmask) & (meta["INSTCODE"]=='c4d') & (meta["plver"]<'V3.5.0'):
       # --CP bit masks, Pre-V3.5.0 (PLVER)
       # Bit   DQ Type  PROCTYPE
       # 1  detector bad pixel          ->  1 
@@ -799,84 +833,106 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
 
 
     # 3b) Make SExtractor config files
-    # Copy the default files
-    shutil.copyfile(configdir+"default.conv","default.conv")
-    shutil.copyfile(configdir+"default.nnw","default.nnw")
-    shutil.copyfile(configdir+"default.param","default.param")
-
-    # Read in configuration file and modify for this image
-    lines = readlines(configdir+'default.config')
-
-    # Gain, saturation, pixscale
-
-    # Things to change
-    # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
-    # GAIN            43.52             # detector gain in e-/ADU.
-    # SEEING_FWHM     1.46920            # stellar FWHM in arcsec
-    # WEIGHT_IMAGE  F4-00507860_01_comb.mask.fits
-
-    filter_name = ''
-    cnt = 0
-    for l in lines:
-        # CATALOG_NAME
-        m = re.search('^CATALOG_NAME',l)
-        if m != None:
-            lines[cnt] = "CATALOG_NAME     "+outfile+"         # name of the output catalog\n"
-        # FLAG_IMAGE
-        m = re.search('^FLAG_IMAGE',l)
-        if m != None:
-            lines[cnt] = "FLAG_IMAGE     "+smaskfile+"         # filename for an input FLAG-image\n"
-        # WEIGHT_IMAGE
-        m = re.search('^WEIGHT_IMAGE',l)
-        if m != None:
-            lines[cnt] = "WEIGHT_IMAGE     "+swtfile+"  # Weight image name\n"
-        # SATUR_LEVEL
-        m = re.search('^SATUR_LEVEL',l)
-        if m != None:
-            lines[cnt] = "SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n"
-        # Gain
-        m = re.search('^GAIN',l)
-        if m != None:
-            lines[cnt] = "GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n"
-        # SEEING_FWHM
-        m = re.search('^SEEING_FWHM',l)
-        if m != None:
-            lines[cnt] = "SEEING_FWHM     "+str(meta["cpfwhm"])+"            # stellar FWHM in arcsec\n"
-        # PHOT_APERTURES, aperture diameters in pixels
-        m = re.search('^PHOT_APERTURES',l)
-        if m != None:
-            aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
-            aper_pix = aper_world / meta["pixscale"]
-            lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
-        # Filter name
-        m = re.search('^FILTER_NAME',l)
-        if m != None:
-            filter_name = (l.split())[1]
-        cnt = cnt+1
-    # Write out the new config file
-    if os.path.exists("default.config"):
-        os.remove("default.config")
-    fo = open('default.config', 'w')
-    fo.writelines(lines)
-    fo.close()
-
+    # Instrument template parsed once, chip values on the command line
+    if usetemplate:
+        tmpl = sexconfig.gettemplate(configdir,meta["INSTCODE"],meta["pixscale"])
+        overrides = {'CATALOG_NAME':outfile, 'FLAG_IMAGE':smaskfile, 'WEIGHT_IMAGE':swtfile,
+                     'SATUR_LEVEL':meta["saturate"], 'GAIN':meta["gain"], 'SEEING_FWHM':meta["cpfwhm"]}
+        sexcmd = tmpl.command(sfluxfile,overrides)
+        filter = tmpl.kernel
+        if configfile is not None:
+            if os.path.exists(configfile): os.remove(configfile)
+            with open(configfile,'w') as fo:
+                fo.write(tmpl.render(overrides))
+    # Rewrite the config files for this chip
+    else:
+        # Copy the default files
+        shutil.copyfile(configdir+"default.conv","default.conv")
+        shutil.copyfile(configdir+"default.nnw","default.nnw")
+        shutil.copyfile(configdir+"default.param","default.param")
+
+        # Read in configuration file and modify for this image
+        lines = readlines(configdir+'default.config')
+
+        # Gain, saturation, pixscale
+
+        # Things to change
+        # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
+        # GAIN            43.52             # detector gain in e-/ADU.
+        # SEEING_FWHM     1.46920            # stellar FWHM in arcsec
+        # WEIGHT_IMAGE  F4-00507860_01_comb.mask.fits
+
+        filter_name = ''
+        cnt = 0
+        for l in lines:
+            # CATALOG_NAME
+            m = re.search('^CATALOG_NAME',l)
+            if m != None:
+                lines[cnt] = "CATALOG_NAME     "+outfile+"         # name of the output catalog\n"
+            # FLAG_IMAGE
+            m = re.search('^FLAG_IMAGE',l)
+            if m != None:
+                lines[cnt] = "FLAG_IMAGE     "+smaskfile+"         # filename for an input FLAG-image\n"
+            # WEIGHT_IMAGE
+            m = re.search('^WEIGHT_IMAGE',l)
+            if m != None:
+                lines[cnt] = "WEIGHT_IMAGE     "+swtfile+"  # Weight image name\n"
+            # SATUR_LEVEL
+            m = re.search('^SATUR_LEVEL',l)
+            if m != None:
+                lines[cnt] = "SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n"
+            # Gain
+            m = re.search('^GAIN',l)
+            if m != None:
+                lines[cnt] = "GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n"
+            # SEEING_FWHM
+            m = re.search('^SEEING_FWHM',l)
+            if m != None:
+                lines[cnt] = "SEEING_FWHM     "+str(meta["cpfwhm"])+"            # stellar FWHM in arcsec\n"
+            # PHOT_APERTURES, aperture diameters in pixels
+            m = re.search('^PHOT_APERTURES',l)
+            if m != None:
+                aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
+                aper_pix = aper_world / meta["pixscale"]
+                lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
+            # Filter name
+            m = re.search('^FILTER_NAME',l)
+            if m != None:
+                filter_name = (l.split())[1]
+            cnt = cnt+1
+        # Write out the new config file
+        if os.path.exists("default.config"):
+            os.remove("default.config")
+        fo = open('default.config', 'w')
+        fo.writelines(lines)
+        fo.close()
+
+        filter = None
+        if (filter_name != ''):
+            # Load the filter array
+            f = open(filter_name,'r')
+            linenum = 0
+            for line in f:
+                if (linenum == 1):
+                    shape = line.split(' ')[1]
+                    # Make it two pixels larger
+                    filter = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
+                    #filter = np.zeros(np.array(shape.split('x'),dtype='i'),dtype='f')
+                #if (linenum > 1):
+                #    linedata = np.array(line.split(' '),dtype='f')
+                #    filter[:,linenum-2] = linedata
+                linenum += 1
+            f.close()
+        sexcmd = ["sex",sfluxfile,"-c","default.config"]
+
+    # Grow the regions around bad pixels with a separable dilation, the mask
+    # is written once (also when there is no filter)
+    if fastmask:
+        newmask = maskprep.grow(mask,filter.shape) if filter is not None else mask
+        fits.writeto(smaskfile,newmask,header=mhead,output_verify='warn')
     # Convolve the mask file with the convolution kernel to "grow" the regions
     # around bad pixels the SE already does to the weight map
-    if (filter_name != ''):
-        # Load the filter array
-        f = open(filter_name,'r')
-        linenum = 0
-        for line in f:
-            if (linenum == 1):
-                shape = line.split(' ')[1]
-                # Make it two pixels larger
-                filter = np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
-                #filter = np.zeros(np.array(shape.split('x'),dtype='i'),dtype='f')
-            #if (linenum > 1):
-            #    linedata = np.array(line.split(' '),dtype='f')
-            #    filter[:,linenum-2] = linedata
-            linenum += 1
-        f.close()
+    elif filter is not None:
         # Normalize the filter array
         #filter /= np.sum(filter)
         # Convolve with mask
@@ -893,7 +949,7 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     try:
         # Save the SExtractor info to a logfile
         sf = open(logfile,'w')
-        retcode = subprocess.call(["sex",sfluxfile,"-c","default.config"],stdout=sf,stderr=subprocess.STDOUT)
+        retcode = subprocess.call(sexcmd,stdout=sf,stderr=subprocess.STDOUT)
         sf.close()
         if retcode < 0:
             logger.error("Child was terminated by signal"+str(-retcode))
@@ -925,8 +981,8 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
         ind1 = grep(arr,'Background:',index=True)
         ind2 = grep(arr,'RMS',index=True)
         ind3 = grep(arr,'Threshold',index=True)
-        background = np.float(arr[ind1[0]+1])
-        rms = np.float(arr[ind2[0]+1])
+        background = float(arr[ind1[0]+1])
+        rms = float(arr[ind2[0]+1])
         meta["SKYMED"] = (background,"Median sky background")
         meta["SKYRMS"] = (rms,"RMS of sky")
 
@@ -1455,7 +1511,7 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
 
 # DAOPHOT FIND detection
 #-----------------------
-def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None):
+def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,session=None):
     '''
     This runs DAOPHOT FIND on an image.
 
@@ -1475,6 +1531,10 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None):
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     cat : astropy table
@@ -1539,25 +1599,29 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None):
             "EXIT\n" \
             "END_DAOPHOT\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT detection failed:"+str(e))
-        logger.error(e)
-        raise Exception("DAOPHOT failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT detection failed:"+str(e))
+            logger.error(e)
+            raise Exception("DAOPHOT failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1591,7 +1655,7 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None):
         raise Exception("Output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Load and return the catalog
     logger.info("Output file = "+outfile)
@@ -1600,7 +1664,7 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None):
 
 # DAOPHOT aperture photometry
 #----------------------------
-def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,apersfile=None,logfile=None,logger=None):
+def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,apersfile=None,logfile=None,logger=None,session=None):
     '''
     This runs DAOPHOT aperture photometry on an image.
 
@@ -1628,6 +1692,10 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     cat : astropy table
@@ -1724,10 +1792,11 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
             "EXIT\n" \
             "END_DAOPHOT\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
@@ -1742,17 +1811,20 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     else:
         movedpsf = False
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT aperture photometry failed:"+str(e))
-        logger.error(e)
-        raise Exception("DAOPHOT failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT aperture photometry failed:"+str(e))
+            logger.error(e)
+            raise Exception("DAOPHOT failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1772,7 +1844,7 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
                 l1 = l1[0:len(l1)-7]   # strip BELL at end \x07\n
                 lo = l1.find(":")
                 hi = l1.find("+-")
-                maglim = np.float(l1[lo+1:hi])
+                maglim = float(l1[lo+1:hi])
                 logger.info(l1.strip())   # clip leading/trailing whitespace
     # Failure
     else:
@@ -1780,7 +1852,7 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
         raise Exception("Output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Move PSF file back
     if movedpsf is True: os.rename(psftemp,base+".psf")
@@ -1792,7 +1864,7 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
 
 # Pick PSF stars using DAOPHOT
 #-----------------------------
-def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optfile=None,logfile=None,logger=None):
+def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optfile=None,logfile=None,logger=None,session=None):
     '''
     This runs DAOPHOT aperture photometry on an image.
 
@@ -1818,6 +1890,10 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optf
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     cat : astropy table
@@ -1889,25 +1965,29 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optf
             "EXIT\n" \
             "END_DAOPHOT\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PICKPSF failed:"+str(e))
-        logger.error(e)
-        raise Exception("DAOPHOT failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT PICKPSF failed:"+str(e))
+            logger.error(e)
+            raise Exception("DAOPHOT failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1928,7 +2008,7 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optf
         raise Exception("DAOPHOT failed")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Return the catalog
     logger.info("Output file = "+outfile)
@@ -1937,7 +2017,7 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,optf
 
 # Run DAOPHOT PSF
 #-------------------
-def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfile=None,logfile=None,verbose=False,logger=None):
+def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfile=None,logfile=None,verbose=False,logger=None,session=None):
     '''
     This runs DAOPHOT PSF to create a .psf file.
 
@@ -1967,6 +2047,10 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     pararr : list
@@ -2048,25 +2132,29 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
             "EXIT\n" \
             "END_DAOPHOT\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PSF failed:"+str(e))
-        logger.error(e)
-        raise Exception("DAOPHOT failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOPHOT PSF failed:"+str(e))
+            logger.error(e)
+            raise Exception("DAOPHOT failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -2103,7 +2191,7 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
         raise Exception("DAOPHOT output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Return the parameter and profile error information
     logger.info("Output file = "+outfile)
@@ -2113,7 +2201,7 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
 # Subtract neighbors of PSF stars
 #--------------------------------
 def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,psffile=None,
-              nstfile=None,grpfile=None,logfile=None,logger=None):
+              nstfile=None,grpfile=None,logfile=None,logger=None,session=None):
     '''
     This subtracts neighbors of PSF stars so that an improved PSF can be made.
 
@@ -2147,6 +2235,10 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     Nothing is returned.  The subtracted image and logfile will be created.
@@ -2240,25 +2332,29 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
             "EXIT\n" \
             "END_DAOPHOT\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("PSF star neighbor subtracting failed:"+str(e))
-        logger.error(e)
-        raise Exception("PSF subtraction failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("PSF star neighbor subtracting failed:"+str(e))
+            logger.error(e)
+            raise Exception("PSF subtraction failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile):
@@ -2273,7 +2369,7 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
         raise Exception("PSF subtraction failed")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Print final output filename
     logger.info("Output file = "+outfile)
@@ -2282,7 +2378,8 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
 # Create DAOPHOT PSF
 #-------------------
 def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,maxiter=5,minstars=6,nsigrej=2,subneighbors=True,
-              subfile=None,optfile=None,neifile=None,nstfile=None,grpfile=None,meta=None,logfile=None,verbose=False,logger=None):
+              subfile=None,optfile=None,neifile=None,nstfile=None,grpfile=None,meta=None,logfile=None,verbose=False,logger=None,session=None,
+              psfcache=None,cachekey=None,earlystop=True):
     '''
     Iteratively create a DAOPHOT PSF for an image.
 
@@ -2334,6 +2431,20 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+    psfcache : PsfCache, optional
+           Warm-start from the cached PSF of this CCD and seeing (see psfcache.py) and
+           store the new PSF in the cache.  All the analytic models are fit again when
+           the cached one does worse than for the cached PSF (PsfCache.recheck()).
+    cachekey : tuple, optional
+           The (instrument, ccdnum, fwhm in arcsec) cache key, needed with `psfcache`.
+    earlystop : bool, default is True
+           Stop iterating once chi stops improving (psfcache.Convergence) instead of only
+           when it changes by less than 0.002.  If the last iteration made chi worse, the
+           PSF is fit again with the PSF stars of the best iteration.
+
     Returns
     -------
     Nothing is returned.  The PSF, subtracted image and logfile are created.
@@ -2385,6 +2496,10 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
     if os.path.exists(listfile+".orig"): os.remove(listfile+".orig")
     shutil.copy(listfile,listfile+".orig")
 
+    # PSF stars of the iteration with the best chi
+    bestlistfile = listfile+".best"
+    if os.path.exists(bestlistfile): os.remove(bestlistfile)
+
     # Iterate
     #---------
     if doiter is False: maxiter=1
@@ -2392,16 +2507,29 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
     endflag = 0
     lastchi = 99.99
     dchi_thresh = 0.002
+    policy = Convergence(dchi=dchi_thresh) if earlystop else None
+
+    # Warm start, fit only the cached model and start from the cached PSF stars
+    psfoptfile = optfile
+    entry = None
+    if (psfcache is not None) & (cachekey is not None):
+        psfoptfile = base+".warm.opt"
+        entry = psfcache.warmstart(cachekey,optfile,wlistfile,psfoptfile,minstars=minstars)
+        if entry is None: psfoptfile = optfile
+        elif (policy is not None) and entry['exact']: policy.target = entry.get('iterchi')
+
     while (endflag==0):
         logger.info("Iter = "+str(iter))
 
         # Run DAOPSF
         try:
-            pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+            pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,optfile=psfoptfile,logger=logger,session=session)
             chi = np.min(parchi)
         except:
             logger.error("Failure in DAOPSF")
             raise
+        if (policy is not None) and ((policy.best is None) or (chi < policy.best)):
+            shutil.copy(wlistfile,bestlistfile)
 
         # Check for bad stars
         nstars = len(profs)
@@ -2429,15 +2557,52 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
             logger.info("  Removing IDs="+str(" ".join(profs[bdstars]['ID'].astype(str))))
             logger.info("  "+str(nbdstars)+" bad stars removed. "+str(nstars-nbdstars)+" PSF stars left")
         # Should we end
-        if (iter==maxiter) | (nbdstars==0) | (nstars<=minstars) | (np.abs(lastchi-chi)<dchi_thresh): endflag=1
+        if policy is not None:
+            if (iter==maxiter) | (nbdstars==0) | (nstars<=minstars) | policy.update(chi): endflag=1
+        else:
+            if (iter==maxiter) | (nbdstars==0) | (nstars<=minstars) | (np.abs(lastchi-chi)<dchi_thresh): endflag=1
         iter = iter+1
         lastchi = chi
+    niter = iter-1
+    iterchi = lastchi
+    if (policy is not None) and (policy.reason is not None):
+        logger.info("Stopped after "+str(niter)+" iterations, "+policy.reason)
+
+    # Chi got worse in the last iteration, go back to the PSF stars of the best one
+    if (policy is not None) and (chi > policy.best):
+        logger.info("Chi="+str(chi)+" is worse than the best chi="+str(policy.best)+", fitting again with those PSF stars")
+        shutil.copy(bestlistfile,wlistfile)
+        try:
+            pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,optfile=psfoptfile,logger=logger,session=session)
+            chi = np.min(parchi)
+        except:
+            logger.error("Failure in DAOPSF")
+            raise
+        iterchi = chi
+    if os.path.exists(bestlistfile): os.remove(bestlistfile)
+
+    # Fit all of the analytic models again if the cached one does worse here than
+    #  for the cached PSF, or was carried over too many times
+    recheck = False
+    if (entry is not None) and psfcache.recheck(entry,iterchi):
+        logger.info("Warm chi="+str(iterchi)+" with "+entry['model']+" (cached chi="+str(entry.get('iterchi'))+
+                    ", used "+str(entry.get('nwarm',0))+" times), fitting all PSF models again")
+        psfcache.nrecheck += 1
+        recheck = True
+        psfoptfile = optfile
+        try:
+            pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,optfile=psfoptfile,logger=logger,session=session)
+            chi = np.min(parchi)
+        except:
+            logger.error("Failure in DAOPSF")
+            raise
+        iterchi = chi
 
     # Subtract PSF star neighbors
     if subneighbors:
         subfile = base+"a.fits"
         try:
-            subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger)
+            subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger,session=session)
         except:
             logger.error("Subtracting neighbors failed.  Keeping original PSF file")
         # Check that the subtracted image exist and rerun DAOPSF
@@ -2445,16 +2610,27 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
             # Final run of DAOPSF
             logger.info("Final DAOPSF run")
             try:
-                pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,optfile=psfoptfile,logger=logger,session=session)
                 chi = np.min(parchi)
             except:
                 logger.error("Failure in DAOPSF")
                 raise
 
+    # Store in the PSF cache
+    if (psfcache is not None) & (cachekey is not None):
+        gdstars = (profs['FLAG'] != 'saturated')
+        # Number of times in a row the model was carried over from the cache
+        nwarm = entry.get('nwarm',0)+1 if (entry is not None) and (recheck is False) else 0
+        psfcache.put(cachekey[0],cachekey[1],cachekey[2],psffile,wlistfile,chi=chi,iterchi=iterchi,
+                     medsig=np.median(profs['SIG'][gdstars]),niter=niter,nstars=len(profs),nwarm=nwarm)
+    if os.path.exists(base+".warm.opt"): os.remove(base+".warm.opt")
+
     # Put information in meta
     if meta is not None:
         meta['PSFCHI'] = (chi,"Final PSF Chi value")
         meta['PSFSTARS'] = (len(profs),"Number of PSF stars")
+        meta['PSFITER'] = (niter,"Number of PSF star rejection iterations")
+        meta['PSFWARM'] = (entry is not None,"PSF warm-started from the PSF cache")
 
     # Copy working list to final list
     if os.path.exists(listfile): os.remove(listfile)
@@ -2464,7 +2640,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
 
 # Run ALLSTAR
 #-------------
-def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfile=None,meta=None,logfile=None,logger=None):
+def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfile=None,meta=None,logfile=None,logger=None,session=None):
     '''
     Run DAOPHOT ALLSTAR on an image.
 
@@ -2494,6 +2670,10 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     cat : astropy table
@@ -2552,7 +2732,7 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
     os.symlink(psffile,tpsffile)
 
     # Load the option file lines
-    optlines = readlines(optfile)
+    optlines = readlines(optfile,raw=True)   # keep the newlines, one option per line
     # Lines for the DAOPHOT ALLSTAR script
     lines = ["#!/bin/sh\n",
              "allstar << END_ALLSTAR >> "+logfile+"\n"]
@@ -2567,25 +2747,29 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
               "EXIT\n",
               "END_ALLSTAR\n"]
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
     # Copy option file to daophot.opt
     if os.path.exists("allstar.opt") is False: shutil.copyfile(optfile,"allstar.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
-        if retcode < 0:
-            logger.warning("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.warning("ALLSTAR failed:"+str(e))
-        logger.warning(e)
-        raise Exception("ALLSTAR failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+            if retcode < 0:
+                logger.warning("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.warning("ALLSTAR failed:"+str(e))
+            logger.warning(e)
+            raise Exception("ALLSTAR failed")
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -2604,7 +2788,7 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
         raise Exception("ALLSTAR failed")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Put information in the header
     if meta is not None:
@@ -2616,7 +2800,7 @@ def allstar(imfile=None,psffile=None,apfile=None,subfile=None,outfile=None,optfi
 
 # Calculate aperture corrections
 #-------------------------------
-def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=None,logger=None):
+def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=None,logger=None,session=None):
     '''
     Run DAOGROW that calculates curve of growths using aperture photometry.
 
@@ -2641,6 +2825,10 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
     logger : logging object
            The logger to use for the logging information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     totcat : astropy table
@@ -2733,22 +2921,26 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
             ""+str(maxerr)+"\n" \
             "DONE\n"
     # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    if session is None:
+        f = open(scriptfile,'w')
+        f.writelines(lines)
+        f.close()
+        os.chmod(scriptfile,509)
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOGROW failed:"+str(e))
-        logger.error(e)
-        raise Exception("DAOGROW failed")
+    # Run the script, or send its lines to the session
+    if session is not None:
+        session.runscript(lines,logfile)
+    else:
+        try:
+            retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
+            if retcode < 0:
+                logger.error("Child was terminated by signal"+str(-retcode))
+            else:
+                pass
+        except OSError as e:
+            logger.error("DAOGROW failed:"+str(e))
+            logger.error(e)
+            raise Exception("DAOGROW failed")
 
     # Check that the outfile file exists
     if os.path.exists(toutfile) is True:
@@ -2767,7 +2959,7 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
         raise Exception("Output not found")
 
     # Delete the script
-    os.remove(scriptfile)
+    if os.path.exists(scriptfile): os.remove(scriptfile)
 
     # Load and return the catalog
     logger.info("Output file = "+outfile)
@@ -2778,7 +2970,7 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
 
 # Calculate aperture corrections
 #-------------------------------
-def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None):
+def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None,session=None):
     '''
     Calculate the aperture correction for an image.
 
@@ -2802,6 +2994,10 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
     logger : logging object
            The logger to use for the loggin information.
 
+    session : DaoSession, optional
+           Send the commands to this persistent DAOPHOT/ALLSTAR session (see daosession.py)
+           instead of writing a script and starting a new process.
+
     Returns
     -------
     apcor : float
@@ -2858,23 +3054,23 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
     apertures = [3.0, 3.7965, 4.8046, 6.0803, 7.6947, 9.7377, 12.3232, 15.5952, 19.7360, \
                  24.9762, 31.6077, 40.0000, 50.0000]
     apersfile = base+".apers"
-    apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,apersfile=apersfile,logger=logger)
+    apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,apersfile=apersfile,logger=logger,session=session)
 
     # Step 2: Get PSF photometry from the same image
-    psfcat = allstar(imfile,psffile,base+".ap",optfile=alsoptfile,logger=logger)
+    psfcat = allstar(imfile,psffile,base+".ap",optfile=alsoptfile,logger=logger,session=session)
 
     # Step 3: Run DAOGROW
     #  it creates a .tot, .cur, .poi files
     #  use .tot and .als files to calculate delta mag for each star (see mkdel.pro)
     #  and then a total aperture correction for all the stars.
-    totcat = daogrow(base+".ap",apersfile,meta,logger=logger)
+    totcat = daogrow(base+".ap",apersfile,meta,logger=logger,session=session)
     # Check that the magnitudes arent' all NANs, this can sometimes happen
     if np.sum(np.isnan(totcat['MAG'])) > 0:
         logger.info("DAOGROW .tot file has NANs.  Trying 2 free parameters instead.")
-        totcat = daogrow(base+".ap",apersfile,meta,nfree=2,logger=logger)
+        totcat = daogrow(base+".ap",apersfile,meta,nfree=2,logger=logger,session=session)
     if np.sum(np.isnan(totcat['MAG'])) > 0:
         logger.info("DAOGROW .tot file has NANs.  Trying 4 free parameters instead.")
-        totcat = daogrow(base+".ap",apersfile,meta,nfree=4,logger=logger)
+        totcat = daogrow(base+".ap",apersfile,meta,nfree=4,logger=logger,session=session)
 
     # Step 4: Calculate median aperture correction
     totcat = daoread(base+".tot")
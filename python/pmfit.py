@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+# Batched weighted proper-motion solver.
+# This fits the proper motions of many objects at once from flat arrays of
+# measurements, instead of calling dln.robust_slope() for every object and axis.
+# The slopes are closed-form weighted least-squares fits and the outliers are
+# downweighted with a fixed number of vectorized reweighting iterations
+# (same reweighting as dln.wtslope(reweight=True), Stetson 1996).
+# robustsolve() takes the same arrays and runs dln.robust_slope() per object,
+# the estimator of the database mode of fix_pms.
+
+import numpy as np
+import time
+from argparse import ArgumentParser
+from dlnpyutils import utils as dln
+
+def segslope(lo,num,x,y,sigma,niter=1):
+    """ Weighted least-squares slope of Y vs. X for each segment of label-sorted arrays.
+
+    Parameters
+    ----------
+    lo : numpy array
+       Start index of each segment.
+    num : numpy array
+       Number of elements in each segment.
+    x, y, sigma : numpy array
+       The data and uncertainties, sorted by segment.
+    niter : int, optional
+       Number of reweighting iterations.  Default is 1, which is the
+       same as dln.wtslope(reweight=True).
+
+    Returns
+    -------
+    slope : numpy array
+       The slope for each segment.
+    slperr : numpy array
+       Uncertainty in the slope for each segment.
+
+    """
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        wt = 1/sigma**2
+        totwt = np.add.reduceat(wt,lo)
+        mnx = np.add.reduceat(wt*x,lo)/totwt
+        mny = np.add.reduceat(wt*y,lo)/totwt
+        sumwtxx = np.add.reduceat(wt*x**2,lo)
+        slope = (np.add.reduceat(wt*x*y,lo)/totwt-mnx*mny)/(sumwtxx/totwt-mnx**2)
+        slperr = 1.0/np.sqrt(sumwtxx-mnx**2*totwt)
+        # Reweight the points based on the residuals
+        mnsigma = np.repeat(np.add.reduceat(sigma,lo)/num,num)
+        for i in range(niter):
+            resid = y-np.repeat(slope,num)*x
+            resid -= np.repeat(np.add.reduceat(resid,lo)/num,num)
+            wt2 = wt/(1+np.abs(resid)**2/mnsigma)
+            totwt2 = np.add.reduceat(wt2,lo)
+            mnx2 = np.add.reduceat(wt2*x,lo)/totwt2
+            mny2 = np.add.reduceat(wt2*y,lo)/totwt2
+            slope = (np.add.reduceat(wt2*x*y,lo)/totwt2-mnx2*mny2)/(np.add.reduceat(wt2*x**2,lo)/totwt2-mnx2**2)
+    # Degenerate segments, e.g. all measurements at the same time
+    bad = ~np.isfinite(slope) | ~np.isfinite(slperr) | (num<2)
+    slope[bad] = np.nan
+    slperr[bad] = np.nan
+    return slope, slperr
+
+def pmsolve(objlabel,mjd,ra,dec,raerr,decerr,objdec=None,niter=1):
+    """ Measure proper motions for many objects at once.
+
+    Parameters
+    ----------
+    objlabel : numpy array
+       Object label for each measurement.
+    mjd : numpy array
+       MJD for each measurement.
+    ra, dec : numpy array
+       Coordinates of each measurement in degrees.
+    raerr, decerr : numpy array
+       Coordinate uncertainties in arcsec.
+    objdec : numpy array, optional
+       Mean declination of each object (in sorted label order) used for the
+       cos(dec) correction.  By default the weighted mean of DEC is used.
+    niter : int, optional
+       Number of reweighting iterations.  Default is 1, which is the
+       same as dln.wtslope(reweight=True).
+
+    Returns
+    -------
+    out : numpy structured array
+       One element per unique label (sorted) with LABEL, NDET, PMRA, PMRAERR,
+       PMDEC and PMDECERR in mas/yr.  Objects with only one measurement have NaN.
+
+    """
+
+    out,seg = relpos(objlabel,mjd,ra,dec,raerr,decerr,objdec=objdec)
+    if seg is None:
+        return out
+    lo,num,t,dra,ddec,sraerr,sdecerr = seg
+
+    # Only fit objects with multiple measurements
+    out['pmra'], out['pmraerr'] = segslope(lo,num,t,dra,sraerr,niter=niter)
+    out['pmdec'], out['pmdecerr'] = segslope(lo,num,t,ddec,sdecerr,niter=niter)
+
+    return out
+
+
+def robustsolve(objlabel,mjd,ra,dec,raerr,decerr,objdec=None):
+    """ Measure proper motions with dln.robust_slope(reweight=True), one object at a time.
+
+    Same inputs and output as pmsolve().  This is the estimator of the
+    database mode of fix_pms.
+    """
+    out,seg = relpos(objlabel,mjd,ra,dec,raerr,decerr,objdec=objdec)
+    if seg is None:
+        return out
+    lo,num,t,dra,ddec,sraerr,sdecerr = seg
+    for c in ['pmra','pmraerr','pmdec','pmdecerr']:
+        out[c] = np.nan
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for i in np.flatnonzero(num>1):
+            sl = slice(lo[i],lo[i]+num[i])
+            out['pmra'][i], out['pmraerr'][i] = dln.robust_slope(t[sl],dra[sl],sraerr[sl],reweight=True)
+            out['pmdec'][i], out['pmdecerr'][i] = dln.robust_slope(t[sl],ddec[sl],sdecerr[sl],reweight=True)
+    # Degenerate objects, e.g. all measurements at the same time
+    for c in ['pmra','pmdec']:
+        bad = ~np.isfinite(out[c]) | ~np.isfinite(out[c+'err'])
+        out[c][bad] = np.nan
+        out[c+'err'][bad] = np.nan
+    return out
+
+
+def relpos(objlabel,mjd,ra,dec,raerr,decerr,objdec=None):
+    """ Sort measurements by object and get the positions and times relative to the object means.
+
+    Returns the output array of pmsolve() with LABEL and NDET filled in,
+    and (LO, NUM, T, DRA, DDEC, RAERR, DECERR) with the segment starts and
+    sizes, the times in years and the positions and errors in mas, or None
+    if there are no measurements.
+    """
+
+    radeg = np.float64(180.00) / np.pi
+    objlabel = np.atleast_1d(objlabel)
+    nmeas = len(objlabel)
+    dtype_pm = np.dtype([('label',objlabel.dtype),('ndet',int),('pmra',np.float64),('pmraerr',np.float64),
+                         ('pmdec',np.float64),('pmdecerr',np.float64)])
+    if nmeas==0:
+        return np.zeros(0,dtype=dtype_pm),None
+
+    # Sort by object
+    si = np.argsort(objlabel,kind='stable')
+    slabel = objlabel[si]
+    brk = np.flatnonzero(slabel[1:] != slabel[0:-1])+1
+    lo = np.hstack((0,brk))
+    num = np.diff(np.hstack((lo,nmeas)))
+    nobj = len(lo)
+    out = np.zeros(nobj,dtype=dtype_pm)
+    out['label'] = slabel[lo]
+    out['ndet'] = num
+
+    t = np.array(mjd,np.float64)[si]
+    sra = np.array(ra,np.float64)[si]
+    sdec = np.array(dec,np.float64)[si]
+    sraerr = np.array(raerr,np.float64)[si]*1e3     # milli arcsec
+    sdecerr = np.array(decerr,np.float64)[si]*1e3   # milli arcsec
+
+    # Mean declination for the cos(dec) term
+    if objdec is None:
+        with np.errstate(divide='ignore',invalid='ignore'):
+            wt_dec = 1.0/sdecerr**2
+            objdec = np.add.reduceat(sdec*wt_dec,lo)/np.add.reduceat(wt_dec,lo)
+        objdec = np.where(np.isfinite(objdec),objdec,sdec[lo])
+
+    # Relative positions, handle RA=0 wrap
+    dra = sra-np.repeat(sra[lo],num)
+    dra = (dra+180) % 360 - 180
+    dra -= np.repeat(np.add.reduceat(dra,lo)/num,num)
+    dra *= 3600*1e3 * np.cos(np.repeat(objdec,num)/radeg)   # convert to true angle, milli arcsec
+    ddec = sdec-np.repeat(np.add.reduceat(sdec,lo)/num,num)
+    ddec *= 3600*1e3                                        # convert to milli arcsec
+    t -= np.repeat(np.add.reduceat(t,lo)/num,num)
+    t /= 365.2425                                           # convert to year
+
+    return out,(lo,num,t,dra,ddec,sraerr,sdecerr)
+
+
+def simmoving(nobj=5000,nmeas=20,pmsig=20.0,outfrac=0.05,seed=0):
+    """ Simulate measurements of moving sources."""
+    rnd = np.random.RandomState(seed)
+    radeg = np.float64(180.00) / np.pi
+    ndet = rnd.randint(3,nmeas+1,nobj)
+    objlabel = np.repeat(np.arange(nobj),ndet)
+    n = len(objlabel)
+    ra0 = rnd.rand(nobj)*360
+    dec0 = rnd.rand(nobj)*120-60
+    pmra = rnd.randn(nobj)*pmsig      # mas/yr
+    pmdec = rnd.randn(nobj)*pmsig
+    mjd = 56000+rnd.rand(n)*2500
+    raerr = 0.005+rnd.rand(n)*0.05    # arcsec
+    decerr = 0.005+rnd.rand(n)*0.05
+    dt = (mjd-56000)/365.2425
+    ra = ra0[objlabel] + (pmra[objlabel]*dt + rnd.randn(n)*raerr*1e3)/3.6e6/np.cos(dec0[objlabel]/radeg)
+    dec = dec0[objlabel] + (pmdec[objlabel]*dt + rnd.randn(n)*decerr*1e3)/3.6e6
+    # Outliers
+    bd = rnd.rand(n) < outfrac
+    dec[bd] += rnd.randn(np.sum(bd))*10*decerr[bd]/3600
+    ra[bd] += rnd.randn(np.sum(bd))*10*raerr[bd]/3600
+    ra = ra % 360
+    si = rnd.permutation(n)
+    return {'objlabel':objlabel[si],'mjd':mjd[si],'ra':ra[si],'dec':dec[si],'raerr':raerr[si],'decerr':decerr[si],
+            'pmra':pmra,'pmdec':pmdec}
+
+def compare(nobj=5000,nmeas=20,niter=1,seed=0,wttol=1e-6,mednsig=0.75):
+    """ Compare the batched solver to dln.wtslope() and dln.robust_slope() on simulated
+    moving sources.
+
+    The batched solver is the vectorized dln.wtslope(reweight=True), with niter=1 the
+    slopes have to agree to WTTOL times the uncertainty and the uncertainties to 1e-10
+    relative.  dln.robust_slope() (what fix_pms used) is a different estimator, a grid
+    search of the L1 loss, so its slopes only agree statistically: the median
+    |batch-robust|/err has to be below MEDNSIG (~0.45 on the default simulation, the
+    90th percentile is ~2) and the batched slopes have to be at least as close to the
+    true proper motions (median, 5% margin).  Returns a dictionary with 'ok'.
+    """
+
+    radeg = np.float64(180.00) / np.pi
+    sim = simmoving(nobj,nmeas,seed=seed)
+
+    # Batched solver
+    t0 = time.time()
+    pm = pmsolve(sim['objlabel'],sim['mjd'],sim['ra'],sim['dec'],sim['raerr'],sim['decerr'],niter=niter)
+    dt_batch = time.time()-t0
+
+    # One object at a time with wtslope and robust_slope
+    t0 = time.time()
+    index = dln.create_index(sim['objlabel'])
+    nobj1 = len(index['value'])
+    rpm = np.zeros(nobj1,dtype=pm.dtype)
+    wpm = np.zeros(nobj1,dtype=pm.dtype)
+    for i in range(nobj1):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        raerr = np.array(sim['raerr'][indx]*1e3,np.float64)
+        ra = np.array(sim['ra'][indx],np.float64)
+        ra -= np.mean(ra)
+        wt = 1/sim['decerr'][indx]**2
+        ra *= 3600*1e3 * np.cos(np.sum(sim['dec'][indx]*wt)/np.sum(wt)/radeg)
+        t = sim['mjd'][indx].copy()
+        t -= np.mean(t)
+        t /= 365.2425
+        rpm['pmra'][i], rpm['pmraerr'][i] = dln.robust_slope(t,ra,raerr,reweight=True)
+        wpm['pmra'][i], wpm['pmraerr'][i] = dln.wtslope(t,ra,raerr,error=True,reweight=True)
+        decerr = np.array(sim['decerr'][indx]*1e3,np.float64)
+        dec = np.array(sim['dec'][indx],np.float64)
+        dec -= np.mean(dec)
+        dec *= 3600*1e3
+        rpm['pmdec'][i], rpm['pmdecerr'][i] = dln.robust_slope(t,dec,decerr,reweight=True)
+        wpm['pmdec'][i], wpm['pmdecerr'][i] = dln.wtslope(t,dec,decerr,error=True,reweight=True)
+    dt_robust = time.time()-t0
+
+    print('per object:   %8.2f sec' % dt_robust)
+    print('pmsolve:      %8.3f sec' % dt_batch)
+    print('speed-up:     %8.1f' % (dt_robust/dt_batch))
+    out = {'dt_robust':dt_robust,'dt_batch':dt_batch}
+    ok = True
+    for c in ['pmra','pmdec']:
+        # Same estimator as wtslope(reweight=True)
+        wtnsig = np.max(np.abs(pm[c]-wpm[c])/wpm[c+'err'])
+        # Difference relative to the uncertainty
+        nsig = np.abs(pm[c]-rpm[c])/rpm[c+'err']
+        errdiff = np.nanmax(np.abs(pm[c+'err']-rpm[c+'err'])/rpm[c+'err'])
+        truediff_batch = np.median(np.abs(pm[c]-sim[c]))
+        truediff_robust = np.median(np.abs(rpm[c]-sim[c]))
+        print('%-6s max |batch-wtslope|/err = %g' % (c,wtnsig))
+        print('%-6s median |batch-robust|/err = %6.3f  90th percentile = %6.3f  max relative err diff = %g' %
+              (c,np.median(nsig),np.percentile(nsig,90),errdiff))
+        print('%-6s median |fit-true| batch = %6.3f  robust = %6.3f mas/yr' % (c,truediff_batch,truediff_robust))
+        out[c+'_wtnsig'] = wtnsig
+        out[c+'_mednsig'] = np.median(nsig)
+        out[c+'_errdiff'] = errdiff
+        if niter == 1: ok &= (wtnsig < wttol)
+        ok &= (errdiff < 1e-10) & (np.median(nsig) < mednsig) & (truediff_batch <= 1.05*truediff_robust)
+    out['ok'] = bool(ok)
+    print('PASSED' if ok else 'FAILED')
+    return out
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Compare the batched proper motion solver to robust_slope.')
+    parser.add_argument('--nobj', type=int, default=5000, help='Number of objects')
+    parser.add_argument('--nmeas', type=int, default=20, help='Maximum number of measurements per object')
+    parser.add_argument('--niter', type=int, default=1, help='Number of reweighting iterations')
+    args = parser.parse_args()
+    compare(args.nobj,args.nmeas,args.niter)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+# Local-data proper-motion refit for fix_pms.py.
+#
+# fix_pms() gets the measurements of a pixel from the datalab database
+# (nsc_dr2.meas joined to nsc_dr2.object, one sub-pixel at a time) and then
+# refits the proper motions object by object.  That needs the database to
+# be up and it is the bottleneck.  Here the measurements are read straight
+# from the combine products on disk instead:
+#
+#  - the PIX_idstr.db database next to the object catalog (or the
+#    PIX_nNSIDE_SUBPIX_idstr.db ones of a split pixel), or the pixel's
+#    segments of the idstr store (idstore.py) if the combine used --iddir,
+#    give the exposures and the measid -> objectid mapping,
+#  - the RA/RAERR/DEC/DECERR/MJD come from the exposure measurement
+#    catalogs, EXP_meas.fits.gz written by
+#    nsc_instcal_combine_update_meas.py or the chip-level EXP_CCDNUM_meas.fits
+#    files before that.  They are read in a thread pool.
+#
+# The proper motions of all the objects in the pixel are then refit with
+# the same estimator as the database mode, dln.robust_slope() per object
+# (pmfit.robustsolve()), or with the batched pmfit.pmsolve() for --batch.
+# "python pmlocal.py" runs fix_pms() in this mode end-to-end on small
+# synthetic pixels, no database needed.
+
+import os
+import sys
+import numpy as np
+import time
+import shutil
+import tempfile
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from astropy.io import fits
+from astropy.table import Table
+from dlnpyutils import utils as dln
+import dbsession
+import idstore
+import pmfit
+
+# Same as the output of fix_pms.get_meas()
+dtype_meas = np.dtype([('objectid',(str,50)),('ra',np.float64),('raerr',float),
+                       ('dec',np.float64),('decerr',float),('mjd',np.float64)])
+
+def idstrfiles(hdir,pix):
+    """ IDSTR databases of a pixel, the split high-resolution ones if there are no others."""
+    dbfile = os.path.join(hdir,str(pix)+'_idstr.db')
+    if os.path.exists(dbfile):
+        return [dbfile]
+    return sorted(glob(os.path.join(hdir,str(pix)+'_n*_idstr.db')))
+
+def readidstr(dbfiles):
+    """ Read and concatenate the measid, exposure and objectid columns of IDSTR databases.
+
+    Measurements that appear more than once (e.g. in the buffer of two
+    subpixels) are only returned once.
+    """
+    dtype = np.dtype([('measid',(str,50)),('exposure',(str,50)),('objectid',(str,50))])
+    cats = []
+    for dbfile in dbfiles:
+        sess = dbsession.getsession(dbfile)
+        cats.append(sess.queryarray('SELECT measid,exposure,objectid FROM idstr',dtype))
+        dbsession.closesession(dbfile)
+    if len(cats)==0:
+        return np.zeros(0,dtype=dtype)
+    return uniqmeas(np.hstack(cats))
+
+def readstore(iddir,pix):
+    """ Read the measid, exposure and objectid columns of a pixel from the idstr store."""
+    store = idstore.IdStore(iddir)
+    idstr = uniqmeas(store.getpixel(pix))
+    store.close()
+    return idstr
+
+def uniqmeas(idstr):
+    """ Only keep the first row of each measid."""
+    _,ui = np.unique(idstr['measid'],return_index=True)
+    if len(ui)<len(idstr):
+        idstr = idstr[np.sort(ui)]
+    return idstr
+
+def expmeasfiles(measdir,instrument,dateobs,exposure):
+    """ Measurement catalogs of an exposure, the exposure-level one or else the chip-level ones."""
+    night = dateobs[0:4]+dateobs[5:7]+dateobs[8:10]
+    expdir = os.path.join(measdir,instrument,night,exposure)
+    for f in [expdir+'/'+exposure+'_meas.fits.gz',expdir+'/'+exposure+'_meas.fits']:
+        if os.path.exists(f):
+            return [f]
+    return sorted(glob(expdir+'/'+exposure+'_*_meas.fits'))
+
+def readexposure(files,measid,objectid):
+    """ Read the measurements with MEASID from exposure measurement catalogs.
+
+    OBJECTID is the object of each MEASID.  Returns the matched measurements.
+    """
+    out = []
+    for f in files:
+        cat = fits.getdata(f,1)
+        cmeasid = np.char.strip(cat['MEASID'])
+        if cmeasid.dtype.kind=='S': cmeasid=np.char.decode(cmeasid)
+        ind1,ind2 = dln.match(measid,cmeasid)
+        if len(ind1)==0: continue
+        meas1 = np.zeros(len(ind1),dtype=dtype_meas)
+        meas1['objectid'] = objectid[ind1]
+        for c in ['ra','raerr','dec','decerr','mjd']:
+            meas1[c] = cat[c.upper()][ind2]
+        out.append(meas1)
+    if len(out)==0:
+        return np.zeros(0,dtype=dtype_meas)
+    return np.hstack(out)
+
+def getmeas(pix,meta,hdir,measdir,nthreads=4,iddir=None,verbose=True):
+    """ Get the measurements of a pixel from the combine products on disk.
+
+    Parameters
+    ----------
+    pix : int or str
+       HEALPix pixel of the object catalog.
+    meta : table
+       Exposure summary table of the object catalog (first extension), with
+       BASE, INSTRUMENT and DATEOBS columns.
+    hdir : str
+       Directory of the object catalog and its IDSTR database(s).
+    measdir : str
+       Root directory of the exposure measurement catalogs,
+       MEASDIR/INSTRUMENT/NIGHT/EXPOSURE/.
+    nthreads : int, optional
+       Number of reader threads.  Default is 4.
+    iddir : str, optional
+       Directory of the idstr store to read the pixel's idstr from instead of
+       the IDSTR databases in HDIR.
+    verbose : bool, optional
+       Verbose output.  Default is True.
+
+    Returns
+    -------
+    meas : numpy structured array
+       OBJECTID, RA, RAERR, DEC, DECERR and MJD of the measurements, like
+       fix_pms.get_meas().
+
+    """
+
+    t0 = time.time()
+    if iddir is not None:
+        idstr = readstore(iddir,pix)
+        source = 'the idstr store '+iddir
+    else:
+        dbfiles = idstrfiles(hdir,pix)
+        if len(dbfiles)==0:
+            raise ValueError('No IDSTR database for '+str(pix)+' in '+hdir)
+        idstr = readidstr(dbfiles)
+        source = str(len(dbfiles))+' IDSTR database(s)'
+    if len(idstr)==0:
+        return np.zeros(0,dtype=dtype_meas)
+    eindex = dln.create_index(idstr['exposure'])
+    nexp = len(eindex['value'])
+    if verbose: print(str(len(idstr))+' measurements in '+str(nexp)+' exposures from '+source)
+
+    # Exposure directories from the summary table
+    base = np.char.strip(np.array(meta['base']).astype(str))
+    ind1,ind2 = dln.match(eindex['value'],base)
+    if len(ind1)<nexp and verbose:
+        print(str(nexp-len(ind1))+' exposures are not in the summary table')
+
+    def loadone(k):
+        i = ind1[k]
+        m = ind2[k]
+        files = expmeasfiles(measdir,str(meta['instrument'][m]).strip(),str(meta['dateobs'][m]).strip(),eindex['value'][i])
+        if len(files)==0:
+            if verbose: print(eindex['value'][i]+' measurement catalogs NOT FOUND')
+            return np.zeros(0,dtype=dtype_meas)
+        indx = eindex['index'][eindex['lo'][i]:eindex['hi'][i]+1]
+        return readexposure(files,idstr['measid'][indx],idstr['objectid'][indx])
+
+    with ThreadPoolExecutor(max(1,nthreads)) as executor:
+        out = list(executor.map(loadone,range(len(ind1))))
+    meas = np.hstack(out) if len(out)>0 else np.zeros(0,dtype=dtype_meas)
+    if verbose: print('Loaded '+str(len(meas))+' measurements in '+str(time.time()-t0)+' seconds')
+    return meas
+
+def refit(obj,meas,batch=False):
+    """ Refit the proper motions of all the objects.
+
+    OBJ is updated in place for objects with more than one measurement.
+    The slopes come from dln.robust_slope() like the database mode of
+    fix_pms, or from the batched solver if BATCH is set.  Returns the
+    number of measurements of each object.
+    """
+    nobj = len(obj)
+    ndet = np.zeros(nobj,int)
+    if len(meas)==0:
+        return ndet
+    # Object index of each measurement
+    objectid = np.char.strip(np.array(obj['objectid']).astype(str))
+    si = np.argsort(objectid)
+    pos = np.minimum(np.searchsorted(objectid[si],meas['objectid']),nobj-1)
+    gd, = np.where(objectid[si][pos]==meas['objectid'])
+    if len(gd)<len(meas):
+        print(str(len(meas)-len(gd))+' measurements do not belong to objects in this pixel')
+    if len(gd)==0:
+        return ndet
+    label = si[pos[gd]]
+    solve = pmfit.pmsolve if batch else pmfit.robustsolve
+    pm = solve(label,meas['mjd'][gd],meas['ra'][gd],meas['dec'][gd],
+               meas['raerr'][gd],meas['decerr'][gd],
+               objdec=np.array(obj['dec'])[np.unique(label)])
+    ndet[pm['label']] = pm['ndet']
+    gdpm = pm['ndet']>1
+    for n in ['pmra','pmraerr','pmdec','pmdecerr']:
+        obj[n][pm['label'][gdpm]] = pm[n][gdpm]
+    return ndet
+
+
+def simpixel(combdir,measdir,pix,nobj=2000,nexp=20,nother=200,pmsig=20.0,seed=0):
+    """ Write synthetic combine products of a pixel with moving objects.
+
+    The object catalog and IDSTR database go into COMBDIR/PIX//1000/, the
+    exposure measurement catalogs (with some measurements of objects of
+    other pixels) into MEASDIR/INSTRUMENT/NIGHT/EXPOSURE/.  Returns the
+    true proper motions.
+    """
+    rnd = np.random.RandomState(seed)
+    radeg = np.float64(180.00) / np.pi
+    hdir = os.path.join(combdir,str(int(pix)//1000))
+    if os.path.exists(hdir) is False: os.makedirs(hdir)
+
+    # Exposures
+    meta = Table()
+    night = 20130101+np.arange(nexp)
+    meta['base'] = ['c4d_%d_%06d_ooi_g_v1' % (night[i]%1000000,int(pix)*1000+i) for i in range(nexp)]
+    meta['instrument'] = 'c4d'
+    meta['dateobs'] = ['%d-%02d-%02dT03:00:00' % (2013+i//12,i%12+1,1+i%28) for i in range(nexp)]
+    meta['mjd'] = 56293.0+np.arange(nexp)*60+rnd.rand(nexp)
+    meta['nobjects'] = 0
+    meta['healpix'] = int(pix)
+
+    # Objects
+    dtype_obj = np.dtype([('objectid',(str,50)),('pix',int),('ra',np.float64),('dec',np.float64),('ndet',int),
+                          ('pmra',np.float32),('pmraerr',np.float32),('pmdec',np.float32),('pmdecerr',np.float32)])
+    obj = np.zeros(nobj,dtype=dtype_obj)
+    obj['objectid'] = [str(pix)+'.'+str(i+1) for i in range(nobj)]
+    obj['pix'] = int(pix)
+    obj['ra'] = 120+rnd.rand(nobj)*0.5
+    obj['dec'] = -30+rnd.rand(nobj)*0.5
+    obj['pmra'] = 999999.    # the values to correct
+    obj['pmdec'] = 999999.
+    pmra = rnd.randn(nobj)*pmsig     # mas/yr
+    pmdec = rnd.randn(nobj)*pmsig
+    detected = rnd.rand(nobj,nexp)<0.7
+    detected[:,0] = True
+    oind,eind = np.where(detected)
+    keep = (oind!=0) | (eind==0)     # a single detection
+    oind,eind = oind[keep],eind[keep]
+    obj['ndet'] = np.bincount(oind,minlength=nobj)
+    n = len(oind)
+    dt = (meta['mjd'][eind]-56293.0)/365.2425
+    raerr = (0.005+rnd.rand(n)*0.05).astype(np.float32).astype(float)    # arcsec, float32 like the catalogs
+    decerr = (0.005+rnd.rand(n)*0.05).astype(np.float32).astype(float)
+    ra = obj['ra'][oind] + (pmra[oind]*dt + rnd.randn(n)*raerr*1e3)/3.6e6/np.cos(obj['dec'][oind]/radeg)
+    dec = obj['dec'][oind] + (pmdec[oind]*dt + rnd.randn(n)*decerr*1e3)/3.6e6
+    measid = np.array([meta['base'][e]+'.'+str(i) for i,e in enumerate(eind)])
+    objectid = obj['objectid'][oind]
+
+    # IDSTR database, same schema as writeidstr2db()
+    dbfile = os.path.join(hdir,str(pix)+'_idstr.db')
+    if os.path.exists(dbfile): os.remove(dbfile)
+    sess = dbsession.getsession(dbfile)
+    sess.execute('''CREATE TABLE idstr(measid TEXT, exposure TEXT, objectid TEXT, objectindex INTEGER)''')
+    sess.insert('idstr',['measid','exposure','objectid','objectindex'],[measid,np.array(meta['base'])[eind],objectid,oind])
+    dbsession.closesession(dbfile)
+
+    # Exposure measurement catalogs, with measurements of other pixels
+    for e in range(nexp):
+        ind, = np.where(eind==e)
+        nmeas = len(ind)+nother
+        cat = Table()
+        cat['MEASID'] = np.hstack((measid[ind],[meta['base'][e]+'.other'+str(i) for i in range(nother)]))
+        cat['OBJECTID'] = np.hstack((objectid[ind],np.repeat('9999999.1',nother)))
+        cat['EXPOSURE'] = meta['base'][e]
+        cat['MJD'] = meta['mjd'][e]
+        cat['RA'] = np.hstack((ra[ind],rnd.rand(nother)))
+        cat['RAERR'] = np.hstack((raerr[ind],np.ones(nother))).astype(np.float32)
+        cat['DEC'] = np.hstack((dec[ind],rnd.rand(nother)))
+        cat['DECERR'] = np.hstack((decerr[ind],np.ones(nother))).astype(np.float32)
+        cat['MAG_AUTO'] = np.float32(20.0)
+        cat = cat[rnd.permutation(nmeas)]
+        dateobs = meta['dateobs'][e]
+        expdir = os.path.join(measdir,'c4d',dateobs[0:4]+dateobs[5:7]+dateobs[8:10],meta['base'][e])
+        if os.path.exists(expdir) is False: os.makedirs(expdir)
+        cat.write(expdir+'/'+meta['base'][e]+'_meas.fits.gz',overwrite=True)
+
+    # Object catalog
+    objfile = os.path.join(hdir,str(pix)+'.fits')
+    if os.path.exists(objfile+'.gz'): os.remove(objfile+'.gz')
+    meta.write(objfile+'.gz')
+    hdulist = fits.open(objfile+'.gz')
+    hdulist.append(fits.table_to_hdu(Table(obj)))
+    hdulist.writeto(objfile+'.gz',overwrite=True)
+    hdulist.close()
+
+    return {'pmra':pmra,'pmdec':pmdec,'objectid':obj['objectid'],
+            'meas':{'label':oind,'mjd':meta['mjd'][eind],'ra':ra,'dec':dec,'raerr':raerr,'decerr':decerr}}
+
+
+def dbslope(m,objdec):
+    """ Proper motions of the objects with more than one measurement, fit one at a time
+    with dln.robust_slope() like the database mode of fix_pms.  OBJDEC is the
+    declination of each object."""
+    radeg = np.float64(180.00) / np.pi
+    out = {}
+    for k in np.unique(m['label']):
+        ind, = np.where(m['label']==k)
+        if len(ind)<2: continue
+        t = m['mjd'][ind].copy()
+        t -= np.mean(t)
+        t /= 365.2425
+        ra = m['ra'][ind]-np.mean(m['ra'][ind])
+        ra *= 3600*1e3 * np.cos(objdec[k]/radeg)
+        dec = m['dec'][ind]-np.mean(m['dec'][ind])
+        dec *= 3600*1e3
+        pmra, pmraerr = dln.robust_slope(t,ra,m['raerr'][ind]*1e3,reweight=True)
+        pmdec, pmdecerr = dln.robust_slope(t,dec,m['decerr'][ind]*1e3,reweight=True)
+        out[k] = (pmra,pmraerr,pmdec,pmdecerr)
+    return out
+
+def test(npix=2,nobj=2000,nexp=20,nproc=2,batch=False,tmpdir=None):
+    """ Run fix_pms() in local mode on synthetic pixels and check the proper motions.
+
+    They have to be the same as dln.robust_slope() on the true measurements,
+    one object at a time like the database mode, or as pmfit.pmsolve() for BATCH.
+    """
+    import fix_pms
+    outdir = tempfile.mkdtemp(prefix='pmlocal',dir=tmpdir)
+    ok = True
+    try:
+        combdir = os.path.join(outdir,'combine')
+        measdir = os.path.join(outdir,'meas')
+        pixels = [str(1000+i) for i in range(npix)]
+        truth = [simpixel(combdir,measdir,p,nobj,nexp,seed=i) for i,p in enumerate(pixels)]
+        t0 = time.time()
+        fix_pms.fix_pms_pixels(pixels,nproc=nproc,batch=batch,local=True,combdir=combdir,measdir=measdir)
+        dt = time.time()-t0
+        print('%d pixels with %d processes in %6.2f sec' % (npix,nproc,dt))
+        for p,tr in zip(pixels,truth):
+            obj = fits.getdata(os.path.join(combdir,str(int(p)//1000),p+'_pmcorr.fits.gz'),2)
+            # Same as the reference fit on the true measurement arrays
+            m = tr['meas']
+            if batch:
+                pm = pmfit.pmsolve(m['label'],m['mjd'],m['ra'],m['dec'],m['raerr'],m['decerr'],
+                                   objdec=obj['dec'][np.unique(m['label'])])
+                ref = {l:(r['pmra'],r['pmraerr'],r['pmdec'],r['pmdecerr']) for l,r in zip(pm['label'],pm) if r['ndet']>1}
+            else:
+                ref = dbslope(m,obj['dec'])
+            gd = np.array(sorted(ref.keys()))
+            same = True
+            for i,c in enumerate(['pmra','pmraerr','pmdec','pmdecerr']):
+                same &= np.allclose(obj[c][gd],[ref[k][i] for k in gd],rtol=1e-5)
+            # Objects with one measurement are not refit
+            single = np.setdiff1d(np.unique(m['label']),gd)
+            same &= np.all(obj['pmra'][single]==999999.)
+            nsig = np.abs(obj['pmra'][gd]-tr['pmra'][gd])/obj['pmraerr'][gd]
+            print('pixel %s  %d objects refit  same as %s=%s  median |pmra-true|/err = %5.2f' %
+                  (p,len(gd),'pmsolve' if batch else 'robust_slope',same,np.median(nsig)))
+            ok &= same & (np.median(nsig)<2)
+    finally:
+        shutil.rmtree(outdir)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Test the local-data proper motion refit on synthetic pixels.')
+    parser.add_argument('--npix', type=int, default=2, help='Number of pixels')
+    parser.add_argument('--nobj', type=int, default=2000, help='Number of objects per pixel')
+    parser.add_argument('--nexp', type=int, default=20, help='Number of exposures')
+    parser.add_argument('--nproc', type=int, default=2, help='Number of processes')
+    parser.add_argument('--batch', action='store_true', help='Use the batched proper motion solver')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Temporary directory')
+    args = parser.parse_args()
+    sys.exit(0 if test(args.npix,args.nobj,args.nexp,args.nproc,args.batch,args.tmpdir) else 1)
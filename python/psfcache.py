@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+#
+# PSFCACHE.PY -- Warm start and early stop for the iterative DAOPHOT PSF
+#
+# phot.createpsf() builds every chip's PSF from scratch: DAOPHOT PSF is run
+# with AN=-6, so it fits all six analytic models every time, the worst PSF
+# stars are removed and the fit is repeated up to maxiter=5 times, and the
+# neighbors are subtracted for one more fit.  The chips of one exposure and
+# the repeat visits of a field all have very similar PSFs.
+#
+# PsfCache keeps the result of each createpsf() in a directory, keyed by
+# instrument, CCD number and seeing bin: the analytic model DAOPHOT picked,
+# the final chi and profile scatter, and copies of the .psf and the final
+# list of PSF stars.  A chip with a cached entry fits only the cached model
+# (AN set in a copy of the .opt file) and, for the same CCD, starts from the
+# PSF stars of the cached list that are found again in its own candidate
+# list (after removing the dither offset).  Another CCD of the same
+# instrument and seeing bin supplies the model only.  So that a cached
+# model does not keep choosing itself, createpsf() fits all six models
+# again (recheck()) when the warm chi is worse than the cached one, and in
+# any case once a model has been carried over MAXWARM times.  Like
+# ChipCache the directory is the state (one JSON file per key that names
+# its own versions of the .psf and .lst files, each written to a temporary
+# file and renamed), so the chip processes of chippool.py can share it.
+#
+# Convergence is the stopping rule of the rejection loop.  The old loop
+# stopped when chi changed by less than 0.002, Convergence also stops when
+# chi got worse or improved by less than a fraction of the best value so
+# far, or (same CCD only) when it reached the chi the loop ended with for
+# the cached PSF.
+#
+# "python psfcache.py --benchmark" runs createpsf() on two synthetic visits
+# of a multi-chip field against the stub DAOPHOT of daostub.py, cold
+# (old stopping rule, no cache) and warm (cache and Convergence), and
+# reports the iterations and DAOPHOT PSF runs saved and the timing.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import time
+import glob
+import json
+import shutil
+import tempfile
+import logging
+from argparse import ArgumentParser
+import daoio
+
+# DAOPHOT analytic PSF models, AN = index+1
+MODELS = ['GAUSSIAN','MOFFAT15','MOFFAT25','LORENTZ','PENNY1','PENNY2']
+
+
+def psfmodel(psffile):
+    """ Name and AN code of the analytic model of a DAOPHOT .psf file."""
+    f = open(psffile,'r')
+    name = f.readline().split()[0].upper()
+    f.close()
+    an = MODELS.index(name)+1 if name in MODELS else None
+    return name, an
+
+
+def matchlist(x1,y1,x2,y2,tol=1.5,maxshift=50.0):
+    """ Match two star lists that can be offset by up to MAXSHIFT pixels.
+    The offset is the peak of the histogram of the pairwise differences.
+
+    Returns
+    -------
+    ind1, ind2 : numpy arrays
+       Indices of the matched stars in the two lists.
+
+    """
+    x1,y1,x2,y2 = [np.asarray(v,float) for v in [x1,y1,x2,y2]]
+    if len(x1)==0 or len(x2)==0:
+        return np.zeros(0,int), np.zeros(0,int)
+    dx = (x2[None,:]-x1[:,None]).ravel()
+    dy = (y2[None,:]-y1[:,None]).ravel()
+    near = (np.abs(dx)<maxshift) & (np.abs(dy)<maxshift)
+    if np.sum(near)==0:
+        return np.zeros(0,int), np.zeros(0,int)
+    nbin = int(np.ceil(2*maxshift/tol))
+    hist,xedge,yedge = np.histogram2d(dx[near],dy[near],bins=nbin,range=[[-maxshift,maxshift],[-maxshift,maxshift]])
+    ix,iy = np.unravel_index(np.argmax(hist),hist.shape)
+    # Refine with the pairs around the peak
+    xc,yc = 0.5*(xedge[ix]+xedge[ix+1]), 0.5*(yedge[iy]+yedge[iy+1])
+    pk = near & (np.abs(dx-xc)<tol) & (np.abs(dy-yc)<tol)
+    xoff,yoff = np.median(dx[pk]), np.median(dy[pk])
+    # Nearest star of list 2 for each star of list 1, one-to-one
+    dist = np.hypot(x2[None,:]-x1[:,None]-xoff,y2[None,:]-y1[:,None]-yoff)
+    ind2 = np.argmin(dist,axis=1)
+    gd = (dist[np.arange(len(x1)),ind2]<tol)
+    ind1 = np.arange(len(x1))[gd]
+    ind2 = ind2[gd]
+    ind2,uind = np.unique(ind2,return_index=True)
+    return ind1[uind], ind2
+
+
+class Convergence:
+    """ Stopping rule for the PSF star rejection loop of createpsf().
+
+    Parameters
+    ----------
+    dchi : float, optional
+       Stop when chi improved by less than this.  Default is 0.002 (the old rule).
+    rtol : float, optional
+       Stop when chi improved by less than this fraction of the best chi so far.
+       Default is 0.02.
+    target : float, optional
+       Stop when chi is within RTOL of this value (the chi the loop ended with for
+       the cached PSF).
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        policy = Convergence(target=0.031)
+        while True:
+            chi = ...
+            if policy.update(chi): break
+
+    """
+
+    def __init__(self,dchi=0.002,rtol=0.02,target=None):
+        self.dchi = dchi
+        self.rtol = rtol
+        self.target = target
+        self.best = None
+        self.niter = 0
+        self.reason = None
+
+    def __repr__(self):
+        return 'Convergence(%d iterations, best chi=%s, %s)' % (self.niter,self.best,self.reason)
+
+    def update(self,chi):
+        """ Add the chi of the latest iteration, returns True if the loop should stop."""
+        self.niter += 1
+        stop = False
+        if (self.target is not None) and (chi <= self.target*(1+self.rtol)):
+            stop, self.reason = True, 'reached cached chi'
+        elif (self.best is not None) and (self.best-chi < np.max([self.dchi,self.rtol*self.best])):
+            stop, self.reason = True, 'no improvement'
+        self.best = chi if self.best is None else np.min([self.best,chi])
+        return stop
+
+
+class PsfCache:
+    """ Directory of PSF results keyed by instrument, CCD number and seeing bin.
+
+    Parameters
+    ----------
+    cachedir : str
+       Directory for the cache entries, shared by the chips and exposures.
+    seeingbin : float, optional
+       Width of the seeing (FWHM) bins in arcsec.  Default is 0.1.
+    rtol : float, optional
+       Fit all the models again if the warm chi is worse than the cached chi by
+       more than this fraction.  Default is 0.1.
+    maxwarm : int, optional
+       Fit all the models again after the cached model was used this many times
+       in a row.  Default is 5.
+    logger : logger object, optional
+       The Logger to use for logging output.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cache = PsfCache('/data0/scratch/psfcache/')
+        createpsf('F1_dao.fits','F1_dao.ap','F1_dao.lst',psfcache=cache,cachekey=('c4d',5,1.12))
+
+    """
+
+    def __init__(self,cachedir,seeingbin=0.1,rtol=0.1,maxwarm=5,logger=None):
+        self.cachedir = os.path.abspath(cachedir)
+        self.seeingbin = seeingbin
+        self.rtol = rtol
+        self.maxwarm = maxwarm
+        self.logger = logger
+        if os.path.exists(self.cachedir) is False:
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                pass     # made by another process
+        # Statistics
+        self.nhit = 0
+        self.nnear = 0
+        self.nmiss = 0
+        self.nput = 0
+        self.nrecheck = 0
+
+    def __repr__(self):
+        return 'PsfCache(%s, %d hits, %d other-CCD hits, %d misses, %d rechecks)' % (self.cachedir,self.nhit,self.nnear,
+                                                                                     self.nmiss,self.nrecheck)
+
+    def key(self,instrument,ccdnum,fwhm):
+        """ Cache key, FWHM in arcsec."""
+        return '%s_%02d_s%03d' % (instrument,int(ccdnum),int(np.round(fwhm/self.seeingbin)))
+
+    def read(self,key):
+        jsonfile = os.path.join(self.cachedir,key+'.json')
+        if os.path.exists(jsonfile) is False: return None
+        try:
+            f = open(jsonfile,'r')
+            entry = json.load(f)
+            f.close()
+        except ValueError:
+            return None
+        entry['psffile'] = os.path.join(self.cachedir,entry.get('psffile',key+'.psf'))
+        entry['listfile'] = os.path.join(self.cachedir,entry.get('listfile',key+'.lst'))
+        return entry
+
+    def lookup(self,instrument,ccdnum,fwhm):
+        """ The entry for this CCD and seeing bin, else the one of the nearest CCD of the
+        same instrument and seeing bin that has the model most of these CCDs use
+        (entry['exact'] is False), else None."""
+        key = self.key(instrument,ccdnum,fwhm)
+        entry = self.read(key)
+        if entry is not None:
+            self.nhit += 1
+            entry['exact'] = True
+            return entry
+        sbin = key.split('_')[-1]
+        others = glob.glob(os.path.join(self.cachedir,'%s_*_%s.json' % (instrument,sbin)))
+        others = sorted(others,key=lambda f: abs(int(os.path.basename(f).split('_')[-2])-int(ccdnum)))
+        entries = [self.read(os.path.basename(f)[:-5]) for f in others]
+        entries = [e for e in entries if e is not None]
+        if len(entries)>0:
+            models = [e['model'] for e in entries]
+            best = max(models,key=lambda m: (models.count(m),-models.index(m)))
+            entry = entries[models.index(best)]
+            self.nnear += 1
+            entry['exact'] = False
+            return entry
+        self.nmiss += 1
+        return None
+
+    def put(self,instrument,ccdnum,fwhm,psffile,listfile,**info):
+        """ Store the PSF and the final list of PSF stars of a chip, INFO (chi, medsig,
+        niter, nwarm, ...) goes in the JSON entry with the model name and AN code."""
+        key = self.key(instrument,ccdnum,fwhm)
+        model, an = psfmodel(psffile)
+        if an is None: return None
+        entry = {'key':key, 'instrument':instrument, 'ccdnum':int(ccdnum), 'fwhm':float(fwhm),
+                 'model':model, 'an':an, 'time':time.time()}
+        for k in info.keys():
+            entry[k] = info[k].item() if hasattr(info[k],'item') else info[k]
+        # The .psf and .lst files of every put get their own names, which the
+        #  JSON file points to.  Replacing the JSON file (a rename) switches the
+        #  entry to the new pair at once, so a reader never gets a .psf and a
+        #  .lst from different puts.
+        tid,tfile = tempfile.mkstemp(prefix='.tmp',suffix='.json',dir=self.cachedir)
+        os.close(tid)
+        version = os.path.basename(tfile)[4:-5]
+        for src,ext,name in [(psffile,'.psf','psffile'),(listfile,'.lst','listfile')]:
+            entry[name] = key+'.'+version+ext
+            tid,tfile1 = tempfile.mkstemp(prefix='.tmp',suffix=ext,dir=self.cachedir)
+            os.close(tid)
+            shutil.copyfile(src,tfile1)
+            os.rename(tfile1,os.path.join(self.cachedir,entry[name]))
+        f = open(tfile,'w')
+        json.dump(entry,f)
+        f.close()
+        os.rename(tfile,os.path.join(self.cachedir,key+'.json'))
+        # Remove the files of the replaced versions, after a minute so that
+        #  readers of the old JSON file can still open them
+        now = time.time()
+        for f in glob.glob(os.path.join(self.cachedir,key+'.*.psf'))+glob.glob(os.path.join(self.cachedir,key+'.*.lst')):
+            if os.path.basename(f) in [entry['psffile'],entry['listfile']]: continue
+            try:
+                if now-os.path.getmtime(f)>60: os.remove(f)
+            except OSError:
+                pass     # removed by another process
+        self.nput += 1
+        if self.logger is not None:
+            self.logger.info('Stored '+model+' PSF in cache as '+key)
+        return entry
+
+    def warmstart(self,cachekey,optfile,listfile,outoptfile,minstars=6):
+        """ Prepare a warm start from the cache.
+
+        Parameters
+        ----------
+        cachekey : tuple
+           (instrument, ccdnum, fwhm in arcsec).
+        optfile : str
+           The DAOPHOT option file of the chip.
+        listfile : str
+           The working list of PSF stars, trimmed in place to the stars of the
+           cached list (same CCD only).
+        outoptfile : str
+           Copy of OPTFILE with AN set to the cached model.
+        minstars : int, optional
+           Keep the full list if fewer than 2*MINSTARS cached stars are found again.
+
+        Returns
+        -------
+        entry : dict or None
+           The cache entry, entry['nlist'] is the number of PSF stars kept from the
+           cached list.  None if there is no entry.
+
+        """
+        entry = self.lookup(*cachekey)
+        if entry is None: return None
+        # Fit only the cached analytic model
+        f = open(optfile,'r')
+        optlines = [l for l in f.readlines() if l.split('=')[0].strip().upper() != 'AN']
+        f.close()
+        optlines.append('%2s = %8.2f\n' % ('AN',entry['an']))
+        f = open(outoptfile,'w')
+        f.writelines(optlines)
+        f.close()
+        # Start from the PSF stars of the cached list that are found again
+        entry['nlist'] = 0
+        if entry['exact'] and os.path.exists(entry['listfile']):
+            cached = daoio.daoread(entry['listfile'])
+            cur = daoio.daoread(listfile)
+            if (cached is not None) and (cur is not None):
+                ind1, ind2 = matchlist(cached['X'],cached['Y'],cur['X'],cur['Y'])
+                if len(ind2) >= 2*minstars:
+                    f = open(listfile,'r')
+                    lines = f.readlines()
+                    f.close()
+                    f = open(listfile,'w')
+                    f.writelines(lines[0:3]+[lines[3+i] for i in np.sort(ind2)])
+                    f.close()
+                    entry['nlist'] = len(ind2)
+        if self.logger is not None:
+            self.logger.info('Warm start from '+entry['key']+': '+entry['model']+', chi='+str(entry['chi'])+
+                             ', '+str(entry['nlist'])+' cached PSF stars found')
+        return entry
+
+    def recheck(self,entry,chi):
+        """ Whether a warm start should fit all the analytic models again: its CHI
+        (at the end of the rejection loop) is worse than the cached one by more than
+        RTOL, or the cached model was carried over MAXWARM times already."""
+        if entry is None: return False
+        ref = entry.get('iterchi',entry.get('chi'))
+        if (ref is not None) and (chi > ref*(1+self.rtol)):
+            return True
+        return entry.get('nwarm',0) >= self.maxwarm
+
+    def clear(self):
+        """ Remove all entries."""
+        for f in glob.glob(os.path.join(self.cachedir,'*')):
+            os.remove(f)
+
+
+def simfield(outdir,ccdnum=1,visit=1,fwhm=4.0,nstars=400,nx=1024,ny=2048,shift=(7.3,-4.1),pixscale=0.26):
+    """ Synthetic DAOPHOT-ready chip of a field with neighbors and cosmic rays: flux_dao.fits,
+    .opt and .coo.  The stars depend on CCDNUM only, later visits are shifted by SHIFT
+    and have new noise and cosmic rays."""
+    from astropy.io import fits
+    from astropy.table import Table
+    import daostub
+    rnd = np.random.RandomState(ccdnum)
+    x = rnd.uniform(30,nx-30,nstars)
+    y = rnd.uniform(30,ny-30,nstars)
+    mag = rnd.uniform(14,21,nstars)
+    # Close companions of 15% of the stars
+    nei = rnd.rand(nstars)<0.15
+    ang = rnd.uniform(0,2*np.pi,nstars)
+    sep = rnd.uniform(1.0,2.0,nstars)*fwhm
+    x = np.concatenate([x,(x+sep*np.cos(ang))[nei]])
+    y = np.concatenate([y,(y+sep*np.sin(ang))[nei]])
+    mag = np.concatenate([mag,(mag+rnd.uniform(0.5,2.0,nstars))[nei]])
+    x += (visit-1)*shift[0]
+    y += (visit-1)*shift[1]
+    rnd = np.random.RandomState(1000*visit+ccdnum)
+    im = rnd.normal(1600,10,(ny,nx))
+    daostub.addstars(im,x-1,y-1,10**(-0.4*(mag-25)),fwhm)
+    # Cosmic rays, 2x2 pixel hits on top of 3% of the stars and elsewhere
+    hit = np.where(rnd.rand(len(x))<0.03)[0]
+    cx = np.concatenate([x[hit]+rnd.uniform(-1.5,1.5,len(hit)),rnd.uniform(0,nx,300)]).astype(int)
+    cy = np.concatenate([y[hit]+rnd.uniform(-1.5,1.5,len(hit)),rnd.uniform(0,ny,300)]).astype(int)
+    for cx1,cy1 in zip(np.clip(cx,0,nx-2),np.clip(cy,0,ny-2)):
+        im[cy1:cy1+2,cx1:cx1+2] += rnd.uniform(2000,8000)
+    fits.writeto(os.path.join(outdir,'flux_dao.fits'),im.astype(np.float32),overwrite=True)
+    opt = ['RE = 1.55\n','GA = 3.91\n','LO = 7.00\n','HI = 38652.0\n','FW = %.2f\n' % fwhm,'TH = 3.50\n',
+           'LS = 0.2\n','HS = 1.0\n','LR = -1.0\n','HR = 1.0\n','WA = -2\n','FI = %.2f\n' % fwhm,
+           'PS = %.2f\n' % (4*fwhm),'VA = 2\n','AN = -6\n','EX = 5\n','PE = 0.75\n','PR = 5.00\n']
+    f = open(os.path.join(outdir,'flux_dao.opt'),'w')
+    f.writelines(opt)
+    f.close()
+    cat = Table()
+    cat['NUMBER'] = np.arange(1,len(x)+1)
+    cat['X_IMAGE'] = x
+    cat['Y_IMAGE'] = y
+    cat['MAG_AUTO'] = mag
+    cat['MAGERR_AUTO'] = 0.001*10**(0.2*(mag-10))
+    meta = {'NAXIS1':nx,'NAXIS2':ny,'SATURATE':38652.0,'RDNOISE':6.0,'GAIN':3.9,'SKYMED':1600.,'SKYRMS':10.}
+    daoio.sextodao(cat,meta,os.path.join(outdir,'flux_dao.coo'),format='coo')
+    return fwhm*pixscale
+
+
+def benchmark(nchips=4,nvisits=2,nstars=400,nx=1024,ny=2048,tmpdir=None):
+    """ createpsf() on NVISITS visits of an NCHIPS field, cold and with the PSF cache and
+    the early stop.  The warm PSFs have to have a chi within 10% of the cold ones."""
+    import phot
+    import daostub
+    import daosession
+    # phot.daoread(fast=False) uses the python 2 "long"
+    if not hasattr(phot,'long'): phot.long = int
+    logger = logging.getLogger('psfcache')
+    outroot = tempfile.mkdtemp(prefix='psfcache',dir=tmpdir)
+    curdir = os.getcwd()
+    oldpath = os.environ['PATH']
+    ok = True
+    try:
+        bindir = os.path.join(outroot,'bin')
+        os.mkdir(bindir)
+        daostub.mkstub(bindir)
+        os.environ['PATH'] = bindir+os.pathsep+oldpath
+        cache = PsfCache(os.path.join(outroot,'cache'),logger=logger)
+        results = {}
+        for mode in ['cold','warm']:
+            rows = []
+            for visit in range(1,nvisits+1):
+                for ccdnum in range(1,nchips+1):
+                    wdir = os.path.join(outroot,'%s_%d_%02d' % (mode,visit,ccdnum))
+                    os.mkdir(wdir)
+                    fwhm = simfield(wdir,ccdnum,visit,nstars=nstars,nx=nx,ny=ny)
+                    os.chdir(wdir)
+                    meta = {}
+                    with daosession.DaoSession(logger=logger) as session:
+                        apcat, maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',
+                                                         logger=logger,session=session)
+                        phot.daopickpsf('flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,logger=logger,session=session)
+                        t0 = time.time()
+                        if mode=='cold':
+                            phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,earlystop=False,
+                                           logger=logger,session=session)
+                        else:
+                            phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,psfcache=cache,
+                                           cachekey=('c4d',ccdnum,fwhm),logger=logger,session=session)
+                        dt = time.time()-t0
+                    npsf = len([s for s in session.stats if s[1]=='PSF'])
+                    model, an = psfmodel('flux_dao.psf')
+                    rows.append({'visit':visit,'ccdnum':ccdnum,'time':dt,'niter':meta['PSFITER'][0],'npsf':npsf,
+                                 'chi':meta['PSFCHI'][0],'nstars':meta['PSFSTARS'][0],'model':model,
+                                 'warm':meta['PSFWARM'][0]})
+                    os.chdir(curdir)
+            results[mode] = rows
+
+        print('%d visits x %d chips, %d stars, %dx%d' % (nvisits,nchips,nstars,nx,ny))
+        print('visit ccd | %-8s %4s %4s %7s %8s | %-8s %4s %4s %7s %8s %5s' %
+              ('cold','iter','PSF','chi','ms','warm','iter','PSF','chi','ms','start'))
+        for c,w in zip(results['cold'],results['warm']):
+            print('%5d %3d | %-8s %4d %4d %7.4f %8.1f | %-8s %4d %4d %7.4f %8.1f %5s' %
+                  (c['visit'],c['ccdnum'],c['model'],c['niter'],c['npsf'],c['chi'],1e3*c['time'],
+                   w['model'],w['niter'],w['npsf'],w['chi'],1e3*w['time'],w['warm']))
+            ok &= (w['chi'] <= 1.1*c['chi'])
+        tot = {}
+        for mode in ['cold','warm']:
+            tot[mode] = [np.sum([r[k] for r in results[mode]]) for k in ['niter','npsf','time']]
+            print('%-5s %3d iterations  %3d DAOPHOT PSF runs  %7.3f s' % tuple([mode]+tot[mode]))
+        print('saved %d iterations, %d DAOPHOT PSF runs (%d analytic model fits), %.3f s (%.1fx)' %
+              (tot['cold'][0]-tot['warm'][0],tot['cold'][1]-tot['warm'][1],
+               len(MODELS)*tot['cold'][1]-np.sum([r['npsf']*(1 if r['warm'] else len(MODELS)) for r in results['warm']])-
+               (len(MODELS)-1)*cache.nrecheck,
+               tot['cold'][2]-tot['warm'][2],tot['cold'][2]/tot['warm'][2]))
+        print('%d of %d chips use the model of the cold run' %
+              (np.sum([c['model']==w['model'] for c,w in zip(results['cold'],results['warm'])]),len(results['cold'])))
+        print(cache)
+        ok &= (tot['warm'][0] < tot['cold'][0]) & (tot['warm'][2] < tot['cold'][2])
+    finally:
+        os.chdir(curdir)
+        os.environ['PATH'] = oldpath
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the PSF cache and early stop of createpsf.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nchips', type=int, default=4, help='Number of chips')
+    parser.add_argument('--nvisits', type=int, default=2, help='Number of visits')
+    parser.add_argument('--nstars', type=int, default=400, help='Number of stars per chip')
+    args = parser.parse_args()
+    benchmark(args.nchips,args.nvisits,args.nstars)
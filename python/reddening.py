@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# Cached SFD E(B-V) lookups from a HEALPix-resampled map.
+#
+# The combine creates a new dustmaps SFDQuery() for every pixel, which reads
+# the two 4096x4096 SFD Lambert projection images (~130 MB) and takes
+# seconds, and then does the ICRS->Galactic transformation with astropy for
+# every object.  Here the SFD map is sampled once at the centers of the
+# pixels of an equatorial RING HEALPix map (buildmap()) and saved as a
+# float32 .npy file.  EBVMap memory-maps that file, so all of the processes
+# on a machine share the same pages in the OS cache and a process only
+# reads the parts of the sky it looks up.  ebv() does bulk nearest-pixel or
+# bilinear (healpy get_interp_val) lookups directly in RA/DEC.
+#
+# Accuracy: SFD has a 6.1 arcmin FWHM and 2.4 arcmin pixels.  With bilinear
+# interpolation the difference to SFDQuery() (order=1) has to stay within
+# TOLERANCE = max(0.01 mag, 3%) for 99.9% of random positions.  On a
+# synthetic map with SFD-like structure (simsfd()) the default NSIDE=2048
+# (1.7 arcmin pixels) gives a median difference of 0.1% and a 99.9th
+# percentile of 0.9%, NSIDE=1024 gives 0.3% and 2.4%.  accuracy() checks a
+# map against dustmaps.
+
+import os
+import sys
+import numpy as np
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+import healpy as hp
+import psutil
+
+# Default map and resolution
+MAPFILE = '/net/dl2/dnidever/nsc/instcal/sfd_ebv_healpix_n2048.npy'
+NSIDE = 2048
+
+# Tolerance of the bilinear lookups against SFDQuery(), absolute and relative
+TOLERANCE = (0.01, 0.03)
+
+_maps = {}
+
+
+def buildmap(outfile,nside=NSIDE,map_dir=None,chunksize=2000000,verbose=True):
+    """ Sample the SFD map at the centers of an equatorial RING HEALPix map.
+
+    Parameters
+    ----------
+    outfile : str
+       Output .npy file.
+    nside : int, optional
+       HEALPix Nside of the map.  Default is 2048.
+    map_dir : str, optional
+       Directory with the SFD files, default is the dustmaps data directory.
+    chunksize : int, optional
+       Number of pixels to query at a time.  Default is 2,000,000.
+    verbose : bool, optional
+       Print progress.  Default is True.
+
+    Returns
+    -------
+    outfile : str
+       The output file.
+
+    """
+    from dustmaps.sfd import SFDQuery
+    from astropy.coordinates import SkyCoord
+    t0 = time.time()
+    sfd = SFDQuery(map_dir)
+    npix = hp.nside2npix(nside)
+    # Write to a temporary file and move it into place at the end
+    tmpfile = outfile+'.'+str(os.getpid())+'.tmp.npy'
+    out = np.lib.format.open_memmap(tmpfile,mode='w+',dtype=np.float32,shape=(npix,))
+    for lo in range(0,npix,chunksize):
+        hi = np.minimum(lo+chunksize,npix)
+        ra,dec = hp.pix2ang(nside,np.arange(lo,hi),lonlat=True)
+        c = SkyCoord(ra,dec,frame='icrs',unit='deg')
+        out[lo:hi] = sfd(c)
+        if verbose: print('  %d/%d pixels  %6.1f sec' % (hi,npix,time.time()-t0))
+    out.flush()
+    del out
+    os.replace(tmpfile,outfile)
+    if verbose: print('Wrote '+outfile+'  nside='+str(nside)+'  dt = %6.1f sec' % (time.time()-t0))
+    return outfile
+
+
+class EBVMap:
+    """ Memory-mapped HEALPix E(B-V) map."""
+
+    def __init__(self,mapfile=MAPFILE):
+        self.mapfile = mapfile
+        self.map = np.load(mapfile,mmap_mode='r')
+        self.nside = hp.npix2nside(len(self.map))
+
+    def __repr__(self):
+        return 'EBVMap('+self.mapfile+', nside='+str(self.nside)+')'
+
+    def ebv(self,ra,dec,interp=True):
+        """ E(B-V) at RA/DEC in degrees, bilinear or nearest pixel."""
+        ra = np.asarray(ra,float)
+        dec = np.asarray(dec,float)
+        if interp:
+            return np.asarray(hp.get_interp_val(self.map,ra,dec,lonlat=True),np.float32)
+        return np.asarray(self.map[hp.ang2pix(self.nside,ra,dec,lonlat=True)],np.float32)
+
+
+def getmap(mapfile=None):
+    """ The map of this process, opened on first use."""
+    if mapfile is None: mapfile = MAPFILE
+    emap = _maps.get(mapfile)
+    if emap is None:
+        emap = EBVMap(mapfile)
+        _maps[mapfile] = emap
+    return emap
+
+def ebv(ra,dec,interp=True,mapfile=None):
+    """ E(B-V) at RA/DEC in degrees from the cached HEALPix map.
+
+    Parameters
+    ----------
+    ra : numpy array
+       Right ascension in degrees.
+    dec : numpy array
+       Declination in degrees.
+    interp : bool, optional
+       Bilinear interpolation between the four nearest pixels, otherwise use
+       the value of the pixel.  Default is True.
+    mapfile : str, optional
+       The .npy map made with buildmap(), default is MAPFILE.
+
+    Returns
+    -------
+    ebv : numpy array
+       E(B-V) in mag.
+
+    """
+    return getmap(mapfile).ebv(ra,dec,interp=interp)
+
+
+def randomradec(n,seed=0):
+    """ Uniform random positions on the sky."""
+    rnd = np.random.RandomState(seed)
+    ra = rnd.rand(n)*360
+    dec = np.rad2deg(np.arcsin(rnd.rand(n)*2-1))
+    return ra, dec
+
+def accuracy(mapfile,map_dir=None,n=200000,interp=True,seed=1,verbose=True):
+    """ Compare the lookups of a map to SFDQuery() at random positions.
+
+    Returns a dictionary with the median and 99.9 percentile absolute and
+    relative differences and whether they are within TOLERANCE.
+    """
+    from dustmaps.sfd import SFDQuery
+    from astropy.coordinates import SkyCoord
+    ra,dec = randomradec(n,seed)
+    ref = SFDQuery(map_dir)(SkyCoord(ra,dec,frame='icrs',unit='deg'))
+    val = EBVMap(mapfile).ebv(ra,dec,interp=interp)
+    diff = np.abs(val-ref)
+    rel = diff/np.maximum(ref,1e-3)
+    out = {'nside':hp.npix2nside(len(np.load(mapfile,mmap_mode='r'))),'interp':interp,
+           'absmed':np.median(diff),'abs999':np.percentile(diff,99.9),
+           'relmed':np.median(rel),'rel999':np.percentile(rel,99.9),
+           'within':np.mean(diff<=np.maximum(TOLERANCE[0],TOLERANCE[1]*ref))}
+    out['okay'] = out['within']>=0.999
+    if verbose:
+        print('nside=%5d interp=%-5s  |dE| median %7.5f  99.9%% %7.4f   rel median %6.4f  99.9%% %6.4f  within tolerance %7.4f' %
+              (out['nside'],interp,out['absmed'],out['abs999'],out['relmed'],out['rel999'],out['within']))
+    return out
+
+def simsfd(map_dir,size=4096,seed=0):
+    """ Write a synthetic dust map in the SFD Lambert format, with dust-like structure.
+
+    A log-normal random field with a k^-2.8 power spectrum, smoothed to the
+    6.1 arcmin SFD resolution and scaled with a cosecant latitude law.
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from scipy import ndimage
+    if os.path.exists(map_dir) is False: os.makedirs(map_dir)
+    rnd = np.random.RandomState(seed)
+    scale = 2*np.rad2deg(np.sqrt(2))/size     # deg/pixel, the equator is at the edge
+    for k,pole in enumerate(['ngp','sgp']):
+        head = fits.Header()
+        head['CTYPE1'] = 'GLON-ZEA'
+        head['CTYPE2'] = 'GLAT-ZEA'
+        head['CRPIX1'] = size/2+0.5
+        head['CRPIX2'] = size/2+0.5
+        head['CRVAL1'] = 0.0
+        head['CRVAL2'] = 90.0 if pole=='ngp' else -90.0
+        head['CDELT1'] = -scale if pole=='ngp' else scale
+        head['CDELT2'] = scale
+        head['LONPOLE'] = 180.0 if pole=='ngp' else 0.0
+        # Gaussian random field
+        kx = np.fft.fftfreq(size)
+        kk = np.sqrt(kx.reshape(-1,1)**2+kx.reshape(1,-1)**2)
+        kk[0,0] = 1.0
+        amp = kk**(-2.8/2)
+        amp[0,0] = 0.0
+        field = np.fft.ifft2(amp*(rnd.randn(size,size)+1j*rnd.randn(size,size))).real.astype(np.float32)
+        del kk, amp
+        field /= np.std(field)
+        field = ndimage.gaussian_filter(field,(6.1/60/scale)/2.35)
+        field /= np.std(field)
+        # Cosecant law in latitude
+        w = WCS(head)
+        yy,xx = np.mgrid[0:size,0:size]
+        l,b = w.all_pix2world(xx.ravel(),yy.ravel(),0)
+        del xx, yy
+        b = np.nan_to_num(np.abs(b).reshape(size,size))
+        data = 0.02*np.exp(0.8*field)/np.maximum(np.sin(np.deg2rad(b)),0.05)
+        hdu = fits.PrimaryHDU(data.astype(np.float32),header=head)
+        hdu.writeto(os.path.join(map_dir,'SFD_dust_4096_'+pole+'.fits'),overwrite=True)
+        del data, field, l, b
+    return map_dir
+
+def benchmark(map_dir=None,nside=[1024,2048],n=1000000,tmpdir=None):
+    """ Benchmark the startup and lookup cost, and the accuracy, against SFDQuery().
+
+    If MAP_DIR is not given a synthetic SFD-format map is used.
+    """
+    from dustmaps.sfd import SFDQuery
+    from astropy.coordinates import SkyCoord
+    outdir = tempfile.mkdtemp(prefix='reddening',dir=tmpdir)
+    results = {}
+    try:
+        if map_dir is None:
+            print('Making synthetic SFD map')
+            map_dir = simsfd(os.path.join(outdir,'sfd'))
+        process = psutil.Process(os.getpid())
+        ra,dec = randomradec(n,seed=2)
+        # SFDQuery, startup (first lookup, the images are read lazily) and lookup
+        #  private memory, the memory-mapped map is shared between processes
+        uss0 = process.memory_full_info().uss
+        t0 = time.time()
+        sfd = SFDQuery(map_dir)
+        sfd(SkyCoord(ra[0:1],dec[0:1],frame='icrs',unit='deg'))
+        dtstart0 = time.time()-t0
+        t0 = time.time()
+        sfd(SkyCoord(ra,dec,frame='icrs',unit='deg'))
+        dtlook0 = time.time()-t0
+        drss0 = process.memory_full_info().uss-uss0
+        print('SFDQuery         startup %6.3f sec  %6.1f MB   %d lookups %6.2f sec  %10.0f/s' %
+              (dtstart0,drss0/1e6,n,dtlook0,n/dtlook0))
+        results['sfd'] = {'startup':dtstart0,'memory':drss0,'lookup':dtlook0}
+        del sfd
+        for ns in nside:
+            mapfile = os.path.join(outdir,'ebv_n'+str(ns)+'.npy')
+            t0 = time.time()
+            buildmap(mapfile,ns,map_dir,verbose=False)
+            dtbuild = time.time()-t0
+            for interp in [False,True]:
+                _maps.clear()
+                uss0 = process.memory_full_info().uss
+                t0 = time.time()
+                getmap(mapfile)
+                ebv(ra[0:1],dec[0:1],interp=interp,mapfile=mapfile)
+                dtstart = time.time()-t0
+                t0 = time.time()
+                ebv(ra,dec,interp=interp,mapfile=mapfile)
+                dtlook = time.time()-t0
+                drss = process.memory_full_info().uss-uss0
+                print('nside=%5d %-7s startup %6.3f sec  %6.1f MB   %d lookups %6.2f sec  %10.0f/s  speed-up %5.1f  (build %5.1f sec)' %
+                      (ns,'interp' if interp else 'nearest',dtstart,drss/1e6,n,dtlook,n/dtlook,(dtstart0+dtlook0)/(dtstart+dtlook),dtbuild))
+                acc = accuracy(mapfile,map_dir,interp=interp)
+                results[(ns,interp)] = {'startup':dtstart,'memory':drss,'lookup':dtlook,'build':dtbuild,'accuracy':acc}
+        _maps.clear()
+    finally:
+        shutil.rmtree(outdir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Build or benchmark the HEALPix E(B-V) map.')
+    parser.add_argument('outfile', type=str, nargs='?', default=MAPFILE, help='Output map file')
+    parser.add_argument('--nside', type=int, default=NSIDE, help='HEALPix Nside')
+    parser.add_argument('--mapdir', type=str, default=None, help='SFD map directory')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark against SFDQuery (synthetic map if no --mapdir)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.mapdir)
+        sys.exit()
+
+    buildmap(args.outfile,args.nside,args.mapdir)
+    accuracy(args.outfile,args.mapdir)
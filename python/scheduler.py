@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+# Resumable work scheduler backed by a manifest database.
+#
+# The main scripts (nsc_instcal_measure_main.py, nsc_instcal_combine_main.py,
+# nsc_instcal_measure_update_main.py) used to build their task lists by
+# calling os.path.exists() on every expected output, which takes very long
+# on the network filesystems, and then split the tasks statically across a
+# hard-coded list of hosts.  Here the tasks are kept in a sqlite manifest
+# on a local disk with their state (pending, running, done, failed), number
+# of attempts, host/pid, runtime, peak RSS and return code.
+#
+# A manifest on a local disk uses the WAL journal.  WAL needs shared
+# memory between the processes, so a manifest that the workers of several
+# hosts share over NFS is opened with shared=True, which uses the rollback
+# journal (journal_mode=DELETE) and only the file locks.  All the writes
+# that read first are in BEGIN IMMEDIATE transactions in both modes.
+#
+#  - Manifest.add() inserts new tasks and leaves the existing ones alone,
+#    so re-running a main script only looks at the outputs of tasks it has
+#    never seen before (if at all).
+#  - Manifest.claim() hands out pending tasks inside a BEGIN IMMEDIATE
+#    transaction, so any number of worker processes can share a manifest
+#    and each task is claimed exactly once.
+#  - Manifest.recover() puts the "running" tasks of processes that no
+#    longer exist back to pending (or failed after MAXATTEMPTS), so a
+#    crashed worker or machine is resumed without rescanning anything.
+#  - runworker() runs up to NMULTI tasks at a time as subprocesses and
+#    records the runtime and the peak RSS of each one (from os.wait4()).
+#    With a memory cap (MAXMEM, given or stored in the manifest) it only
+#    starts a task if the predicted memory of the tasks it runs stays
+#    below the cap, tasks that do not fit are held back and later ones
+#    that do fit are started.  A task always starts on an idle worker.
+#
+# "python scheduler.py --test" runs dummy tasks with several workers,
+# including a simulated crash.
+
+import os
+import sys
+import numpy as np
+import time
+import socket
+import sqlite3
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+# Task states
+STATES = ['pending','running','done','failed']
+
+# sqlite settings of a manifest on a local disk, and of one shared by the
+#  hosts over a network filesystem (no WAL, it needs shared memory)
+PRAGMAS = [('journal_mode','WAL'),('synchronous','NORMAL'),('busy_timeout',600000)]
+SHAREDPRAGMAS = [('journal_mode','DELETE'),('synchronous','FULL'),('busy_timeout',600000)]
+
+dtype_task = np.dtype([('name',(str,200)),('cmd',(str,1000)),('cmddir',(str,500)),('output',(str,500)),
+                       ('state',(str,10)),('attempts',int),('host',(str,50)),('pid',int),('started',float),
+                       ('finished',float),('runtime',float),('maxrss',float),('returncode',int),('mem',float)])
+
+def hostname():
+    """ Short host name."""
+    return socket.gethostname().split('.')[0]
+
+def pidalive(pid):
+    """ Does a process with this PID exist on this host."""
+    if pid<=0:
+        return False
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Manifest:
+    """ Manifest database of tasks.
+
+    Parameters
+    ----------
+    dbfile : str
+       The manifest sqlite database file, on a local disk unless SHARED.
+    maxattempts : int, optional
+       Number of times a task is tried before it is marked failed.
+       Default is 1.
+    shared : bool, optional
+       The manifest is shared by the workers of several hosts over a
+       network filesystem, use the rollback journal.  Default is False.
+
+    """
+
+    def __init__(self,dbfile,maxattempts=1,shared=False):
+        self.dbfile = dbfile
+        self.maxattempts = maxattempts
+        self.shared = shared
+        # isolation_level=None, transactions are handled here
+        self.db = sqlite3.connect(dbfile,isolation_level=None,timeout=600)
+        for name,value in (SHAREDPRAGMAS if shared else PRAGMAS):
+            self.db.execute('PRAGMA '+name+'='+str(value))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS task(name TEXT PRIMARY KEY, cmd TEXT, cmddir TEXT,
+                           output TEXT, state TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, host TEXT DEFAULT '',
+                           pid INTEGER DEFAULT 0, started REAL DEFAULT 0, finished REAL DEFAULT 0,
+                           runtime REAL DEFAULT 0, maxrss REAL DEFAULT 0, returncode INTEGER DEFAULT 0,
+                           priority INTEGER DEFAULT 0, mem REAL DEFAULT 0)''')
+        # Manifests written before the predicted memory was kept
+        cols = [r[1] for r in self.db.execute('PRAGMA table_info(task)').fetchall()]
+        if 'mem' not in cols:
+            self.db.execute('ALTER TABLE task ADD COLUMN mem REAL DEFAULT 0')
+        self.db.execute('CREATE INDEX IF NOT EXISTS task_state ON task(state,priority)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS setting(name TEXT PRIMARY KEY, value REAL)')
+
+    def __repr__(self):
+        return 'Manifest('+self.dbfile+')'
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM task').fetchone()[0]
+
+    def close(self):
+        """ Close the database connection."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def setvalue(self,name,value):
+        """ Store a setting shared by the workers, e.g. "maxmem".  None removes it."""
+        if value is None:
+            self.db.execute('DELETE FROM setting WHERE name=?',(name,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO setting(name,value) VALUES(?,?)',(name,float(value)))
+
+    def getvalue(self,name,default=None):
+        """ Get a setting, DEFAULT if it is not set."""
+        row = self.db.execute('SELECT value FROM setting WHERE name=?',(name,)).fetchone()
+        return row[0] if row is not None else default
+
+    def add(self,names,cmds,cmddirs=None,outputs=None,priority=None,mem=None,checkdone=False,redo=False):
+        """ Add tasks.  Tasks that are already in the manifest are left alone.
+
+        Parameters
+        ----------
+        names : list
+           Unique task names, e.g. the pixel number or exposure.
+        cmds : list
+           Shell command of each task.
+        cmddirs : list, optional
+           Directory to run each command in.
+        outputs : list, optional
+           Expected output file of each task.
+        priority : list, optional
+           Tasks with lower values are claimed first, then in the order
+           they were added.
+        mem : list, optional
+           Predicted memory of each task in bytes, for the memory cap of
+           runworker().  The values of the existing tasks are updated.
+        checkdone : bool, optional
+           Mark the NEW tasks whose output already exists as done.  Only
+           the outputs of tasks that were not in the manifest are checked.
+        redo : bool, optional
+           Put the given tasks that are already in the manifest back to
+           pending.  Default is False.
+
+        Returns
+        -------
+        nnew : int
+           Number of new tasks.
+
+        """
+        names = [str(n) for n in names]
+        ntask = len(names)
+        if cmddirs is None: cmddirs=['']*ntask
+        if outputs is None: outputs=['']*ntask
+        if priority is None: priority=np.zeros(ntask,int)
+        if mem is None:
+            mem = np.zeros(ntask,float)
+            setmem = False
+        else:
+            setmem = True
+        mem = np.broadcast_to(np.array(mem,dtype=float),ntask)
+        cmddirs = np.broadcast_to(np.array(cmddirs,dtype=str),ntask)
+        outputs = np.broadcast_to(np.array(outputs,dtype=str),ntask)
+        # Only the new tasks
+        have = set()
+        for i in range(0,ntask,500):
+            chunk = names[i:i+500]
+            rows = self.db.execute('SELECT name FROM task WHERE name IN ('+','.join('?'*len(chunk))+')',chunk).fetchall()
+            have.update([r[0] for r in rows])
+        new = [i for i in range(ntask) if names[i] not in have]
+        data = []
+        for i in new:
+            state = 'pending'
+            if checkdone and outputs[i]!='' and os.path.exists(outputs[i]):
+                state = 'done'
+            data.append((names[i],str(cmds[i]),str(cmddirs[i]),str(outputs[i]),state,int(priority[i]),float(mem[i])))
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany('INSERT OR IGNORE INTO task(name,cmd,cmddir,output,state,priority,mem) VALUES(?,?,?,?,?,?,?)',data)
+        if setmem:
+            self.db.executemany('UPDATE task SET mem=? WHERE name=?',[(float(mem[i]),names[i]) for i in range(ntask) if names[i] in have])
+        if redo:
+            old = [(names[i],) for i in range(ntask) if names[i] in have]
+            self.db.executemany('''UPDATE task SET state='pending',attempts=0 WHERE name=? AND state!='running' ''',old)
+        self.db.execute('COMMIT')
+        return len(new)
+
+    def claim(self,n=1,host=None,pid=None,maxmem=None):
+        """ Atomically claim up to N pending tasks, with a total predicted memory of at most
+        MAXMEM bytes if that is given.  Returns a list of task dictionaries."""
+        if host is None: host=hostname()
+        if pid is None: pid=os.getpid()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            if maxmem is None:
+                rows = self.db.execute('''SELECT name,cmd,cmddir,output,attempts,mem FROM task WHERE state='pending'
+                                          ORDER BY priority,rowid LIMIT ?''',(int(n),)).fetchall()
+            else:
+                rows = []
+                free = maxmem
+                for r in self.db.execute('''SELECT name,cmd,cmddir,output,attempts,mem FROM task WHERE state='pending'
+                                             AND mem<=? ORDER BY priority,rowid''',(float(maxmem),)).fetchall():
+                    if len(rows)>=n: break
+                    if r[5]>free: continue
+                    rows.append(r)
+                    free -= r[5]
+            now = time.time()
+            self.db.executemany('''UPDATE task SET state='running',attempts=attempts+1,host=?,pid=?,started=?
+                                   WHERE name=?''',[(host,pid,now,r[0]) for r in rows])
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return [{'name':r[0],'cmd':r[1],'cmddir':r[2],'output':r[3],'attempts':r[4]+1,'mem':r[5]} for r in rows]
+
+    def setpid(self,name,pid):
+        """ Record the process ID of a running task."""
+        self.db.execute('UPDATE task SET pid=? WHERE name=?',(int(pid),name))
+
+    def finish(self,name,returncode,runtime=0.0,maxrss=0.0):
+        """ Record the end of a task.  Failed tasks are retried until MAXATTEMPTS."""
+        self.db.execute('BEGIN IMMEDIATE')
+        attempts, = self.db.execute('SELECT attempts FROM task WHERE name=?',(name,)).fetchone()
+        if returncode==0:
+            state = 'done'
+        elif attempts<self.maxattempts:
+            state = 'pending'
+        else:
+            state = 'failed'
+        self.db.execute('''UPDATE task SET state=?,finished=?,runtime=?,maxrss=?,returncode=? WHERE name=?''',
+                        (state,time.time(),float(runtime),float(maxrss),int(returncode),name))
+        self.db.execute('COMMIT')
+        return state
+
+    def recover(self,host=None,timeout=None):
+        """ Put the running tasks of dead processes back to pending.
+
+        Tasks on HOST (default this host) whose process does not exist
+        anymore are recovered.  With TIMEOUT (seconds), running tasks on
+        other hosts that started longer ago than that are recovered as well.
+        Tasks that already had MAXATTEMPTS attempts are marked failed.
+        Returns the number of recovered tasks.
+        """
+        if host is None: host=hostname()
+        self.db.execute('BEGIN IMMEDIATE')
+        rows = self.db.execute('''SELECT name,host,pid,started,attempts FROM task WHERE state='running' ''').fetchall()
+        now = time.time()
+        dead = []
+        for name,thost,pid,started,attempts in rows:
+            if thost==host:
+                if pidalive(pid) and pid!=os.getpid(): continue
+            elif timeout is None or (now-started)<timeout:
+                continue
+            state = 'pending' if attempts<self.maxattempts else 'failed'
+            dead.append((state,name))
+        self.db.executemany('UPDATE task SET state=?,pid=0 WHERE name=?',dead)
+        self.db.execute('COMMIT')
+        return len(dead)
+
+    def reset(self,state='failed'):
+        """ Put all tasks in STATE back to pending with zero attempts."""
+        cur = self.db.execute('UPDATE task SET state=\'pending\',attempts=0 WHERE state=?',(state,))
+        return cur.rowcount
+
+    def counts(self):
+        """ Number of tasks in each state."""
+        out = dict([(s,0) for s in STATES])
+        for state,n in self.db.execute('SELECT state,count(*) FROM task GROUP BY state').fetchall():
+            out[state] = n
+        return out
+
+    def tasks(self,state=None):
+        """ Get the tasks as a numpy structured array, optionally only those in STATE."""
+        cols = ','.join(dtype_task.names)
+        cmd = 'SELECT '+cols+' FROM task'
+        params = ()
+        if state is not None:
+            cmd += ' WHERE state=?'
+            params = (state,)
+        rows = self.db.execute(cmd+' ORDER BY rowid',params).fetchall()
+        out = np.zeros(len(rows),dtype=dtype_task)
+        if len(rows)>0:
+            out[...] = rows
+        return out
+
+
+def runworker(dbfile,nmulti=1,maxattempts=1,waittime=0.0,logger=None,host=None,maxmem=None,shared=False):
+    """ Run the tasks of a manifest, NMULTI at a time, until there are none left.
+
+    Running tasks of dead processes on this host are recovered first.
+    With a memory cap a task is only started if the predicted memory of
+    the running tasks stays below it, or if nothing else is running.
+
+    Parameters
+    ----------
+    dbfile : str
+       The manifest database file.
+    nmulti : int, optional
+       Number of tasks to run at the same time.  Default is 1.
+    maxattempts : int, optional
+       Number of times a task is tried.  Default is 1.
+    waittime : float, optional
+       Seconds to wait between starting tasks.  Default is 0.
+    logger : logging.Logger, optional
+       Logger, by default print() is used.
+    host : str, optional
+       Host name to record, default is this host.
+    maxmem : float, optional
+       Memory cap in bytes for the predicted memory of the running tasks.
+       Default is the "maxmem" setting of the manifest, if any.
+    shared : bool, optional
+       The manifest is shared by several hosts, see Manifest.
+
+    Returns
+    -------
+    counts : dict
+       Number of tasks in each state at the end.
+
+    """
+    log = logger.info if logger is not None else print
+    man = Manifest(dbfile,maxattempts=maxattempts,shared=shared)
+    if maxmem is None: maxmem=man.getvalue('maxmem')
+    nrecover = man.recover(host=host)
+    if nrecover>0: log(str(nrecover)+' tasks of dead processes recovered')
+    log(str(man.counts()))
+    if maxmem is not None: log('Memory cap %.1f GB' % (maxmem/1e9))
+    running = {}     # pid -> (task,start time,process)
+    ndone = 0
+    while True:
+        # Start tasks in the free slots, and in the free memory
+        while len(running)<nmulti:
+            free = None
+            if maxmem is not None and len(running)>0:
+                free = maxmem-np.sum([r[0]['mem'] for r in running.values()])
+            tasks = man.claim(1,host=host,maxmem=free)
+            if len(tasks)==0: break
+            task = tasks[0]
+            cwd = task['cmddir'] if task['cmddir']!='' else None
+            if cwd is not None and os.path.exists(cwd) is False: os.makedirs(cwd)
+            proc = subprocess.Popen(task['cmd'],shell=True,cwd=cwd)
+            man.setpid(task['name'],proc.pid)
+            # Keep the Popen object, otherwise its finalizer hands the pid to
+            #  subprocess' own reaping and wait4() below can miss it
+            running[proc.pid] = (task,time.time(),proc)
+            log('Starting '+task['name']+' (attempt '+str(task['attempts'])+')  pid='+str(proc.pid))
+            if waittime>0: time.sleep(waittime)
+        if len(running)==0:
+            break
+        # Wait for any of the tasks to finish, with their resource usage
+        pid,status,rusage = os.wait4(-1,0)
+        if pid not in running: continue
+        task,start,proc = running.pop(pid)
+        if os.WIFEXITED(status):
+            returncode = os.WEXITSTATUS(status)
+        else:
+            returncode = -os.WTERMSIG(status)
+        proc.returncode = returncode      # already reaped
+        runtime = time.time()-start
+        maxrss = rusage.ru_maxrss*1024.0     # kilobytes on linux
+        state = man.finish(task['name'],returncode,runtime,maxrss)
+        ndone += 1
+        log('%s %s  returncode=%d  %.1f sec  %.1f MB' % (task['name'],state,returncode,runtime,maxrss/1e6))
+    counts = man.counts()
+    log(str(ndone)+' tasks run.  '+str(counts))
+    man.close()
+    return counts
+
+
+def _worker(args):
+    """ Run a worker in a separate process."""
+    dbfile,nmulti,maxattempts,host = args
+    return runworker(dbfile,nmulti,maxattempts=maxattempts,host=host,shared=True)
+
+def test(ntasks=40,nworkers=3,nmulti=2,tmpdir=None):
+    """ Run dummy tasks with several workers sharing the manifest (as shared=True, like the
+    hosts), including a crashed one, and check the manifest."""
+    outdir = tempfile.mkdtemp(prefix='scheduler',dir=tmpdir)
+    ok = True
+    try:
+        dbfile = os.path.join(outdir,'manifest.db')
+        names = ['task%03d' % i for i in range(ntasks)]
+        outputs = [os.path.join(outdir,n+'.out') for n in names]
+        # Each task appends to its own file, allocates memory and sleeps.
+        # Every 10th task fails.
+        cmds = []
+        for i,n in enumerate(names):
+            cmd = sys.executable+' -c "import time,sys; a=bytearray(%d); open(\'%s\',\'a\').write(\'x\'); time.sleep(%.2f); sys.exit(%d)"' % \
+                  ((i%5+1)*20000000,outputs[i],0.05+0.05*(i%3),1 if i%10==9 else 0)
+            cmds.append(cmd)
+        # Outputs of the first two exist already
+        for f in outputs[0:2]:
+            with open(f,'w') as fil: fil.write('x')
+        man = Manifest(dbfile,shared=True)
+        nnew = man.add(names,cmds,outputs=outputs,checkdone=True)
+        # Adding them again does nothing
+        nnew2 = man.add(names,cmds,outputs=outputs,checkdone=True)
+        print('%d tasks added, %d added the second time' % (nnew,nnew2))
+        ok &= (nnew==ntasks) & (nnew2==0)
+        ok &= man.counts()['done']==2
+
+        # Simulate a crash: tasks claimed by a process that no longer exists
+        crashed = man.claim(3,pid=2**22+12345)
+        print(str(man.counts()))
+        man.close()
+
+        # Workers in separate processes
+        t0 = time.time()
+        pool = multiprocessing.Pool(nworkers)
+        try:
+            pool.map(_worker,[(dbfile,nmulti,2,None)]*nworkers)
+        finally:
+            pool.close()
+            pool.join()
+        dt = time.time()-t0
+
+        man = Manifest(dbfile,shared=True)
+        tasks = man.tasks()
+        counts = man.counts()
+        print('%d workers x %d  %.2f sec  %s' % (nworkers,nmulti,dt,str(counts)))
+        # Every task ran exactly once, except the failed ones that were retried
+        nrun = np.array([len(open(f).read()) if os.path.exists(f) else 0 for f in outputs])
+        fail = np.array([i%10==9 for i in range(ntasks)])
+        pre = np.zeros(ntasks,bool)
+        pre[0:2] = True
+        runonce = np.all(nrun[~fail & ~pre]==1) and np.all(nrun[pre]==1) and np.all(nrun[fail & ~pre]==2)
+        print('each task run once (failed ones twice) = %s' % runonce)
+        ok &= runonce
+        ok &= (counts['done']==ntasks-np.sum(fail)) & (counts['failed']==np.sum(fail)) & (counts['running']==0)
+        ok &= np.all(tasks['attempts'][fail]==2)
+        crashnames = [t['name'] for t in crashed]
+        ok &= np.all(tasks['state'][np.isin(tasks['name'],crashnames)]=='done')
+        rss = tasks['maxrss'][~pre]
+        print('peak RSS %.1f - %.1f MB   runtime %.2f - %.2f sec' %
+              (np.min(rss)/1e6,np.max(rss)/1e6,np.min(tasks['runtime'][~pre]),np.max(tasks['runtime'][~pre])))
+        ok &= np.all(rss>0) & (np.max(rss)>np.min(rss)+50e6)
+        # Resuming a finished manifest does nothing
+        counts2 = runworker(dbfile,nmulti,shared=True)
+        ok &= counts2==counts
+        man.close()
+    finally:
+        shutil.rmtree(outdir)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Run the tasks of a manifest database.')
+    parser.add_argument('manifest', type=str, nargs='?', default=None, help='Manifest database file')
+    parser.add_argument('-nm','--nmulti', type=int, default=1, help='Number of tasks to run at the same time')
+    parser.add_argument('--maxattempts', type=int, default=1, help='Number of times to try a task')
+    parser.add_argument('--maxmem', type=float, default=None, help='Memory cap in GB for the predicted memory of the running tasks')
+    parser.add_argument('--shared', action='store_true', help='The manifest is shared by several hosts over a network filesystem')
+    parser.add_argument('--status', action='store_true', help='Only print the number of tasks in each state')
+    parser.add_argument('--reset', type=str, default=None, help='Put the tasks in this state back to pending')
+    parser.add_argument('--test', action='store_true', help='Run dummy tasks')
+    args = parser.parse_args()
+    if args.test:
+        sys.exit(0 if test() else 1)
+    if args.manifest is None:
+        parser.error('manifest is required')
+    if args.status or args.reset is not None:
+        man = Manifest(args.manifest,shared=args.shared)
+        if args.reset is not None:
+            print(str(man.reset(args.reset))+' tasks reset')
+        print(man.counts())
+        man.close()
+    else:
+        runworker(args.manifest,args.nmulti,maxattempts=args.maxattempts,shared=args.shared,
+                  maxmem=(args.maxmem*1e9 if args.maxmem is not None else None))
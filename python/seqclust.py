@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+# Incremental sequential clustering of measurements in exposures.
+#
+# seqcluster() in nsc_instcal_combine_cluster.py crossmatches every exposure
+# against all of the objects found so far with coords.xmatch(), which
+# recomputes the unit vectors of all objects and builds a new KD-tree each
+# time, and grows the object array with add_elements() which copies it.
+# That is O(nexp x nobj) per pixel.
+#
+# Here the object unit vectors live in an amortized-growth buffer and are
+# indexed by a short list of cKDTrees over contiguous ranges of objects
+# (a logarithmic method: a new tree is made for each exposure's new objects
+# and merged with the previous tree while that is not more than twice as
+# large).  A query merges the k nearest neighbors of all the trees, which
+# gives exactly the same neighbors and distances as one tree over all the
+# objects, and then runs the same unique-match resolution as coords.xmatch().
+# So the labels are identical to the original algorithm (barring exactly
+# equal distances, where the KD-tree neighbor order is not defined anyway).
+
+import numpy as np
+import time
+from argparse import ArgumentParser
+from scipy.spatial import cKDTree
+from dlnpyutils import utils as dln, coords
+
+def unitvectors(ra,dec):
+    """ Unit vectors of RA/DEC in degrees, computed exactly like coords.xmatch()."""
+    X = np.vstack((ra,dec)).T
+    X = X * (np.pi / 180.)
+    Y = np.transpose(np.vstack([np.cos(X[:, 0]) * np.cos(X[:, 1]),
+                                np.sin(X[:, 0]) * np.cos(X[:, 1]),
+                                np.sin(X[:, 1])]))
+    return Y
+
+def uniquematch(dist,ind,dcr):
+    """ Resolve k-nearest neighbor lists into unique one-to-one matches like coords.xmatch(unique=True).
+
+    Parameters
+    ----------
+    dist : numpy array
+       Chord distances of the k nearest neighbors [N1,k], INF for no match.
+    ind : numpy array
+       Indices of the k nearest neighbors [N1,k].
+    dcr : float or numpy array
+       Maximum radius in arcsec, scalar or one per element.
+
+    Returns
+    -------
+    ind1, ind2, mindist : numpy array
+       Indices into the first and second lists of the matches and the distances in arcsec.
+
+    """
+
+    n1 = dist.shape[0]
+    # convert distances back to angles using the law of tangents
+    not_inf = ~np.isinf(dist)
+    x = 0.5 * dist[not_inf]
+    dist[not_inf] = (180. / np.pi * 2 * np.arctan2(x,
+                            np.sqrt(np.maximum(0, 1 - x ** 2))))
+    dist[not_inf] *= 3600.0      # in arcsec
+
+    # no matches
+    if np.sum(~np.isinf(dist[:,0]))==0:
+        return [], [], [np.inf]
+
+    done = 0
+    niter = 1
+    # Loop until we converge
+    while (done==0):
+
+        # If DCR is an array then impose the max limits for each element
+        if dln.size(dcr)>1:
+            bd,nbd = dln.where(dist[:,0] > dcr)
+            if nbd>0:
+                dist[bd,:] = np.inf
+
+        # no matches
+        if np.sum(~np.isinf(dist[:,0]))==0:
+            return [], [], [np.inf]
+
+        # closest matches
+        not_inf1 = ~np.isinf(dist[:,0])
+        not_inf1_ind, = np.where(not_inf1)
+        ind1 = np.arange(n1)[not_inf1]        # index into original ra1/dec1 arrays
+        ind2 = ind[:,0][not_inf1]             # index into original ra2/dec2 arrays
+        mindist = dist[:,0][not_inf1]
+        if len(ind2)==0:
+            return [], [], [np.inf]
+        index = dln.create_index(ind2)
+        # some duplicates to deal with
+        bd,nbd = dln.where(index['num']>1)
+        if nbd>0:
+            torem = []   # index into shortened ind1/ind2/mindist
+            for i in range(nbd):
+                indx = index['index'][index['lo'][bd[i]]:index['hi'][bd[i]]+1]
+                # keep the one with the smallest minimum distance
+                si = np.argsort(mindist[indx])
+                torem += list(indx[si[1:]])
+            ntorem = len(torem)
+            torem_orig_index = not_inf1_ind[torem]  # index into original ind/dist arrays
+            # For each element that is now unmatched, move up the next possible
+            # match in the dist/ind list if it isn't INF
+            for i in range(ntorem):
+                if ~np.isinf(dist[torem_orig_index[i],niter-1]):
+                    ind[torem_orig_index[i],:] = np.hstack( (ind[torem_orig_index[i],niter:].squeeze(), np.repeat(-1,niter)) )
+                    dist[torem_orig_index[i],:] = np.hstack( (dist[torem_orig_index[i],niter:].squeeze(), np.repeat(np.inf,niter)) )
+                else:
+                    ind[torem_orig_index[i],:] = -1
+                    dist[torem_orig_index[i],:] = np.inf
+        else:
+            ntorem = 0
+
+        niter += 1
+        # Are we done, no duplicates or hit the maximum 10
+        if (ntorem==0) | (niter>=10): done=1
+
+    return ind1, ind2, mindist
+
+
+class ObjectIndex:
+    """ Incrementally updated KD-tree index of object positions."""
+
+    def __init__(self,nbuf=10000):
+        self.xyz = np.zeros((nbuf,3),np.float64)
+        self.n = 0
+        self.trees = []     # [start, end, cKDTree] over contiguous object ranges
+        self.nbuild = 0     # number of objects put into trees, for statistics
+
+    def __len__(self):
+        return self.n
+
+    def add(self,ra,dec):
+        """ Add objects to the index."""
+        m = len(ra)
+        if m==0: return
+        # Amortized growth of the buffer
+        if self.n+m > len(self.xyz):
+            newxyz = np.zeros((max(2*len(self.xyz),self.n+m),3),np.float64)
+            newxyz[0:self.n] = self.xyz[0:self.n]
+            self.xyz = newxyz
+        self.xyz[self.n:self.n+m] = unitvectors(ra,dec)
+        start = self.n
+        self.n += m
+        # Merge with the previous trees while they are not much larger
+        while (len(self.trees)>0) and ((self.trees[-1][1]-self.trees[-1][0]) <= 2*(self.n-start)):
+            start = self.trees.pop()[0]
+        # The tree keeps a reference to this view, the buffer rows are never changed
+        self.trees.append([start,self.n,cKDTree(self.xyz[start:self.n])])
+        self.nbuild += self.n-start
+
+    def query(self,Y,max_y,k=10):
+        """ k nearest objects within a chord distance, same output as cKDTree.query() on all the objects."""
+        nq = len(Y)
+        if len(self.trees)==0:
+            return np.zeros((nq,k))+np.inf, np.zeros((nq,k),int)+self.n
+        dist = []
+        ind = []
+        for start,end,tree in self.trees:
+            d,i = tree.query(Y,k=k,distance_upper_bound=max_y)
+            d = d.reshape(nq,k)
+            i = i.reshape(nq,k)+start
+            i[np.isinf(d)] = self.n
+            dist.append(d)
+            ind.append(i)
+        if len(dist)==1:
+            return dist[0], ind[0]
+        dist = np.hstack(dist)
+        ind = np.hstack(ind)
+        # trees are in index order so ties keep the lower index first
+        si = np.argsort(dist,axis=1,kind='stable')[:,0:k]
+        return np.take_along_axis(dist,si,axis=1), np.take_along_axis(ind,si,axis=1)
+
+
+def seqcluster(cat,dcr=0.5,inpobj=None,trim=False):
+    """ Sequential clustering of measurements in exposures using an incremental KD-tree index.
+
+    Parameters
+    ----------
+    cat : numpy structured array
+       Measurements with EXPOSURE, RA and DEC.
+    dcr : float or numpy array
+       Matching radius in arcsec, scalar or one per measurement.
+    inpobj : numpy structured array, optional
+       Object catalog to start with (label, ra, dec, ndet).
+    trim : bool, optional
+       Remove objects without any detections.  Default is False.
+
+    Returns
+    -------
+    labels : numpy array
+       Object label for each measurement.
+    obj : numpy structured array
+       The object catalog.
+
+    """
+
+    ncat = len(cat)
+    labels = np.zeros(ncat)-1
+
+    # Create exposures index
+    index = dln.create_index(cat['EXPOSURE'])
+    nexp = len(index['value'])
+
+    # Create object catalog
+    dtype_obj = np.dtype([('label',int),('ra',np.float64),('dec',np.float64),('ndet',int)])
+    objindex = ObjectIndex(max(ncat,1))
+    # Is there an input object catalog that we are starting with?
+    if inpobj is not None:
+        cnt = len(inpobj)
+        obj = np.zeros(cnt+ncat,dtype=inpobj.dtype)
+        obj[0:cnt] = inpobj
+        objindex.add(obj['ra'][0:cnt],obj['dec'][0:cnt])
+    else:
+        # at most one object per measurement, no growth needed
+        obj = np.zeros(ncat,dtype=dtype_obj)
+        cnt = 0
+
+    # Loop over exposures
+    for i in range(nexp):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        ra1 = cat['RA'][indx]
+        dec1 = cat['DEC'][indx]
+        ncat1 = len(indx)
+        if dln.size(dcr)>1:
+            dcr1 = dcr[indx]
+        else:
+            dcr1 = dcr
+
+        # Second and up, match new sources to the objects
+        if cnt>0:
+            if dln.size(dcr1)>1:
+                max_distance = (np.max(dcr1) / 3600) * (np.pi / 180.)
+            else:
+                max_distance = (dcr1 / 3600) * (np.pi / 180.)
+            max_y = np.sqrt(2 - 2 * np.cos(max_distance))
+            dist,ind = objindex.query(unitvectors(ra1,dec1),max_y,k=10)
+            ind2,ind1,mdist = uniquematch(dist,ind,dcr1)
+            nmatch = dln.size(ind1)
+            #  Some matches, add data to existing record for these sources
+            if nmatch>0:
+                obj['ndet'][ind1] += 1
+                labels[indx[ind2]] = ind1
+                left = np.ones(ncat1,bool)
+                left[ind2] = False
+                indx = indx[left]
+                ra1 = ra1[left]
+                dec1 = dec1[left]
+                ncat1 = len(indx)
+
+        # Some left, add records for these sources
+        if ncat1>0:
+            ind1 = np.arange(ncat1)+cnt
+            obj['label'][ind1] = ind1
+            obj['ra'][ind1] = ra1
+            obj['dec'][ind1] = dec1
+            obj['ndet'][ind1] = 1
+            labels[indx] = ind1
+            objindex.add(ra1,dec1)
+            cnt += ncat1
+
+    # Trim off the excess elements
+    obj = obj[0:cnt]
+    # Trim off any objects that do not have any detections
+    #  could happen if an object catalog was input
+    if trim is True:
+        bd, nbd = dln.where(obj['ndet']<1)
+        if nbd>0: obj = np.delete(obj,bd)
+
+    return labels, obj
+
+
+def loopseqcluster(cat,dcr=0.5,inpobj=None,trim=False):
+    """ The original sequential clustering with coords.xmatch(), kept as a reference."""
+
+    ncat = len(cat)
+    labels = np.zeros(ncat)-1
+
+    # Create exposures index
+    index = dln.create_index(cat['EXPOSURE'])
+    nexp = len(index['value'])
+
+    # Create object catalog
+    dtype_obj = np.dtype([('label',int),('ra',np.float64),('dec',np.float64),('ndet',int)])
+    # Is there an input object catalog that we are starting with?
+    if inpobj is not None:
+        obj = inpobj
+        cnt = len(obj)
+    else:
+        obj = np.zeros(np.min([500000,ncat]),dtype=dtype_obj)
+        cnt = 0
+    nobj = len(obj)
+
+    # Loop over exposures
+    for i in range(nexp):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        cat1 = cat[indx]
+        ncat1 = len(cat1)
+        if dln.size(dcr)>1:
+            dcr1 = dcr[indx]
+        else:
+            dcr1 = dcr
+
+        # First exposure
+        if cnt==0:
+            ind1 = np.arange(ncat1)
+            obj['label'][ind1] = ind1
+            obj['ra'][ind1] = cat1['RA']
+            obj['dec'][ind1] = cat1['DEC']
+            obj['ndet'][ind1] = 1
+            labels[indx] = ind1
+            cnt += ncat1
+
+        # Second and up
+        else:
+            #  Match new sources to the objects
+            ind2,ind1,dist = coords.xmatch(cat1['RA'],cat1['DEC'],obj[0:cnt]['ra'],obj[0:cnt]['dec'],dcr1,unique=True)
+            nmatch = dln.size(ind1)
+            #  Some matches, add data to existing record for these sources
+            if nmatch>0:
+                obj['ndet'][ind1] += 1
+                labels[indx[ind2]] = ind1
+                if nmatch<ncat1:
+                    indx = np.delete(indx,ind2)
+                    cat1 = np.delete(cat1,ind2)
+                    ncat1 = dln.size(cat1)
+                else:
+                    cat1 = np.array([])
+                    ncat1 = 0
+
+            # Some left, add records for these sources
+            if ncat1>0:
+                # Add new elements
+                if (cnt+ncat1)>nobj:
+                    old = obj.copy()
+                    nnew = dln.gt(300000,len(old))
+                    obj = np.zeros(len(old)+nnew,dtype=old.dtype)
+                    obj[0:len(old)] = old
+                    del old
+                    nobj = len(obj)
+                ind1 = np.arange(ncat1)+cnt
+                obj['label'][ind1] = ind1
+                obj['ra'][ind1] = cat1['RA']
+                obj['dec'][ind1] = cat1['DEC']
+                obj['ndet'][ind1] = 1
+                labels[indx] = ind1
+
+                cnt += ncat1
+    # Trim off the excess elements
+    obj = obj[0:cnt]
+    # Trim off any objects that do not have any detections
+    if trim is True:
+        bd, nbd = dln.where(obj['ndet']<1)
+        if nbd>0: obj = np.delete(obj,bd)
+
+    return labels, obj
+
+
+def simexposures(nexp=100,nstar=200000,nnoise=300,size=1.0,fov=0.15,sigma=0.1,seed=0):
+    """ Simulate measurements of a field observed in many exposures.
+
+    Each exposure covers a random FOV x FOV deg region of the SIZE x SIZE deg
+    field.  SIGMA is the positional scatter in arcsec.
+    """
+    rnd = np.random.RandomState(seed)
+    cosd = np.cos(np.deg2rad(-30))
+    ra0 = 120+rnd.rand(nstar)*size/cosd
+    dec0 = -30+rnd.rand(nstar)*size
+    cats = []
+    dtype = np.dtype([('EXPOSURE',(str,20)),('RA',np.float64),('DEC',np.float64),('RAERR',np.float64),('DECERR',np.float64)])
+    for i in range(nexp):
+        # each exposure detects most of the stars in its footprint and some noise/transients
+        x0 = rnd.rand()*(size-fov)
+        y0 = rnd.rand()*(size-fov)
+        det = ((ra0-120)*cosd>=x0) & ((ra0-120)*cosd<x0+fov) & (dec0+30>=y0) & (dec0+30<y0+fov)
+        det &= rnd.rand(nstar) < 0.85
+        nd = np.sum(det)
+        cat = np.zeros(nd+nnoise,dtype=dtype)
+        cat['EXPOSURE'] = 'exp%05d' % i
+        cat['RA'][0:nd] = ra0[det] + rnd.randn(nd)*sigma/3600/cosd
+        cat['DEC'][0:nd] = dec0[det] + rnd.randn(nd)*sigma/3600
+        cat['RA'][nd:] = 120+(x0+rnd.rand(nnoise)*fov)/cosd
+        cat['DEC'][nd:] = -30+y0+rnd.rand(nnoise)*fov
+        cat['RAERR'] = sigma
+        cat['DECERR'] = sigma
+        cats.append(cat[rnd.permutation(len(cat))])
+    return np.hstack(cats)
+
+def benchmark(nexps=[10,50,100,200,500],nstar=200000,nnoise=300,dcr=0.5,maxloop=500):
+    """ Scaling benchmark of the incremental and original sequential clustering."""
+
+    print('  NEXP   NMEAS    NOBJ    xmatch(s)  kdtree(s)  speed-up  same')
+    results = []
+    for nexp in nexps:
+        cat = simexposures(nexp,nstar,nnoise)
+        # array DCR like hybridcluster uses
+        dcr1 = np.maximum(3*cat['RAERR'],dcr)*(0.8+0.4*np.random.RandomState(1).rand(len(cat)))
+        t0 = time.time()
+        labels,obj = seqcluster(cat,dcr=dcr1)
+        dt_new = time.time()-t0
+        if nexp<=maxloop:
+            t0 = time.time()
+            labels0,obj0 = loopseqcluster(cat,dcr=dcr1)
+            dt_old = time.time()-t0
+            same = np.array_equal(labels,labels0) & np.array_equal(obj,obj0)
+        else:
+            dt_old = np.nan
+            same = None
+        print('%6d %7d %7d %10.2f %10.2f %9.1f  %s' % (nexp,len(cat),len(obj),dt_old,dt_new,dt_old/dt_new,same))
+        results.append({'nexp':nexp,'nmeas':len(cat),'nobj':len(obj),'dt_xmatch':dt_old,'dt_kdtree':dt_new,'same':same})
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Scaling benchmark of incremental sequential clustering.')
+    parser.add_argument('--nexp', type=str, default='10,50,100,200,500', help='Comma-separated list of number of exposures')
+    parser.add_argument('--nstar', type=int, default=200000, help='Number of stars')
+    parser.add_argument('--nnoise', type=int, default=300, help='Number of noise detections per exposure')
+    parser.add_argument('--maxloop', type=int, default=500, help='Maximum exposures to run the original algorithm for')
+    args = parser.parse_args()
+    nexps = [int(n) for n in args.nexp.split(',')]
+    benchmark(nexps,args.nstar,args.nnoise,maxloop=args.maxloop)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# SEXCONFIG.PY -- SExtractor configuration templates
+#
+# For every chip phot.runsex() and the HDU loop of nsc_instcal_measure.py
+# copy default.conv/nnw/param into the working directory, read
+# default.config and rewrite it with regex substitutions for the gain,
+# saturation, seeing and file names, and read the filter file again to get
+# the kernel that grows the mask.
+#
+# A SexTemplate parses the configuration once per instrument.  The
+# instrument-level values (aperture diameters for the pixel scale, the
+# paths of the auxiliary files) go into a template config file, and the
+# auxiliary files are copied once into a shared directory.  All of these
+# files are read-only and shared by the chips (and the chip processes of
+# chippool.py).  The chip values are passed to "sex" as command-line
+# overrides (-GAIN 3.98 ...), which take precedence over the config file,
+# so nothing is written per chip.  render() still gives the equivalent
+# full config for the provenance copy next to the catalogs.
+#
+# "python sexconfig.py --benchmark" measures the per-chip setup overhead of
+# both approaches with a stub "sex" that checks the effective settings.
+
+from __future__ import print_function
+
+import os
+import sys
+import numpy as np
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+# Auxiliary files that are copied along with default.config
+AUXFILES = ['default.conv','default.nnw','default.param']
+# Keywords that refer to the auxiliary files
+AUXKEYS = ['PARAMETERS_NAME','FILTER_NAME','STARNNW_NAME']
+# Aperture radii in arcsec (1, 2, 4, 6, 8" diameters)
+APER_WORLD = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0])
+
+# Templates already parsed in this process
+_TEMPLATES = {}
+
+
+def parseline(line):
+    """ Split a SExtractor config line into keyword, value and comment.
+
+    Returns None for blank and comment lines.
+    """
+    s = line.strip()
+    if s=='' or s.startswith('#'):
+        return None
+    comment = ''
+    if '#' in s:
+        comment = s[s.index('#'):]
+        s = s[:s.index('#')].strip()
+    arr = s.split(None,1)
+    value = arr[1].strip() if len(arr)>1 else ''
+    return arr[0], value, comment
+
+
+def parseconfig(lines,overrides=None):
+    """ The effective settings of config lines and command-line overrides (the last occurrence wins)."""
+    settings = {}
+    for l in lines:
+        out = parseline(l)
+        if out is not None:
+            settings[out[0]] = out[1]
+    if overrides is not None:
+        for k in overrides:
+            settings[k] = str(overrides[k])
+    return settings
+
+
+def aperstring(pixscale):
+    """ PHOT_APERTURES value, aperture diameters in pixels."""
+    aper_pix = APER_WORLD*2 / pixscale
+    return ', '.join(np.array(np.round(aper_pix,2),dtype='str'))
+
+
+def growkernel(filterfile):
+    """ The kernel used to grow the masked regions, the filter shape plus two pixels."""
+    with open(filterfile,'r') as f:
+        lines = f.readlines()
+    shape = lines[1].split(' ')[1]
+    return np.ones(np.array(shape.split('x'),dtype='i')+2,dtype='i')
+
+
+def writeonce(filename,data):
+    """ Write a read-only file atomically unless it already exists."""
+    if os.path.exists(filename):
+        return
+    tid,tfile = tempfile.mkstemp(prefix=os.path.basename(filename)+'.',dir=os.path.dirname(filename))
+    with os.fdopen(tid,'wb') as f:
+        f.write(data)
+    os.chmod(tfile,0o444)
+    os.rename(tfile,filename)
+
+
+class SexTemplate:
+    """ SExtractor configuration of one instrument.
+
+    Parameters
+    ----------
+    configdir : str
+       The directory with default.config, default.conv, default.nnw and default.param.
+    instcode : str
+       The instrument code (c4d, k4m, ksb).
+    pixscale : float
+       The pixel scale in arcsec/pixel, sets the aperture diameters.
+    shareddir : str, optional
+       Directory for the shared read-only files.  Default is "nsc_sexconfig" in
+       the system temporary directory.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        tmpl = gettemplate(dir+'config/','c4d',0.27)
+        cmd = tmpl.command('flux.fits',{'GAIN':gain,'SATUR_LEVEL':saturate,'SEEING_FWHM':fwhm})
+
+    """
+
+    def __init__(self,configdir,instcode,pixscale,shareddir=None):
+        if shareddir is None:
+            shareddir = os.path.join(tempfile.gettempdir(),'nsc_sexconfig')
+        self.configdir = configdir
+        self.instcode = instcode
+        self.pixscale = pixscale
+        # Read the config and auxiliary files once
+        with open(os.path.join(configdir,'default.config'),'r') as f:
+            lines = f.readlines()
+        aux = {}
+        for a in AUXFILES:
+            with open(os.path.join(configdir,a),'rb') as f:
+                aux[a] = f.read()
+        # Shared directory, named by the contents so versions do not collide
+        md5 = hashlib.md5(''.join(lines).encode())
+        for a in AUXFILES: md5.update(aux[a])
+        self.dir = os.path.join(os.path.abspath(shareddir),'%s_%s' % (instcode,md5.hexdigest()[0:12]))
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                if not os.path.isdir(self.dir): raise
+        for a in AUXFILES:
+            writeonce(os.path.join(self.dir,a),aux[a])
+        # Instrument-level values
+        self.lines = []
+        filter_name = ''
+        for l in lines:
+            out = parseline(l)
+            if out is not None:
+                key,value,comment = out
+                if key=='PHOT_APERTURES':
+                    l = "PHOT_APERTURES  "+aperstring(pixscale)+"            # MAG_APER aperture diameter(s) in pixels\n"
+                if (key in AUXKEYS) and (value in AUXFILES):
+                    l = "%-16s %s   %s\n" % (key,os.path.join(self.dir,value),comment)
+                if key=='FILTER_NAME':
+                    filter_name = value
+            self.lines.append(l)
+        self.configfile = os.path.join(self.dir,'default_%s_%s.config' % (instcode,str(pixscale)))
+        writeonce(self.configfile,''.join(self.lines).encode())
+        # Kernel to grow the mask
+        self.kernel = None
+        if filter_name != '':
+            if filter_name in AUXFILES:
+                filter_name = os.path.join(self.dir,filter_name)
+            self.kernel = growkernel(filter_name)
+
+    def __repr__(self):
+        return 'SexTemplate(%s, pixscale=%s, %s)' % (self.instcode,str(self.pixscale),self.configfile)
+
+    def command(self,imfile,overrides=None,sexcmd='sex'):
+        """ The "sex" command for an image with the chip values as command-line overrides."""
+        cmd = [sexcmd,imfile,'-c',self.configfile]
+        if overrides is not None:
+            for k in overrides:
+                cmd += ['-'+k,str(overrides[k])]
+        return cmd
+
+    def settings(self,overrides=None):
+        """ The effective settings for a chip."""
+        return parseconfig(self.lines,overrides)
+
+    def render(self,overrides=None):
+        """ The full config text for a chip, equivalent to the template plus the overrides."""
+        if overrides is None: overrides = {}
+        out = []
+        for l in self.lines:
+            p = parseline(l)
+            if (p is not None) and (p[0] in overrides):
+                l = "%-16s %s   %s\n" % (p[0],str(overrides[p[0]]),p[2])
+            out.append(l)
+        return ''.join(out)
+
+
+def gettemplate(configdir,instcode,pixscale,shareddir=None):
+    """ The SexTemplate of an instrument, parsed once per process."""
+    key = (os.path.abspath(configdir),instcode,pixscale,shareddir)
+    if key not in _TEMPLATES:
+        _TEMPLATES[key] = SexTemplate(configdir,instcode,pixscale,shareddir)
+    return _TEMPLATES[key]
+
+
+def oldsetup(configdir,wdir,saturate,gain,fwhm,pixscale):
+    """ Per-chip configuration of the HDU loop of nsc_instcal_measure.py (the reference)."""
+    import re
+    shutil.copyfile(configdir+"default.conv",wdir+"/default.conv")
+    shutil.copyfile(configdir+"default.nnw",wdir+"/default.nnw")
+    shutil.copyfile(configdir+"default.param",wdir+"/default.param")
+    f = open(configdir+'default.config', 'r')
+    lines = f.readlines()
+    f.close()
+    filter_name = ''
+    cnt = 0
+    for l in lines:
+        m = re.search('^SATUR_LEVEL',l)
+        if m != None:
+            lines[cnt] = "SATUR_LEVEL     "+str(saturate)+"         # level (in ADUs) at which arises saturation\n"
+        m = re.search('^GAIN',l)
+        if m != None:
+            lines[cnt] = "GAIN            "+str(gain)+"            # detector gain in e-/ADU.\n"
+        m = re.search('^SEEING_FWHM',l)
+        if m != None:
+            lines[cnt] = "SEEING_FWHM     "+str(fwhm)+"            # stellar FWHM in arcsec\n"
+        m = re.search('^WEIGHT_IMAGE',l)
+        if m != None:
+            lines[cnt] = "WEIGHT_IMAGE  wt.fits    # Weight image name.\n"
+        m = re.search('^PHOT_APERTURES',l)
+        if m != None:
+            aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2
+            aper_pix = aper_world / pixscale
+            lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"
+        m = re.search('^FILTER_NAME',l)
+        if m != None:
+            filter_name = (l.split())[1]
+        cnt = cnt+1
+    if os.path.exists(wdir+"/default.config"):
+        os.remove(wdir+"/default.config")
+    fo = open(wdir+'/default.config', 'w')
+    fo.writelines(lines)
+    fo.close()
+    kernel = growkernel(wdir+'/'+filter_name)
+    return ['sex','flux.fits','-c','default.config'], kernel
+
+def newsetup(configdir,shareddir,saturate,gain,fwhm,pixscale):
+    """ Per-chip configuration with the instrument template."""
+    tmpl = gettemplate(configdir,'c4d',pixscale,shareddir)
+    cmd = tmpl.command('flux.fits',{'SATUR_LEVEL':saturate,'GAIN':gain,'SEEING_FWHM':fwhm,'WEIGHT_IMAGE':'wt.fits'})
+    return cmd, tmpl.kernel
+
+def benchmark(nchips=62,configdir=None,tmpdir=None):
+    """ Per-chip setup overhead of rewriting the config files and of the templates.
+
+    The stub "sex" is run for every chip and the effective settings
+    (with checksums of the auxiliary files) of both approaches compared.
+    """
+    if configdir is None:
+        configdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'../params/')
+    configdir = os.path.join(configdir,'')
+    import daostub
+    outroot = tempfile.mkdtemp(prefix='sexconfig',dir=tmpdir)
+    ok = True
+    try:
+        # Stub "sex" of daostub.py, writes the effective settings and the checksums of
+        #  the auxiliary files it was pointed to into the catalog
+        stub = daostub.mksex(outroot)
+        rnd = np.random.RandomState(3)
+        chips = [(float(rnd.uniform(4e4,6e4)),float(rnd.uniform(3.5,4.5)),float(rnd.uniform(0.8,2.0))) for i in range(nchips)]
+        origdir = os.getcwd()
+        results = {}
+        for name in ['old','new']:
+            wdir = os.path.join(outroot,name)
+            os.makedirs(wdir)
+            os.chdir(wdir)
+            shareddir = os.path.join(outroot,'shared')
+            tsetup,trun = 0.0,0.0
+            settings = []
+            try:
+                for saturate,gain,fwhm in chips:
+                    t0 = time.time()
+                    if name=='old':
+                        cmd,kernel = oldsetup(configdir,wdir,saturate,gain,fwhm,0.27)
+                    else:
+                        cmd,kernel = newsetup(configdir,shareddir,saturate,gain,fwhm,0.27)
+                    tsetup += time.time()-t0
+                    cmd[0] = stub
+                    t0 = time.time()
+                    subprocess.call([sys.executable]+cmd)
+                    trun += time.time()-t0
+                    with open('cat.fits') as f:
+                        settings.append(f.read())
+                    os.remove('cat.fits')
+                    settings[-1] += str(kernel.shape)
+            finally:
+                os.chdir(origdir)
+            results[name] = {'setup':tsetup,'run':trun,'settings':settings,'files':len(os.listdir(wdir))}
+        same = results['old']['settings']==results['new']['settings']
+        ok &= same
+        # The shared files are read-only
+        tmpl = gettemplate(configdir,'c4d',0.27,os.path.join(outroot,'shared'))
+        ok &= all([(os.stat(os.path.join(tmpl.dir,f)).st_mode & 0o222)==0 for f in os.listdir(tmpl.dir)])
+        print('%d chips' % nchips)
+        print('%-6s %14s %14s %16s' % ('','setup ms/chip','stub ms/chip','files per chip'))
+        for name in ['old','new']:
+            r = results[name]
+            print('%-6s %14.2f %14.1f %16d' % (name,1e3*r['setup']/nchips,1e3*r['run']/nchips,r['files']))
+        print('setup %.1fx faster, same effective settings = %s' % (results['old']['setup']/results['new']['setup'],same))
+    finally:
+        for root,dirs,files in os.walk(outroot):
+            for f in files: os.chmod(os.path.join(root,f),0o644)
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='SExtractor configuration templates.')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    parser.add_argument('--nchips', type=int, default=62, help='Number of chips')
+    parser.add_argument('--configdir', type=str, default=None, help='SExtractor config directory')
+    args = parser.parse_args()
+    benchmark(args.nchips,args.configdir)
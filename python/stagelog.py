@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+#
+# STAGELOG.PY -- Per-stage timing and resource records of the chip processing
+#
+# Chip.process() in nsc_instcal_sexdaophot.py runs runsex, mkopt, mkdaoim,
+# sextodao, daoaperphot, daopickpsf, createpsf, allstar, getapcor and
+# finalcat with only log messages, so it is not known which stage dominates
+# the runtime in production.
+#
+# StageLog.stage() wraps one stage and writes a JSON-lines record for it:
+#   wall      elapsed seconds
+#   cpu       CPU seconds of this process (cpu_self), of the SExtractor and
+#             DAOPHOT children that finished in the stage (cpu_children) and
+#             of the programs of a persistent DaoSession (cpu_programs)
+#   maxrss    peak RSS in MB of this process during the stage (the peak is
+#             reset through /proc/self/clear_refs where the kernel allows
+#             it, otherwise it is the peak so far), the largest finished
+#             child so far (maxrss_children) and the session programs
+#   read/write  MB read and written (rchar/wchar of /proc/PID/io, which
+#             include the finished children)
+#   nlaunch   subprocesses started from python (subprocess.Popen, counted
+#             by a subclass that is only installed while a stage runs),
+#             npid the PIDs used on the host in the meantime (includes the
+#             shells and their programs)
+# plus the chip (exposure, extension, ccdnum, instrument, host, pid) and
+# anything the caller adds to the record, e.g. the createpsf iterations.
+# A "total" record closes each chip.  Each record is one write() to a file
+# opened for appending, so the chip processes of chippool.py can share one
+# file.
+#
+# "python stagelog.py files/directories ..." summarizes the records of many
+# exposures: the distribution of the cost of each stage, its share of the
+# total, and the createpsf iterations.  "python stagelog.py --benchmark"
+# instruments the DAOPHOT stages on synthetic chips against the stub
+# programs of daostub.py, checks the records and reports the overhead.
+
+from __future__ import print_function
+
+import os
+import numpy as np
+import time
+import glob
+import json
+import socket
+import resource
+import subprocess
+import contextlib
+import logging
+from argparse import ArgumentParser
+
+# Subprocesses started by this process while the counter was installed,
+#  and the number of stages that need it
+_NLAUNCH = [0]
+_NINSTALL = [0]
+# The original Popen, also if another copy of this module installed its counter
+_Popen = getattr(subprocess.Popen,'_popen',subprocess.Popen)
+
+class _CountingPopen(_Popen):
+    """ subprocess.Popen that counts the launches."""
+    _popen = _Popen
+    def __init__(self,*args,**kwargs):
+        _NLAUNCH[0] += 1
+        _Popen.__init__(self,*args,**kwargs)
+
+def install():
+    """ Count the subprocess.Popen (and so call, check_output, ...) launches until
+        the matching uninstall().  StageLog.stage() does this around every stage."""
+    _NINSTALL[0] += 1
+    if _NINSTALL[0]==1:
+        subprocess.Popen = _CountingPopen
+
+def uninstall():
+    """ Put the original subprocess.Popen back once the last install() is undone."""
+    if _NINSTALL[0]==0: return
+    _NINSTALL[0] -= 1
+    if _NINSTALL[0]==0 and subprocess.Popen is _CountingPopen:
+        subprocess.Popen = _Popen
+
+
+def nlaunch():
+    """ Number of subprocesses started so far."""
+    return _NLAUNCH[0]
+
+
+def lastpid():
+    """ The most recently assigned process ID on this host."""
+    try:
+        return int(open('/proc/loadavg').read().split()[-1])
+    except (IOError,OSError,ValueError):
+        return 0
+
+
+def procio(pid='self'):
+    """ Bytes read and written by a process (and its finished children)."""
+    try:
+        out = {}
+        f = open('/proc/%s/io' % pid)
+        for line in f:
+            k,v = line.split(':')
+            out[k] = int(v)
+        f.close()
+        return out['rchar'], out['wchar']
+    except (IOError,OSError,KeyError):
+        return 0, 0
+
+
+def proccpu(pid):
+    """ User+system CPU seconds of a running process."""
+    try:
+        f = open('/proc/%d/stat' % pid)
+        stat = f.read()
+        f.close()
+        arr = stat[stat.rindex(')')+2:].split()
+        return (int(arr[11])+int(arr[12]))/float(os.sysconf('SC_CLK_TCK'))
+    except (IOError,OSError,ValueError):
+        return 0.0
+
+
+def prochwm(pid='self'):
+    """ Peak RSS (VmHWM) of a process in bytes."""
+    try:
+        f = open('/proc/%s/status' % pid)
+        for line in f:
+            if line.startswith('VmHWM:'):
+                f.close()
+                return int(line.split()[1])*1024
+        f.close()
+    except (IOError,OSError,ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024 if pid=='self' else 0
+
+
+def resetpeak():
+    """ Reset the peak RSS of this process, True if the kernel allows it."""
+    try:
+        f = open('/proc/self/clear_refs','w')
+        f.write('5')
+        f.close()
+        return True
+    except (IOError,OSError):
+        return False
+
+
+def metavalues(meta,keys):
+    """ Values of META keys as a dictionary with lower case keys, (value,comment)
+        tuples of a dictionary meta are unpacked."""
+    out = {}
+    if meta is None: return out
+    for k in keys:
+        if k not in meta: continue
+        v = meta[k]
+        if isinstance(v,tuple): v = v[0]
+        out[k.lower()] = v.item() if hasattr(v,'item') else v
+    return out
+
+
+class StageLog:
+    """ JSON-lines records of the stages of one chip.
+
+    Parameters
+    ----------
+    logfile : str, optional
+       File the records are appended to.  By default they are only kept in
+       StageLog.records.
+    logger : logger object, optional
+       The Logger for a one-line summary of each stage.
+    **context
+       Added to every record, e.g. exposure, extension, ccdnum, instrument.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        slog = StageLog('F1.stages.jsonl',exposure='c4d_160301_030405_ooi_g_v1',ccdnum=5)
+        with slog.stage('runsex'):
+            chip.runsex()
+        with slog.stage('createpsf',session=session) as rec:
+            chip.createpsf()
+            rec['psfiter'] = chip.meta['PSFITER']
+        slog.total()
+
+    """
+
+    def __init__(self,logfile=None,logger=None,**context):
+        self.logfile = logfile
+        self.logger = logger
+        self.context = {'host':socket.gethostname().split('.')[0], 'pid':os.getpid()}
+        for k in context.keys():
+            v = context[k]
+            self.context[k] = v.item() if hasattr(v,'item') else v
+        self.records = []
+
+    def __repr__(self):
+        return 'StageLog(%d stages%s)' % (len(self.records),', '+self.logfile if self.logfile else '')
+
+    def snapshot(self,session=None):
+        t = os.times()
+        rchar,wchar = procio()
+        snap = {'time':time.time(), 'cpu_self':t[0]+t[1], 'cpu_children':t[2]+t[3], 'read':rchar, 'write':wchar,
+                'nlaunch':nlaunch(), 'pid':lastpid(), 'programs':{}}
+        if session is not None:
+            for prog in session.programs.values():
+                pid = prog.proc.pid
+                if prog.proc.poll() is not None: continue
+                r,w = procio(pid)
+                snap['programs'][pid] = (proccpu(pid),r,w,prochwm(pid))
+        return snap
+
+    @contextlib.contextmanager
+    def stage(self,name,session=None,**extra):
+        """ Context manager that records the stage NAME, it yields the record so that
+        the caller can add to it.  With a DaoSession the CPU, I/O and peak RSS of its
+        programs are included."""
+        rec = dict(self.context)
+        rec['stage'] = name
+        rec.update(extra)
+        install()
+        resetpeak()
+        s0 = self.snapshot(session)
+        try:
+            yield rec
+            rec['status'] = 'ok'
+        except Exception as e:
+            rec['status'] = 'error'
+            rec['error'] = str(e)[0:500]
+            raise
+        finally:
+            s1 = self.snapshot(session)
+            uninstall()
+            rec['start'] = s0['time']
+            rec['wall'] = s1['time']-s0['time']
+            rec['cpu_self'] = s1['cpu_self']-s0['cpu_self']
+            rec['cpu_children'] = s1['cpu_children']-s0['cpu_children']
+            # Programs that were running at the end, started in the stage or before
+            cpu_programs, read, write, hwm = 0.0, 0, 0, 0
+            for pid in s1['programs'].keys():
+                c1,r1,w1,h1 = s1['programs'][pid]
+                c0,r0,w0,h0 = s0['programs'].get(pid,(0.0,0,0,0))
+                cpu_programs += c1-c0
+                read += r1-r0
+                write += w1-w0
+                hwm = max(hwm,h1)
+            # Programs that ended in the stage were reaped, their CPU and I/O are in the
+            #  children's now, take off what they used before the stage
+            for pid in s0['programs'].keys():
+                if pid in s1['programs']: continue
+                c0,r0,w0,h0 = s0['programs'][pid]
+                cpu_programs -= c0
+                read -= r0
+                write -= w0
+            rec['cpu_programs'] = cpu_programs
+            rec['cpu'] = rec['cpu_self']+rec['cpu_children']+rec['cpu_programs']
+            rec['maxrss'] = prochwm()/1e6
+            rec['maxrss_children'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024/1e6
+            rec['maxrss_programs'] = hwm/1e6
+            rec['read'] = (s1['read']-s0['read']+read)/1e6
+            rec['write'] = (s1['write']-s0['write']+write)/1e6
+            rec['nlaunch'] = s1['nlaunch']-s0['nlaunch']
+            rec['npid'] = max(s1['pid']-s0['pid'],0)
+            self.emit(rec)
+
+    def emit(self,rec):
+        """ Append a record to the list and the file."""
+        self.records.append(rec)
+        if self.logfile is not None:
+            line = json.dumps(rec,sort_keys=True)+'\n'
+            fd = os.open(self.logfile,os.O_WRONLY|os.O_APPEND|os.O_CREAT,420)
+            os.write(fd,line.encode())
+            os.close(fd)
+        if self.logger is not None:
+            self.logger.info('%s: %.2f s wall, %.2f s CPU, %.0f MB peak, %.1f MB read, %.1f MB written, %d launches' %
+                             (rec['stage'],rec['wall'],rec['cpu'],max(rec['maxrss'],rec['maxrss_programs']),
+                              rec['read'],rec['write'],rec['nlaunch']))
+
+    def total(self,**extra):
+        """ Record the sum of the stages so far."""
+        stages = [r for r in self.records if r['stage']!='total']
+        if len(stages)==0: return None
+        rec = dict(self.context)
+        rec.update({'stage':'total', 'start':stages[0]['start'],
+                    'status':'ok' if np.all([r['status']=='ok' for r in stages]) else 'error',
+                    'nstages':len(stages)})
+        for k in ['wall','cpu','cpu_self','cpu_children','cpu_programs','read','write','nlaunch','npid']:
+            rec[k] = sum([r[k] for r in stages])
+        for k in ['maxrss','maxrss_children','maxrss_programs']:
+            rec[k] = max([r[k] for r in stages])
+        rec.update(extra)
+        self.emit(rec)
+        return rec
+
+
+def readrecords(paths):
+    """ Read the records of JSON-lines files, directories are searched for *.stages.jsonl."""
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root,dirs,names in os.walk(p):
+                files += [os.path.join(root,n) for n in names if n.endswith('.stages.jsonl')]
+        else:
+            files += glob.glob(p)
+    records = []
+    for fil in sorted(files):
+        f = open(fil)
+        for line in f:
+            line = line.strip()
+            if line=='': continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass     # partial line of a killed job
+        f.close()
+    return records
+
+
+def summarize(records,group=None):
+    """ Distribution of the cost of each stage over the chips.
+
+    Parameters
+    ----------
+    records : list
+       Stage records (see readrecords()).
+    group : str, optional
+       Summarize separately for each value of this key, e.g. "instrument".
+
+    Returns
+    -------
+    lines : list
+       The lines of the summary.
+
+    """
+    groups = {}
+    for r in records:
+        groups.setdefault(r.get(group,'all') if group else 'all',[]).append(r)
+    lines = []
+    for g in sorted(groups.keys()):
+        recs = groups[g]
+        stages = []
+        for r in recs:
+            if r['stage'] not in stages: stages.append(r['stage'])
+        if 'total' in stages: stages = [s for s in stages if s!='total']+['total']
+        nexp = len(set([r.get('exposure') for r in recs]))
+        nchip = len(set([(r.get('exposure'),r.get('extension'),r.get('host'),r.get('pid')) for r in recs]))
+        totwall = sum([r['wall'] for r in recs if r['stage']!='total'])
+        if group: lines.append('%s = %s' % (group,g))
+        lines.append('%d records, %d exposures, %d chips' % (len(recs),nexp,nchip))
+        lines.append('%-12s %5s %4s %8s %8s %8s %9s %6s %8s %8s %8s %8s %6s' %
+                     ('stage','n','err','wall p50','p90','max','total s','share','cpu p50','rss p50','read p50',
+                      'write p50','launch'))
+        for s in stages:
+            sr = [r for r in recs if r['stage']==s]
+            wall = np.array([r['wall'] for r in sr])
+            cpu = np.array([r['cpu'] for r in sr])
+            rss = np.array([max(r['maxrss'],r.get('maxrss_programs',0)) for r in sr])
+            read = np.array([r['read'] for r in sr])
+            write = np.array([r['write'] for r in sr])
+            nl = np.array([r['nlaunch'] for r in sr])
+            nerr = np.sum([r['status']!='ok' for r in sr])
+            share = 100*np.sum(wall)/totwall if (totwall>0 and s!='total') else 100.0
+            lines.append('%-12s %5d %4d %8.2f %8.2f %8.2f %9.1f %5.1f%% %8.2f %8.0f %8.1f %8.1f %6.1f' %
+                         (s,len(sr),nerr,np.median(wall),np.percentile(wall,90),np.max(wall),np.sum(wall),share,
+                          np.median(cpu),np.median(rss),np.median(read),np.median(write),np.mean(nl)))
+        # createpsf convergence
+        psf = [r for r in recs if r['stage']=='createpsf' and r.get('psfiter') is not None]
+        if len(psf)>0:
+            niter = np.array([r['psfiter'] for r in psf])
+            vals,counts = np.unique(niter,return_counts=True)
+            lines.append('createpsf iterations: mean %.2f, '  % np.mean(niter)+
+                         ', '.join(['%d: %d' % (v,c) for v,c in zip(vals,counts)])+
+                         ('' if psf[0].get('psfwarm') is None else
+                          ', %d%% warm starts' % (100*np.mean([bool(r.get('psfwarm')) for r in psf]))))
+        lines.append('')
+    return lines
+
+
+def benchmark(nexp=2,nchips=2,nstars=300,nx=1024,ny=2048,tmpdir=None):
+    """ Instrument the DAOPHOT stages of Chip.process() on synthetic chips run with a
+    DaoSession against the stub programs.  Each chip has to have a record for every stage
+    and a total, the launches have to match the stub programs that ran and the stage
+    walls have to add up to the chip's wall time."""
+    import shutil
+    import tempfile
+    import phot
+    import daostub
+    import daosession
+    # phot.daoread(fast=False) uses the python 2 "long"
+    if not hasattr(phot,'long'): phot.long = int
+    logger = logging.getLogger('stagelog')
+    outroot = tempfile.mkdtemp(prefix='stagelog',dir=tmpdir)
+    curdir = os.getcwd()
+    oldpath = os.environ['PATH']
+    ok = True
+    try:
+        bindir = os.path.join(outroot,'bin')
+        os.mkdir(bindir)
+        daostub.mkstub(bindir)
+        os.environ['PATH'] = bindir+os.pathsep+oldpath
+        countfile = os.path.join(outroot,'count.txt')
+        os.environ['DAOSTUB_COUNT'] = countfile
+        logfile = os.path.join(outroot,'stages.jsonl')
+        stages = ['daoaperphot','daopickpsf','createpsf','allstar','getapcor']
+        nprog = 0
+        for iexp in range(nexp):
+            for ccdnum in range(1,nchips+1):
+                wdir = os.path.join(outroot,'exp%d_%02d' % (iexp,ccdnum))
+                os.mkdir(wdir)
+                daostub.simchip(wdir,nstars,nx,ny,seed=100*iexp+ccdnum)
+                os.chdir(wdir)
+                if os.path.exists(countfile): os.remove(countfile)
+                slog = StageLog(logfile,exposure='exp%d' % iexp,extension=ccdnum,ccdnum=ccdnum,instrument='c4d')
+                meta = {'DATE-OBS':'2016-03-01T03:04:05.6','exptime':90.0,'airmass':1.2}
+                session = daosession.DaoSession(ramdisk=True,inputs=['flux_dao.fits','flux_dao.coo','flux_dao.opt',
+                                                                     'flux_dao.als.opt'],exports=['*.log'],logger=logger)
+                with session:
+                    # the stages have to account for the time the session is open
+                    t0 = time.time()
+                    with slog.stage('daoaperphot',session=session):
+                        apcat, maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',
+                                                         logger=logger,session=session)
+                    with slog.stage('daopickpsf',session=session):
+                        phot.daopickpsf('flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,logger=logger,session=session)
+                    with slog.stage('createpsf',session=session) as rec:
+                        phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,logger=logger,session=session)
+                        rec.update(metavalues(meta,['PSFITER','PSFCHI','PSFSTARS','PSFWARM']))
+                    with slog.stage('allstar',session=session):
+                        phot.allstar('flux_dao.fits','flux_dao.psf','flux_dao.ap',outfile='flux_dao.als',logger=logger,
+                                     session=session)
+                    with slog.stage('getapcor',session=session):
+                        phot.apcor('flux_daoa.fits','flux_dao.lst','flux_dao.psf',meta,optfile='flux_dao.opt',
+                                   alsoptfile='flux_dao.als.opt',logger=logger,session=session)
+                    wall = time.time()-t0
+                tot = slog.total()
+                nrun = len(open(countfile).readlines())
+                nprog += nrun
+                ok &= ([r['stage'] for r in slog.records]==stages+['total'])
+                ok &= (tot['nlaunch']==nrun)
+                ok &= (tot['wall']<=wall) & (tot['wall']>0.9*wall)
+                ok &= (tot['cpu']>0) & np.all([r['status']=='ok' for r in slog.records])
+                ok &= (slog.records[2].get('psfiter',0)>0)
+                os.chdir(curdir)
+
+        # Overhead of a stage record
+        slog = StageLog(None)
+        t0 = time.time()
+        for i in range(200):
+            with slog.stage('empty'): pass
+        overhead = (time.time()-t0)/200
+        records = readrecords([logfile])
+        tot = [r for r in records if r['stage']=='total']
+        ok &= (len(records)==nexp*nchips*(len(stages)+1))
+        ok &= (overhead < 0.01*np.median([r['wall'] for r in tot]))
+        print('\n'.join(summarize(records)))
+        print('%d programs run by the stub, %d launches recorded' % (nprog,sum([r['nlaunch'] for r in tot])))
+        print('overhead %.2f ms per stage record, %.3f%% of the median chip' %
+              (1e3*overhead,100*len(stages)*overhead/np.median([r['wall'] for r in tot])))
+    finally:
+        os.chdir(curdir)
+        os.environ['PATH'] = oldpath
+        if 'DAOSTUB_COUNT' in os.environ: del os.environ['DAOSTUB_COUNT']
+        shutil.rmtree(outroot)
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Summarize the per-stage records of the chip processing.')
+    parser.add_argument('files', nargs='*', help='JSON-lines files or directories with *.stages.jsonl files')
+    parser.add_argument('--group', type=str, default=None, help='Summarize separately by this key, e.g. instrument')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+    else:
+        print('\n'.join(summarize(readrecords(args.files),group=args.group)))
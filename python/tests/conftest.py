@@ -0,0 +1,7 @@
+# The pipeline modules import each other as top-level modules (import var,
+#  import daoio, ...), put the python directory on the path like running them
+#  from there does.
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+import numpy as np
+
+import aggregate
+
+
+def test_aggregate_matches_loop():
+    cat, labels = aggregate.simpixel(nobj=400,nexp=12,seed=1)
+    nobj = len(np.unique(labels))
+    obj1 = aggregate.initobj(np.zeros(nobj,dtype=aggregate.objdtype()))
+    obj2 = aggregate.initobj(np.zeros(nobj,dtype=aggregate.objdtype()))
+    value1, fidmag1 = aggregate.loopaggregate(cat,labels,obj1)
+    value2, fidmag2 = aggregate.aggregate(cat,labels,obj2)
+    assert np.array_equal(value1,value2)
+    np.testing.assert_allclose(fidmag2,fidmag1,rtol=1e-12,equal_nan=True)
+    # float32 columns, the segmented sums differ from np.sum() by ~1e-15 relative
+    for n in obj1.dtype.names:
+        np.testing.assert_allclose(obj2[n].astype(float),obj1[n].astype(float),rtol=1e-6,atol=1e-6,
+                                   equal_nan=True,err_msg=n)
+
+
+def test_segindex_is_stable():
+    index = aggregate.segindex(np.array([3,1,3,2,1,3]))
+    assert list(index['value']) == [1,2,3]
+    assert list(index['num']) == [2,1,3]
+    # stable: equal labels keep their input order
+    assert list(index['index']) == [1,4,3,0,2,5]
@@ -0,0 +1,149 @@
+import os
+import logging
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+import batchapcor
+import daostub
+import phot
+
+# phot.daoread(fast=False) uses the python 2 "long"
+if not hasattr(phot,'long'): phot.long = int
+
+RADII = [3.0,6.0803,9.7377,15.5952,19.7360]
+NX = 2000
+
+
+def chipwcs(col,row):
+    # 2x2 chips around RA=150, DEC=2 with 0.26"/pixel
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN','DEC--TAN']
+    wcs.wcs.crval = [150.0,2.0]
+    wcs.wcs.crpix = [0.5*NX-(col-0.5)*NX,0.5*NX-(row-0.5)*NX]
+    wcs.wcs.cdelt = [-0.26/3600,0.26/3600]
+    return wcs
+
+
+def truecor(wcs,x,y):
+    # The aperture correction changes linearly over the focal plane
+    ra, dec = wcs.all_pix2world(x,y,1)
+    u, v = batchapcor.focalplane(ra,dec,150.0,2.0)
+    return 0.3+0.5*u+0.2*v
+
+
+def growfile(tmpdir,ccdnum,col,row,nstars,seed):
+    """ growstars() table of a chip, the aperture magnitudes of Moffat stars with log(alpha)
+    changing across the focal plane, with RA/DEC/CCDNUM from addcoords()."""
+    rnd = np.random.RandomState(seed)
+    wcs = chipwcs(col,row)
+    x = rnd.uniform(1,NX,nstars)
+    y = rnd.uniform(1,NX,nstars)
+    ra, dec = wcs.all_pix2world(x,y,1)
+    u, v = batchapcor.focalplane(ra,dec,150.0,2.0)
+    alpha = np.exp(np.log(2.5)+1.0*u)
+    tot = rnd.uniform(14,17,nstars)
+    mag = tot[:,None]-2.5*np.log10(batchapcor.growth(np.array(RADII)[None,:],alpha[:,None],2.5))
+    err = np.zeros(mag.shape)+0.005
+    mag += rnd.normal(0,0.002,mag.shape)
+    cat = Table()
+    cat['ID'] = np.arange(1,nstars+1)
+    cat['X'] = x
+    cat['Y'] = y
+    cat['MAGPSF'] = tot+truecor(wcs,x,y)
+    cat['ERRPSF'] = np.zeros(nstars)+0.005
+    cat['MAG'] = mag.reshape(nstars,len(RADII))
+    cat['ERR'] = err.reshape(nstars,len(RADII))
+    cat.meta['APERS'] = ','.join(['%.4f' % r for r in RADII])
+    batchapcor.addcoords(cat,wcs,ccdnum,NX,NX)
+    fil = os.path.join(str(tmpdir),'exp_%d.grow.fits' % ccdnum)
+    cat.write(fil,overwrite=True)
+    return fil
+
+
+@pytest.fixture
+def growfiles(tmpdir):
+    # Chip 4 has no growth-curve stars at all
+    nstars = {1:60,2:60,3:60,4:0}
+    return [growfile(tmpdir,c,(c-1) % 2,(c-1)//2,nstars[c],c) for c in range(1,5)]
+
+
+def test_addcoords_empty_chip(growfiles):
+    cat = Table.read(growfiles[3])
+    assert len(cat) == 0
+    assert cat.meta['CCDNUM'] == 4
+    ra, dec = chipwcs(1,1).all_pix2world(0.5*(NX+1),0.5*(NX+1),1)
+    assert abs(cat.meta['RA']-ra) < 1e-6 and abs(cat.meta['DEC']-dec) < 1e-6
+    cat = Table.read(growfiles[0])
+    assert np.all(cat['CCDNUM'] == 1) and len(cat) == 60
+
+
+def test_focalplane_every_chip(growfiles,caplog):
+    with caplog.at_level(logging.INFO):
+        apcors, curve = batchapcor.exposureapcor(growfiles,logger=logging.getLogger('test'))
+    assert curve.focal and curve.nstars == 180
+    alpha, beta = curve.alphabeta()
+    assert abs(alpha-2.5) < 0.1 and abs(beta-2.5) < 0.1
+    assert abs(curve.pars[2]-1.0) < 0.1
+    # The empty chip gets the focal-plane fit at its center, and that is logged
+    assert sorted(apcors.keys()) == [1,2,3,4]
+    assert apcors[4][1] == 0
+    for c in range(1,5):
+        col, row = (c-1) % 2, (c-1)//2
+        assert abs(apcors[c][0]-truecor(chipwcs(col,row),0.5*(NX+1),0.5*(NX+1))) < 0.01
+    assert 'CCDNUM 4: only 0 stars' in caplog.text and 'focal-plane fit' in caplog.text
+    assert 'No growth-curve stars in '+growfiles[3] in caplog.text
+
+
+def test_exposure_mode_median(growfiles,caplog):
+    with caplog.at_level(logging.INFO):
+        apcors, curve = batchapcor.exposureapcor(growfiles,mode='exposure',ccdnums=[5],
+                                                 logger=logging.getLogger('test'))
+    assert not curve.focal
+    # Chip 4 (no stars) and chip 5 (no grow file) get the exposure median
+    assert sorted(apcors.keys()) == [1,2,3,4,5]
+    assert apcors[4] == apcors[5]
+    assert apcors[5][1] == 0
+    assert 'CCDNUM 5: only 0 stars' in caplog.text and 'exposure median' in caplog.text
+
+
+def test_no_stars(growfiles):
+    apcors, curve = batchapcor.exposureapcor(growfiles[3:])
+    assert apcors == {} and curve is None
+
+
+def test_unknown_mode(growfiles):
+    for mode in ['chip','focal','']:
+        with pytest.raises(ValueError):
+            batchapcor.exposureapcor(growfiles,mode=mode)
+    assert batchapcor.APCORMODES == ['chip','exposure','focalplane']
+
+
+def test_updatecat(tmpdir):
+    catfile = os.path.join(str(tmpdir),'exp_1.fits')
+    cat = Table()
+    cat['MAGPSF'] = np.array([15.0,16.0],np.float32)
+    hdulist = fits.HDUList([fits.PrimaryHDU(),fits.table_to_hdu(cat)])
+    hdulist.writeto(catfile)
+    batchapcor.updatecat(catfile,0.25,mode='exposure')
+    head = fits.getheader(catfile,0)
+    assert head['APCOR'] == 0.25 and head['APCORMOD'] == 'exposure'
+    assert np.allclose(fits.getdata(catfile,1)['MAGPSF'],[14.75,15.75])
+
+
+def test_addstars_wing():
+    im = np.zeros((201,201))
+    daostub.addstars(im,[100.0],[100.0],[1000.0],4.0,rad=100,wing=0.2)
+    assert abs(np.sum(im)/1000.0-1) < 0.02
+    # The halo puts more light outside 3 FWHM than the plain Moffat
+    plain = daostub.addstars(np.zeros((201,201)),[100.0],[100.0],[1000.0],4.0,rad=100)
+    yy, xx = np.mgrid[0:201,0:201]
+    out = np.hypot(xx-100,yy-100) > 12
+    assert np.sum(im[out]) > 2*np.sum(plain[out])
+
+
+def test_benchmark(tmpdir):
+    assert batchapcor.benchmark(ncol=2,nrow=2,nstars=300,nx=768,ny=768,tmpdir=str(tmpdir))
@@ -0,0 +1,90 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import chipcache
+
+
+@pytest.fixture
+def bigfile(tmp_path):
+    return chipcache.simexposure(str(tmp_path),nchips=4,nx=64,ny=64)[0]
+
+
+def test_pixels_and_hits(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'))
+    d0,h0 = fits.getdata(bigfile,2,header=True)
+    d1,h1 = cache.getdata(bigfile,2,header=True)
+    assert np.array_equal(d0,d1) and h1['CCDNUM']==2
+    cache.getdata(bigfile,'S2')
+    cache.path(bigfile,2)
+    assert (cache.nmiss,cache.nhit)==(2,1)
+    # copy-on-write
+    d1 *= 0
+    assert np.array_equal(fits.getdata(cache.path(bigfile,2)),d0)
+    h2 = fits.getheader(cache.path(bigfile,2,addpdu=True))
+    assert h2['DTINSTRU']=='decam'
+
+
+def test_key_changes_with_source(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'))
+    k0 = cache.key(bigfile,1)
+    d0 = cache.getdata(bigfile,1).copy()
+    # a new file at the same path
+    time.sleep(0.01)
+    chipcache.simexposure(os.path.dirname(bigfile),nchips=4,nx=64,ny=64,seed=5)
+    assert cache.key(bigfile,1)!=k0
+    d1 = cache.getdata(bigfile,1)
+    assert np.array_equal(d1,fits.getdata(bigfile,1)) and not np.array_equal(d0,d1)
+
+
+def test_lru_eviction(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'),minage=0.0)
+    onesize = os.path.getsize(cache.path(bigfile,1))
+    cache.maxbytes = 2.5*onesize
+    for e in [2,3,1,4]:
+        time.sleep(0.01)
+        cache.path(bigfile,e)
+    left = sorted([int(f[2].split('_')[-1][:-5]) for f in cache.files()])
+    assert left==[1,4] and cache.nevict==3
+
+
+def test_linked_files_not_evicted(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'),minage=0.0)
+    wdir = tmp_path/'chip'
+    wdir.mkdir()
+    onesize = os.path.getsize(cache.path(bigfile,1))
+    cache.clear()
+    # budget of less than one chip, linking the other files must not evict the flux
+    cache.maxbytes = 0.5*onesize
+    outs = [str(wdir/n) for n in ['flux.fits','wt.fits','mask.fits']]
+    for e,out in zip([1,2,3],outs):
+        time.sleep(0.01)
+        cache.link(bigfile,e,out)
+    assert len(cache.files())==3 and cache.nevict==0
+    for e,out in zip([1,2,3],outs):
+        assert os.path.exists(out) and not os.path.islink(out)
+        assert np.array_equal(fits.getdata(out),fits.getdata(bigfile,e))
+    # released by the chip, evicted on the next write
+    for out in outs: os.remove(out)
+    cache.path(bigfile,4)
+    assert [int(f[2].split('_')[-1][:-5]) for f in cache.files()]==[4]
+
+
+def test_link_survives_clear(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'))
+    out = str(tmp_path/'flux.fits')
+    cache.link(bigfile,3,out)
+    cache.clear()
+    assert np.array_equal(fits.getdata(out),fits.getdata(bigfile,3))
+
+
+def test_minage_protects_recent(tmp_path,bigfile):
+    cache = chipcache.ChipCache(str(tmp_path/'cache'),maxbytes=1.0,minage=60.0)
+    for e in [1,2,3]:
+        cache.path(bigfile,e)
+    assert len(cache.files())==3 and cache.nevict==0
+    cache.minage = 0.0
+    assert cache.evict()==0 and cache.nevict==3
@@ -0,0 +1,67 @@
+import os
+import time
+
+import numpy as np
+
+import chippool
+
+
+def _workchip(extension,outdir=None,fail=None,dt=0.0):
+    # Writes a fixed file name in the current directory, like the sex/daophot steps
+    with open('flux.coo','w') as fo:
+        fo.write('%d\n' % extension)
+    time.sleep(dt)
+    if extension==fail:
+        raise ValueError('bad chip %d' % extension)
+    text = open('flux.coo').read()
+    with open(os.path.join(outdir,'chip_%d.coo' % extension),'w') as fo:
+        fo.write(text)
+    return extension+100
+
+
+def test_chips_isolated(tmp_path):
+    outdir = str(tmp_path/'out')
+    os.makedirs(outdir)
+    wdir = str(tmp_path/'wdir')
+    stats = chippool.processchips(_workchip,range(1,9),wdir,nproc=4,outdir=outdir,dt=0.05)
+    assert stats['ok'].all()
+    assert stats['extension'].tolist()==list(range(1,9))
+    assert stats['ccdnum'].tolist()==list(range(101,109))
+    for e in range(1,9):
+        assert open(os.path.join(outdir,'chip_%d.coo' % e)).read()=='%d\n' % e
+    assert np.all(stats['wall']>=0.05)
+    # the chip directories are removed
+    assert os.listdir(wdir)==[]
+
+
+def test_failure_collected(tmp_path):
+    outdir = str(tmp_path/'out')
+    os.makedirs(outdir)
+    for nproc in [1,2]:
+        wdir = str(tmp_path/('wdir%d' % nproc))
+        stats = chippool.processchips(_workchip,[1,2,3],wdir,nproc=nproc,outdir=outdir,fail=2)
+        assert stats['ok'].tolist()==[True,False,True]
+        assert 'bad chip 2' in stats['error'][1]
+        assert stats['ccdnum'][1]==-1
+        assert os.getcwd()!=chippool.chipdir(wdir,2)
+
+
+def test_keep_chipdirs(tmp_path):
+    outdir = str(tmp_path/'out')
+    os.makedirs(outdir)
+    wdir = str(tmp_path/'wdir')
+    chippool.processchips(_workchip,[3,4],wdir,nproc=1,cleanup=False,outdir=outdir)
+    for e in [3,4]:
+        assert os.path.exists(os.path.join(chippool.chipdir(wdir,e),'flux.coo'))
+
+
+def test_parallel_speedup(tmp_path):
+    outdir = str(tmp_path/'out')
+    os.makedirs(outdir)
+    t0 = time.time()
+    chippool.processchips(_workchip,range(1,9),str(tmp_path/'w1'),nproc=1,outdir=outdir,dt=0.2)
+    tserial = time.time()-t0
+    t0 = time.time()
+    chippool.processchips(_workchip,range(1,9),str(tmp_path/'w4'),nproc=4,outdir=outdir,dt=0.2)
+    tpar = time.time()-t0
+    assert tpar<0.75*tserial
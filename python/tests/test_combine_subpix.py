@@ -0,0 +1,113 @@
+import os
+import time
+import numpy as np
+import healpy as hp
+
+import nsc_instcal_combine_cluster as cc
+import footprint
+
+
+def fakecombine(pix,version=None,hlist=None,metacache=None,outdir='',**kwargs):
+    # Record when each subpixel ran and what it was given
+    t0 = time.time()
+    time.sleep(0.5)
+    with open(os.path.join(outdir,str(pix)+'.txt'),'w') as f:
+        f.write('%f %f %d %d %d\n' % (t0,time.time(),len(hlist),len(metacache),kwargs['nproc']))
+    return None
+
+
+def test_runsubpix_memory_budget(tmp_path,monkeypatch):
+    monkeypatch.setattr(cc,'combine',fakecombine)
+    dopix = [10,11,12,13,14]
+    nmeasest = np.array([1,5,2,4,3])*1e6
+    maxmem = 7e9          # with MEASMEM=1000 at most 7M measurements at once
+    hlist = np.arange(3)
+    metacache = {'a':1}
+    dt = cc.runsubpix(dopix,'v1',256,hlist,metacache,nmeasest,nmulti=3,maxmem=maxmem,outdir=str(tmp_path))
+    assert len(dt)==5
+    assert np.all(dt>0.4)
+    runs = {}
+    for pix in dopix:
+        t0,t1,nhlist,nmeta,nproc = np.loadtxt(str(tmp_path/(str(pix)+'.txt')))
+        runs[pix] = (t0,t1)
+        # the shared hlist and meta-data reach the workers
+        assert nhlist==3 and nmeta==1 and nproc==1
+    # Largest first, the subpixels sent out together can start in any order
+    assert runs[11][0]<min([runs[p][1] for p in dopix])
+    # The running subpixels never exceed the budget
+    mem = dict(zip(dopix,nmeasest*cc.MEASMEM))
+    for pix in dopix:
+        t = runs[pix][0]+0.01
+        used = sum(mem[p] for p in dopix if runs[p][0]<=t<runs[p][1])
+        assert used<=maxmem
+
+
+def test_runsubpix_single_process(tmp_path,monkeypatch):
+    calls = []
+    monkeypatch.setattr(cc,'combine',lambda pix,**kw: calls.append((pix,kw['nside'],kw['multilevel'])))
+    dt = cc.runsubpix([3,4],'v1',512,[],{},np.array([1,1]),nmulti=1)
+    assert calls==[(3,512,False),(4,512,False)]
+    assert len(dt)==2
+
+
+def test_subpixmeasest_chip_coverage():
+    pix = hp.ang2pix(128,120.0,-30.0,lonlat=True)
+    dopix = hp.query_polygon(256,np.transpose(hp.boundaries(128,pix)))
+    assert len(dopix)==4
+    cenra, cendec = hp.pix2ang(128,pix,lonlat=True)
+    area = hp.nside2pixarea(256,degrees=True)
+    # One big chip over the whole pixel, 1e5 sources per deg^2
+    big = np.array([[-1,1,1,-1]],float)
+    est = cc.subpixmeasest(dopix,256,cenra,cendec,np.array([1e5]),cenra+big,cendec+np.array([[-1,-1,1,1]],float))
+    assert np.allclose(est,1e5*area)
+    # A small chip on the first subpixel only, 4 times the density
+    ra1, dec1 = hp.pix2ang(256,dopix[0],lonlat=True)
+    d = 0.05
+    vra = np.vstack((big+cenra,ra1+np.array([[-d,d,d,-d]])/np.cos(np.deg2rad(dec1))))
+    vdec = np.vstack((np.array([[-1,-1,1,1]])+cendec,dec1+np.array([[-d,-d,d,d]])))
+    est2 = cc.subpixmeasest(dopix,256,cenra,cendec,np.array([1e5,4e5]),vra,vdec)
+    assert np.allclose(est2[1:],1e5*area)
+    small = est2[0]-1e5*area
+    assert 0.5<small/(4e5*(2*d)**2)<2.0
+    assert np.argmax(est2)==0
+
+
+def test_pixelchips_index_and_metacache(tmp_path):
+    metafiles = footprint.simmetafiles(str(tmp_path/'meta'),nexp=30,size=2.0)
+    pix = hp.ang2pix(128,121.0,-29.0,lonlat=True)
+    buffdict = footprint.regionbuffer(128,pix)
+    dopix = hp.query_polygon(512,np.transpose(hp.boundaries(128,pix)))
+    metacache = {}
+    for mfile in metafiles: cc.readmeta(mfile,metacache)
+    dens, vra, vdec = cc.pixelchips(metafiles,buffdict,metacache=metacache)
+    est = cc.subpixmeasest(dopix,512,buffdict['cenra'],buffdict['cendec'],dens,vra,vdec)
+    fpindex = footprint.FootprintIndex(str(tmp_path/'fp.db'))
+    fpindex.update(metafiles)
+    dens2, vra2, vdec2 = cc.pixelchips(metafiles,buffdict,fpindex=fpindex)
+    fpindex.close()
+    est2 = cc.subpixmeasest(dopix,512,buffdict['cenra'],buffdict['cendec'],dens2,vra2,vdec2)
+    # The index only has the chips near the pixel, the result is the same
+    assert len(dens2)<len(dens)
+    assert np.allclose(est,est2)
+    # The subpixels differ with the chip gaps and the exposure edges
+    assert np.all(est>0) and np.std(est)>0.01*np.mean(est)
+
+
+def test_benchmarkmultilevel_temporary_outputs(tmp_path,monkeypatch):
+    cmds = []
+    def fakecall(cmd,shell=False):
+        # the outputs go to the temporary directories
+        outdir = cmd[cmd.index('--outdir')+1]
+        iddir = cmd[cmd.index('--iddir')+1]
+        assert outdir.startswith(str(tmp_path)) and iddir.startswith(str(tmp_path))
+        assert os.path.isdir(outdir) and os.path.isdir(iddir)
+        open(os.path.join(outdir,'1234.fits.gz'),'w').close()
+        cmds.append(cmd)
+        return 0
+    monkeypatch.setattr(cc.subprocess,'call',fakecall)
+    res = cc.benchmarkmultilevel(1234,'v1',nmulti=2,tmpdir=str(tmp_path))
+    assert sorted(res.keys())==['inprocess','spawn']
+    assert '--spawn' in cmds[0] and '--spawn' not in cmds[1]
+    assert cmds[0][cmds[0].index('--outdir')+1]!=cmds[1][cmds[1].index('--outdir')+1]
+    # and are removed afterwards
+    assert os.listdir(str(tmp_path))==[]
@@ -0,0 +1,62 @@
+import numpy as np
+
+import costmodel
+
+
+def test_dispatch_shared_queue():
+    cost = np.array([3.0,2.0,2.0,1.0])
+    mem = np.ones(4)
+    order = np.argsort(-cost,kind='stable')
+    host,start,finish = costmodel.dispatch(cost,mem,[order]*2)
+    assert np.max(finish)==4.0
+    assert np.all(host>=0)
+    # Fixed lists are run as given
+    assert costmodel.makespan(cost,mem,[np.array([0,1]),np.array([2,3])])==5.0
+
+
+def test_dispatch_memory_cap():
+    cost = np.ones(4)
+    mem = np.array([6.0,6.0,3.0,3.0])
+    host,start,finish = costmodel.dispatch(cost,mem,[np.arange(4)],nslots=4,maxmem=10.0)
+    # Never more than the cap running at the same time on the host
+    for t in np.unique(start):
+        assert np.sum(mem[(start<=t) & (finish>t)])<=10.0
+    # A job larger than the cap still runs on an idle host
+    host,start,finish = costmodel.dispatch(np.ones(2),np.array([20.0,1.0]),[np.arange(2)],nslots=2,maxmem=10.0)
+    assert np.all(host==0) and start[0]==0.0
+
+
+def test_predict_is_unbiased():
+    # Runtimes from the model family with log-normal scatter, the
+    #  predictions are means and not medians
+    rnd = np.random.RandomState(3)
+    feat = np.zeros(20000,dtype=costmodel.dtype_feat)
+    feat['nexp'] = rnd.randint(1,100,len(feat))
+    feat['nmeas'] = feat['nexp']*rnd.lognormal(np.log(3000),1.0,len(feat))
+    runtime = np.exp(np.log(1e-3)+0.9*np.log1p(feat['nmeas'])+0.1*np.log1p(feat['nexp']))*rnd.lognormal(0.0,0.6,len(feat))
+    model = costmodel.CostModel().fit(feat,runtime,runtime*1e6)
+    assert abs(model.tsig-0.6)<0.02
+    cost,mem = model.predict(feat)
+    assert abs(np.sum(cost)/np.sum(runtime)-1)<0.03
+    # the memory has a margin
+    assert np.median(mem/(runtime*1e6))>2
+
+
+def test_shared_queue_beats_random_split():
+    res = costmodel.simulate(npix=3000,nhosts=3,nslots=5,maxmem=20e9,nhist=500,seeds=[0,1,2,3])
+    for r in res:
+        assert r['shared']<=r['random']
+        assert r['shared']<=1.15*r['lower']
+    assert np.median([r['random']/r['shared'] for r in res])>1.03
+
+
+def test_pixelfeatures():
+    healstr = np.zeros(5,dtype=np.dtype([('FILE',(str,50)),('PIX',int)]))
+    healstr['FILE'] = ['a_cat.fits','b_cat.fits','a_cat.fits','c_cat.fits','b_cat.fits']
+    healstr['PIX'] = [7,7,9,9,9]
+    expinfo = (np.array([3.0,6.0,30.0]),np.array(['c4d','c4d','k4m']))     # a, b, c
+    feat = costmodel.pixelfeatures(healstr,nside=128,expinfo=expinfo)
+    scale = costmodel.hp.nside2pixarea(128,degrees=True)
+    assert feat['pix'].tolist()==[7,9]
+    assert feat['nexp'].tolist()==[2,3]
+    assert np.allclose(feat['nmeas'],[(1+2)*scale,(1+2+100)*scale])
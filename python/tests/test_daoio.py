@@ -0,0 +1,67 @@
+import logging
+
+import numpy as np
+import pytest
+
+import daoio
+import phot
+
+# phot.daoread() uses the python 2 "long"
+if not hasattr(phot,'long'): phot.long = int
+
+
+@pytest.fixture(scope='module')
+def simfiles(tmp_path_factory):
+    return daoio.simfiles(str(tmp_path_factory.mktemp('daoio')),nstars=300,naper=5)
+
+
+@pytest.mark.parametrize('ext',['coo','lst','als','tot','ap'])
+def test_daoread_same_as_phot(simfiles,ext):
+    files,secat = simfiles
+    old = phot.daoread(files[ext],fast=False)
+    new = daoio.daoread(files[ext])
+    assert old.colnames==new.colnames and len(new)==300
+    for n in old.colnames:
+        assert old[n].dtype==new[n].dtype
+        assert np.array_equal(np.asarray(old[n]),np.asarray(new[n]))
+
+
+def test_daoread_values(simfiles):
+    files,secat = simfiles
+    lst = daoio.daoread(files['lst'])
+    assert np.array_equal(lst['ID'],secat['NUMBER'])
+    assert np.allclose(lst['X'],secat['X_IMAGE']+1,atol=5e-4)
+    ap = daoio.daoread(files['ap'])
+    assert ap['MAG'].shape==(300,5)
+    assert np.all(ap['ERR'][ap['MAG']==99.999]==9.9999)
+
+
+@pytest.mark.parametrize('fmt',['coo','lst','als'])
+def test_sextodao_same_as_phot(simfiles,tmp_path,fmt):
+    files,secat = simfiles
+    meta = {'NAXIS1':2046,'NAXIS2':4094,'SATURATE':38652.0,'RDNOISE':6.0,'GAIN':3.9,'SKYMED':1600.,'SKYRMS':10.}
+    logger = logging.getLogger('daoio')
+    phot.sextodao(secat,meta,str(tmp_path/'old'),format=fmt,logger=logger,fast=False)
+    daoio.sextodao(secat,meta,str(tmp_path/'new'),format=fmt,logger=logger)
+    assert open(str(tmp_path/'old'),'rb').read()==open(str(tmp_path/'new'),'rb').read()
+    # and it reads back
+    assert len(daoio.daoread(str(tmp_path/'new')))==len(secat)
+
+
+def test_aperswrite(tmp_path):
+    apers = [3.0,3.7965,4.2431,5.0,6.5,10.0,15.0,20.0]
+    phot.aperswrite(str(tmp_path/'old.opt'),apers,fast=False)
+    daoio.aperswrite(str(tmp_path/'new.opt'),apers)
+    new = open(str(tmp_path/'new.opt')).read()
+    assert open(str(tmp_path/'old.opt')).read()==new
+    assert new.split('\n')[-3:-1]==['IS = 15.0000','OS = 20.0000']
+
+
+def test_fixedwidth_short_lines():
+    f = daoio.fixedwidth([b'   12  1.5',b'    7'],[5,5])
+    assert f[0].astype(int).tolist()==[12,7]
+    assert f[1].tolist()==[b'  1.5',b'']
+
+
+def test_missing_file(tmp_path):
+    assert daoio.daoread(str(tmp_path/'none.als')) is None
@@ -0,0 +1,59 @@
+import os
+import glob
+
+import numpy as np
+
+import daostub
+import daosession
+import phot
+
+# phot.daoread(fast=False) uses the python 2 "long"
+if not hasattr(phot,'long'): phot.long = int
+
+
+def test_benchmark_same_products(tmp_path):
+    assert daosession.benchmark(nstars=100,nx=256,ny=512,tmpdir=str(tmp_path))
+
+
+def test_parsescript():
+    lines = ['#!/bin/sh\n','daophot << END_DAOPHOT >> F1.log\n','OPTIONS\n','F1.opt\n','\n','ATTACH F1.fits\n',
+             'PICKPSF\n','F1.ap\n','EXIT\n','EXIT\n','END_DAOPHOT\n']
+    prog,logfile,inputs = daosession.parsescript(lines)
+    assert (prog,logfile)==('daophot','F1.log')
+    assert inputs==lines[2:8]
+    assert daosession.parsescript(''.join(lines))==(prog,logfile,inputs)
+
+
+def test_session_ramdisk_exports(tmp_path,monkeypatch):
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    daostub.mkstub(str(bindir))
+    countfile = str(tmp_path/'count.txt')
+    monkeypatch.setenv('PATH',str(bindir)+os.pathsep+os.environ['PATH'])
+    monkeypatch.setenv('DAOSTUB_COUNT',countfile)
+    wdir = tmp_path/'chip'
+    wdir.mkdir()
+    daostub.simchip(str(wdir),nstars=80,nx=256,ny=512)
+    monkeypatch.chdir(str(wdir))
+    session = daosession.DaoSession(ramdisk=True,inputs=['flux_dao.fits','flux_dao.coo','flux_dao.opt'],
+                                    exports=['flux_dao.ap','*.log'])
+    with session:
+        assert os.getcwd()==session.workdir
+        for i in range(3):
+            apcat,maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',session=session)
+            assert len(apcat)>0
+    # only the exports are copied back, the scratch directory is gone
+    assert os.getcwd()==str(wdir)
+    assert not os.path.exists(session.workdir or '/nonexistent')
+    assert os.path.exists('flux_dao.ap') and len(glob.glob('*.log'))>0
+    assert not os.path.exists('flux_dao.apers')
+    # one DAOPHOT for the three stages
+    assert open(countfile).read().split()==['daophot']
+    assert session.nspawn==1 and len(session.stats)==3
+
+
+def test_addstars_flux():
+    im = np.zeros((101,101))
+    daostub.addstars(im,[50.0],[50.0],[1000.0],4.0,rad=50)
+    assert abs(np.sum(im)/1000.0-1)<0.02
+    assert np.unravel_index(np.argmax(im),im.shape)==(50,50)
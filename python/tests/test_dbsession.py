@@ -0,0 +1,47 @@
+import numpy as np
+
+import dbsession
+
+
+def pragma(sess,name):
+    return sess.query('PRAGMA '+name)[0][0]
+
+
+def test_default_session_is_durable(tmp_path):
+    dbfile = str(tmp_path/'durable.db')
+    sess = dbsession.getsession(dbfile)
+    assert pragma(sess,'journal_mode')=='delete'
+    assert pragma(sess,'synchronous')==2   # FULL, the sqlite default
+    assert pragma(sess,'busy_timeout')==600000
+    dbsession.closesession(dbfile)
+
+
+def test_scratch_session_and_reapply(tmp_path):
+    dbfile = str(tmp_path/'scratch.db')
+    sess = dbsession.getsession(dbfile,pragmas=dbsession.SCRATCH_PRAGMAS)
+    assert pragma(sess,'journal_mode')=='wal'
+    assert pragma(sess,'synchronous')==0
+    # No arguments gives back the same session unchanged
+    assert dbsession.getsession(dbfile) is sess
+    assert pragma(sess,'synchronous')==0
+    # Different arguments are applied to the open session
+    sess2 = dbsession.getsession(dbfile,pragmas=dbsession.PRAGMAS+[('synchronous','FULL')],batchsize=10)
+    assert sess2 is sess
+    assert pragma(sess,'synchronous')==2
+    assert sess.batchsize==10
+    dbsession.closesession(dbfile)
+
+
+def test_insert_and_queryarray(tmp_path):
+    dbfile = str(tmp_path/'rows.db')
+    sess = dbsession.getsession(dbfile,batchsize=7)
+    sess.execute('CREATE TABLE t(name TEXT, val REAL)')
+    names = np.char.add('n',np.arange(50).astype(str))
+    vals = np.arange(50)*0.5
+    assert sess.insert('t',['name','val'],[names,vals])==50
+    # committed in batches of 7
+    assert sess.ntrans>=8
+    cat = sess.queryarray('SELECT name,val FROM t',np.dtype([('name',(str,10)),('val',float)]))
+    assert np.all(cat['name']==names)
+    assert np.all(cat['val']==vals)
+    dbsession.closesession(dbfile)
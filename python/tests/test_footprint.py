@@ -0,0 +1,78 @@
+import os
+import multiprocessing
+import numpy as np
+import healpy as hp
+from dlnpyutils import coords
+
+import footprint
+
+
+def _update(args):
+    dbfile, metafiles = args
+    fpindex = footprint.FootprintIndex(dbfile)
+    nadd = fpindex.update(metafiles)
+    fpindex.close()
+    return nadd
+
+
+def checkindex(dbfile,nexp):
+    fpindex = footprint.FootprintIndex(dbfile)
+    sess = fpindex._session()
+    assert fpindex.count()==(nexp,nexp*60)
+    chipid = np.array(sess.query('SELECT chipid FROM chip'))[:,0]
+    assert len(np.unique(chipid))==len(chipid)
+    # Every cell entry points to an existing chip and every chip has cells
+    cellchip = np.array(sess.query('SELECT DISTINCT chipid FROM cellchip'))[:,0]
+    assert set(cellchip)==set(chipid)
+    return fpindex
+
+
+def test_concurrent_updates(tmp_path):
+    metafiles = footprint.simmetafiles(str(tmp_path/'meta'),nexp=12,size=1.0,seed=2)
+    dbfile = str(tmp_path/'footprint.db')
+    # Overlapping lists from several processes at once, like combine jobs
+    jobs = [(dbfile,metafiles[i:i+6]) for i in range(0,12,2)]+[(dbfile,metafiles)]
+    pool = multiprocessing.Pool(4)
+    nadd = pool.map(_update,jobs)
+    pool.close()
+    pool.join()
+    assert np.sum(nadd)==12
+    fpindex = checkindex(dbfile,12)
+    assert fpindex.update(metafiles)==0
+    # A changed meta file is re-indexed and replaces its old chips
+    os.utime(metafiles[3],(1e9,1e9))
+    assert fpindex.update(metafiles)==1
+    fpindex.close()
+    fpindex = checkindex(dbfile,12)
+    fpindex.close()
+
+
+def test_query_matches_all_chips(tmp_path):
+    metafiles = footprint.simmetafiles(str(tmp_path/'meta'),nexp=10,size=1.0,seed=3)
+    fpindex = footprint.FootprintIndex(str(tmp_path/'footprint.db'))
+    fpindex.update(metafiles)
+    allchips = fpindex.getchips()
+    pix = hp.ang2pix(256,120.5,-29.5,lonlat=True)
+    for p in [pix]+list(hp.get_all_neighbours(256,pix)[0:3]):
+        buffdict = footprint.regionbuffer(256,p)
+        expmeta,chips = fpindex.query(buffdict,metafiles)
+        keep = []
+        for j in range(len(allchips)):
+            vlon,vlat = coords.rotsphcen(allchips['vra'][j],allchips['vdec'][j],buffdict['cenra'],buffdict['cendec'],gnomic=True)
+            if coords.doPolygonsOverlap(buffdict['lon'],buffdict['lat'],vlon,vlat): keep.append(allchips['chipid'][j])
+        assert len(keep)>0
+        assert sorted(chips['chipid'])==sorted(keep)
+        assert set(expmeta['metafile'])==set(chips['metafile'])
+    fpindex.close()
+
+
+def test_missing(tmp_path):
+    metafiles = footprint.simmetafiles(str(tmp_path/'meta'),nexp=4,size=1.0,seed=4)
+    fpindex = footprint.FootprintIndex(str(tmp_path/'footprint.db'))
+    fpindex.update(metafiles[0:3])
+    # Meta files that do not exist are not missing, changed ones are not checked
+    os.utime(metafiles[0],(1e9,1e9))
+    assert fpindex.missing(list(metafiles)+[str(tmp_path/'none_meta.fits')])==[metafiles[3]]
+    fpindex.update(metafiles)
+    assert fpindex.missing(metafiles)==[]
+    fpindex.close()
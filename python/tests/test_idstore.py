@@ -0,0 +1,95 @@
+import os
+import multiprocessing
+import numpy as np
+
+import dbsession
+import idstore
+
+
+def test_getexposure_matches_npy_layout(tmp_path):
+    cats = idstore.simidstr(npix=12,nexp=30,nperexp=6,nmeas=50,seed=1)
+    rootdir = str(tmp_path/'ids')
+    npydir = str(tmp_path/'npy')
+    # Concurrent appends, like many pixel jobs
+    pool = multiprocessing.Pool(3)
+    pool.map(idstore._appendone,[(rootdir,)+c for c in cats])
+    pool.close()
+    pool.join()
+    for c in cats: idstore.writenpy(npydir,*c)
+    store = idstore.IdStore(rootdir)
+    nseg,nexp,nrows = store.count()
+    assert nseg==12
+    assert nrows==np.sum([len(c[1]) for c in cats])
+    for exp in store.exposures()['exposure']:
+        cat = store.getexposure(exp)
+        old = idstore.readnpy(npydir,exp)
+        assert sorted(cat['measid'])==sorted(old['measid'])
+        assert dict(zip(cat['measid'],cat['objectid']))==dict(zip(old['measid'],old['objectid']))
+    store.close()
+
+
+def test_replace_remove_and_addidstrdb(tmp_path):
+    store = idstore.IdStore(str(tmp_path/'ids'))
+    store.append('1000',['a1','a2','b1'],['e1','e1','e2'],['o1','o2','o1'])
+    # A re-run replaces the segment of that pixel
+    store.append('1000',['a1','b1'],['e1','e2'],['o5','o6'])
+    assert store.count()==(1,2,2)
+    assert store.getexposure('e1')['objectid'].tolist()==['o5']
+    # The split segments of a pixel take precedence
+    store.append('1000_n256_7',['a9'],['e1'],['o9'])
+    assert store.getexposure('e1')['measid'].tolist()==['a9']
+    assert len(store.getexposure('e1',dedup=False))==2
+    store.remove('1000_n256_7')
+    assert store.getexposure('e1')['measid'].tolist()==['a1']
+    # A combine PIX_idstr.db file
+    dbfile = str(tmp_path/'1001_idstr.db')
+    sess = dbsession.getsession(dbfile)
+    sess.execute('CREATE TABLE idstr(measid TEXT, exposure TEXT, objectid TEXT, objectindex INTEGER)')
+    sess.insert('idstr',['measid','exposure','objectid','objectindex'],[['m1','m2'],['e2','e3'],['p1','p2'],[0,1]])
+    dbsession.closesession(dbfile)
+    assert store.addidstrdb(dbfile)==2
+    cat = store.getexposure('e2')
+    assert sorted(zip(cat['measid'],cat['pix']))==[('b1',1000),('m1',1001)]
+    store.close()
+
+
+def test_replace_retires_old_segment(tmp_path):
+    rootdir = str(tmp_path/'ids')
+    store = idstore.IdStore(rootdir)
+    store.append('1000',['a1','a2'],['e1','e2'],['o1','o2'])
+    oldpath = os.path.join(rootdir,store.segments()['path'][0])
+    # A reader that looked up the old segment before the swap can still read it
+    reader = idstore.IdStore(rootdir)
+    parts = reader._session().query('SELECT path FROM segment')
+    store.append('1000',['a1'],['e1'],['o5'])
+    assert os.path.exists(oldpath) and os.path.exists(os.path.join(rootdir,parts[0][0],'measid.npy'))
+    assert store.getexposure('e1')['objectid'].tolist()==['o5']
+    store.remove('1000')
+    assert store.count()==(0,0,0)
+    # Deleted once nothing has pointed at them for KEEP seconds
+    assert store.purge(keep=3600)==0
+    assert store.purge(keep=0)==2
+    assert not os.path.exists(oldpath) and os.listdir(os.path.dirname(oldpath))==[]
+    reader.close()
+    store.close()
+
+
+def test_renumber_and_getpixel(tmp_path):
+    store = idstore.IdStore(str(tmp_path/'ids'),keep=0)
+    store.append('1000_n256_1',['a1','a2','b1'],['e1','e1','e2'],['1000.1','1000.2','1000.1'])
+    store.append('1000_n256_2',['a2','c1'],['e1','e3'],['1000.1','1000.2'])
+    store.append('1001',['d1'],['e1'],['1001.1'])
+    assert store.renumber('1000_n256_2',['1000.1','1000.2'],['1000.3','1000.4'])==2
+    # the measid column is linked, not rewritten, and the old segment is purged
+    assert store.count()==(3,3,6)
+    assert len(os.listdir(str(tmp_path/'ids'/'segments'/'1')))==3
+    cat = store.getpixel(1000)
+    assert sorted(zip(cat['measid'],cat['exposure'],cat['objectid']))==[
+        ('a1','e1','1000.1'),('a2','e1','1000.2'),('a2','e1','1000.3'),('b1','e2','1000.1'),('c1','e3','1000.4')]
+    assert store.getexposure('e3')['objectid'].tolist()==['1000.4']
+    # The full pixel segment is not used when there are split ones
+    store.append('1000',['z1'],['e1'],['1000.9'])
+    assert 'z1' not in store.getpixel(1000)['measid']
+    assert len(store.getpixel(1000,dedup=False))==6
+    assert len(store.getpixel(1002))==0
+    store.close()
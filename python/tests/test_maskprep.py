@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import maskprep
+
+
+@pytest.mark.parametrize('rule,instcode,plver',[('integer','c4d','V3.9'),('integer','k4m','V4.0'),
+                                                 ('bits','c4d','V3.4.0')])
+def test_convert_same_as_old(rule,instcode,plver):
+    mask = maskprep.simmask(200,100,rule=rule)
+    for dtype in [np.int16,np.int32,np.int64]:
+        m = mask.astype(dtype)
+        new = maskprep.convert(m,instcode,plver)
+        old = maskprep.oldconvert(m.copy(),instcode,plver)
+        assert new.dtype==old.dtype and np.array_equal(new,old)
+        # the input is not modified
+        assert np.array_equal(m,mask.astype(dtype))
+
+
+def test_convert_integer_values():
+    mask = np.arange(8,dtype=np.int16).reshape(2,4)
+    assert maskprep.convert(mask,'c4d','V3.9').ravel().tolist()==[0,1,2,4,8,16,32,64]
+    assert maskprep.maskrule('c4d','V3.4.0')=='bits'
+    assert maskprep.maskrule('xyz','V1') is None
+    assert maskprep.convert(mask,'xyz','V1') is mask
+
+
+@pytest.mark.parametrize('shape',[(3,3),(4,6),(5,2),(1,1)])
+def test_grow_same_as_convolve(shape):
+    mask = maskprep.convert(maskprep.simmask(150,90),'c4d','V3.9')
+    kernel = np.ones(shape,dtype='i')
+    assert np.array_equal(maskprep.grow(mask,shape),maskprep.oldgrow(mask,kernel))
+
+
+def test_prepare():
+    mask = np.zeros((20,20),np.int16)
+    mask[10,10] = 5
+    wt = np.ones((20,20))
+    wt[0,0] = -1
+    flag,wt2,sexmask = maskprep.prepare(mask,wt,'c4d','V3.9',np.ones((3,3),'i'))
+    assert sexmask[10,10]==16 and flag[10,10]==16
+    assert np.sum(flag==1)==8 and flag[9,9]==1 and flag[8,8]==0
+    assert wt2[10,10]==0 and wt2[0,0]==0 and np.sum(wt2==0)==2
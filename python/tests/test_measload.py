@@ -0,0 +1,31 @@
+import numpy as np
+
+import measload
+
+dtype_cat = np.dtype([('MEASID',(str,30)),('EXPOSURE',(str,40)),('RA',float),('DEC',float),('RAERR',float),
+                      ('FWHM',float),('MAG_AUTO',float)])
+
+# Region that cuts some of the measurements
+buffdict = {'cenra':120.25,'cendec':-29.75,'lon':np.array([-0.2,0.2,0.2,-0.2]),'lat':np.array([-0.2,-0.2,0.2,0.2])}
+
+
+def test_loadchips_matches_grow_loader(tmp_path):
+    chfiles = measload.simchipfiles(str(tmp_path),nchips=12,nrows=400,seed=5)
+    cat0 = measload.growload(chfiles,dtype_cat,buffdict)
+    cat,counts,stats = measload.loadchips(chfiles,dtype_cat,buffdict,nthreads=3)
+    assert 0<len(cat)<np.sum([measload.chipsize(f) for f in chfiles])
+    assert np.array_equal(cat,cat0)
+    assert np.sum(counts)==len(cat)==stats['nrows']
+    # The FWHM and RAERR fixes were applied
+    assert np.all(cat['FWHM']>=0) and np.all(cat['RAERR']>0)
+
+
+def test_loadchips_writer_in_chip_order(tmp_path):
+    chfiles = measload.simchipfiles(str(tmp_path),nchips=10,nrows=300,seed=6)
+    written = []
+    cat,counts,stats = measload.loadchips(chfiles,buffdict=buffdict,writer=written.append,nthreads=4)
+    assert len(cat)==0
+    assert [len(c) for c in written]==[c for c in counts if c>0]
+    allcat = np.hstack(written)
+    cat0 = measload.growload(chfiles,dtype_cat,buffdict)
+    assert np.array_equal(allcat['MEASID'].astype(str),cat0['MEASID'])
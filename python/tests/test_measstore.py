@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import measstore
+
+
+@pytest.fixture(params=['sqlite','npy'])
+def store(request,tmp_path):
+    path = str(tmp_path/'meas')
+    if request.param=='sqlite': path += '.db'
+    st = measstore.openstore(path,request.param)
+    for cat in measstore.simchips(2000,10,seed=3): st.write(cat)
+    st.finalize()
+    yield st
+    st.remove()
+
+
+def test_count_and_range(store):
+    cats = measstore.simchips(2000,10,seed=3)
+    allcat = np.hstack(cats)
+    assert store.count()==len(allcat)
+    rng = store.radecrange()
+    assert np.allclose(rng,[allcat['RA'].min(),allcat['RA'].max(),allcat['DEC'].min(),allcat['DEC'].max()])
+    # A box query returns exactly the rows inside the box
+    rar = [10.1,10.3]
+    decr = [-19.9,-19.7]
+    cat = store.getdata(rar=rar,decr=decr)
+    inbox = (allcat['RA']>=rar[0]) & (allcat['RA']<rar[1]) & (allcat['DEC']>=decr[0]) & (allcat['DEC']<decr[1])
+    assert np.sum(inbox)>0
+    assert sorted(cat['MEASID'])==sorted(allcat['MEASID'][inbox])
+
+
+def test_labels_and_deletes(store):
+    coords = store.getcoords()
+    rowid = np.sort(coords['ROWID'])
+    labels = np.arange(len(rowid))//4
+    store.setlabels(rowid,labels)
+    store.createindex('objlabel')
+    cat = store.getdata(objlabel=7)
+    assert len(cat)==4
+    assert np.all(cat['OBJLABEL']==7)
+    assert sorted(cat['ROWID'])==rowid[28:32].tolist()
+    cat = store.getdata(objlabel=[0,9])
+    assert len(cat)==40
+    # Deleted rows are gone from the count and from every query
+    store.deleterows(rowid[28:30])
+    assert store.count()==len(rowid)-2
+    cat = store.getdata(objlabel=7)
+    assert sorted(cat['ROWID'])==rowid[30:32].tolist()
+    assert np.sum(np.isin(store.getcoords()['ROWID'],rowid[28:30]))==0
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        measstore.openstore(str(tmp_path/'x'),'hdf5')
@@ -0,0 +1,25 @@
+import numpy as np
+
+import objparent
+
+
+def test_matches_polygon_loop():
+    obj = objparent.simobj(4000,size=0.2*np.sqrt(4000/1e5),seed=1)
+    parent0, nerror = objparent.loopparent(obj)
+    out = objparent.find_obj_parent(obj.copy())
+    assert np.sum(parent0)>0
+    assert np.array_equal(out['parent'],parent0)
+
+
+def test_companion_inside_ellipse():
+    dtype = np.dtype([('ra',float),('dec',float),('asemi',np.float32),('bsemi',np.float32),
+                      ('theta',np.float32),('fwhm',np.float32)])
+    obj = np.zeros(4,dtype=dtype)
+    # A large round object with a companion 0.3" away, and an isolated pair 1.5" apart
+    obj['ra'] = [10.0,10.0,10.1,10.1]
+    obj['dec'] = [20.0,20.0+0.3/3600,20.0,20.0+1.5/3600]
+    obj['asemi'] = [1.0,0.3,1.0,0.3]
+    obj['bsemi'] = [1.0,0.3,1.0,0.3]
+    obj['fwhm'] = [3.0,1.0,3.0,1.0]
+    out = objparent.find_obj_parent(obj.copy())
+    assert out['parent'].tolist()==[True,False,False,False]
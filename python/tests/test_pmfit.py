@@ -0,0 +1,51 @@
+import numpy as np
+
+import pmfit
+
+
+def test_compare_regression():
+    # Tolerances are documented in pmfit.compare()
+    out = pmfit.compare(nobj=300,nmeas=15,seed=2)
+    assert out['ok']
+    assert out['pmra_wtnsig'] < 1e-6 and out['pmdec_wtnsig'] < 1e-6
+
+
+def test_pmsolve_exact_motion():
+    # Noise-free linear motion is recovered exactly, across RA=0
+    mjd = 56000+np.array([0.,300,700,1200,2000,0,500,1000])
+    label = np.array([5,5,5,5,5,9,9,9])
+    dt = (mjd-56000)/365.2425
+    dec = np.where(label==5,30.0,-10.0)+np.where(label==5,-8.0,3.0)*dt/3.6e6
+    ra = (np.where(label==5,359.99999,120.0)+np.where(label==5,12.0,-4.0)*dt/3.6e6/np.cos(np.radians(dec))) % 360
+    err = np.full(len(mjd),0.01)
+    pm = pmfit.pmsolve(label,mjd,ra,dec,err,err)
+    assert list(pm['label']) == [5,9]
+    assert list(pm['ndet']) == [5,3]
+    np.testing.assert_allclose(pm['pmra'],[12.0,-4.0],atol=1e-3)
+    np.testing.assert_allclose(pm['pmdec'],[-8.0,3.0],atol=1e-6)
+
+
+def test_pmsolve_single_measurement_is_nan():
+    pm = pmfit.pmsolve(np.array([1,2,2]),np.array([56000.,56000,56400]),np.array([10.,20,20]),
+                       np.array([0.,5,5]),np.full(3,0.01),np.full(3,0.01))
+    assert np.isnan(pm['pmra'][0]) and np.isnan(pm['pmraerr'][0])
+    assert np.isfinite(pm['pmra'][1])
+
+
+
+def test_robustsolve_exact_motion():
+    # Same output layout as pmsolve, noise-free motion is recovered across RA=0
+    mjd = 56000+np.array([0.,300,700,1200,2000,0,500,1000,400])
+    label = np.array([5,5,5,5,5,9,9,9,11])
+    dt = (mjd-56000)/365.2425
+    dec = np.where(label==5,30.0,-10.0)+np.where(label==5,-8.0,3.0)*dt/3.6e6
+    ra = (np.where(label==5,359.99999,120.0)+np.where(label==5,12.0,-4.0)*dt/3.6e6/np.cos(np.radians(dec))) % 360
+    err = np.full(len(mjd),0.01)
+    pm = pmfit.robustsolve(label,mjd,ra,dec,err,err)
+    assert pm.dtype == pmfit.pmsolve(label,mjd,ra,dec,err,err).dtype
+    assert list(pm['label']) == [5,9,11]
+    assert list(pm['ndet']) == [5,3,1]
+    np.testing.assert_allclose(pm['pmra'][:2],[12.0,-4.0],atol=1e-3)
+    np.testing.assert_allclose(pm['pmdec'][:2],[-8.0,3.0],atol=1e-3)
+    assert np.isnan(pm['pmra'][2]) and np.isnan(pm['pmdecerr'][2])
+    assert len(pmfit.robustsolve(np.zeros(0,int),[],[],[],[],[])) == 0
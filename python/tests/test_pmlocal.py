@@ -0,0 +1,43 @@
+import os
+
+import dbsession
+import idstore
+import pmlocal
+
+
+def test_local_refit_matches_robust_slope(tmp_path):
+    # Same estimator as the database mode
+    assert pmlocal.test(npix=2,nobj=400,nexp=12,nproc=2,tmpdir=str(tmp_path))
+
+
+def test_local_refit_batch_matches_pmsolve(tmp_path):
+    assert pmlocal.test(npix=1,nobj=400,nexp=12,nproc=1,batch=True,tmpdir=str(tmp_path))
+
+
+def test_readidstr_split_pixels(tmp_path):
+    hdir = str(tmp_path)
+    for name,rows in [('1000_n256_1',[('m1','e1','o1'),('m2','e1','o2')]),
+                      ('1000_n256_2',[('m2','e1','o2'),('m3','e2','o3')])]:
+        dbfile = os.path.join(hdir,name+'_idstr.db')
+        sess = dbsession.getsession(dbfile)
+        sess.execute('CREATE TABLE idstr(measid TEXT, exposure TEXT, objectid TEXT, objectindex INTEGER)')
+        sess.insert('idstr',['measid','exposure','objectid','objectindex'],list(zip(*[r+(0,) for r in rows])))
+        dbsession.closesession(dbfile)
+    dbfiles = pmlocal.idstrfiles(hdir,1000)
+    assert len(dbfiles)==2
+    # m2 is in the buffer of both subpixels and is only returned once
+    idstr = pmlocal.readidstr(dbfiles)
+    assert idstr['measid'].tolist()==['m1','m2','m3']
+    assert idstr['objectid'].tolist()==['o1','o2','o3']
+    assert len(pmlocal.readidstr([]))==0
+
+
+def test_readstore_same_as_idstr_databases(tmp_path):
+    pmlocal.simpixel(str(tmp_path/'combine'),str(tmp_path/'meas'),1000,nobj=50,nexp=5)
+    hdir = str(tmp_path/'combine'/'1')
+    store = idstore.IdStore(str(tmp_path/'ids'))
+    store.addidstrdb(os.path.join(hdir,'1000_idstr.db'))
+    store.close()
+    old = pmlocal.readidstr(pmlocal.idstrfiles(hdir,1000))
+    new = pmlocal.readstore(str(tmp_path/'ids'),1000)
+    assert sorted(zip(old['measid'],old['exposure'],old['objectid']))==sorted(zip(new['measid'],new['exposure'],new['objectid']))
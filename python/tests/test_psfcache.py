@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+import daostub
+import daosession
+import phot
+import psfcache
+
+# phot.daoread(fast=False) uses the python 2 "long"
+if not hasattr(phot,'long'): phot.long = int
+
+
+def fakepsf(fil,model):
+    with open(fil,'w') as f:
+        f.write('%s    25    3    2    0   13.262     28000.0   1024.5   2048.5\n' % model)
+    return fil
+
+
+def fakelist(fil,n):
+    with open(fil,'w') as f:
+        f.write(' NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n')
+        f.write('  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n\n')
+        for i in range(n):
+            f.write('%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n' % (i+1,10.0+i,20.0+2*i,15.0,0.01,1600.0))
+    return fil
+
+
+def test_put_and_lookup(tmp_path):
+    cache = psfcache.PsfCache(str(tmp_path/'cache'))
+    assert cache.lookup('c4d',5,1.0) is None
+    psf = fakepsf(str(tmp_path/'a.psf'),'MOFFAT25')
+    lst = fakelist(str(tmp_path/'a.lst'),10)
+    entry = cache.put('c4d',5,1.0,psf,lst,chi=np.float64(0.02),iterchi=0.021,nwarm=2)
+    assert entry['model']=='MOFFAT25' and entry['an']==3 and isinstance(entry['chi'],float)
+    got = cache.lookup('c4d',5,1.02)
+    assert got['exact'] and got['nwarm']==2
+    assert open(got['psffile']).read()==open(psf).read()
+    assert open(got['listfile']).read()==open(lst).read()
+    # other seeing bin
+    assert cache.lookup('c4d',5,1.5) is None
+    assert (cache.nhit,cache.nmiss)==(1,2)
+
+
+def test_put_replaces_whole_entry(tmp_path):
+    cache = psfcache.PsfCache(str(tmp_path))
+    e1 = cache.put('c4d',1,1.0,fakepsf(str(tmp_path/'1.psf'),'GAUSSIAN'),fakelist(str(tmp_path/'1.lst'),7),chi=0.03)
+    old = cache.read(e1['key'])
+    e2 = cache.put('c4d',1,1.0,fakepsf(str(tmp_path/'2.psf'),'PENNY2'),fakelist(str(tmp_path/'2.lst'),9),chi=0.02)
+    new = cache.read(e2['key'])
+    # each version has its own pair of files, the JSON file points to one of them
+    assert new['psffile']!=old['psffile'] and new['listfile']!=old['listfile']
+    assert psfcache.psfmodel(new['psffile'])[0]=='PENNY2'
+    assert len(open(new['listfile']).readlines())==3+9
+    # the replaced version stays readable for a while
+    assert psfcache.psfmodel(old['psffile'])[0]=='GAUSSIAN'
+    os.utime(old['psffile'],(0,0))
+    os.utime(old['listfile'],(0,0))
+    cache.put('c4d',1,1.0,str(tmp_path/'2.psf'),str(tmp_path/'2.lst'),chi=0.02)
+    assert not os.path.exists(old['psffile']) and not os.path.exists(old['listfile'])
+    assert os.path.exists(new['psffile'])
+    assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('.tmp')])==0
+
+
+def test_other_ccd_majority_model(tmp_path):
+    cache = psfcache.PsfCache(str(tmp_path))
+    for ccd,model in [(1,'MOFFAT25'),(2,'MOFFAT25'),(3,'PENNY2')]:
+        cache.put('c4d',ccd,1.0,fakepsf(str(tmp_path/'x.psf'),model),fakelist(str(tmp_path/'x.lst'),7))
+    entry = cache.lookup('c4d',4,1.0)
+    assert entry['exact'] is False and entry['model']=='MOFFAT25' and entry['ccdnum']==2
+    assert cache.lookup('k4m',4,1.0) is None
+
+
+def test_recheck():
+    cache = psfcache.PsfCache.__new__(psfcache.PsfCache)
+    cache.rtol,cache.maxwarm = 0.1,3
+    entry = {'chi':0.020,'iterchi':0.022,'nwarm':0}
+    assert not cache.recheck(entry,0.024)
+    assert cache.recheck(entry,0.0243)
+    entry['nwarm'] = 3
+    assert cache.recheck(entry,0.01)
+    assert not cache.recheck(None,1.0)
+
+
+def test_convergence():
+    pol = psfcache.Convergence(dchi=0.002,rtol=0.02)
+    assert not pol.update(0.05)
+    assert not pol.update(0.04)
+    assert pol.update(0.0395) and pol.reason=='no improvement'
+    pol = psfcache.Convergence(target=0.03)
+    assert pol.update(0.0305) and pol.reason=='reached cached chi'
+
+
+def test_matchlist_offset():
+    rnd = np.random.RandomState(2)
+    x,y = rnd.uniform(0,500,60),rnd.uniform(0,500,60)
+    ind1,ind2 = psfcache.matchlist(x,y,x[10:]+7.3,y[10:]-4.1)
+    assert np.array_equal(ind1,np.arange(10,60)) and np.array_equal(ind2,np.arange(50))
+
+
+def test_warm_start_rechecks_wrong_model(tmp_path,monkeypatch):
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    daostub.mkstub(str(bindir))
+    monkeypatch.setenv('PATH',str(bindir)+os.pathsep+os.environ['PATH'])
+    logger = logging.getLogger('psfcache')
+    cache = psfcache.PsfCache(str(tmp_path/'cache'),logger=logger)
+    models = {}
+    for mode in ['cold','warm']:
+        wdir = tmp_path/mode
+        wdir.mkdir()
+        fwhm = psfcache.simfield(str(wdir),ccdnum=3,nstars=200,nx=512,ny=1024)
+        monkeypatch.chdir(str(wdir))
+        if mode=='warm':
+            # a wrong model in the cache, with a better chi than this chip can get with it
+            e = cache.put('c4d',3,fwhm,fakepsf(str(tmp_path/'g.psf'),'GAUSSIAN'),str(tmp_path/'cold'/'flux_dao.lst'),
+                          chi=0.001,iterchi=0.001,nwarm=1)
+            assert e['model']=='GAUSSIAN'
+        meta = {}
+        with daosession.DaoSession(logger=logger) as session:
+            apcat,maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',logger=logger,session=session)
+            phot.daopickpsf('flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,logger=logger,session=session)
+            if mode=='cold':
+                phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,logger=logger,session=session)
+            else:
+                phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,psfcache=cache,
+                               cachekey=('c4d',3,fwhm),logger=logger,session=session)
+        models[mode] = psfcache.psfmodel('flux_dao.psf')[0]
+    assert meta['PSFWARM'][0] and cache.nrecheck==1
+    assert models['warm']==models['cold']!='GAUSSIAN'
+    entry = cache.lookup('c4d',3,fwhm)
+    assert entry['model']==models['cold'] and entry['nwarm']==0
+    assert json.load(open(os.path.join(cache.cachedir,entry['key']+'.json')))['nwarm']==0
+
+
+def test_createpsf_keeps_best_iteration(tmp_path,monkeypatch):
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    daostub.mkstub(str(bindir))
+    monkeypatch.setenv('PATH',str(bindir)+os.pathsep+os.environ['PATH'])
+    logger = logging.getLogger('psfcache')
+    psfcache.simfield(str(tmp_path),ccdnum=3,nstars=200,nx=512,ny=1024)
+    monkeypatch.chdir(str(tmp_path))
+    # Chi gets worse in the third iteration, the fit after the loop has to use
+    #  the PSF stars of the second
+    chis = [0.05,0.04,0.045,0.04]
+    lists = []
+    daopsf = phot.daopsf
+    def fakechi(imfile,listfile,apfile,**kwargs):
+        pararr, parchi, profs = daopsf(imfile,listfile,apfile,**kwargs)
+        lists.append(open(listfile).read())
+        # always some stars to reject
+        profs['SIG'][0] = 100*np.median(profs['SIG'])
+        return pararr, np.zeros(len(parchi))+chis[len(lists)-1], profs
+    monkeypatch.setattr(phot,'daopsf',fakechi)
+    meta = {}
+    apcat,maglim = phot.daoaperphot('flux_dao.fits','flux_dao.coo',outfile='flux_dao.ap',logger=logger)
+    phot.daopickpsf('flux_dao.fits','flux_dao.ap',maglim,'flux_dao.lst',100,logger=logger)
+    phot.createpsf('flux_dao.fits','flux_dao.ap','flux_dao.lst',meta=meta,subneighbors=False,logger=logger)
+    assert len(lists)==4 and meta['PSFITER'][0]==3
+    assert lists[3]==lists[1] and lists[2]!=lists[1]
+    assert meta['PSFCHI'][0]==0.04
+    assert not os.path.exists('flux_dao.lst.best')
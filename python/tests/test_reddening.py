@@ -0,0 +1,41 @@
+import warnings
+import numpy as np
+import healpy as hp
+import pytest
+
+import reddening
+
+
+@pytest.fixture(scope='module')
+def sfddir(tmp_path_factory):
+    return reddening.simsfd(str(tmp_path_factory.mktemp('sfd')),size=1024)
+
+
+def test_map_matches_sfd_at_pixel_centers(sfddir,tmp_path):
+    from dustmaps.sfd import SFDQuery
+    from astropy.coordinates import SkyCoord
+    mapfile = reddening.buildmap(str(tmp_path/'ebv.npy'),128,sfddir,verbose=False)
+    emap = reddening.getmap(mapfile)
+    assert emap.nside==128
+    rnd = np.random.RandomState(3)
+    pix = rnd.choice(hp.nside2npix(128),2000,replace=False)
+    ra,dec = hp.pix2ang(128,pix,lonlat=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ref = SFDQuery(sfddir)(SkyCoord(ra,dec,frame='icrs',unit='deg'))
+    assert np.allclose(reddening.ebv(ra,dec,interp=False,mapfile=mapfile),ref,rtol=1e-6)
+    assert np.allclose(reddening.ebv(ra,dec,interp=True,mapfile=mapfile),ref,rtol=1e-5)
+    # The map is opened once per process
+    assert reddening.getmap(mapfile) is emap
+    reddening._maps.clear()
+
+
+def test_accuracy_improves_with_nside(sfddir,tmp_path):
+    acc = []
+    for nside in [128,256]:
+        mapfile = reddening.buildmap(str(tmp_path/('ebv%d.npy' % nside)),nside,sfddir,verbose=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            acc.append(reddening.accuracy(mapfile,sfddir,n=20000,verbose=False))
+    assert acc[1]['absmed']<0.5*acc[0]['absmed']
+    assert acc[1]['within']>acc[0]['within']
@@ -0,0 +1,92 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+
+import scheduler
+
+
+def test_workers_run_every_task_once(tmp_path):
+    # In a fresh interpreter, the peak RSS of a task includes that of the
+    #  process it was forked from and the test process can be large
+    code = 'import sys,scheduler; sys.exit(0 if scheduler.test(ntasks=20,nworkers=2,nmulti=2,tmpdir=%r) else 1)' % str(tmp_path)
+    pydir = os.path.dirname(os.path.abspath(scheduler.__file__))
+    res = subprocess.run([sys.executable,'-c',code],cwd=pydir,capture_output=True,text=True)
+    assert res.returncode==0, res.stdout+res.stderr
+
+
+def test_manifest_claim_and_finish(tmp_path):
+    man = scheduler.Manifest(str(tmp_path/'manifest.db'),maxattempts=2)
+    assert man.add(['a','b','c'],['true','true','true'],priority=[1,3,2])==3
+    # Lowest priority value first, and a claimed task is not claimed again
+    claimed = man.claim(2,pid=os.getpid())
+    assert [t['name'] for t in claimed]==['a','c']
+    assert [t['name'] for t in man.claim(5,pid=os.getpid())]==['b']
+    assert len(man.claim(1))==0
+    assert man.finish('b',0)=='done'
+    # A failed task with attempts left goes back to pending, then fails for good
+    assert man.finish('c',1)=='pending'
+    assert [t['name'] for t in man.claim(1,pid=os.getpid())]==['c']
+    assert man.finish('c',1)=='failed'
+    assert man.counts()['running']==1
+    # The running task of a process that is gone is recovered
+    man.setpid('a',2**22+12345)
+    assert man.recover()==1
+    assert man.counts()=={'pending':1,'running':0,'done':1,'failed':1}
+    man.close()
+
+
+def test_shared_manifest_no_wal(tmp_path):
+    dbfile = str(tmp_path/'manifest.db')
+    man = scheduler.Manifest(dbfile)
+    assert man.db.execute('PRAGMA journal_mode').fetchone()[0]=='wal'
+    man.close()
+    # A manifest shared over NFS uses the rollback journal
+    man = scheduler.Manifest(dbfile,shared=True)
+    assert man.db.execute('PRAGMA journal_mode').fetchone()[0]=='delete'
+    assert man.add(['a'],['true'])==1
+    man.close()
+    assert not os.path.exists(dbfile+'-wal')
+
+
+def test_claim_memory_cap(tmp_path):
+    man = scheduler.Manifest(str(tmp_path/'manifest.db'))
+    man.add(['a','b','c','d'],['true']*4,priority=[0,1,2,3],mem=[6e9,5e9,3e9,1e9])
+    # b does not fit next to a, the smaller ones after it do
+    assert [t['name'] for t in man.claim(1,pid=os.getpid(),maxmem=10e9)]==['a']
+    assert [t['name'] for t in man.claim(3,pid=os.getpid(),maxmem=4e9)]==['c','d']
+    assert len(man.claim(1,maxmem=4e9))==0
+    assert [t['name'] for t in man.claim(1,pid=os.getpid())]==['b']
+    # The settings for the workers
+    assert man.getvalue('maxmem') is None
+    man.setvalue('maxmem',8e9)
+    assert man.getvalue('maxmem')==8e9
+    man.setvalue('maxmem',None)
+    assert man.getvalue('maxmem',1.0)==1.0
+    man.close()
+
+
+def test_runworker_memory_cap(tmp_path):
+    dbfile = str(tmp_path/'manifest.db')
+    man = scheduler.Manifest(dbfile,shared=True)
+    names = ['t%d' % i for i in range(6)]
+    # Each pair of the big tasks is over the cap, the small ones fit next to a big one
+    mem = [6e9,6e9,6e9,1e9,1e9,1e9]
+    man.add(names,['sleep 0.3']*6,mem=mem)
+    man.setvalue('maxmem',8e9)
+    man.close()
+    counts = scheduler.runworker(dbfile,nmulti=3,shared=True)
+    assert counts['done']==6
+    man = scheduler.Manifest(dbfile,shared=True)
+    tasks = man.tasks()
+    man.close()
+    assert list(tasks['mem'])==mem
+    # The predicted memory of the tasks running at any time stays under the cap
+    for t in tasks:
+        now = (tasks['started']<=t['started']) & (tasks['finished']>t['started'])
+        assert np.sum(tasks['mem'][now])<=8e9
+    # and the small tasks did run next to the big ones
+    big = tasks[:3]
+    small = tasks[3:]
+    assert any(np.any((big['started']<=s['started']) & (big['finished']>s['started'])) for s in small)
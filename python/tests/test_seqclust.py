@@ -0,0 +1,28 @@
+import numpy as np
+
+import seqclust
+
+
+def test_seqcluster_matches_loop():
+    cat = seqclust.simexposures(nexp=15,nstar=3000,nnoise=20,size=0.3,fov=0.15,seed=4)
+    labels,obj = seqclust.seqcluster(cat,dcr=0.5)
+    labels0,obj0 = seqclust.loopseqcluster(cat,dcr=0.5)
+    assert len(obj)==len(obj0)
+    assert np.array_equal(labels,labels0)
+    assert np.allclose(obj['ra'],obj0['ra'])
+    assert np.array_equal(obj['ndet'],obj0['ndet'])
+
+
+def test_seqcluster_recovers_stars():
+    # Two exposures of the same three stars, all measured within the radius
+    dtype = np.dtype([('EXPOSURE',(str,20)),('RA',np.float64),('DEC',np.float64),('RAERR',np.float64),('DECERR',np.float64)])
+    cat = np.zeros(6,dtype=dtype)
+    cat['EXPOSURE'] = ['e1','e1','e1','e2','e2','e2']
+    cat['RA'] = [10.0,10.001,10.002,10.0+0.1/3600,10.002,10.001]
+    cat['DEC'] = [5.0,5.0,5.0,5.0,5.0+0.1/3600,5.0]
+    labels,obj = seqclust.seqcluster(cat,dcr=0.5)
+    assert len(obj)==3
+    assert labels[0]==labels[3]
+    assert labels[1]==labels[5]
+    assert labels[2]==labels[4]
+    assert np.all(obj['ndet']==2)
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+import sexconfig
+
+CONFIGDIR = os.path.join(os.path.dirname(os.path.abspath(sexconfig.__file__)),'..','params','')
+
+
+def test_benchmark_same_settings(tmp_path):
+    assert sexconfig.benchmark(nchips=3,tmpdir=str(tmp_path))
+
+
+def test_parseline():
+    assert sexconfig.parseline('GAIN   4.0   # detector gain\n')==('GAIN','4.0','# detector gain')
+    assert sexconfig.parseline('# comment\n') is None
+    assert sexconfig.parseline('   \n') is None
+    assert sexconfig.parseconfig(['GAIN 1\n','GAIN 2\n'],{'SATUR_LEVEL':5})=={'GAIN':'2','SATUR_LEVEL':'5'}
+
+
+def test_template_matches_old_setup(tmp_path):
+    wdir = tmp_path/'old'
+    wdir.mkdir()
+    sexconfig._TEMPLATES.clear()
+    cmd,kernel = sexconfig.oldsetup(CONFIGDIR,str(wdir),45000.0,4.1,1.2,0.27)
+    old = sexconfig.parseconfig(open(str(wdir/'default.config')).readlines())
+    tmpl = sexconfig.gettemplate(CONFIGDIR,'c4d',0.27,str(tmp_path/'shared'))
+    overrides = {'SATUR_LEVEL':45000.0,'GAIN':4.1,'SEEING_FWHM':1.2,'WEIGHT_IMAGE':'wt.fits'}
+    new = tmpl.settings(overrides)
+    for k in sexconfig.AUXKEYS:
+        assert os.path.basename(new.pop(k))==old.pop(k)
+    assert new==old
+    assert np.array_equal(kernel,tmpl.kernel)
+    # render() gives the same settings as the command-line overrides
+    assert sexconfig.parseconfig(tmpl.render(overrides).split('\n'))==tmpl.settings(overrides)
+    cmd = tmpl.command('flux.fits',{'GAIN':4.1})
+    assert cmd==['sex','flux.fits','-c',tmpl.configfile,'-GAIN','4.1']
+
+
+def test_template_parsed_once_and_shared(tmp_path):
+    sexconfig._TEMPLATES.clear()
+    t1 = sexconfig.gettemplate(CONFIGDIR,'c4d',0.27,str(tmp_path))
+    assert sexconfig.gettemplate(CONFIGDIR,'c4d',0.27,str(tmp_path)) is t1
+    t2 = sexconfig.gettemplate(CONFIGDIR,'k4m',0.258,str(tmp_path))
+    assert t2.dir!=t1.dir and t2.configfile!=t1.configfile
+    assert sexconfig.aperstring(0.258) in open(t2.configfile).read()
+    for f in os.listdir(t1.dir):
+        assert (os.stat(os.path.join(t1.dir,f)).st_mode & 0o222)==0
+    # A second instance (another process) reuses the files
+    t3 = sexconfig.SexTemplate(CONFIGDIR,'c4d',0.27,str(tmp_path))
+    assert t3.configfile==t1.configfile
+    for root,dirs,files in os.walk(str(tmp_path)):
+        for f in files: os.chmod(os.path.join(root,f),0o644)
+
+
+def test_writeonce(tmp_path):
+    fil = str(tmp_path/'a.txt')
+    sexconfig.writeonce(fil,b'first')
+    sexconfig.writeonce(fil,b'second')
+    assert open(fil).read()=='first'
+    assert os.listdir(str(tmp_path))==['a.txt']
+    os.chmod(fil,0o644)
@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+import pytest
+
+import stagelog
+
+
+def test_benchmark(tmp_path):
+    assert stagelog.benchmark(nexp=1,nchips=1,nstars=100,nx=256,ny=512,tmpdir=str(tmp_path))
+
+
+def test_popen_only_counted_in_stages(tmp_path):
+    # importing the module leaves subprocess alone
+    assert subprocess.Popen is stagelog._Popen
+    slog = stagelog.StageLog(str(tmp_path/'s.jsonl'),exposure='e1',ccdnum=3)
+    with slog.stage('two') as rec:
+        assert subprocess.Popen is stagelog._CountingPopen
+        subprocess.call(['true'])
+        subprocess.check_output(['true'])
+        rec['extra'] = 5
+    assert subprocess.Popen is stagelog._Popen
+    subprocess.call(['true'])
+    with slog.stage('none'):
+        pass
+    recs = slog.records
+    assert [r['nlaunch'] for r in recs]==[2,0]
+    assert recs[0]['extra']==5 and recs[0]['ccdnum']==3 and recs[0]['status']=='ok'
+    assert recs[0]['wall']>0 and recs[0]['cpu_children']>=0
+
+
+def test_nested_and_failed_stages():
+    slog = stagelog.StageLog()
+    with slog.stage('outer'):
+        with slog.stage('inner'):
+            subprocess.call(['true'])
+        assert subprocess.Popen is stagelog._CountingPopen
+        subprocess.call(['true'])
+    assert subprocess.Popen is stagelog._Popen
+    assert [(r['stage'],r['nlaunch']) for r in slog.records]==[('inner',1),('outer',2)]
+    with pytest.raises(ValueError):
+        with slog.stage('bad'):
+            raise ValueError('broken chip')
+    assert subprocess.Popen is stagelog._Popen
+    assert slog.records[-1]['status']=='error' and 'broken chip' in slog.records[-1]['error']
+    # uninstall() without install() does nothing
+    stagelog.uninstall()
+    assert stagelog._NINSTALL[0]==0
+
+
+def test_total_readrecords_summarize(tmp_path):
+    logfile = str(tmp_path/'a.stages.jsonl')
+    for ccd in [1,2]:
+        slog = stagelog.StageLog(logfile,exposure='e1',extension=ccd,instrument='c4d')
+        for name in ['runsex','createpsf']:
+            with slog.stage(name) as rec:
+                if name=='createpsf': rec['psfiter'] = ccd+1
+        tot = slog.total()
+        assert tot['nstages']==2 and abs(tot['wall']-sum([r['wall'] for r in slog.records[:2]]))<1e-9
+    # a partial line of a killed job is skipped
+    with open(logfile,'a') as f: f.write('{"stage": "runs')
+    records = stagelog.readrecords([str(tmp_path)])
+    assert len(records)==6
+    lines = stagelog.summarize(records,group='instrument')
+    assert lines[0]=='instrument = c4d' and lines[1]=='6 records, 1 exposures, 2 chips'
+    assert [l.split()[0] for l in lines[3:6]]==['runsex','createpsf','total']
+    assert lines[6].startswith('createpsf iterations: mean 2.50')
+    assert os.path.exists(logfile)
@@ -0,0 +1,24 @@
+import numpy as np
+
+import tiledcluster
+
+
+def test_tiled_matches_single_shot(tmp_path):
+    assert tiledcluster.testtiled(nstar=3000,nexp=5,nnoise=800,nper=4000,nproc=2,tmpdir=str(tmp_path))
+
+
+def test_unionfind():
+    uf = tiledcluster.UnionFind(6)
+    uf.union(0,3)
+    uf.union(3,5)
+    uf.union(1,2)
+    assert uf.find(5)==uf.find(0)
+    assert uf.find(1)==uf.find(2)
+    assert uf.find(4)!=uf.find(0)
+    assert len(np.unique(uf.roots()))==3
+
+
+def test_samepartition():
+    assert tiledcluster.samepartition(np.array([0,0,1,-1]),np.array([5,5,2,-1]))
+    assert not tiledcluster.samepartition(np.array([0,0,1,-1]),np.array([5,2,2,-1]))
+    assert not tiledcluster.samepartition(np.array([0,0,1,-1]),np.array([5,5,2,3]))
@@ -0,0 +1,28 @@
+import numpy as np
+from dlnpyutils import utils as dln
+
+import var
+
+
+def test_segmented_engine_matches_loop():
+    assert var.test(nobj=600,nexp=20,seed=3)
+
+
+def test_varmetric_values():
+    # Two filters, r alternates between 10 and 11, g is constant
+    meas = np.zeros(6,dtype=np.dtype([('FILTER',(str,3)),('MJD',float),('MAG_AUTO',float),('MAGERR_AUTO',float)]))
+    meas['FILTER'] = ['r','r','r','r','g','g']
+    meas['MJD'] = [1.0,2.0,3.0,4.0,1.5,2.5]
+    meas['MAG_AUTO'] = [10.0,11.0,10.0,11.0,12.0,12.0]
+    meas['MAGERR_AUTO'] = 0.1
+    obj = var.varmetric(meas)[0]
+    assert obj['ndet']==6 and obj['nphotr']==4 and obj['nphotg']==2
+    # Weighted mean magnitudes
+    rmag = dln.wtmean(meas['MAG_AUTO'][0:4],meas['MAGERR_AUTO'][0:4],magnitude=True,reweight=True)
+    assert np.isclose(obj['rmag'],rmag,atol=1e-5) and np.isclose(obj['gmag'],12.0)
+    resid = np.array([10.0,11.0,10.0,11.0])-rmag
+    assert np.isclose(obj['rrms'],np.sqrt(np.mean(resid**2)),atol=1e-5) and obj['grms']<1e-5
+    # RMS of the residuals of all filters
+    assert np.isclose(obj['rmsvar'],np.sqrt(np.sum(resid**2)/6),atol=1e-5)
+    # Fiducial magnitude is r first
+    assert var.fiducialmag(np.atleast_1d(obj))[0]==obj['rmag']
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+# Parallel tiled clustering of the measurements in a large region.
+#
+# For more than 1M measurements clusterdata() splits the region into an
+# nx x nx RA/DEC grid with a 10" buffer and clusters the subregions one after
+# another, each taking only the measurements that a previous subregion did
+# not label.  That makes every subregion depend on the one before it.
+#
+# Here every tile is clustered independently (buffer included) on a process
+# pool and the tiles are stitched afterwards:
+#
+#  1) Each measurement is in the core (without buffer) of exactly one tile,
+#     the cores are half-open [r0,r1) x [d0,d1) intervals.
+#  2) A tile cluster is "owned" by the tile if its weighted mean position is
+#     in the tile's core, like the boundary rule of the serial code.
+#  3) Union-find over all tile clusters: the owned clusters that share a
+#     measurement are merged.  A measurement that is not in any owned
+#     cluster takes the cluster of its core tile.
+#  4) Final labels are numbered in order of the smallest ROWID.
+#
+# The result does not depend on the tile order or the number of processes.
+# For clusters smaller than the buffer this gives the same partition as
+# clustering the whole region at once, testtiled() checks that with DBSCAN.
+
+import os
+import numpy as np
+import time
+import shutil
+import tempfile
+import functools
+import multiprocessing
+from argparse import ArgumentParser
+import psutil
+from sklearn.cluster import DBSCAN
+
+
+class UnionFind:
+    """ Union-find (disjoint sets) over integer nodes with path compression."""
+
+    def __init__(self,n):
+        self.parent = np.arange(n)
+
+    def find(self,i):
+        parent = self.parent
+        root = i
+        while parent[root]!=root:
+            root = parent[root]
+        # Path compression
+        while parent[i]!=root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(self,i,j):
+        ri = self.find(i)
+        rj = self.find(j)
+        if ri==rj: return
+        # Keep the lower node as the root so the result is deterministic
+        if ri<rj:
+            self.parent[rj] = ri
+        else:
+            self.parent[ri] = rj
+
+    def roots(self):
+        """ Root of every node."""
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand,parent): break
+            parent = grand
+        self.parent = parent
+        return parent.copy()
+
+
+def tilegrid(ranges,ncat,nper=100000,buff=10./3600.0):
+    """ RA/DEC grid of tiles with buffers like clusterdata() uses.
+
+    Parameters
+    ----------
+    ranges : list
+       RA/DEC range of the data [min(ra),max(ra),min(dec),max(dec)].
+    ncat : int
+       Number of measurements.
+    nper : int, optional
+       Approximate number of measurements per tile.  Default is 100000.
+    buff : float, optional
+       Buffer around each tile in degrees.  Default is 10 arcsec.
+
+    Returns
+    -------
+    tiles : list
+       List of dictionaries with the tile number, core ranges (rcore, dcore)
+       and buffered ranges (rar, decr).
+
+    """
+    nsub = int(np.ceil(ncat/nper))
+    nx = int(np.ceil(np.sqrt(nsub)))  # divide RA and DEC intro nx regions
+    xr = [ranges[0]-0.001, ranges[1]+0.001]  # extend slightly
+    dx = (xr[1]-xr[0])/nx
+    if (xr[1]-xr[0])>180:   # across RA=0
+        dx = (xr[0]-(xr[1]-360))/nx
+    yr = [ranges[2]-0.001, ranges[3]+0.001]  # extend slightly
+    dy = (yr[1]-yr[0])/nx
+    mndec = np.mean(yr)
+    rabuff = buff/np.cos(np.deg2rad(mndec))  # correct for cos(dec)
+    tiles = []
+    for r in range(nx):
+        r0 = xr[0]+r*dx
+        r1 = xr[0]+(r+1)*dx
+        for d in range(nx):
+            d0 = yr[0]+d*dy
+            d1 = yr[0]+(d+1)*dy
+            tiles.append({'tile':len(tiles),'rcore':[r0,r1],'dcore':[d0,d1],
+                          'rar':[r0-rabuff,r1+rabuff],'decr':[d0-buff,d1+buff]})
+    return tiles
+
+
+def clusterlabels(cat,clusterfunc):
+    """ Labels of a clustering function that may also return an object catalog."""
+    out = clusterfunc(cat)
+    if isinstance(out,tuple):
+        out = out[0]
+    return np.asarray(out).astype(int)
+
+def dbscanlabels(cat,eps=0.5,minsamples=3):
+    """ DBSCAN on the unit vectors, EPS in arcsec.  Same in every tile."""
+    ra = np.deg2rad(cat['RA'])
+    dec = np.deg2rad(cat['DEC'])
+    X = np.column_stack((np.cos(ra)*np.cos(dec),np.sin(ra)*np.cos(dec),np.sin(dec)))
+    chord = 2*np.sin(np.deg2rad(eps/3600.0)/2)
+    return DBSCAN(eps=chord,min_samples=minsamples).fit(X).labels_
+
+def clustertile(tile,store,clusterfunc):
+    """ Cluster the measurements of one tile including its buffer.
+
+    Returns a dictionary with the ROWID, RA, DEC, RAERR, DECERR and local
+    LABEL of the measurements, INCORE (measurement in the tile core),
+    OWNED (its cluster center is in the tile core) and timing and memory.
+    """
+    t0 = time.time()
+    r0,r1 = tile['rcore']
+    d0,d1 = tile['dcore']
+    cat = store.getdata(rar=tile['rar'],decr=tile['decr'])
+    ncat = len(cat)
+    out = {'tile':tile['tile'],'nmeas':ncat,'nclusters':0,'dt_read':time.time()-t0,'dt_cluster':0.0}
+    if ncat==0:
+        out['rowid'] = np.zeros(0,int)
+        out['label'] = np.zeros(0,int)
+        out['incore'] = np.zeros(0,bool)
+        out['owned'] = np.zeros(0,bool)
+        for n in ['ra','dec','raerr','decerr']: out[n]=np.zeros(0,float)
+    else:
+        t1 = time.time()
+        labels = clusterlabels(cat,clusterfunc)
+        out['dt_cluster'] = time.time()-t1
+        ra = np.asarray(cat['RA'],float)
+        dec = np.asarray(cat['DEC'],float)
+        incore = (ra>=r0) & (ra<r1) & (dec>=d0) & (dec<d1)
+        # Weighted mean cluster centers, noise (label<0) is never owned
+        owned = np.zeros(ncat,bool)
+        gd, = np.where(labels>=0)
+        if len(gd)>0:
+            wt_ra = 1.0/np.asarray(cat['RAERR'][gd],float)**2
+            wt_dec = 1.0/np.asarray(cat['DECERR'][gd],float)**2
+            nlab = np.max(labels[gd])+1
+            cenra = np.bincount(labels[gd],ra[gd]*wt_ra,nlab)/np.maximum(np.bincount(labels[gd],wt_ra,nlab),1e-300)
+            cendec = np.bincount(labels[gd],dec[gd]*wt_dec,nlab)/np.maximum(np.bincount(labels[gd],wt_dec,nlab),1e-300)
+            labowned = (cenra>=r0) & (cenra<r1) & (cendec>=d0) & (cendec<d1)
+            owned[gd] = labowned[labels[gd]]
+            out['nclusters'] = len(np.unique(labels[gd]))
+        out['rowid'] = np.asarray(cat['ROWID'],int)
+        out['label'] = labels
+        out['incore'] = incore
+        out['owned'] = owned
+        out['ra'] = ra
+        out['dec'] = dec
+        out['raerr'] = np.asarray(cat['RAERR'],float)
+        out['decerr'] = np.asarray(cat['DECERR'],float)
+    out['dt_total'] = time.time()-t0
+    out['mem'] = psutil.Process(os.getpid()).memory_info()[0]
+    return out
+
+def _clustertile(args):
+    return clustertile(*args)
+
+
+def stitch(results):
+    """ Merge the tile clusterings with a union-find pass.
+
+    Parameters
+    ----------
+    results : list
+       Outputs of clustertile() for all of the tiles.
+
+    Returns
+    -------
+    rowid : numpy array
+       ROWID of every measurement, sorted.
+    labels : numpy array
+       Final object label of every measurement, -1 for unclustered (noise).
+    index : numpy array
+       Index of each ROWID's core measurement in the concatenated tile arrays.
+
+    """
+    # Global cluster node numbers, offset by tile
+    nodes = []
+    offset = 0
+    for res in results:
+        lab = res['label']
+        node = np.where(lab>=0,lab+offset,-1)
+        nodes.append(node)
+        if len(lab)>0: offset += max(np.max(lab)+1,0)
+    nnodes = offset
+    rowid = np.hstack([res['rowid'] for res in results])
+    node = np.hstack(nodes) if len(nodes)>0 else np.zeros(0,int)
+    owned = np.hstack([res['owned'] for res in results])
+    incore = np.hstack([res['incore'] for res in results])
+    uf = UnionFind(nnodes)
+
+    # Owned clusters that share a measurement are merged
+    ow, = np.where(owned & (node>=0))
+    si = ow[np.lexsort((node[ow],rowid[ow]))]
+    same, = np.where(rowid[si][1:]==rowid[si][0:-1])
+    for i in same:
+        uf.union(node[si[i]],node[si[i+1]])
+    roots = uf.roots()
+
+    # Core measurements, every ROWID once
+    core, = np.where(incore)
+    core = core[np.argsort(rowid[core],kind='stable')]
+    outrowid = rowid[core]
+    if len(outrowid)!=len(np.unique(rowid)):
+        raise ValueError('Tile cores do not cover every measurement exactly once')
+    # Node of the owned cluster, otherwise the cluster of the core tile
+    ownednode = np.zeros(len(outrowid),int)-1
+    if len(ow)>0:
+        ind = np.searchsorted(outrowid,rowid[ow])
+        ownednode[ind] = node[ow]
+    outnode = np.where(ownednode>=0,ownednode,node[core])
+    outroot = np.where(outnode>=0,roots[np.maximum(outnode,0)],-1)
+
+    # Number the objects in order of their smallest ROWID
+    labels = np.zeros(len(outrowid),int)-1
+    gd, = np.where(outroot>=0)
+    if len(gd)>0:
+        uroot, first, inv = np.unique(outroot[gd],return_index=True,return_inverse=True)
+        rank = np.zeros(len(uroot),int)
+        rank[np.argsort(first,kind='stable')] = np.arange(len(uroot))
+        labels[gd] = rank[inv]
+
+    # Index of the core measurements into the concatenated tile arrays
+    return outrowid, labels, core
+
+
+def tiledcluster(store,ncat,clusterfunc,nproc=1,nper=100000,buff=10./3600.0,verbose=True):
+    """ Cluster the measurements of a store in parallel tiles.
+
+    Parameters
+    ----------
+    store : measurement store
+       Store with the measurements, see measstore.py.
+    ncat : int
+       Number of measurements.
+    clusterfunc : function
+       Function that takes a catalog and returns labels (or labels, obj).
+       It must be defined at module level so it can be pickled.
+    nproc : int, optional
+       Number of processes.  Default is 1.
+    nper : int, optional
+       Approximate number of measurements per tile.  Default is 100000.
+    buff : float, optional
+       Tile buffer in degrees.  Default is 10 arcsec.
+    verbose : bool, optional
+       Print per-tile timing and memory.  Default is True.
+
+    Returns
+    -------
+    rowid : numpy array
+       ROWID of every measurement, sorted.
+    labels : numpy array
+       Object label for every measurement.
+    obj : numpy structured array
+       Objects with OBJLABEL, RA, DEC (weighted mean) and NMEAS.
+    stats : list
+       Timing and memory of each tile.
+
+    """
+
+    t0 = time.time()
+    ranges = store.radecrange()  # [min(ra),max(ra),min(dec),max(dec)]
+    tiles = tilegrid(ranges,ncat,nper=nper,buff=buff)
+    if verbose: print(str(len(tiles))+' tiles with '+str(nproc)+' processes')
+
+    args = [(tile,store,clusterfunc) for tile in tiles]
+    if nproc>1:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = list(pool.imap(_clustertile,args))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_clustertile(a) for a in args]
+    t1 = time.time()
+
+    stats = []
+    for res in results:
+        stats.append({'tile':res['tile'],'nmeas':res['nmeas'],'nclusters':res['nclusters'],'dt_read':res['dt_read'],
+                      'dt_cluster':res['dt_cluster'],'dt_total':res['dt_total'],'mem':res['mem']})
+        if verbose:
+            print('tile %4d  %8d meas  %8d clusters  read %7.2f sec  cluster %7.2f sec  %6.2f GB' %
+                  (res['tile'],res['nmeas'],res['nclusters'],res['dt_read'],res['dt_cluster'],res['mem']/1e9))
+
+    # Stitch
+    rowid, labels, core = stitch(results)
+    if verbose: print('stitching done after '+str(time.time()-t1)+' sec.')
+
+    # Weighted mean positions of the objects
+    gd, = np.where(labels>=0)
+    nobj = np.max(labels)+1 if len(gd)>0 else 0
+    ra = np.hstack([res['ra'] for res in results])[core][gd]
+    dec = np.hstack([res['dec'] for res in results])[core][gd]
+    wt_ra = 1.0/np.hstack([res['raerr'] for res in results])[core][gd]**2
+    wt_dec = 1.0/np.hstack([res['decerr'] for res in results])[core][gd]**2
+    obj = np.zeros(nobj,dtype=np.dtype([('OBJLABEL',int),('RA',float),('DEC',float),('NMEAS',int)]))
+    obj['OBJLABEL'] = np.arange(nobj)
+    obj['NMEAS'] = np.bincount(labels[gd],minlength=nobj)
+    obj['RA'] = np.bincount(labels[gd],ra*wt_ra,nobj)/np.bincount(labels[gd],wt_ra,nobj)
+    obj['DEC'] = np.bincount(labels[gd],dec*wt_dec,nobj)/np.bincount(labels[gd],wt_dec,nobj)
+
+    if verbose: print('tiled clustering done after '+str(time.time()-t0)+' sec.')
+
+    return rowid, labels, obj, stats
+
+
+def simfield(nstar=20000,nexp=10,nnoise=5000,size=0.5,spacing=6.0,sigma=0.1,seed=0):
+    """ Simulate a field of well-separated stars plus isolated noise measurements.
+
+    Stars are on a jittered grid with SPACING arcsec, each measured NEXP times
+    with SIGMA arcsec scatter.  Noise is put half-way between the grid points.
+    """
+    rnd = np.random.RandomState(seed)
+    ra0,dec0 = 120.0,-30.0
+    cosd = np.cos(np.deg2rad(dec0))
+    ngrid = int(size*3600/spacing)
+    cells = rnd.permutation(ngrid*ngrid)
+    star = cells[0:nstar]
+    noise = cells[nstar:nstar+nnoise]
+    sx = (star % ngrid + 0.5 + rnd.uniform(-0.1,0.1,len(star)))*spacing
+    sy = (star // ngrid + 0.5 + rnd.uniform(-0.1,0.1,len(star)))*spacing
+    nx = (noise % ngrid)*spacing
+    ny = (noise // ngrid)*spacing
+    x = np.hstack((np.repeat(sx,nexp)+rnd.randn(len(sx)*nexp)*sigma,nx))
+    y = np.hstack((np.repeat(sy,nexp)+rnd.randn(len(sy)*nexp)*sigma,ny))
+    cat = np.zeros(len(x),dtype=np.dtype([('MEASID',(str,30)),('EXPOSURE',(str,40)),('RA',float),('DEC',float),
+                                          ('RAERR',float),('DECERR',float)]))
+    cat['RA'] = ra0+x/3600/cosd
+    cat['DEC'] = dec0+y/3600
+    cat['RAERR'] = sigma
+    cat['DECERR'] = sigma
+    cat['MEASID'] = np.char.add('m',np.arange(len(cat)).astype(str))
+    return cat[rnd.permutation(len(cat))]
+
+def samepartition(labels1,labels2):
+    """ Check that two labelings are the same partition, with the same noise (label<0)."""
+    if len(labels1)!=len(labels2): return False
+    if np.any((labels1<0)!=(labels2<0)): return False
+    gd = labels1>=0
+    pairs = np.unique(np.column_stack((labels1[gd],labels2[gd])),axis=0)
+    return (len(pairs)==len(np.unique(labels1[gd]))) & (len(pairs)==len(np.unique(labels2[gd])))
+
+def testtiled(nstar=20000,nexp=10,nnoise=5000,nper=30000,nproc=2,tmpdir=None):
+    """ Check that tiled DBSCAN gives the same result as single-shot DBSCAN on a synthetic field."""
+    import measstore
+    cat = simfield(nstar,nexp,nnoise)
+    storedir = tempfile.mkdtemp(prefix='tiledcluster',dir=tmpdir)
+    try:
+        store = measstore.NpyMeasStore(storedir)
+        cat1 = np.zeros(len(cat),dtype=measstore.dtype_meas)
+        for n in cat.dtype.names: cat1[n]=cat[n]
+        store.write(cat1)
+        store.finalize()
+        ncat = store.count()
+        func = functools.partial(dbscanlabels,eps=0.5,minsamples=3)
+        # Single shot
+        t0 = time.time()
+        allcat = store.getdata()
+        labels0 = func(allcat)
+        rowid0 = allcat['ROWID']
+        si = np.argsort(rowid0)
+        rowid0,labels0 = rowid0[si],labels0[si]
+        dt0 = time.time()-t0
+        # Tiled
+        t0 = time.time()
+        rowid,labels,obj,stats = tiledcluster(store,ncat,func,nproc=nproc,nper=nper,verbose=False)
+        dt1 = time.time()-t0
+        same = np.array_equal(rowid,rowid0) and samepartition(labels,labels0)
+        print('%d measurements, %d tiles, %d objects' % (ncat,len(stats),len(obj)))
+        print('single-shot %6.2f sec   tiled (%d proc) %6.2f sec   same=%s' % (dt0,nproc,dt1,same))
+        # Tile order and process count do not matter
+        rowid2,labels2,obj2,stats2 = tiledcluster(store,ncat,func,nproc=1,nper=nper,verbose=False)
+        same = same and np.array_equal(labels,labels2)
+        if not same:
+            raise AssertionError('Tiled clustering does not match single-shot DBSCAN')
+    finally:
+        shutil.rmtree(storedir)
+    return same
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Check tiled clustering against single-shot DBSCAN.')
+    parser.add_argument('--nstar', type=int, default=20000, help='Number of stars')
+    parser.add_argument('--nexp', type=int, default=10, help='Number of exposures')
+    parser.add_argument('--nper', type=int, default=30000, help='Measurements per tile')
+    parser.add_argument('--nproc', type=int, default=2, help='Number of processes')
+    parser.add_argument('--tmpdir', type=str, default=None, help='Temporary directory')
+    args = parser.parse_args()
+    testtiled(args.nstar,args.nexp,nper=args.nper,nproc=args.nproc,tmpdir=args.tmpdir)
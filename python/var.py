@@ -1,9 +1,33 @@
 #!/usr/bin/env python
 
+# Photometric variability metrics and variable selection.
+#
+# varmetrics() is a segmented, array-at-a-time engine: it takes the flat
+# measurement arrays (filter, mag, err, mjd) plus the index of the object of
+# each measurement and computes the mean magnitudes and the rms, MAD, IQR,
+# eta, J, K, chi and RoMS indices for all objects at once with segmented
+# reductions (np.add.reduceat).  The percentiles and medians for MAD and IQR
+# come from sorting the residuals within each object once and indexing into
+# the sorted segments.  The segments are sorted in blocks of the same length
+# (segargsort), which is ~10x faster than a global np.lexsort.  The same
+# engine is used by the columnar aggregation in aggregate.py so the metrics
+# are computed once in the combine, and selectvariables() picks the
+# fiducial magnitudes with array operations instead of a loop over the
+# objects.
+#
+# The original one-object-at-a-time algorithm is kept in loopvarmetric()
+# as the reference.  The segmented sums are accumulated sequentially while
+# np.sum() uses pairwise summation for 8 or more elements, so the float64
+# values agree to ~1e-15 relative and almost always round to the same
+# float32 values.  "python var.py --test" runs the comparison and
+# "python var.py" the throughput benchmark.
+
 import os
 import sys
 import numpy as np
 import warnings
+import time
+from argparse import ArgumentParser
 from astropy.io import fits
 from astropy.utils.exceptions import AstropyWarning
 from astropy.table import Table, vstack, Column
@@ -13,6 +37,273 @@ from astropy.coordinates import SkyCoord
 from scipy.optimize import least_squares
 from scipy.interpolate import interp1d
 
+# Filters with columns in the object catalog
+FILTERS = ['u','g','r','i','z','y','vr']
+# Order of priority for the fiducial magnitude
+FIDFILTERS = ['r','g','i','z','y','vr','u']
+# Variability indices
+VARCOLS = ['rmsvar','madvar','iqrvar','etavar','jvar','kvar','chivar','romsvar']
+
+# OBJ schema of varmetric()
+dtype_obj = np.dtype([('deltamjd',np.float32),('ndet',np.int16),('nphot',np.int16),
+                      ('ndetu',np.int16),('nphotu',np.int16),('umag',np.float32),('urms',np.float32),('uerr',np.float32),
+                      ('ndetg',np.int16),('nphotg',np.int16),('gmag',np.float32),('grms',np.float32),('gerr',np.float32),
+                      ('ndetr',np.int16),('nphotr',np.int16),('rmag',np.float32),('rrms',np.float32),('rerr',np.float32),
+                      ('ndeti',np.int16),('nphoti',np.int16),('imag',np.float32),('irms',np.float32),('ierr',np.float32),
+                      ('ndetz',np.int16),('nphotz',np.int16),('zmag',np.float32),('zrms',np.float32),('zerr',np.float32),
+                      ('ndety',np.int16),('nphoty',np.int16),('ymag',np.float32),('yrms',np.float32),('yerr',np.float32),
+                      ('ndetvr',np.int16),('nphotvr',np.int16),('vrmag',np.float32),('vrrms',np.float32),('vrerr',np.float32),
+                      ('rmsvar',np.float32),('madvar',np.float32),('iqrvar',np.float32),('etavar',np.float32),
+                      ('jvar',np.float32),('kvar',np.float32),('chivar',np.float32),('romsvar',np.float32),
+                      ('variable10sig',np.int16),('nsigvar',np.float32)])
+
+
+def segmedian(sval,lo,num):
+    """ Median of each segment of an array that is sorted within the segments."""
+    mid = lo+num//2
+    med = sval[mid].astype(np.float64)
+    even = (num % 2)==0
+    if np.sum(even)>0:
+        med[even] = (sval[mid[even]-1]+sval[mid[even]])/2.0
+    return med
+
+def segpercentile(sval,lo,num,q):
+    """ Linearly-interpolated percentile of each segment of an array that is sorted within the segments."""
+    # Same as np.percentile(x,q) with the default 'linear' method
+    vindex = (num-1)*(q/100.0)
+    below = np.floor(vindex).astype(int)
+    above = np.minimum(below+1,num-1)
+    gamma = vindex-below
+    a = sval[lo+below]
+    b = sval[lo+above]
+    diff = b-a
+    out = a+diff*gamma
+    hig = (gamma>=0.5)
+    out[hig] = b[hig]-diff[hig]*(1-gamma[hig])
+    return out
+
+def segargsort(val,lo,num):
+    """ Indices that sort an array within its segments, like np.lexsort((val,seg)) for sorted SEG.
+
+    The segments of the same length are gathered into a 2D array and
+    sorted along the rows, which is much faster than a global lexsort
+    for many short segments.
+    """
+    out = np.arange(len(val))
+    for n in np.unique(num[num>1]):
+        ind = lo[num==n].reshape(-1,1)+np.arange(n)
+        out[ind] = np.take_along_axis(ind,np.argsort(val[ind],axis=1,kind='stable'),axis=1)
+    return out
+
+def filtercodes(filt):
+    """ Index into FILTERS of each filter name (case insensitive), -1 for other filters."""
+    filt = np.atleast_1d(filt)
+    if filt.dtype.kind not in ['U','S']:
+        filt = filt.astype(str)
+    code = np.zeros(len(filt),np.int8)-1
+    # Compare to the lower and upper case names, lowercase only the rest
+    for k,f in enumerate(FILTERS):
+        for name in [f,f.upper()]:
+            if filt.dtype.kind=='S': name = name.encode()
+            code[filt==name] = k
+    rest, = np.where(code<0)
+    if len(rest)>0:
+        lfilt = np.char.lower(filt[rest].astype(str))
+        for k,f in enumerate(FILTERS):
+            code[rest[lfilt==f]] = k
+    return code
+
+def initvar(obj):
+    """ Set the photometry and variability columns to their "bad" values."""
+    names = obj.dtype.names
+    for f in VARCOLS:
+        if f in names: obj[f] = np.nan
+    for f in FILTERS:
+        if 'ndet'+f in names: obj['ndet'+f] = 0
+        if 'nphot'+f in names: obj['nphot'+f] = 0
+        if f+'mag' in names: obj[f+'mag'] = 99.99
+        if f+'err' in names: obj[f+'err'] = 9.99
+        if f+'rms' in names: obj[f+'rms'] = np.nan
+    if 'nphot' in names: obj['nphot'] = 0
+    return obj
+
+def fiducialmag(obj):
+    """ Fiducial magnitude of the objects, used to select variables.
+
+    The first good magnitude in the order of priority r,g,i,z,Y,VR,u
+    of the objects with NPHOT>0, otherwise NaN.
+    """
+    nobj = len(obj)
+    fidmag = np.zeros(nobj,float)+np.nan
+    for f in FIDFILTERS:
+        fmag = obj[f+'mag'].astype(float)
+        gfid = np.isnan(fidmag) & (obj['nphot']>0) & (fmag<50)
+        fidmag[gfid] = fmag[gfid]
+    return fidmag
+
+def varmetrics(objind,filt,mag,magerr,mjd,obj):
+    """ Compute the photometric variability metrics for all objects at once.
+
+    Parameters
+    ----------
+    objind : numpy array
+       Index into OBJ of the object of each measurement.  The measurements
+       are grouped by object internally if they are not already.
+    filt : numpy array
+       Filter of each measurement (case insensitive).  Measurements with a
+       filter not in FILTERS are ignored.
+    mag : numpy array
+       Magnitude of each measurement, values >=50 are bad.
+    magerr : numpy array
+       Magnitude uncertainty of each measurement.
+    mjd : numpy array
+       MJD of each measurement.
+    obj : numpy structured array
+       Object catalog, filled in place.  The per-filter NDET, NPHOT, MAG, ERR
+       and RMS columns, NPHOT and the variability indices are set, only the
+       columns that exist.
+
+    Returns
+    -------
+    fidmag : numpy array
+       Fiducial magnitude for each object, used to select variables.
+
+    Example
+    -------
+
+    fidmag = varmetrics(objind,meas['FILTER'],meas['MAG_AUTO'],meas['MAGERR_AUTO'],meas['MJD'],obj)
+
+    """
+
+    objind = np.atleast_1d(objind)
+    nmeas = len(objind)
+    nobj = len(obj)
+    fcode = filtercodes(filt)
+    mag = np.atleast_1d(mag)
+    magerr = np.atleast_1d(magerr)
+    mjd = np.atleast_1d(mjd)
+    for arr in [fcode,mag,magerr,mjd]:
+        if len(arr) != nmeas:
+            raise ValueError('objind, filt, mag, magerr and mjd must have the same number of elements')
+    if nmeas>0 and (np.min(objind)<0 or np.max(objind)>=nobj):
+        raise ValueError('objind out of range of obj')
+    names = obj.dtype.names
+    initvar(obj)
+
+    # Group the measurements by object
+    if nmeas>1 and np.any(objind[1:]<objind[0:-1]):
+        si = np.argsort(objind,kind='stable')
+        objind,fcode,mag,magerr,mjd = objind[si],fcode[si],mag[si],magerr[si],mjd[si]
+
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        # Mean magnitudes
+        # Convert totalwt and totalfluxwt to MAG and ERR PER FILTER
+        resid = np.zeros(nmeas)+np.nan     # residual mag
+        relresid = np.zeros(nmeas)+np.nan  # residual mag relative to the uncertainty
+        nphot = np.zeros(nobj,int)
+        for k,f in enumerate(FILTERS):
+            find, = np.where(fcode==k)
+            if len(find)==0: continue
+            fobj,fnum = np.unique(objind[find],return_counts=True)
+            if 'ndet'+f in names: obj['ndet'+f][fobj] = fnum
+
+            # Measurements with good photometry
+            gph = find[mag[find]<50]
+            if len(gph)==0: continue
+            pobj,plo,pnum = np.unique(objind[gph],return_index=True,return_counts=True)
+            obj['nphot'+f][pobj] = pnum
+            nphot[pobj] += pnum
+            # Only one measurement
+            one = (pnum==1)
+            obj[f+'mag'][pobj[one]] = mag[gph[plo[one]]]
+            obj[f+'err'][pobj[one]] = magerr[gph[plo[one]]]
+            # Multiple measurements, same as dln.wtmean(mag,err,magnitude=True,reweight=True,error=True)
+            mult = ~one
+            if np.sum(mult)==0: continue
+            x = mag[gph]
+            sigma = magerr[gph]
+            wt = 1/sigma**2
+            flux = 2.5118864**x
+            totwt = np.add.reduceat(wt,plo)
+            fmn = np.add.reduceat(flux*wt,plo)/totwt
+            xmn = 2.50*np.log10(fmn)
+            # Reweight the points based on the residuals
+            mnsigma = np.add.reduceat(sigma,plo)/pnum
+            wt2 = wt/(1+np.abs(x-np.repeat(xmn,pnum))**2/np.repeat(mnsigma,pnum))
+            fmn2 = np.add.reduceat(flux*wt2,plo)/np.add.reduceat(wt2,plo)
+            newmag = 2.50*np.log10(fmn2)
+            newerr = np.sqrt(1.0/totwt)
+            dmag = x-np.repeat(newmag,pnum)
+            rms = np.sqrt(np.add.reduceat(dmag**2,plo)/pnum)
+            obj[f+'mag'][pobj[mult]] = newmag[mult]
+            obj[f+'err'][pobj[mult]] = newerr[mult]
+            obj[f+'rms'][pobj[mult]] = rms[mult]
+            # Residual mag
+            rmult = np.repeat(mult,pnum)
+            resid[gph[rmult]] = dmag[rmult]
+            # Residual mag relative to the uncertainty
+            #  set a lower threshold of 0.02 in the uncertainty
+            rpnum = np.repeat(pnum,pnum)
+            relresid[gph[rmult]] = (np.sqrt(rpnum/(rpnum-1)) * dmag/np.maximum(sigma,0.02))[rmult]
+
+        # Calculate variability indices
+        gdresid, = np.where(np.isfinite(resid))
+        if len(gdresid)>0:
+            robj = objind[gdresid]
+            resid2 = resid[gdresid]
+            vobj,vlo,vnum = np.unique(robj,return_index=True,return_counts=True)
+            sumresidsq = np.add.reduceat(resid2**2,vlo)
+            # Sort the residuals within each object
+            rsi = segargsort(resid2,vlo,vnum)
+            sresid2 = resid2[rsi]
+            q25 = segpercentile(sresid2,vlo,vnum,25)
+            q50 = segpercentile(sresid2,vlo,vnum,50)
+            q75 = segpercentile(sresid2,vlo,vnum,75)
+            # RMS
+            rmsvar = np.sqrt(sumresidsq/vnum)
+            # MAD
+            absdev = np.abs(resid2-np.repeat(q50,vnum))
+            madvar = 1.4826*segmedian(absdev[segargsort(absdev,vlo,vnum)],vlo,vnum)
+            # IQR
+            iqrvar = 0.741289*(q75-q25)
+            # 1/eta, residuals in time order
+            tsi = segargsort(mjd[gdresid],vlo,vnum)
+            resid2tsi = resid2[tsi]
+            dresidsq = np.zeros(len(gdresid))
+            dresidsq[0:-1] = (resid2tsi[1:]-resid2tsi[0:-1])**2
+            dresidsq[vlo+vnum-1] = 0.0    # differences across objects
+            etavar = sumresidsq / np.add.reduceat(dresidsq,vlo)
+            obj['rmsvar'][vobj] = rmsvar
+            obj['madvar'][vobj] = madvar
+            obj['iqrvar'][vobj] = iqrvar
+            obj['etavar'][vobj] = etavar
+
+        # Calculate variability indices wrt to uncertainties
+        gdrelresid, = np.where(np.isfinite(relresid))
+        if len(gdrelresid)>0:
+            relresid2 = relresid[gdrelresid]
+            vobj,vlo,vnum = np.unique(objind[gdrelresid],return_index=True,return_counts=True)
+            pk = relresid2**2-1
+            jvar = np.add.reduceat(np.sign(pk)*np.sqrt(np.abs(pk)),vlo)/vnum
+            sumrelsq = np.add.reduceat(relresid2**2,vlo)
+            sumabsrel = np.add.reduceat(np.abs(relresid2),vlo)
+            chivar = np.sqrt(sumrelsq)/vnum
+            kdenom = np.sqrt(sumrelsq/vnum)
+            kvar = np.where(kdenom!=0,(sumabsrel/vnum)/kdenom,np.nan)
+            # RoMS
+            romsvar = sumabsrel/(vnum-1)
+            obj['jvar'][vobj] = jvar
+            obj['kvar'][vobj] = kvar
+            obj['chivar'][vobj] = chivar
+            obj['romsvar'][vobj] = romsvar
+
+        # Make NPHOT from NPHOTX
+        obj['nphot'] = nphot
+
+    # Fiducial magnitude, used to select variables
+    #  order of priority: r,g,i,z,Y,VR,u
+    return fiducialmag(obj)
+
 
 def varmetric(inpmeas):
     """ Compute photometric variability metrics."""
@@ -46,25 +337,51 @@ def varmetric(inpmeas):
         mjdcol = 'mjd'
     if mjdcol not in meas.dtype.names:
         raise ValueError('No mjd column')
-    
 
-    # OBJ schema
-    dtype_obj = np.dtype([('deltamjd',np.float32),('ndet',np.int16),('nphot',np.int16),
-                          ('ndetu',np.int16),('nphotu',np.int16),('umag',np.float32),('urms',np.float32),('uerr',np.float32),
-                          ('ndetg',np.int16),('nphotg',np.int16),('gmag',np.float32),('grms',np.float32),('gerr',np.float32),
-                          ('ndetr',np.int16),('nphotr',np.int16),('rmag',np.float32),('rrms',np.float32),('rerr',np.float32),
-                          ('ndeti',np.int16),('nphoti',np.int16),('imag',np.float32),('irms',np.float32),('ierr',np.float32),
-                          ('ndetz',np.int16),('nphotz',np.int16),('zmag',np.float32),('zrms',np.float32),('zerr',np.float32),
-                          ('ndety',np.int16),('nphoty',np.int16),('ymag',np.float32),('yrms',np.float32),('yerr',np.float32),
-                          ('ndetvr',np.int16),('nphotvr',np.int16),('vrmag',np.float32),('vrrms',np.float32),('vrerr',np.float32),
-                          ('rmsvar',np.float32),('madvar',np.float32),('iqrvar',np.float32),('etavar',np.float32),
-                          ('jvar',np.float32),('kvar',np.float32),('chivar',np.float32),('romsvar',np.float32),
-                          ('variable10sig',np.int16),('nsigvar',np.float32)])
-
-    
+    # Initialize the OBJ structured array
     obj = np.zeros(1,dtype=dtype_obj)
+    obj['ndet'] = nmeas
+    obj['deltamjd'] = np.max(meas[mjdcol])-np.min(meas[mjdcol])
+
+    # One object, all the measurements have object index 0
+    varmetrics(np.zeros(nmeas,int),meas[filtcol],meas[magcol],meas[errcol],meas[mjdcol],obj)
+
+    return obj
 
 
+def loopvarmetric(inpmeas):
+    """ Compute photometric variability metrics for a single object.  This is the original algorithm."""
+    # meas is a catalog of measurements for a single object
+
+    nmeas = len(inpmeas)
+    
+    # Need the catalog to be a numpy array
+    if isinstance(inpmeas,np.ndarray):
+        meas = inpmeas
+    else:
+        meas = np.array(inpmeas)
+        
+    filtcol = 'FILTER'
+    if filtcol not in meas.dtype.names:
+        filtcol = 'filter'
+    if filtcol not in meas.dtype.names:
+        raise ValueError('No filter column')
+    magcol = 'MAG_AUTO'
+    if magcol not in meas.dtype.names:
+        magcol = 'mag_auto'
+    if magcol not in meas.dtype.names:
+        raise ValueError('No mag_auto column')
+    errcol = 'MAGERR_AUTO'
+    if errcol not in meas.dtype.names:
+        errcol = 'magerr_auto'
+    if errcol not in meas.dtype.names:
+        raise ValueError('No magerr_auto column')
+    mjdcol = 'MJD'
+    if mjdcol not in meas.dtype.names:
+        mjdcol = 'mjd'
+    if mjdcol not in meas.dtype.names:
+        raise ValueError('No mjd column')
+
     # Initialize the OBJ structured array
     obj = np.zeros(1,dtype=dtype_obj)
     # all bad to start
@@ -80,7 +397,7 @@ def varmetric(inpmeas):
     # Mean magnitudes
     # Convert totalwt and totalfluxwt to MAG and ERR
     #  and average the morphology parameters PER FILTER
-    filtindex = dln.create_index(meas[filtcol].astype(np.str))
+    filtindex = dln.create_index(meas[filtcol].astype(str))
     nfilters = len(filtindex['value'])
     resid = np.zeros(nmeas)+np.nan     # residual mag
     relresid = np.zeros(nmeas)+np.nan  # residual mag relative to the uncertainty
@@ -153,39 +470,37 @@ def varmetric(inpmeas):
     # Make NPHOT from NPHOTX
     obj['nphot'] = obj['nphotu']+obj['nphotg']+obj['nphotr']+obj['nphoti']+obj['nphotz']+obj['nphoty']+obj['nphotvr']
 
-    # Fiducial magnitude, used to select variables below
-    #  order of priority: r,g,i,z,Y,VR,u
-    if obj['nphot']>0:
-        magarr = np.zeros(7,float)
-        for ii,nn in enumerate(['rmag','gmag','imag','zmag','ymag','vrmag','umag']): magarr[ii]=obj[nn]
-        gfid,ngfid = dln.where(magarr<50)
-        if ngfid>0: fidmag=magarr[gfid[0]]
-
-        
     return obj
 
 
-def selectvariables(obj):
-    """ Select variables using photometric variability indices."""
+def selectvariables(obj,fidmag=None):
+    """ Select variables using photometric variability indices.
+
+    Parameters
+    ----------
+    obj : numpy structured array
+       Object catalog with the variability indices, the MADVAR and
+       per-filter magnitudes are used.  The NSIGVAR and VARIABLE10SIG
+       columns are set in place.
+    fidmag : numpy array, optional
+       Fiducial magnitude of the objects, as returned by varmetrics().
+       By default it is computed from the magnitudes with fiducialmag().
+
+    Returns
+    -------
+    obj : numpy structured array
+       The object catalog.
+
+    """
 
     nobj = len(obj)
-    fidmag = np.zeros(nobj,float)+np.nan  # fiducial magnitude
-    # Loop over the objects
-    for i in range(nobj):
-        # Fiducial magnitude, used to select variables below
-        #  order of priority: r,g,i,z,Y,VR,u
-        if obj['nphot'][i]>0:
-            magarr = np.zeros(7,float)
-            for ii,nn in enumerate(['rmag','gmag','imag','zmag','ymag','vrmag','umag']): magarr[ii]=obj[nn][i]
-            gfid,ngfid = dln.where(magarr<50)
-            if ngfid>0: fidmag[i]=magarr[gfid[0]]
+    if fidmag is None:
+        fidmag = fiducialmag(obj)  # fiducial magnitude
 
-    
     # Select Variables
-    #  1) Construct fiducial magnitude (done in loop above)
+    #  1) Construct fiducial magnitude (done above)
     #  2) Construct median VAR and sigma VAR versus magnitude
     #  3) Find objects that Nsigma above the median VAR line
-    si = np.argsort(fidmag)   # NaNs are at end
     varcol = 'madvar'
     gdvar,ngdvar,bdvar,nbdvar = dln.where(np.isfinite(obj[varcol]) & np.isfinite(fidmag),comp=True)
     if ngdvar>0:
@@ -248,3 +563,173 @@ def selectvariables(obj):
 
 
     return obj
+
+
+def loopfidmag(obj):
+    """ Fiducial magnitude one object at a time.  This is the original loop of selectvariables()."""
+    nobj = len(obj)
+    fidmag = np.zeros(nobj,float)+np.nan  # fiducial magnitude
+    for i in range(nobj):
+        # Fiducial magnitude, used to select variables below
+        #  order of priority: r,g,i,z,Y,VR,u
+        if obj['nphot'][i]>0:
+            magarr = np.zeros(7,float)
+            for ii,nn in enumerate(['rmag','gmag','imag','zmag','ymag','vrmag','umag']): magarr[ii]=obj[nn][i]
+            gfid,ngfid = dln.where(magarr<50)
+            if ngfid>0: fidmag[i]=magarr[gfid[0]]
+    return fidmag
+
+
+def simmeas(nobj=20000,nexp=30,fvar=0.02,seed=0):
+    """ Simulate the measurements of a set of objects, a fraction FVAR of them variable.
+
+    Returns the measurement catalog and the object index of each measurement,
+    in random order.
+    """
+    rnd = np.random.RandomState(seed)
+    dtype_meas = np.dtype([('FILTER',(str,3)),('MJD',float),('MAG_AUTO',float),('MAGERR_AUTO',float)])
+    filters = np.array(['u','g','r','i','z','Y','VR'])
+    expfilt = filters[rnd.randint(0,len(filters),nexp)]
+    expmjd = 57000+np.sort(rnd.rand(nexp))*2000
+    mag0 = 16+rnd.rand(nobj)*8
+    amp = np.zeros(nobj)
+    isvar = rnd.rand(nobj)<fvar
+    amp[isvar] = 0.1+rnd.rand(np.sum(isvar))*0.5
+    period = 0.2+rnd.rand(nobj)*10
+    # Each object is detected in a random subset of the exposures
+    detected = rnd.rand(nobj,nexp) < 0.6
+    detected[rnd.rand(nobj)<0.05,:] = False       # some single detections
+    detected[np.arange(nobj),rnd.randint(0,nexp,nobj)] = True
+    oind,eind = np.where(detected)
+    nmeas = len(oind)
+    meas = np.zeros(nmeas,dtype=dtype_meas)
+    meas['FILTER'] = expfilt[eind]
+    meas['MJD'] = expmjd[eind]
+    meas['MAGERR_AUTO'] = 0.005*10**(0.2*(mag0[oind]-16))
+    meas['MAG_AUTO'] = (mag0[oind]+amp[oind]*np.sin(2*np.pi*meas['MJD']/period[oind])+
+                        rnd.randn(nmeas)*meas['MAGERR_AUTO'])
+    meas['MAG_AUTO'][rnd.rand(nmeas)<0.02] = 99.99   # some bad photometry
+    # Shuffle the measurements
+    si = rnd.permutation(nmeas)
+    return meas[si], oind[si]
+
+def compare(obj1,obj2,verbose=True):
+    """ Compare two object catalogs column by column.  Returns the maximum relative difference."""
+    maxrel = 0.0
+    nobj = len(obj1)
+    for n in obj1.dtype.names:
+        v1 = obj1[n].astype(float)
+        v2 = obj2[n].astype(float)
+        bothnan = np.isnan(v1) & np.isnan(v2)
+        nexact = np.sum((v1==v2) | bothnan)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            rel = np.abs(v1-v2)/np.maximum(np.abs(v1),1e-30)
+        rel[bothnan | (v1==v2)] = 0.0
+        rel[np.isnan(rel)] = np.inf     # NaN in only one of them
+        if nobj>0: maxrel = max(maxrel,np.max(rel))
+        if verbose and nexact<nobj:
+            print('  %-12s %7d/%7d identical  max rel diff = %g' % (n,nexact,nobj,np.max(rel)))
+    return maxrel
+
+def test(nobj=3000,nexp=25,seed=1,rtol=1e-6):
+    """ Check the segmented engine against the original per-object algorithm."""
+    ok = True
+    meas, objind = simmeas(nobj,nexp,seed=seed)
+    index = dln.create_index(objind)
+
+    # Metrics, one object at a time
+    obj1 = np.zeros(nobj,dtype=dtype_obj)
+    for i in range(nobj):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        obj1[i] = loopvarmetric(meas[indx])[0]
+
+    # All the objects at once
+    obj2 = np.zeros(nobj,dtype=dtype_obj)
+    obj2['ndet'] = index['num']
+    fidmag = varmetrics(objind,meas['FILTER'],meas['MAG_AUTO'],meas['MAGERR_AUTO'],meas['MJD'],obj2)
+    obj2['deltamjd'] = obj1['deltamjd']
+    maxrel = compare(obj1,obj2)
+    print('varmetrics vs. loop:         max rel diff = %g' % maxrel)
+    ok &= (maxrel<=rtol)
+
+    # Single-object wrapper
+    nbad = 0
+    for i in range(0,nobj,max(1,nobj//200)):
+        indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+        nbad += compare(loopvarmetric(meas[indx]),varmetric(meas[indx]),verbose=False) > rtol
+    print('varmetric vs. loopvarmetric: %d objects differ' % nbad)
+    ok &= (nbad==0)
+
+    # Fiducial magnitudes and variable selection
+    fidmag1 = loopfidmag(obj1)
+    samefid = np.array_equal(fidmag1,fiducialmag(obj1),equal_nan=True) and np.array_equal(fidmag1,fidmag,equal_nan=True)
+    print('fiducial magnitudes same=%s' % samefid)
+    ok &= samefid
+    sel1 = selectvariables(obj1.copy(),fidmag1)
+    sel2 = selectvariables(obj1.copy())
+    samesel = (np.array_equal(sel1['variable10sig'],sel2['variable10sig']) and
+               np.array_equal(sel1['nsigvar'],sel2['nsigvar'],equal_nan=True))
+    print('selectvariables same=%s' % samesel)
+    ok &= samesel
+
+    # Order of the measurements does not matter
+    si = np.argsort(objind,kind='stable')
+    obj3 = np.zeros(nobj,dtype=dtype_obj)
+    varmetrics(objind[si],meas['FILTER'][si],meas['MAG_AUTO'][si],meas['MAGERR_AUTO'][si],meas['MJD'][si],obj3)
+    obj3['ndet'] = obj2['ndet']
+    obj3['deltamjd'] = obj2['deltamjd']
+    sameorder = compare(obj2,obj3,verbose=False)==0
+    print('sorted vs. unsorted input same=%s' % sameorder)
+    ok &= sameorder
+
+    # Filter names in any case, as str or bytes
+    names = np.array(['u','G','r','I','z','Y','y','VR','vr','Vr','vR','N964','bad'])
+    codes = np.array([0,1,2,3,4,5,5,6,6,6,6,-1,-1])
+    samecodes = np.array_equal(filtercodes(names),codes) and np.array_equal(filtercodes(names.astype(bytes)),codes)
+    print('filter codes same=%s' % samecodes)
+    ok &= samecodes
+
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+def benchmark(nobj=[10000,100000,1000000],nexp=30,nloop=5000,seed=0):
+    """ Throughput of the segmented engine and the per-object loop in objects/s."""
+    results = []
+    for n in nobj:
+        meas, objind = simmeas(n,nexp,seed=seed)
+        nmeas = len(meas)
+        # Loop on a subset of the objects
+        nl = min(n,nloop)
+        index = dln.create_index(objind)
+        objl = np.zeros(nl,dtype=dtype_obj)
+        t0 = time.time()
+        for i in range(nl):
+            indx = index['index'][index['lo'][i]:index['hi'][i]+1]
+            objl[i] = loopvarmetric(meas[indx])[0]
+        fidmag = loopfidmag(objl)
+        dt0 = time.time()-t0
+        looprate = nl/dt0
+        # All the objects at once
+        obj = np.zeros(n,dtype=dtype_obj)
+        t0 = time.time()
+        fidmag = varmetrics(objind,meas['FILTER'],meas['MAG_AUTO'],meas['MAGERR_AUTO'],meas['MJD'],obj)
+        dt1 = time.time()-t0
+        t0 = time.time()
+        selectvariables(obj,fidmag)
+        dt2 = time.time()-t0
+        rate = n/(dt1+dt2)
+        print('%8d objects %9d measurements  loop %9.0f objects/s  varmetrics %6.2f sec  selectvariables %6.2f sec  %10.0f objects/s  speed-up %6.1f' %
+              (n,nmeas,looprate,dt1,dt2,rate,rate/looprate))
+        results.append({'nobj':n,'nmeas':nmeas,'looprate':looprate,'dt_varmetrics':dt1,'dt_select':dt2,'rate':rate})
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Test and benchmark the segmented variability metrics.')
+    parser.add_argument('--test', action='store_true', help='Check against the per-object algorithm')
+    parser.add_argument('--nobj', type=str, default='10000,100000,1000000', help='Comma-separated list of number of objects')
+    parser.add_argument('--nexp', type=int, default=30, help='Number of exposures')
+    args = parser.parse_args()
+    if args.test:
+        sys.exit(0 if test() else 1)
+    benchmark([int(n) for n in args.nobj.split(',')],args.nexp)